@@ -0,0 +1,103 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stores benchmark results as baselines and flags regressions against them.
+
+Baselines are stored as JSON files that map each benchmark scenario to the
+metrics measured for it, e.g.:
+
+    {"concurrent": {"windows_per_second": 2150.3, "peak_rss_kib": 31204}}
+"""
+
+import json
+import math
+import os
+
+# Directions in which a metric improves.
+HIGHER_IS_BETTER = 'higher_is_better'
+LOWER_IS_BETTER = 'lower_is_better'
+
+BASELINES_DIR = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+
+def default_path(benchmark_name):
+    """Returns the default path of the baseline file for a benchmark."""
+    return os.path.join(BASELINES_DIR, benchmark_name + '.json')
+
+
+def load(path):
+    """Loads baselines from a file, or returns an empty dict if there is none."""
+    if not os.path.exists(path):
+        return {}
+    with open(path) as baseline_file:
+        return json.load(baseline_file)
+
+
+def save(path, results):
+    """Saves benchmark results to a file as the new baselines."""
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory)
+    with open(path, 'w') as baseline_file:
+        json.dump(results, baseline_file, indent=2, sort_keys=True)
+        baseline_file.write('\n')
+
+
+def fit_exponent(sizes, values):
+    """Fits k in values ~ sizes^k by least squares on a log-log scale.
+
+    A benchmark can compare k to a baseline to catch a change in how its
+    metric scales with the input size, e.g. from linear to quadratic.
+    """
+    xs = [math.log(size) for size in sizes]
+    ys = [math.log(max(value, 1e-9)) for value in values]
+    mean_x = sum(xs) / len(xs)
+    mean_y = sum(ys) / len(ys)
+    covariance = sum((x - mean_x) * (y - mean_y) for x, y in zip(xs, ys))
+    variance = sum((x - mean_x)**2 for x in xs)
+    return covariance / variance
+
+
+def find_regressions(results, baselines, metric_directions, tolerance):
+    """Compares benchmark results to baselines.
+
+    Args:
+        results: A dict mapping each scenario name to a dict of its measured
+            metrics.
+        baselines: Baselines in the same format as results. Scenarios and
+            metrics that have no baseline are not compared.
+        metric_directions: A dict mapping the name of each metric to compare to
+            HIGHER_IS_BETTER or LOWER_IS_BETTER.
+        tolerance: Fraction by which a metric may be worse than its baseline
+            before it counts as a regression, e.g. 0.2 for 20%.
+
+    Returns:
+        A list of messages describing each regression, in scenario order.
+    """
+    regressions = []
+    for scenario in sorted(results):
+        baseline = baselines.get(scenario, {})
+        for metric in sorted(metric_directions):
+            if metric not in baseline or metric not in results[scenario]:
+                continue
+            measured = results[scenario][metric]
+            expected = baseline[metric]
+            if metric_directions[metric] == HIGHER_IS_BETTER:
+                regressed = measured < expected * (1.0 - tolerance)
+            else:
+                regressed = measured > expected * (1.0 + tolerance)
+            if regressed:
+                regressions.append('%s: %s regressed from %g to %g' %
+                                   (scenario, metric, expected, measured))
+    return regressions
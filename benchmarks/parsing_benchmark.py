@@ -0,0 +1,277 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Micro-benchmarks for parsing query results and formatting failures.
+
+Measures _parse_query_result, _format_test_ids and
+_format_check_failure_message with inputs of 10^3 up to --max_rows rows
+(10^7 at most). For each function and input size it reports:
+
+    * seconds: The fastest of --repeat runs.
+    * peak_memory_kib: Growth in peak resident memory while running the
+      function, measured in a fresh process for each size against a baseline
+      taken after a warm-up run and after the input is built. A child process
+      starts with its parent's peak, so on Linux the peak is reset through
+      /proc/self/clear_refs before the baseline is taken. Elsewhere it is the
+      growth of ru_maxrss, which stays at 0 until the function exceeds the
+      earlier peak.
+    * traced_peak_kib: Peak memory allocated by Python objects, when
+      tracemalloc is available (Python 3.4 and later).
+
+Absolute timings depend on the machine, but how they grow with the input size
+should not. The benchmark fits the exponent k of time ~ rows^k for each
+function and fails if it exceeds --max_exponent, which catches accidental
+quadratic behavior regardless of the machine. Results are also compared to
+stored baselines.
+
+Usage:
+
+    python benchmarks/parsing_benchmark.py [--max_rows 10000000]
+"""
+
+import argparse
+import collections
+import datetime
+import gc
+import multiprocessing
+import os
+import re
+import resource
+import sys
+import timeit
+
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is only available in Python 3.4 and later.
+    tracemalloc = None
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import baselines
+import check_table_equivalence
+import cli
+import query_construct
+
+METRIC_DIRECTIONS = {
+    'seconds': baselines.LOWER_IS_BETTER,
+    'peak_memory_kib': baselines.LOWER_IS_BETTER,
+    'time_exponent': baselines.LOWER_IS_BETTER,
+}
+
+# Inputs smaller than this are dominated by fixed costs, so they are not used
+# to fit the scaling exponent.
+_MIN_ROWS_FOR_EXPONENT = 10000
+
+# Size of the input of the run that loads the code under test before memory
+# is measured.
+_WARM_UP_ROWS = 10
+
+_PEAK_RSS_PATTERN = re.compile(r'^VmHWM:\s+(\d+) kB$', re.MULTILINE)
+
+# Fraction of test_ids in generated inputs that duplicate another test_id.
+_DUPLICATE_FRACTION = 0.1
+
+
+def _test_ids(count):
+    """Returns count test_ids in the NDT format, some of them duplicated."""
+    test_ids = []
+    unique_count = int(count * (1 - _DUPLICATE_FRACTION))
+    for sequence in range(count):
+        sequence %= max(1, unique_count)
+        test_ids.append('2015/01/05/mlab1.lga02.measurement-lab.org/'
+                        '20150105T12:34:56.789012000Z_c-%d-%d.example.net:5042.'
+                        's2c_snaplog.gz' % (sequence >> 16, sequence & 0xffff))
+    return test_ids
+
+
+def _query_result(rows):
+    """Returns a bq CSV result with rows mismatched test_ids."""
+    lines = ['per_month_test_id,per_project_test_id']
+    for i, test_id in enumerate(_test_ids(rows)):
+        lines.append(test_id + ',' if i % 2 else ',' + test_id)
+    return '\n'.join(lines) + '\n'
+
+
+def _parse_query_result_benchmark(rows):
+    query_result = _query_result(rows)
+    return lambda: check_table_equivalence._parse_query_result(query_result)
+
+
+def _format_test_ids_benchmark(rows):
+    test_ids = _test_ids(rows)
+    return lambda: check_table_equivalence._format_test_ids(test_ids)
+
+
+def _format_check_failure_message_benchmark(rows):
+    test_ids = _test_ids(rows)
+    per_month_ids = test_ids[::2]
+    per_project_ids = test_ids[1::2]
+    query = query_construct.TableEquivalenceQueryGenerator(
+        0, datetime.datetime(2015, 1, 1),
+        datetime.datetime(2015, 2, 1)).generate_query()
+
+    def run():
+        return check_table_equivalence._format_check_failure_message(
+            per_month_ids, per_project_ids, query)
+
+    return run
+
+
+BENCHMARKS = collections.OrderedDict([
+    # Each benchmark builds its input for a number of rows and returns a
+    # function that runs the code under test on it.
+    ('parse_query_result', _parse_query_result_benchmark),
+    ('format_test_ids', _format_test_ids_benchmark),
+    ('format_check_failure_message', _format_check_failure_message_benchmark),
+])
+
+
+def _reset_peak_rss():
+    """Resets the peak resident memory of this process to its current size.
+
+    Only Linux supports this; elsewhere the peak cannot be reset.
+    """
+    try:
+        with open('/proc/self/clear_refs', 'w') as clear_refs:
+            clear_refs.write('5')
+    except IOError:
+        pass
+
+
+def _peak_rss_kib():
+    """Returns the peak resident memory of this process in KiB."""
+    try:
+        with open('/proc/self/status') as status:
+            return int(_PEAK_RSS_PATTERN.search(status.read()).group(1))
+    except IOError:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS reports bytes rather than KiB.
+        return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def measure(benchmark_name, rows, repeat):
+    """Measures one benchmark at one input size and returns its metrics."""
+    BENCHMARKS[benchmark_name](_WARM_UP_ROWS)()
+    run = BENCHMARKS[benchmark_name](rows)
+    gc.collect()
+    _reset_peak_rss()
+    rss_before = _peak_rss_kib()
+    seconds = min(timeit.repeat(run, number=1, repeat=repeat))
+    metrics = {
+        'seconds': seconds,
+        'peak_memory_kib': _peak_rss_kib() - rss_before,
+    }
+    if tracemalloc:
+        tracemalloc.start()
+        run()
+        _, traced_peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        metrics['traced_peak_kib'] = traced_peak // 1024
+    return metrics
+
+
+def _measure_in_child(benchmark_name, rows, repeat):
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(measure, (benchmark_name, rows, repeat))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _row_counts(max_rows):
+    row_counts = []
+    rows = 1000
+    while rows <= max_rows:
+        row_counts.append(rows)
+        rows *= 10
+    return row_counts
+
+
+def main(args):
+    results = {}
+    failures = []
+    row_counts = _row_counts(args.max_rows)
+    for name in BENCHMARKS:
+        for rows in row_counts:
+            metrics = _measure_in_child(name, rows, args.repeat)
+            results['%s/%d' % (name, rows)] = metrics
+            print('%-29s %9d rows  %10.6f s  %8d KiB peak memory%s' %
+                  (name, rows, metrics['seconds'], metrics['peak_memory_kib'],
+                   ('  %8d KiB traced' % metrics['traced_peak_kib']
+                    if 'traced_peak_kib' in metrics else '')))
+        fitted_sizes = [r for r in row_counts if r >= _MIN_ROWS_FOR_EXPONENT]
+        if len(fitted_sizes) < 2:
+            fitted_sizes = row_counts
+        if len(fitted_sizes) < 2:
+            continue
+        exponent = baselines.fit_exponent(fitted_sizes, [
+            results['%s/%d' % (name, rows)]['seconds'] for rows in fitted_sizes
+        ])
+        results[name] = {'time_exponent': exponent}
+        print('%-29s time ~ rows^%.2f' % (name, exponent))
+        if exponent > args.max_exponent:
+            failures.append('%s: time grows as rows^%.2f, above the limit of '
+                            'rows^%.2f' % (name, exponent, args.max_exponent))
+    if args.update_baseline:
+        baselines.save(args.baseline, results)
+        print('Saved baselines to %s' % args.baseline)
+    else:
+        failures.extend(baselines.find_regressions(results, baselines.load(
+            args.baseline), METRIC_DIRECTIONS, args.tolerance))
+    for failure in failures:
+        print('REGRESSION: %s' % failure)
+    return 1 if failures else 0
+
+
+def _parse_max_rows_arg(max_rows_arg):
+    max_rows = int(max_rows_arg)
+    if not 1000 <= max_rows <= 10**7:
+        raise ValueError('max_rows must be between 1000 and 10000000: %d' %
+                         max_rows)
+    return max_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='BigSanity: Parsing and Formatting Micro-benchmarks',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--max_rows',
+                        default=10**6,
+                        type=_parse_max_rows_arg,
+                        help=('Largest input size; sizes grow by factors of '
+                              '10 from 1000'))
+    parser.add_argument('--repeat',
+                        default=3,
+                        type=cli.parse_positive_int_arg,
+                        help='Number of runs at each size; the fastest counts')
+    parser.add_argument(
+        '--max_exponent',
+        default=1.5,
+        type=cli.parse_positive_float_arg,
+        help=('Maximum exponent k of time ~ rows^k before the scaling of a '
+              'function is reported as a regression'))
+    parser.add_argument('--baseline',
+                        default=baselines.default_path('parsing_benchmark'),
+                        help='Path of the baseline file')
+    parser.add_argument('--update_baseline',
+                        action='store_true',
+                        help='Save the results as the new baselines')
+    parser.add_argument(
+        '--tolerance',
+        default=0.2,
+        type=float,
+        help=('Fraction by which a metric may be worse than its baseline '
+              'before it is reported as a regression'))
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,283 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Compares strategies for finding test_ids missing from one table.
+
+Generates synthetic tables in a local SQLite database at each of several
+sizes, then checks each 1-day window with every strategy:
+
+    * full_outer_join: The default equivalence query, a FULL OUTER JOIN.
+    * anti_join: Two NOT IN anti-joins combined with UNION ALL. Legacy SQL has
+      no EXCEPT, so this is its closest equivalent.
+    * fingerprint_precheck: A query comparing row counts and XORed test_id
+      hashes of the two tables, followed by the full outer join only if the
+      fingerprints differ.
+    * local_set_difference: Downloads the test_ids of both tables and computes
+      the set difference locally.
+
+For each strategy, it reports the query runtime, the rows read from either
+table by the queries the strategy ran (counted by running each query again with
+a row counter on every table) and the bytes of query results, and verifies that
+every strategy finds exactly the same test_ids. It also fits the exponent k of
+runtime ~ size^k for each strategy, where size is the number of tests in the
+dataset, so that a strategy that is only fast on small tables stands out.
+
+Runtimes, and so their exponents, reflect SQLite's single-machine query plans,
+not BigQuery's: SQLite runs a FULL OUTER JOIN as nested loops, which BigQuery
+does not. Rows read and result bytes carry over to BigQuery more closely.
+
+Results are compared to stored baselines, and the benchmark exits with a
+non-zero status if any metric regressed or the strategies disagree.
+
+Usage:
+
+    python benchmarks/query_strategy_benchmark.py [--sizes 1000 10000 100000]
+"""
+
+import argparse
+import collections
+import csv
+import datetime
+import logging
+import os
+import sys
+import time
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import baselines
+import check_table_equivalence
+import cli
+import constants
+import local_execution
+import query_construct
+import synthetic_data
+
+# Fraction of tests left out of one of the tables in each scenario.
+SCENARIOS = collections.OrderedDict([
+    ('equivalent', 0.0),
+    ('sparse_discrepancies', 0.001),
+    ('dense_discrepancies', 0.05),
+])
+
+METRIC_DIRECTIONS = {
+    'seconds': baselines.LOWER_IS_BETTER,
+    'rows_read': baselines.LOWER_IS_BETTER,
+    'result_bytes': baselines.LOWER_IS_BETTER,
+    'time_exponent': baselines.LOWER_IS_BETTER,
+}
+
+# Outcome of checking one window with one strategy.
+StrategyOutcome = collections.namedtuple(
+    'StrategyOutcome', ['per_month_ids', 'per_project_ids', 'result_bytes'])
+
+
+def _parse_csv(result):
+    return list(csv.DictReader(result.splitlines()))
+
+
+def _run_query_strategy(executor, generator):
+    result = executor.execute_query(generator.generate_query())
+    per_month_ids, per_project_ids = (
+        check_table_equivalence._parse_query_result(result))
+    return per_month_ids, per_project_ids, len(result)
+
+
+def _full_outer_join(executor, generator_args):
+    generator = query_construct.TableEquivalenceQueryGenerator(
+        *generator_args,
+        strategy=query_construct.STRATEGY_FULL_OUTER_JOIN)
+    per_month_ids, per_project_ids, result_bytes = _run_query_strategy(
+        executor, generator)
+    return StrategyOutcome(per_month_ids, per_project_ids, result_bytes)
+
+
+def _anti_join(executor, generator_args):
+    generator = query_construct.TableEquivalenceQueryGenerator(
+        *generator_args,
+        strategy=query_construct.STRATEGY_ANTI_JOIN)
+    per_month_ids, per_project_ids, result_bytes = _run_query_strategy(
+        executor, generator)
+    return StrategyOutcome(per_month_ids, per_project_ids, result_bytes)
+
+
+def _fingerprint_precheck(executor, generator_args):
+    generator = query_construct.TableEquivalenceQueryGenerator(*generator_args)
+    fingerprint_result = executor.execute_query(
+        generator.generate_fingerprint_query())
+    row = _parse_csv(fingerprint_result)[0]
+    if (row['per_month_row_count'] == row['per_project_row_count'] and
+            row['per_month_fingerprint'] == row['per_project_fingerprint']):
+        return StrategyOutcome([], [], len(fingerprint_result))
+    per_month_ids, per_project_ids, result_bytes = _run_query_strategy(
+        executor, generator)
+    return StrategyOutcome(per_month_ids, per_project_ids,
+                           len(fingerprint_result) + result_bytes)
+
+
+def _local_set_difference(executor, generator_args):
+    generator = query_construct.TableEquivalenceQueryGenerator(*generator_args)
+    per_month_query, per_project_query = generator.generate_test_id_queries()
+    per_month_result = executor.execute_query(per_month_query)
+    per_project_result = executor.execute_query(per_project_query)
+    per_month_ids = set(r['test_id'] for r in _parse_csv(per_month_result))
+    per_project_ids = set(r['test_id'] for r in _parse_csv(per_project_result))
+    return StrategyOutcome(
+        list(per_month_ids - per_project_ids),
+        list(per_project_ids - per_month_ids),
+        len(per_month_result) + len(per_project_result))
+
+
+STRATEGIES = collections.OrderedDict([
+    ('full_outer_join', _full_outer_join),
+    ('anti_join', _anti_join),
+    ('fingerprint_precheck', _fingerprint_precheck),
+    ('local_set_difference', _local_set_difference),
+])
+
+
+class _QueryRecorder(object):
+    """Passes queries on to an executor and records them."""
+
+    def __init__(self, executor):
+        self._executor = executor
+        self.queries = []
+
+    def execute_query(self, query):
+        self.queries.append(query)
+        return self._executor.execute_query(query)
+
+
+def run_scenario(missing_rate, project, start_date, days, tests_per_day):
+    """Runs every strategy over one synthetic dataset.
+
+    Returns:
+        A (results, disagreements) 2-tuple. results maps each strategy name to
+        a dict of its metrics, and disagreements lists the windows in which a
+        strategy found different test_ids from the full outer join.
+    """
+    executor = local_execution.SqliteQueryExecutor()
+    end_date = start_date + datetime.timedelta(days=days)
+    synthetic_data.SyntheticDatasetGenerator(
+        executor, missing_rate=missing_rate).generate(project, start_date,
+                                                      end_date, tests_per_day)
+    results = dict((name, {
+        'seconds': 0.0,
+        'rows_read': 0,
+        'result_bytes': 0
+    }) for name in STRATEGIES)
+    disagreements = []
+    for day in range(days):
+        window_start = start_date + datetime.timedelta(days=day)
+        generator_args = (project, window_start,
+                          window_start + datetime.timedelta(days=1))
+        expected = None
+        for name, strategy in STRATEGIES.items():
+            recorder = _QueryRecorder(executor)
+            started = time.time()
+            outcome = strategy(recorder, generator_args)
+            results[name]['seconds'] += time.time() - started
+            results[name]['rows_read'] += sum(executor.count_rows_read(query)
+                                              for query in recorder.queries)
+            results[name]['result_bytes'] += outcome.result_bytes
+            found = (sorted(outcome.per_month_ids),
+                     sorted(outcome.per_project_ids))
+            if expected is None:
+                expected = found
+            elif found != expected:
+                disagreements.append('%s disagrees on window %s' %
+                                     (name, cli.format_time(window_start)))
+    return results, disagreements
+
+
+def main(args):
+    logging.basicConfig(level=logging.WARNING)
+    results = {}
+    disagreements = []
+    sizes = sorted(set(args.sizes))
+    for scenario, missing_rate in SCENARIOS.items():
+        for size in sizes:
+            scenario_results, scenario_disagreements = run_scenario(
+                missing_rate, args.project, args.start_date, args.days,
+                max(1, size // args.days))
+            disagreements.extend('%s/%d: %s' % (scenario, size, disagreement)
+                                 for disagreement in scenario_disagreements)
+            for name, metrics in scenario_results.items():
+                results['%s/%d/%s' % (scenario, size, name)] = metrics
+                print('%-21s %7d tests  %-21s %8.3f s  %10d rows read  '
+                      '%10d result bytes' %
+                      (scenario, size, name, metrics['seconds'],
+                       metrics['rows_read'], metrics['result_bytes']))
+        if len(sizes) < 2:
+            continue
+        for name in STRATEGIES:
+            exponent = baselines.fit_exponent(sizes, [
+                results['%s/%d/%s' % (scenario, size, name)]['seconds']
+                for size in sizes
+            ])
+            results['%s/%s' % (scenario, name)] = {'time_exponent': exponent}
+            print('%-21s %-21s time ~ size^%.2f' % (scenario, name, exponent))
+    for disagreement in disagreements:
+        print('MISMATCH: %s' % disagreement)
+    if args.update_baseline:
+        baselines.save(args.baseline, results)
+        print('Saved baselines to %s' % args.baseline)
+        return 1 if disagreements else 0
+    regressions = baselines.find_regressions(results,
+                                             baselines.load(args.baseline),
+                                             METRIC_DIRECTIONS, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return 1 if regressions or disagreements else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='BigSanity: Query Strategy Benchmark',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-p',
+                        '--project',
+                        default=constants.PROJECT_ID_NDT,
+                        type=int,
+                        choices=range(0, 4),
+                        help='ID of M-Lab project to generate tests for')
+    parser.add_argument('-s',
+                        '--start_date',
+                        default='2015-01-28',
+                        type=cli.parse_date_arg,
+                        help='Date of the first window')
+    parser.add_argument('--days',
+                        default=7,
+                        type=cli.parse_positive_int_arg,
+                        help='Number of 1-day windows to check')
+    parser.add_argument('--sizes',
+                        nargs='+',
+                        default=[1000, 10000, 100000],
+                        type=cli.parse_positive_int_arg,
+                        help=('Numbers of synthetic tests in the datasets to '
+                              'run every strategy on, spread evenly over the '
+                              'days'))
+    parser.add_argument(
+        '--baseline',
+        default=baselines.default_path('query_strategy_benchmark'),
+        help='Path of the baseline file')
+    parser.add_argument('--update_baseline',
+                        action='store_true',
+                        help='Save the results as the new baselines')
+    parser.add_argument(
+        '--tolerance',
+        default=0.2,
+        type=float,
+        help=('Fraction by which a metric may be worse than its baseline '
+              'before it is reported as a regression'))
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,250 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Measures the throughput of BigSanity's window scheduler.
+
+Runs the complete check pipeline (window planning, concurrent scheduling,
+retries, query generation, result parsing and progress reporting) over a
+sweep of 1-day windows of every M-Lab project against a fake query executor,
+and reports:
+
+    * windows_per_second: Windows checked per second of wall time.
+    * overhead_ms_per_window: Wall time per window beyond the simulated query
+      latency, i.e. the cost of BigSanity itself.
+    * peak_rss_kib: Peak resident memory of the process that ran the sweep.
+
+Each scenario simulates a different query latency distribution, failure rate
+and result size, and runs in its own process so that its peak memory is
+measured independently. Results are compared to stored baselines, and the
+benchmark exits with a non-zero status if any metric regressed.
+
+Usage:
+
+    python benchmarks/scheduler_benchmark.py [--scenario concurrent flaky]
+"""
+
+import argparse
+import collections
+import datetime
+import logging
+import math
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+from dateutil import relativedelta
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import baselines
+import bigsanity
+import cli
+import constants
+import query_execution
+
+Scenario = collections.namedtuple('Scenario', [
+    'latency_distribution', 'mean_latency', 'failure_rate', 'result_rows',
+    'concurrency'
+])
+
+SCENARIOS = collections.OrderedDict([
+    ('sequential', Scenario('constant', 0.001, 0.0, 0, 1)),
+    ('concurrent', Scenario('exponential', 0.005, 0.0, 0, 16)),
+    ('heavy_tail', Scenario('lognormal', 0.005, 0.0, 0, 16)),
+    ('flaky', Scenario('exponential', 0.005, 0.05, 0, 16)),
+    ('large_results', Scenario('constant', 0.001, 0.0, 1000, 8)),
+])
+
+# Projects whose windows are checked in each sweep, as in a production run.
+PROJECTS = (constants.PROJECT_ID_NDT, constants.PROJECT_ID_NPAD,
+            constants.PROJECT_ID_SIDESTREAM,
+            constants.PROJECT_ID_PARIS_TRACEROUTE)
+
+METRIC_DIRECTIONS = {
+    'windows_per_second': baselines.HIGHER_IS_BETTER,
+    'overhead_ms_per_window': baselines.LOWER_IS_BETTER,
+    'peak_rss_kib': baselines.LOWER_IS_BETTER,
+}
+
+# Standard deviation of the logarithm of lognormal latencies.
+_LOGNORMAL_SIGMA = 1.0
+
+
+class FakeQueryExecutor(object):
+    """Query executor that simulates BigQuery latency, failures and results."""
+
+    def __init__(self, scenario, seed=0, sleep=time.sleep):
+        self._scenario = scenario
+        self._random = random.Random(seed)
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self.total_latency = 0.0
+        self._result = self._format_result(scenario.result_rows)
+
+    def execute_query(self, query):
+        with self._lock:
+            latency = self._next_latency()
+            failed = self._random.random() < self._scenario.failure_rate
+            self.total_latency += latency
+        self._sleep(latency)
+        if failed:
+            raise query_execution.BqBackendError(query, 'backendError')
+        return self._result
+
+    def estimate_query_bytes(self, unused_query):
+        return 0
+
+    def _next_latency(self):
+        distribution = self._scenario.latency_distribution
+        mean = self._scenario.mean_latency
+        if distribution == 'constant':
+            return mean
+        if distribution == 'exponential':
+            return self._random.expovariate(1.0 / mean)
+        if distribution == 'lognormal':
+            mu = math.log(mean) - _LOGNORMAL_SIGMA**2 / 2
+            return self._random.lognormvariate(mu, _LOGNORMAL_SIGMA)
+        raise ValueError('Unknown latency distribution: %s' % distribution)
+
+    def _format_result(self, result_rows):
+        """Formats a bq CSV result with result_rows mismatched test_ids."""
+        if not result_rows:
+            return ''
+        lines = ['per_month_test_id,per_project_test_id']
+        for i in range(result_rows):
+            test_id = 'synthetic/test_id_%d' % i
+            if i % 2:
+                lines.append(',' + test_id)
+            else:
+                lines.append(test_id + ',')
+        return '\n'.join(lines) + '\n'
+
+
+def run_scenario(scenario, start_date, end_date, seed=0):
+    """Runs one scenario and returns its metrics as a dict."""
+    date_step = relativedelta.relativedelta(days=1)
+    fake_executor = FakeQueryExecutor(scenario, seed)
+    query_executor = query_execution.RetryingQueryExecutor(fake_executor,
+                                                           max_attempts=10,
+                                                           initial_delay=0.001,
+                                                           max_delay=0.01)
+    jobs_by_project = bigsanity._plan_project_jobs(PROJECTS,
+                                                   start_date,
+                                                   end_date,
+                                                   date_step,
+                                                   shard_count=1,
+                                                   align_to_months=False)
+    windows = sum(len(jobs) for jobs in jobs_by_project.values())
+    started = time.time()
+    bigsanity._do_cross_table_consistency_check(
+        list(PROJECTS),
+        start_date,
+        end_date,
+        date_step,
+        query_executor,
+        concurrency=scenario.concurrency)
+    elapsed = time.time() - started
+    ideal = fake_executor.total_latency / scenario.concurrency
+    return {
+        'windows': windows,
+        'windows_per_second': windows / elapsed,
+        'overhead_ms_per_window': max(0.0, elapsed - ideal) * 1000.0 / windows,
+        'peak_rss_kib': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    }
+
+
+def _run_scenario_in_child(scenario, start_date, end_date):
+    pool = multiprocessing.Pool(processes=1)
+    try:
+        return pool.apply(run_scenario, (scenario, start_date, end_date))
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _scale_latency(scenario, latency_scale):
+    return scenario._replace(mean_latency=scenario.mean_latency * latency_scale)
+
+
+def main(args):
+    if not args.verbose:
+        # Per-window log messages would dominate the measurements.
+        logging.disable(logging.CRITICAL)
+    results = {}
+    for name in args.scenario:
+        scenario = _scale_latency(SCENARIOS[name], args.latency_scale)
+        results[name] = _run_scenario_in_child(scenario, args.start_date,
+                                               args.end_date)
+        print('%-14s %6d windows  %9.1f windows/s  %7.3f ms overhead/window  '
+              '%8d KiB peak RSS' % (name, results[name]['windows'],
+                                    results[name]['windows_per_second'],
+                                    results[name]['overhead_ms_per_window'],
+                                    results[name]['peak_rss_kib']))
+    if args.update_baseline:
+        baselines.save(args.baseline, results)
+        print('Saved baselines to %s' % args.baseline)
+        return 0
+    regressions = baselines.find_regressions(results,
+                                             baselines.load(args.baseline),
+                                             METRIC_DIRECTIONS, args.tolerance)
+    for regression in regressions:
+        print('REGRESSION: %s' % regression)
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='BigSanity: Scheduler Throughput Benchmark',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--scenario',
+                        nargs='+',
+                        choices=list(SCENARIOS),
+                        default=list(SCENARIOS),
+                        help='Scenarios to run')
+    parser.add_argument('-s',
+                        '--start_date',
+                        default=datetime.datetime.utcfromtimestamp(
+                            constants.MLAB_EPOCH).strftime(cli.DATE_FORMAT),
+                        type=cli.parse_date_arg,
+                        help='Start of the sweep')
+    parser.add_argument(
+        '-e',
+        '--end_date',
+        default=datetime.datetime.now().strftime(cli.DATE_FORMAT),
+        type=cli.parse_date_arg,
+        help='End of the sweep')
+    parser.add_argument('--latency_scale',
+                        default=1.0,
+                        type=cli.parse_positive_float_arg,
+                        help='Factor by which to scale simulated latencies')
+    parser.add_argument('--baseline',
+                        default=baselines.default_path('scheduler_benchmark'),
+                        help='Path of the baseline file')
+    parser.add_argument('--update_baseline',
+                        action='store_true',
+                        help='Save the results as the new baselines')
+    parser.add_argument(
+        '--tolerance',
+        default=0.2,
+        type=float,
+        help=('Fraction by which a metric may be worse than its baseline '
+              'before it is reported as a regression'))
+    parser.add_argument('-v',
+                        '--verbose',
+                        help='Log the output of each check',
+                        action='store_true')
+    sys.exit(main(parser.parse_args()))
@@ -13,51 +13,477 @@
 # limitations under the License.
 
 import argparse
+import collections
 import datetime
 import logging
+import threading
+import time
 
 import cli
+import cost_estimation
+import formatting
+import history
+import instrumentation
 import intervals
+import local_execution
+import prioritization
+import profiling
+import progress
 import query_construct
 import query_execution
+import rate_limiting
+import reporting
+import sampling
+import scan_checks
+import scheduling
+import service
+import work_queue
 import check_table_equivalence
 
 logger = logging.getLogger(__name__)
 LOG_FORMAT = (
     '%(asctime)-15s %(levelname)-5s %(module)s.py:%(lineno)-d %(message)s')
 
+# Roles of a process that uses a shared queue of check jobs.
+_QUEUE_ROLE_PUBLISH = 'publish'
+_QUEUE_ROLE_WORK = 'work'
+_QUEUE_ROLE_REPORT = 'report'
+_QUEUE_ROLES = (_QUEUE_ROLE_PUBLISH, _QUEUE_ROLE_WORK, _QUEUE_ROLE_REPORT)
 
-def _do_cross_table_consistency_check(project, date_start, date_end, date_step):
+
+def _format_shard(shard_count, shard_index):
+    """Formats a shard for log messages, or empty string if not sharded."""
+    if shard_count == 1:
+        return ''
+    return ', shard %d/%d' % (shard_index + 1, shard_count)
+
+
+def _plan_check_jobs(date_start, date_end, date_step, shard_count,
+                     align_to_months):
+    """Plans the individual checks to perform over a date range.
+
+    Returns:
+        A list of (time_range_start, time_range_end, shard_index) 3-tuples,
+        one for each query that the sanity check will run.
+    """
+    check_windows = intervals.date_limits_to_intervals(
+        date_start, date_end, date_step, align_to_months)
+    logger.info('Total of %d time intervals to check.', len(check_windows))
+    jobs = []
+    for date_range_start, date_range_end in check_windows:
+        for shard_index in range(shard_count):
+            jobs.append((date_range_start, date_range_end, shard_index))
+    return jobs
+
+
+def _plan_project_jobs(projects, date_start, date_end, date_step, shard_count,
+                       align_to_months):
+    """Plans the check jobs for each of several projects over a date range.
+
+    Returns:
+        An OrderedDict mapping each project to a list of its jobs, each a
+        (project, time_range_start, time_range_end, shard_index) 4-tuple.
+    """
+    jobs = _plan_check_jobs(date_start, date_end, date_step, shard_count,
+                            align_to_months)
+    jobs_by_project = collections.OrderedDict()
+    for project in projects:
+        jobs_by_project[project] = [(project,) + job for job in jobs]
+    return jobs_by_project
+
+
+def _job_days(job, shard_count):
+    """Returns the days of data covered by a check job.
+
+    Each shard of a time window counts for an equal part of the window.
+    """
+    _, date_range_start, date_range_end, _ = job
+    window_seconds = (date_range_end - date_range_start).total_seconds()
+    return window_seconds / (24 * 60 * 60) / shard_count
+
+
+def _estimate_check_jobs(jobs_by_project,
+                         shard_count,
+                         query_executor,
+                         concurrency,
+                         checks=None):
+    """Estimates the total bytes BigQuery would process to run check jobs.
+
+    Logs the estimate for each job, the total for each project and, if there
+    is more than one project, the total for all projects.
+
+    Args:
+        jobs_by_project: A dict mapping projects to lists of check jobs, as
+            returned by _plan_project_jobs.
+        shard_count: Number of test_id hash shards each time window is split
+            into.
+        query_executor: Executor for BigQuery SQL queries.
+        concurrency: Maximum number of estimates to run at once.
+        checks: An optional list of names of scan checks that run on every
+            window, whose shared query is included in the estimates.
+
+    Returns:
+        The total estimated bytes processed by all of the jobs.
+    """
+    estimator = cost_estimation.CostEstimator(
+        query_construct.TableEquivalenceQueryGeneratorFactory(), query_executor,
+        scan_checks.create_checks(checks or []))
+
+    def estimate_job(job):
+        project, date_range_start, date_range_end, shard_index = job
+        job_bytes = estimator.estimate(project,
+                                       date_range_start,
+                                       date_range_end,
+                                       shard_count=shard_count,
+                                       shard_index=shard_index)
+        logger.info('Estimated cost for project=%d, %s -> %s%s: %s', project,
+                    cli.format_time(date_range_start),
+                    cli.format_time(date_range_end),
+                    _format_shard(shard_count, shard_index),
+                    formatting.format_bytes(job_bytes))
+        return project, job_bytes
+
+    bytes_by_project = collections.defaultdict(int)
+    all_jobs = [job for jobs in jobs_by_project.values() for job in jobs]
+    for project, job_bytes in scheduling.run_concurrently(
+            estimate_job, all_jobs, concurrency):
+        bytes_by_project[project] += job_bytes
+    for project, jobs in jobs_by_project.items():
+        logger.info('Estimated total cost for project=%d: %s in %d queries.',
+                    project, formatting.format_bytes(bytes_by_project[project]),
+                    len(jobs))
+    total_bytes = sum(bytes_by_project.values())
+    if len(jobs_by_project) > 1:
+        logger.info('Estimated total cost for all projects: %s in %d queries.',
+                    formatting.format_bytes(total_bytes), len(all_jobs))
+    return total_bytes
+
+
+def _log_summary(projects, date_start, date_end, windows_by_project,
+                 failures_by_project):
+    """Logs the number of failed checks of each project and of all projects."""
+    for project in projects:
+        logger.info(
+            ('Cross-table consistency check completed for project=%d, %s -> '
+             '%s, with %d failures in %d windows.'), project,
+            cli.format_time(date_start), cli.format_time(date_end),
+            failures_by_project[project], windows_by_project[project])
+    if len(projects) > 1:
+        logger.info(
+            ('Cross-table consistency check completed for %d projects, %s -> '
+             '%s, with %d failures in %d windows (%s).'), len(projects),
+            cli.format_time(date_start), cli.format_time(date_end),
+            sum(failures_by_project.values()), sum(windows_by_project.values()),
+            ', '.join('project=%d: %d' % (project, failures_by_project[project])
+                      for project in projects))
+
+
+def _log_sample_estimates(projects, mismatches_by_project, sample_rate):
+    """Logs the estimated mismatches of each project and of all projects."""
+    for project in projects:
+        logger.info('Sampled check of project=%d found %s.', project,
+                    sampling.format_estimate(
+                        sampling.estimate_mismatches(
+                            mismatches_by_project[project], sample_rate),
+                        sample_rate))
+    if len(projects) > 1:
+        logger.info('Sampled check of %d projects found %s.', len(projects),
+                    sampling.format_estimate(
+                        sampling.estimate_mismatches(
+                            sum(mismatches_by_project.values()), sample_rate),
+                        sample_rate))
+
+
+def _do_cross_table_consistency_check(projects,
+                                      date_start,
+                                      date_end,
+                                      date_step,
+                                      query_executor,
+                                      shard_count=1,
+                                      align_to_months=False,
+                                      dry_run=False,
+                                      max_bytes=None,
+                                      concurrency=1,
+                                      metrics_recorder=None,
+                                      progress_interval=60,
+                                      project_weights=None,
+                                      prioritizer=None,
+                                      check_history=None,
+                                      first_failure_exit=False,
+                                      time_budget=None,
+                                      report_writer=None,
+                                      checks=None,
+                                      sample_rate=None,
+                                      details=None):
     """Performs sanity checks on all the time windows in the given range.
 
     Performs all BigSanity sanity checks on the M-Lab BigQuery tables for the
-    given project and the given time range.
+    given projects and the given time range. The checks of all projects share
+    a single limit on the number of queries that run at once.
 
     Args:
-        project: Numerical ID of M-Lab project in BigQuery (e.g. NDT = 0).
+        projects: List of numerical IDs of M-Lab projects in BigQuery (e.g.
+            NDT = 0).
         date_start: Limits checks to M-Lab tests that occurred on or after this
             date.
         date_end: Limits checks to M-Lab tests that occurred before this date.
+        date_step: Size of each time window to check (as relativedelta).
+        query_executor: Executor for BigQuery SQL queries.
+        shard_count: Number of test_id hash shards to split each time window
+            into. Each shard is checked with an independent query.
+        align_to_months: Whether to snap time window boundaries to calendar
+            months so that each query reads as few monthly tables as possible.
+        dry_run: If True, only estimate the cost of the checks, without running
+            them.
+        max_bytes: If set, the maximum number of bytes the checks may process.
+            The checks are estimated before they run, and none of them run if
+            the estimate exceeds this budget.
+        concurrency: Maximum number of queries to run at once, across all
+            projects.
+        metrics_recorder: If set, a MetricsRecorder to which timing and cost
+            metrics are recorded for each check.
+        progress_interval: Minimum number of seconds between progress log
+            messages, when progress is not reported to a terminal.
+        project_weights: An optional dict mapping projects to their relative
+            share of the concurrent queries while several projects have checks
+            left to run. Projects not in the dict have a weight of 1.
+        prioritizer: If set, a WindowPrioritizer that orders the windows of
+            each project. Otherwise, windows are checked in chronological
+            order.
+        check_history: If set, a CheckHistory to which the result of every
+            window is recorded.
+        first_failure_exit: If True, no further windows are started once a
+            window fails.
+        time_budget: If set, the number of seconds after which no further
+            windows are started.
+        report_writer: If set, a RunReportWriter to which a record of every
+            window is written. Failure log messages then refer to the file
+            that contains the query instead of quoting it.
+        checks: An optional list of names of scan checks (see
+            scan_checks.CHECKS) to run on every window in addition to the table
+            equivalence check. All of them share a single query per window.
+        sample_rate: If set, the fraction of test_id values to which the
+            checks are limited. The number of mismatched test_ids in the whole
+            tables is then estimated at the end of the run.
+        details: How much detail to fetch about the test_id values of failed
+            windows, one of check_table_equivalence.DETAILS. All of them are
+            fetched by default.
     """
+    with profiling.phase('plan_windows'):
+        jobs_by_project = _plan_project_jobs(projects, date_start, date_end,
+                                             date_step, shard_count,
+                                             align_to_months)
+    if dry_run or max_bytes:
+        estimated_bytes = _estimate_check_jobs(
+            jobs_by_project, shard_count, query_executor, concurrency, checks)
+        if dry_run:
+            return
+        if estimated_bytes > max_bytes:
+            logger.error(
+                'Estimated cost of %s exceeds budget of %s. No checks were '
+                'performed. Use a later --start_date, an earlier --end_date or '
+                'a larger --max_bytes.',
+                formatting.format_bytes(estimated_bytes),
+                formatting.format_bytes(max_bytes))
+            return
+    if prioritizer:
+        with profiling.phase('prioritize_windows'):
+            for project, jobs in jobs_by_project.items():
+                jobs_by_project[project] = prioritizer.prioritize(jobs)
+    run_id = check_history.start_run() if check_history else None
+    deadline = time.time() + time_budget if time_budget else None
+    stop_checks = threading.Event()
+    query_generator_factory = (
+        query_construct.TableEquivalenceQueryGeneratorFactory(sample_rate))
     checker = check_table_equivalence.TableEquivalenceChecker(
-        query_construct.TableEquivalenceQueryGeneratorFactory(),
-        query_execution.QueryExecutor())
-    check_windows = intervals.date_limits_to_intervals(date_start, date_end,
-                                                       date_step)
-    logger.info('Total of %d time intervals to check.', len(check_windows))
-    anomalies_detected = 0
-    for date_range_start, date_range_end in check_windows:
-        logger.info('Checking cross-table consistency for project=%d, %s -> %s',
-                    project, date_range_start.strftime(cli.DATE_FORMAT),
-                    date_range_end.strftime(cli.DATE_FORMAT))
-        check_result = checker.check(project, date_range_start, date_range_end)
+        query_generator_factory, query_executor, details or
+        check_table_equivalence.DETAILS_FULL)
+    scan_checker = None
+    if checks:
+        scan_checker = scan_checks.FusedScanChecker(
+            query_generator_factory, query_executor,
+            scan_checks.create_checks(checks))
+    all_jobs = [job for jobs in jobs_by_project.values() for job in jobs]
+    progress_reporter = progress.ProgressReporter(
+        len(all_jobs),
+        sum(_job_days(job, shard_count) for job in all_jobs),
+        log_interval=progress_interval)
+
+    def run_checks(project, date_range_start, date_range_end, shard_index):
+        """Runs the table equivalence check and any scan checks on a window.
+
+        Returns:
+            A (check_result, scan_results) 2-tuple, where check_result is the
+            result of the table equivalence check and scan_results maps the
+            name of each scan check to its result.
+        """
+        check_result = checker.check(project,
+                                     date_range_start,
+                                     date_range_end,
+                                     shard_count=shard_count,
+                                     shard_index=shard_index)
+        scan_results = collections.OrderedDict()
+        if scan_checker:
+            scan_results = scan_checker.check(project,
+                                              date_range_start,
+                                              date_range_end,
+                                              shard_count=shard_count,
+                                              shard_index=shard_index)
+        return check_result, scan_results
+
+    def check_window(project, date_range_start, date_range_end, shard_index):
+        """Checks a window, instrumenting the check if metrics are needed.
+
+        Returns:
+            A (check_result, scan_results, metrics) 3-tuple, as returned by
+            run_checks, where metrics is None if the check was not
+            instrumented.
+        """
+        if not (metrics_recorder or report_writer):
+            return run_checks(project, date_range_start, date_range_end,
+                              shard_index) + (None,)
+        metrics = instrumentation.WindowMetrics(
+            project, date_range_start, date_range_end, shard_count, shard_index)
+        with instrumentation.bind(metrics):
+            check_result, scan_results = run_checks(project, date_range_start,
+                                                    date_range_end, shard_index)
+        metrics.finish(check_result.success and
+                       all(result.success for result in scan_results.values()))
+        if metrics_recorder:
+            metrics_recorder.record(metrics)
+        return check_result, scan_results, metrics
+
+    def check_job(job):
+        project, date_range_start, date_range_end, shard_index = job
+        if stop_checks.is_set() or (deadline and time.time() >= deadline):
+            return project, None, None
+        logger.info(
+            'Checking cross-table consistency for project=%d, %s -> %s%s',
+            project, cli.format_time(date_range_start),
+            cli.format_time(date_range_end),
+            _format_shard(shard_count, shard_index))
+        equivalence_result, scan_results, metrics = check_window(
+            project, date_range_start, date_range_end, shard_index)
+        check_result = scan_checks.combine_results(equivalence_result,
+                                                   scan_results)
+        failure_message = check_result.message
+        if report_writer:
+            sql_path = report_writer.record(project, date_range_start,
+                                            date_range_end, check_result,
+                                            shard_count, shard_index, metrics)
+            if not equivalence_result.success:
+                failure_message = scan_checks.combine_results(
+                    check_table_equivalence.CheckResult(
+                        success=False,
+                        message=check_table_equivalence.format_failure_summary(
+                            equivalence_result, sql_path)),
+                    scan_results).message
+        if check_history:
+            check_history.record(run_id, project, date_range_start,
+                                 date_range_end, check_result, shard_count,
+                                 shard_index)
+        progress_reporter.window_completed(
+            _job_days(job, shard_count), check_result.success)
+        return project, check_result, failure_message
+
+    windows_by_project = dict((project, 0) for project in jobs_by_project)
+    failures_by_project = dict((project, 0) for project in jobs_by_project)
+    mismatches_by_project = dict((project, 0) for project in jobs_by_project)
+    incomplete_windows = 0
+    skipped_windows = 0
+    for project, check_result, failure_message in scheduling.run_fair_share(
+            check_job, jobs_by_project, concurrency, project_weights):
+        if check_result is None:
+            skipped_windows += 1
+            continue
+        windows_by_project[project] += 1
+        mismatches_by_project[project] += (
+            len(set(check_result.per_month_ids)) +
+            len(set(check_result.per_project_ids)))
+        if not check_result.complete:
+            incomplete_windows += 1
         if not check_result.success:
-            logger.error(check_result.message)
-            anomalies_detected += 1
-    logger.info(
-        ('Cross-table consistency check completed for project=%d, %s -> %s, '
-         'with %d failures.'), project, date_start.strftime(cli.DATE_FORMAT),
-        date_end.strftime(cli.DATE_FORMAT), anomalies_detected)
+            logger.error(failure_message)
+            failures_by_project[project] += 1
+            if first_failure_exit and not stop_checks.is_set():
+                logger.info('Stopping at the first failure.')
+                stop_checks.set()
+    progress_reporter.finish()
+    if skipped_windows:
+        logger.warning('Stopped early: %d time windows were not checked.',
+                       skipped_windows)
+    _log_summary(
+        list(jobs_by_project), date_start, date_end, windows_by_project,
+        failures_by_project)
+    if sample_rate and incomplete_windows:
+        logger.warning(
+            'Not all mismatched test_ids of %d time windows were fetched, so '
+            'the mismatches in the whole tables cannot be estimated. Use '
+            '--details full with --sample_rate.', incomplete_windows)
+    elif sample_rate:
+        # Scale by the rate the queries apply, which is rounded to whole hash
+        # buckets.
+        _log_sample_estimates(
+            list(jobs_by_project), mismatches_by_project,
+            query_generator_factory.sample_rate)
+
+
+def _create_query_executor(args):
+    """Creates the query executor described by the command line arguments."""
+    token_bucket = None
+    if args.max_query_rate:
+        token_bucket = rate_limiting.TokenBucket(args.max_query_rate,
+                                                 capacity=args.concurrency)
+    if args.local_database:
+        base_executor = local_execution.SqliteQueryExecutor(args.local_database)
+    else:
+        base_executor = query_execution.QueryExecutor(
+            timeout=args.query_timeout)
+    if args.adaptive_concurrency:
+        base_executor = query_execution.AdaptiveConcurrencyQueryExecutor(
+            base_executor, rate_limiting.AimdConcurrencyLimit(args.concurrency))
+    query_executor = query_execution.RetryingQueryExecutor(
+        base_executor,
+        token_bucket,
+        max_attempts=args.max_attempts)
+    if args.hedge:
+        query_executor = query_execution.HedgingQueryExecutor(query_executor)
+    return query_executor
+
+
+def _serve(args, date_step):
+    """Runs BigSanity as a service, as described by the arguments."""
+    checker = check_table_equivalence.TableEquivalenceChecker(
+        query_construct.TableEquivalenceQueryGeneratorFactory(),
+        _create_query_executor(args))
+    check_service = service.CheckService(checker,
+                                         date_step,
+                                         concurrency=args.concurrency,
+                                         cache_ttl=args.cache_ttl)
+    service.serve(check_service, args.schedule or [], args.serve)
+
+
+def _run_queue_role(args):
+    """Publishes, works on or reports on a shared queue of check jobs."""
+    queue = work_queue.WorkQueue(args.queue, args.lease_seconds,
+                                 args.max_job_attempts)
+    if args.queue_role == _QUEUE_ROLE_PUBLISH:
+        jobs = _plan_check_jobs(args.start_date, args.end_date,
+                                cli.get_interval(args), args.shards,
+                                args.align_months)
+        for project in args.project:
+            added = queue.publish(project, jobs, args.shards)
+            logger.info('Published %d new jobs for project=%d to %s.', added,
+                        project, args.queue)
+    elif args.queue_role == _QUEUE_ROLE_WORK:
+        checker = check_table_equivalence.TableEquivalenceChecker(
+            query_construct.TableEquivalenceQueryGeneratorFactory(),
+            _create_query_executor(args))
+        checked = work_queue.run_worker(
+            queue, checker, work_queue.default_worker_id(), args.concurrency)
+        logger.info('Worker checked %d jobs; no jobs remain.', checked)
+    else:
+        work_queue.log_report(queue)
 
 
 def main(args):
@@ -66,10 +492,57 @@ def main(args):
     else:
         log_level = logging.INFO
     logging.basicConfig(level=log_level, format=LOG_FORMAT)
+    if args.queue:
+        _run_queue_role(args)
+        return
     date_step = cli.get_interval(args)
+    if args.serve is not None:
+        _serve(args, date_step)
+        return
 
-    _do_cross_table_consistency_check(args.project, args.start_date,
-                                      args.end_date, date_step)
+    metrics_recorder = None
+    metrics_jsonl_file = None
+    if args.metrics_jsonl or args.metrics_textfile:
+        if args.metrics_jsonl:
+            metrics_jsonl_file = open(args.metrics_jsonl, 'w')
+        metrics_recorder = instrumentation.MetricsRecorder(metrics_jsonl_file)
+    profiler = None
+    if args.profile:
+        profiler = profiling.PipelineProfiler(args.profile_memory)
+        profiling.activate(profiler)
+    query_executor = _create_query_executor(args)
+    check_history = None
+    if args.history:
+        check_history = history.CheckHistory(args.history)
+    prioritizer = None
+    if args.order == prioritization.ORDER_PRIORITY:
+        prioritizer = prioritization.WindowPrioritizer(
+            check_history, query_executor.table_modified_time)
+    report_writer = None
+    if args.report_dir:
+        report_writer = reporting.RunReportWriter(args.report_dir)
+    try:
+        _do_cross_table_consistency_check(
+            args.project, args.start_date, args.end_date, date_step,
+            query_executor, args.shards, args.align_months, args.dry_run,
+            args.max_bytes, args.concurrency, metrics_recorder,
+            args.progress_interval, dict(args.project_weight or []),
+            prioritizer, check_history, args.first_failure_exit,
+            args.time_budget, report_writer, args.checks, args.sample_rate,
+            args.details)
+    finally:
+        if report_writer:
+            report_writer.close()
+        if metrics_recorder:
+            metrics_recorder.log_summary()
+            if args.metrics_textfile:
+                metrics_recorder.write_prometheus_textfile(
+                    args.metrics_textfile)
+        if metrics_jsonl_file:
+            metrics_jsonl_file.close()
+        if profiler:
+            profiling.deactivate()
+            profiler.write_report(args.profile)
 
 
 if __name__ == '__main__':
@@ -80,8 +553,10 @@ if __name__ == '__main__':
                         '--project',
                         type=int,
                         choices=range(0, 4),
-                        required=True,
-                        help='ID of M-Lab project in BigQuery')
+                        nargs='+',
+                        help=('IDs of M-Lab projects in BigQuery. The checks '
+                              'of all projects share the --concurrency '
+                              'limit.'))
     parser.add_argument('-s',
                         '--start_date',
                         default='2009-02-01',
@@ -92,6 +567,11 @@ if __name__ == '__main__':
         default=datetime.datetime.now().strftime(cli.DATE_FORMAT),
         type=cli.parse_date_arg)
     interval_group = parser.add_mutually_exclusive_group()
+    interval_group.add_argument(
+        '--interval_hours',
+        type=cli.parse_interval_hours_arg,
+        help=('Specifies the size of the time windows for each sanity check '
+              'query in hours.'))
     interval_group.add_argument(
         '-d',
         '--interval_days',
@@ -104,10 +584,219 @@ if __name__ == '__main__':
         type=cli.parse_interval_months_arg,
         help=('Specifies the size of the time windows for each sanity check '
               'query in months.'))
+    parser.add_argument(
+        '--shards',
+        default=1,
+        type=cli.parse_shard_count_arg,
+        help=('Number of test_id hash shards to split each time window into. '
+              'Each shard is checked with a separate query, which bounds the '
+              'resources used by any single query on very dense days.'))
+    parser.add_argument(
+        '--align_months',
+        action='store_true',
+        help=('Snap time window boundaries to the start of calendar months, so '
+              'that windows do not straddle monthly tables. A window that '
+              'would leave less than half a step before a month border is '
+              'extended to the border instead.'))
+    parser.add_argument(
+        '--checks',
+        nargs='+',
+        choices=list(scan_checks.CHECKS),
+        default=[],
+        help=('Scan checks to run on every time window in addition to the '
+              'table equivalence check: row_count_parity compares the number '
+              'of tests per day, null_log_time finds web100 tests without a '
+              'web100_log_entry.log_time and intermediate_snapshots finds '
+              'snapshots with is_last_entry false in the per-project table '
+              'and duplicate_test_ids finds test_ids with several rows in a '
+              'table. The selected checks share one extra query per window.'))
+    parser.add_argument(
+        '--details',
+        choices=check_table_equivalence.DETAILS,
+        default=check_table_equivalence.DETAILS_FULL,
+        help=('How much detail to fetch about the mismatched test_ids of a '
+              'failed time window: none stops each query at the first '
+              'mismatch, which is enough to decide whether the window passes '
+              'and keeps the results of bulk sweeps tiny, sample fetches up to '
+              '100 test_ids for the failure message and full fetches all of '
+              'them.'))
+    parser.add_argument(
+        '--sample_rate',
+        type=cli.parse_sample_rate_arg,
+        help=('Fraction of test_id values to check, e.g. 0.01, for a quick '
+              'check of whether the tables are roughly consistent. The same '
+              'test_ids are sampled from both tables by a hash of the test_id, '
+              'and the number of mismatched test_ids in the whole tables is '
+              'estimated with a 95%% upper bound.'))
+    parser.add_argument(
+        '--order',
+        choices=prioritization.ORDERS,
+        default=prioritization.ORDER_CHRONOLOGICAL,
+        help=('Order in which to check time windows. In priority order, '
+              'recent windows, windows that failed in earlier runs (see '
+              '--history) and windows whose tables were modified since they '
+              'were last checked come first.'))
+    parser.add_argument(
+        '--history',
+        metavar='PATH',
+        help=('Path of a SQLite database in which the result of every time '
+              'window and every missing test_id is recorded, for --order '
+              'priority in later runs and for queries with history.py.'))
+    parser.add_argument(
+        '--first_failure_exit',
+        action='store_true',
+        help='Stop starting new checks once a time window fails.')
+    parser.add_argument(
+        '--time_budget',
+        type=cli.parse_positive_float_arg,
+        help=('Number of seconds after which no new checks are started. '
+              'Combine with --order priority to check the likeliest problems '
+              'within the budget.'))
+    parser.add_argument(
+        '--dry_run',
+        action='store_true',
+        help=('Estimate the bytes each check query would process, without '
+              'running any checks.'))
+    parser.add_argument(
+        '--max_bytes',
+        type=cli.parse_bytes_arg,
+        help=('Maximum number of bytes the checks may process (e.g. 500G). If '
+              'the estimated cost exceeds this budget, no checks are run.'))
+    parser.add_argument('-c',
+                        '--concurrency',
+                        default=1,
+                        type=cli.parse_positive_int_arg,
+                        help='Maximum number of queries to run at once.')
+    parser.add_argument(
+        '--adaptive_concurrency',
+        action='store_true',
+        help=('Start with one query at a time and adapt the number of '
+              'concurrent queries to the capacity BigQuery has available, up '
+              'to --concurrency: raise it while queries succeed at a steady '
+              'latency, and halve it when queries fail for rate limits or '
+              'exhausted resources.'))
+    parser.add_argument(
+        '--project_weight',
+        action='append',
+        type=cli.parse_project_weight_arg,
+        help=('Relative share of the concurrent queries for a project while '
+              'several projects have checks left to run, of the form '
+              'PROJECT:WEIGHT, e.g. 0:3. May be repeated. Projects have a '
+              'weight of 1 by default.'))
+    parser.add_argument(
+        '--max_query_rate',
+        type=cli.parse_positive_float_arg,
+        help=('Maximum number of queries to start per second, to stay within '
+              'the BigQuery project quota. Not limited by default.'))
+    parser.add_argument(
+        '--max_attempts',
+        default=5,
+        type=cli.parse_positive_int_arg,
+        help=('Maximum number of times to attempt a query that fails due to '
+              'rate limits or transient BigQuery errors.'))
+    parser.add_argument(
+        '--query_timeout',
+        type=cli.parse_positive_float_arg,
+        help=('Maximum number of seconds to wait for a query. Queries that '
+              'exceed this deadline are cancelled and fail. Not limited by '
+              'default.'))
+    parser.add_argument(
+        '--hedge',
+        action='store_true',
+        help=('Issue a duplicate of any query that runs longer than the 95th '
+              'percentile latency seen so far, and use whichever finishes '
+              'first.'))
+    parser.add_argument(
+        '--local_database',
+        metavar='PATH',
+        help=('Run queries against M-Lab tables in this local SQLite database '
+              'instead of BigQuery, e.g. to reproduce a sweep offline.'))
+    parser.add_argument(
+        '--metrics_jsonl',
+        help=('Path of a file to which timing and cost metrics for each time '
+              'window are written, one JSON object per line.'))
+    parser.add_argument(
+        '--metrics_textfile',
+        help=('Path of a file to which aggregate metrics are written at the '
+              'end of the run, in the Prometheus textfile format.'))
+    parser.add_argument(
+        '--report_dir',
+        metavar='DIR',
+        help=('Directory to which a report of the run is written as it '
+              'progresses: report.jsonl holds one JSON record per time window '
+              'with its status, mismatch counts, sample test_ids, timing and '
+              'bytes processed, and each distinct query is written once to '
+              'the sql subdirectory, named by the SHA-256 hash of its text.'))
+    parser.add_argument(
+        '--progress_interval',
+        default=60,
+        type=cli.parse_positive_float_arg,
+        help=('Minimum number of seconds between progress log messages. When '
+              'run in a terminal, progress is instead updated in place after '
+              'every time window.'))
+    parser.add_argument(
+        '--profile',
+        metavar='DIR',
+        help=(
+            'Profile each phase of the check pipeline and write the profiling '
+            'data and a ranked text report to this directory.'))
+    parser.add_argument(
+        '--profile_memory',
+        action='store_true',
+        help=('With --profile, also record how much parsing query results '
+              'and formatting failure messages raise peak resident memory.'))
+    parser.add_argument(
+        '--serve',
+        metavar='PORT',
+        type=int,
+        help=('Run as a service: answer ad hoc checks over HTTP on this port '
+              'of localhost, and run the checks given by --schedule.'))
+    parser.add_argument(
+        '--schedule',
+        action='append',
+        type=service.parse_schedule_arg,
+        help=('In service mode, a periodic check of the form '
+              'PROJECT:MINUTES:DAYS, e.g. 0:60:7 re-checks the last 7 days of '
+              'project 0 every hour. May be repeated.'))
+    parser.add_argument(
+        '--cache_ttl',
+        type=cli.parse_positive_float_arg,
+        help=('In service mode, the number of seconds for which the result of '
+              'a window check answers ad hoc checks. Results do not expire by '
+              'default.'))
+    parser.add_argument(
+        '--queue',
+        metavar='PATH',
+        help=('Path of a SQLite database, on storage shared by all workers, '
+              'that holds a queue of check jobs. See --queue_role.'))
+    parser.add_argument(
+        '--queue_role',
+        choices=_QUEUE_ROLES,
+        default=_QUEUE_ROLE_WORK,
+        help=('With --queue: publish the time windows of a sweep as jobs, '
+              'work on jobs until none remain, or report the merged results '
+              'of all workers.'))
+    parser.add_argument(
+        '--lease_seconds',
+        default=3600,
+        type=cli.parse_positive_float_arg,
+        help=('With --queue, the number of seconds after which a job claimed '
+              'by a worker that stopped responding may be claimed by another '
+              'worker.'))
+    parser.add_argument(
+        '--max_job_attempts',
+        default=3,
+        type=cli.parse_positive_int_arg,
+        help=('With --queue, the number of times a job is checked before a '
+              'check error, or a worker that stopped responding, marks it as '
+              'an error for good.'))
     parser.add_argument('-v',
                         '--verbose',
                         help='Produce verbose log output',
                         action='store_true')
 
     args = parser.parse_args()
+    if (args.project is None and args.serve is None and
+            not (args.queue and args.queue_role != _QUEUE_ROLE_PUBLISH)):
+        parser.error('argument -p/--project is required')
     main(args)
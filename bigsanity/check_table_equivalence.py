@@ -16,6 +16,8 @@ import csv
 import io
 import logging
 import formatting
+import instrumentation
+import profiling
 
 logger = logging.getLogger(__name__)
 
@@ -23,6 +25,23 @@ logger = logging.getLogger(__name__)
 # failure messages.
 _MAX_DISPLAYED_TEST_IDS = 10
 
+# How much detail a check fetches about the test_id values of a failed window.
+# With DETAILS_NONE, the query stops at the first mismatched test_id, which is
+# all that is needed to decide whether the window passes. DETAILS_SAMPLE
+# fetches enough test_ids for a failure message, and DETAILS_FULL all of them.
+DETAILS_NONE = 'none'
+DETAILS_SAMPLE = 'sample'
+DETAILS_FULL = 'full'
+DETAILS = (DETAILS_NONE, DETAILS_SAMPLE, DETAILS_FULL)
+
+# The maximum number of rows the equivalence query yields at each level of
+# detail.
+_DETAIL_ROW_LIMITS = {
+    DETAILS_NONE: 1,
+    DETAILS_SAMPLE: 100,
+    DETAILS_FULL: None,
+}
+
 
 def _parse_query_result(query_result):
     """Parses the results of a table equivalence query.
@@ -65,7 +84,7 @@ def _format_test_ids(test_ids):
         A formatted list of test_id values that can be included in a check
         failure message.
     """
-    unique_test_ids = sorted(list(set(test_ids)))[:_MAX_DISPLAYED_TEST_IDS]
+    unique_test_ids = sample_test_ids(test_ids)
     number_omitted_ids = max(0, len(test_ids) - _MAX_DISPLAYED_TEST_IDS)
     if number_omitted_ids:
         unique_test_ids.append(
@@ -74,19 +93,13 @@ def _format_test_ids(test_ids):
     return formatting.indent('\n'.join(unique_test_ids), 2)
 
 
-def _format_check_failure_message(per_month_ids, per_project_ids, query):
-    """Creates a user-friendly message explaining an equivalence check failure.
+def sample_test_ids(test_ids):
+    """Returns the unique test_id values displayed for a list of test_ids."""
+    return sorted(set(test_ids))[:_MAX_DISPLAYED_TEST_IDS]
 
-    Args:
-        per_month_ids: A list of test_id values that appeared only in the
-            per-month tables.
-        per_project_ids: A list of test_id values that appeared only in the
-            per-project tables.
-        query: The SQL query used to compare the two tables.
 
-    Returns:
-        A user-friendly message explaining the sanity check failure.
-    """
+def _format_mismatches(per_month_ids, per_project_ids):
+    """Formats the test_id values of a failed check, without its query."""
     message = 'Check failed: TABLE EQUIVALENCE\n'
     if per_month_ids:
         message += ('test_id values present in per-month table, but NOT present'
@@ -96,22 +109,87 @@ def _format_check_failure_message(per_month_ids, per_project_ids, query):
         message += ('test_id values present in per-project table, but NOT '
                     'present in per-month table:\n')
         message += '%s\n' % _format_test_ids(per_project_ids)
-    message += 'BigQuery SQL:\n%s' % formatting.indent(query, 2)
     return message
 
 
+def _format_incomplete_note(row_limit):
+    return ('Only the first %d mismatched test_id values were fetched. Use '
+            '--details full to fetch them all.\n' % row_limit)
+
+
+def _format_check_failure_message(per_month_ids,
+                                  per_project_ids,
+                                  query,
+                                  row_limit=None):
+    """Creates a user-friendly message explaining an equivalence check failure.
+
+    Args:
+        per_month_ids: A list of test_id values that appeared only in the
+            per-month tables.
+        per_project_ids: A list of test_id values that appeared only in the
+            per-project tables.
+        query: The SQL query used to compare the two tables.
+        row_limit: If set, the limit on the number of rows of the query, which
+            the results reached.
+
+    Returns:
+        A user-friendly message explaining the sanity check failure.
+    """
+    message = _format_mismatches(per_month_ids, per_project_ids)
+    if row_limit:
+        message += _format_incomplete_note(row_limit)
+    return '%sBigQuery SQL:\n%s' % (message, formatting.indent(query, 2))
+
+
+def format_failure_summary(check_result, query_reference):
+    """Creates a failure message that refers to the query instead of quoting it.
+
+    Args:
+        check_result: The CheckResult of a failed check.
+        query_reference: Where to find the query, such as the path of a file
+            that contains it.
+
+    Returns:
+        A user-friendly message explaining the sanity check failure.
+    """
+    message = _format_mismatches(check_result.per_month_ids,
+                                 check_result.per_project_ids)
+    if not check_result.complete:
+        message += _format_incomplete_note(len(check_result.per_month_ids) +
+                                           len(check_result.per_project_ids))
+    return '%sBigQuery SQL: %s' % (message, query_reference)
+
+
 class CheckResult(object):
 
-    def __init__(self, success, message=None):
+    def __init__(self,
+                 success,
+                 message=None,
+                 per_month_ids=None,
+                 per_project_ids=None,
+                 query=None,
+                 complete=True):
         """Represents the result of a sanity check.
 
         Args:
             success: True if the check succeeded.
             message: If success is True, this should be set to None. If success
                 is False, this contains a message explaining the check failure.
+            per_month_ids: A list of test_id values that appeared only in the
+                per-month tables.
+            per_project_ids: A list of test_id values that appeared only in the
+                per-project table.
+            query: The SQL query that performed the check, if known.
+            complete: False if the check fetched only some of the mismatched
+                test_id values, so per_month_ids and per_project_ids are a
+                subset of them.
         """
         self._success = success
         self._message = message
+        self._per_month_ids = per_month_ids or []
+        self._per_project_ids = per_project_ids or []
+        self._query = query
+        self._complete = complete
 
     @property
     def success(self):
@@ -123,6 +201,26 @@ class CheckResult(object):
         """On check failure, contains a message explaining the failure."""
         return self._message
 
+    @property
+    def per_month_ids(self):
+        """The test_id values that appeared only in the per-month tables."""
+        return self._per_month_ids
+
+    @property
+    def per_project_ids(self):
+        """The test_id values that appeared only in the per-project table."""
+        return self._per_project_ids
+
+    @property
+    def query(self):
+        """The SQL query that performed the check, or None if unknown."""
+        return self._query
+
+    @property
+    def complete(self):
+        """Whether the test_id lists hold all of the mismatched test_ids."""
+        return self._complete
+
 
 class TableEquivalenceChecker(object):
     """Checker to verify that two BigQuery tables contain equivalent rows.
@@ -134,18 +232,34 @@ class TableEquivalenceChecker(object):
     order to create a CheckResult object indicating if the check failed and why.
     """
 
-    def __init__(self, query_generator_factory, query_executor):
+    def __init__(self,
+                 query_generator_factory,
+                 query_executor,
+                 details=DETAILS_FULL):
         """Creates a new TableEquivalenceChecker.
 
         Args:
             query_generator_factory: Factory to create
                 TableEquivalenceQueryGenerator instances.
             query_executor: Executor for BigQuery SQL queries.
+            details: How much detail to fetch about the test_id values of a
+                failed window, one of DETAILS.
+
+        Raises:
+            ValueError: If details is not one of DETAILS.
         """
+        if details not in DETAILS:
+            raise ValueError('Unknown level of details: %s' % details)
         self._query_generator_factory = query_generator_factory
         self._query_executor = query_executor
-
-    def check(self, project, time_range_start, time_range_end):
+        self._row_limit = _DETAIL_ROW_LIMITS[details]
+
+    def check(self,
+              project,
+              time_range_start,
+              time_range_end,
+              shard_count=1,
+              shard_index=0):
         """Perform a table equivalence check for a project in a time window.
 
         Given an M-Lab project and a time window, checks that the per-month
@@ -158,20 +272,51 @@ class TableEquivalenceChecker(object):
                 query (as datetime).
             time_range_end: End of time window (not inclusive) for which to
                 generate query (as datetime).
+            shard_count: Number of test_id hash shards the time window is split
+                into. A value of 1 checks the whole window.
+            shard_index: Index of the shard to check, in the range
+                [0, shard_count).
 
         Returns:
             A CheckResult object representing the result of the check.
         """
-        query = self._query_generator_factory.create(
-            project, time_range_start, time_range_end).generate_query()
+        with instrumentation.span('generate_query'), profiling.phase(
+                'generate_query'):
+            query_generator = self._query_generator_factory.create(
+                project,
+                time_range_start,
+                time_range_end,
+                shard_count=shard_count,
+                shard_index=shard_index)
+            if self._row_limit:
+                query = query_generator.generate_query(limit=self._row_limit)
+            else:
+                query = query_generator.generate_query()
         logger.debug('Performing table equivalence check. BigQuery SQL:%s',
                      formatting.indent(query))
-        query_result = self._query_executor.execute_query(query)
+        with instrumentation.span('execute_query'), profiling.phase(
+                'execute_query'):
+            query_result = self._query_executor.execute_query(query)
         if query_result:
             # Non-empty results of the query indicates that the check failed.
-            per_month_ids, per_project_ids = _parse_query_result(query_result)
-            message = _format_check_failure_message(per_month_ids,
-                                                    per_project_ids, query)
-            return CheckResult(success=False, message=message)
+            with instrumentation.span('parse_results'), profiling.phase(
+                    'parse_results', measure_memory=True):
+                per_month_ids, per_project_ids = _parse_query_result(
+                    query_result)
+            # Each row of the results holds one mismatched test_id.
+            complete = not (
+                self._row_limit and
+                len(per_month_ids) + len(per_project_ids) >= self._row_limit)
+            with instrumentation.span('format_message'), profiling.phase(
+                    'format_message', measure_memory=True):
+                message = _format_check_failure_message(
+                    per_month_ids, per_project_ids, query, None
+                    if complete else self._row_limit)
+            return CheckResult(success=False,
+                               message=message,
+                               per_month_ids=per_month_ids,
+                               per_project_ids=per_project_ids,
+                               query=query,
+                               complete=complete)
         else:
-            return CheckResult(success=True)
+            return CheckResult(success=True, query=query)
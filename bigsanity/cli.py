@@ -20,14 +20,62 @@ import datetime
 
 from dateutil import relativedelta
 
+# Multipliers for the unit suffixes accepted in byte count arguments.
+_BYTE_UNITS = {
+    'K': 1024,
+    'M': 1024**2,
+    'G': 1024**3,
+    'T': 1024**4,
+    'P': 1024**5,
+}
+
 # Format of dates when entered as command line arguments or printed to the
 # console.
 DATE_FORMAT = '%Y-%m-%d'
+# Format of times that do not fall on midnight, when entered as command line
+# arguments or printed to the console.
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M'
 
 
 def parse_date_arg(date_arg):
-    """Parses a date command line parameter string into a datetime."""
-    return datetime.datetime.strptime(date_arg, DATE_FORMAT)
+    """Parses a date command line parameter string into a datetime.
+
+    Accepts either a plain date (e.g. 2016-01-11) or a date with a time of day
+    (e.g. 2016-01-11T06:00).
+    """
+    try:
+        return datetime.datetime.strptime(date_arg, DATE_FORMAT)
+    except ValueError:
+        return datetime.datetime.strptime(date_arg, DATETIME_FORMAT)
+
+
+def format_time(dt):
+    """Formats a datetime to be printed to the console.
+
+    Times that fall on midnight are printed as plain dates, so that output for
+    whole-day time windows is unchanged. Other times include the time of day.
+    """
+    if dt.time() == datetime.time():
+        return dt.strftime(DATE_FORMAT)
+    return dt.strftime(DATETIME_FORMAT)
+
+
+def parse_interval_hours_arg(hours_arg):
+    """Parses the interval hours command line string into an interval.
+
+    Args:
+       hours_arg: A string representing a number of hours in an interval.
+
+    Returns:
+        A relativedelta value parsed from the time interval.
+
+    Raises:
+        ValueError: If the supplied hours argument is not positive.
+    """
+    hours = int(hours_arg)
+    if hours <= 0:
+        raise ValueError('Interval value must be a positive number: %d' % hours)
+    return relativedelta.relativedelta(hours=hours)
 
 
 def parse_interval_days_arg(days_arg):
@@ -67,6 +115,109 @@ def parse_interval_months_arg(months_arg):
     return relativedelta.relativedelta(months=months)
 
 
+def parse_shard_count_arg(shards_arg):
+    """Parses the shard count command line string into a number of shards.
+
+    Args:
+       shards_arg: A string representing the number of test_id hash shards to
+           split each time window into.
+
+    Returns:
+        The number of shards as an int.
+
+    Raises:
+        ValueError: If the supplied shard count is not positive.
+    """
+    shards = int(shards_arg)
+    if shards <= 0:
+        raise ValueError('Shard count must be a positive number: %d' % shards)
+    return shards
+
+
+def parse_bytes_arg(bytes_arg):
+    """Parses a byte count command line string into a number of bytes.
+
+    Args:
+       bytes_arg: A string representing a number of bytes, optionally followed
+           by a binary unit suffix of K, M, G, T, or P (e.g. '500G').
+
+    Returns:
+        The number of bytes as an int.
+
+    Raises:
+        ValueError: If the supplied byte count is not positive.
+    """
+    multiplier = 1
+    suffix = bytes_arg[-1:].upper()
+    if suffix in _BYTE_UNITS:
+        multiplier = _BYTE_UNITS[suffix]
+        bytes_arg = bytes_arg[:-1]
+    num_bytes = int(bytes_arg) * multiplier
+    if num_bytes <= 0:
+        raise ValueError('Byte count must be a positive number: %d' % num_bytes)
+    return num_bytes
+
+
+def parse_positive_int_arg(int_arg):
+    """Parses a command line string into a positive integer.
+
+    Raises:
+        ValueError: If the supplied argument is not a positive integer.
+    """
+    value = int(int_arg)
+    if value <= 0:
+        raise ValueError('Value must be a positive number: %d' % value)
+    return value
+
+
+def parse_positive_float_arg(float_arg):
+    """Parses a command line string into a positive floating point number.
+
+    Raises:
+        ValueError: If the supplied argument is not a positive number.
+    """
+    value = float(float_arg)
+    if value <= 0:
+        raise ValueError('Value must be a positive number: %s' % value)
+    return value
+
+
+def parse_sample_rate_arg(rate_arg):
+    """Parses a command line string into a sample rate.
+
+    Raises:
+        ValueError: If the supplied argument is not in the range (0, 1].
+    """
+    value = float(rate_arg)
+    if not 0 < value <= 1:
+        raise ValueError('Sample rate must be in the range (0, 1]: %s' % value)
+    return value
+
+
+def parse_project_weight_arg(weight_arg):
+    """Parses a project weight command line string of the form PROJECT:WEIGHT.
+
+    For example, '0:3' gives project 0 three times the share of concurrent
+    queries of a project with the default weight of 1.
+
+    Returns:
+        A (project, weight) 2-tuple of an int project ID and a float weight.
+
+    Raises:
+        ValueError: If the weight is malformed or not positive.
+    """
+    try:
+        project, weight = weight_arg.split(':')
+        project = int(project)
+        weight = float(weight)
+    except ValueError:
+        raise ValueError('Project weight must have the form PROJECT:WEIGHT: '
+                         '%s' % weight_arg)
+    if project < 0 or weight <= 0:
+        raise ValueError('Project weight must be positive: %s' % weight_arg)
+    return project, weight
+
+
 def get_interval(args):
     """Given BigSanity's command line arguments, retrieves the interval value.
 
@@ -83,12 +234,14 @@ def get_interval(args):
 
     Raises:
         ValueError: If the user did not specify a value for the
-            --interval_days or --interval_months parameters.
+            --interval_hours, --interval_days or --interval_months parameters.
     """
-    if args.interval_days:
+    if args.interval_hours:
+        return args.interval_hours
+    elif args.interval_days:
         return args.interval_days
     elif args.interval_months:
         return args.interval_months
     else:
-        raise ValueError(
-            'Must specify at least one of --interval_days or --interval_months')
+        raise ValueError('Must specify at least one of --interval_hours, '
+                         '--interval_days or --interval_months')
@@ -0,0 +1,91 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Estimates the BigQuery cost of sanity checks without running them."""
+
+import logging
+
+import formatting
+import scan_checks
+
+logger = logging.getLogger(__name__)
+
+
+class CostEstimator(object):
+    """Estimates the number of bytes a table equivalence check would process.
+
+    Uses the same query generator as TableEquivalenceChecker to create the
+    query for a time window, then asks the query executor for a dry run
+    estimate of the bytes that query would process. BigQuery bills by bytes
+    processed, so this is a direct estimate of the cost of the check.
+
+    With scan checks, the estimate includes their shared aggregate query. The
+    follow-up query of DuplicateTestIdCheck is not included, because it only
+    runs when the aggregate query finds likely duplicates.
+    """
+
+    def __init__(self, query_generator_factory, query_executor, checks=None):
+        """Creates a new CostEstimator.
+
+        Args:
+            query_generator_factory: Factory to create
+                TableEquivalenceQueryGenerator instances.
+            query_executor: Executor for BigQuery SQL queries that supports dry
+                runs.
+            checks: An optional list of ScanCheck that run on every window in
+                addition to the table equivalence check.
+        """
+        self._query_generator_factory = query_generator_factory
+        self._query_executor = query_executor
+        self._checks = checks or []
+
+    def estimate(self,
+                 project,
+                 time_range_start,
+                 time_range_end,
+                 shard_count=1,
+                 shard_index=0):
+        """Estimates the bytes processed by a check for a time window.
+
+        Args:
+            project: Numerical ID of M-Lab project in BigQuery (e.g. NDT = 0).
+            time_range_start: Start of window (inclusive) for which to generate
+                query (as datetime).
+            time_range_end: End of time window (not inclusive) for which to
+                generate query (as datetime).
+            shard_count: Number of test_id hash shards the time window is split
+                into.
+            shard_index: Index of the shard to estimate.
+
+        Returns:
+            The number of bytes BigQuery would process to perform the check
+            and its scan checks.
+        """
+        query_generator = self._query_generator_factory.create(
+            project,
+            time_range_start,
+            time_range_end,
+            shard_count=shard_count,
+            shard_index=shard_index)
+        queries = [query_generator.generate_query()]
+        if self._checks:
+            scan_query = scan_checks.generate_scan_query(query_generator,
+                                                         self._checks)
+            if scan_query:
+                queries.append(scan_query)
+        total_bytes = 0
+        for query in queries:
+            logger.debug('Estimating cost of query:%s',
+                         formatting.indent(query))
+            total_bytes += self._query_executor.estimate_query_bytes(query)
+        return total_bytes
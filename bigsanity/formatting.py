@@ -42,3 +42,28 @@ def indent(s, spaces=2):
         raise ValueError('spaces must be non-negative, but was %d' % spaces)
     spacing = ' ' * spaces
     return spacing + s.replace('\n', '\n' + spacing)
+
+
+def format_bytes(num_bytes):
+    """Formats a number of bytes as a human-readable string.
+
+    For example, 1536 becomes '1.5 KiB' and 3 * 2**40 becomes '3.0 TiB'.
+
+    Args:
+        num_bytes: The number of bytes to format. Must be >= 0.
+
+    Returns:
+        The number of bytes in the largest binary unit for which the value is
+        at least 1.
+    """
+    if num_bytes < 1024:
+        return '%d B' % num_bytes
+    value = float(num_bytes)
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        value /= 1024
+        if value < 1024:
+            break
+    else:
+        unit = 'PiB'
+        value /= 1024
+    return '%.1f %s' % (value, unit)
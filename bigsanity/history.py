@@ -0,0 +1,353 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Stores the results of sanity checks from earlier runs in SQLite.
+
+Every run that is given a history database records the outcome of each time
+window it checks, and every test_id that was missing from one of the tables,
+so that later runs can tell which windows have failed before, and so that
+runs can be compared without new BigQuery scans or reparsing logs:
+
+    python bigsanity/history.py --history PATH first_missing TEST_ID
+    python bigsanity/history.py --history PATH new_anomalies
+    python bigsanity/history.py --history PATH monthly_failures
+"""
+
+import argparse
+import collections
+import datetime
+import re
+import sqlite3
+import threading
+import time
+
+import intervals
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id INTEGER PRIMARY KEY,
+    started_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS window_results (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    project INTEGER NOT NULL,
+    window_start INTEGER NOT NULL,
+    window_end INTEGER NOT NULL,
+    shard_count INTEGER NOT NULL,
+    shard_index INTEGER NOT NULL,
+    success INTEGER NOT NULL,
+    complete INTEGER NOT NULL DEFAULT 1,
+    checked_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS window_results_by_window
+    ON window_results (project, window_start, window_end);
+CREATE TABLE IF NOT EXISTS anomalies (
+    id INTEGER PRIMARY KEY,
+    run_id INTEGER NOT NULL REFERENCES runs (id),
+    window_result_id INTEGER NOT NULL REFERENCES window_results (id),
+    project INTEGER NOT NULL,
+    day INTEGER NOT NULL,
+    test_id TEXT NOT NULL,
+    missing_from TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS anomalies_by_day ON anomalies (project, day);
+CREATE INDEX IF NOT EXISTS anomalies_by_test_id ON anomalies (test_id, run_id);
+"""
+
+# Tables from which the test_id of an anomaly was missing.
+MISSING_FROM_PER_MONTH = 'per_month'
+MISSING_FROM_PER_PROJECT = 'per_project'
+
+# M-Lab test_id values start with the date of the test.
+_TEST_ID_DATE_PATTERN = re.compile(r'^(\d{4})/(\d{2})/(\d{2})/')
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+
+WindowStats = collections.namedtuple('WindowStats',
+                                     ['checks', 'failures', 'last_checked'])
+
+Anomaly = collections.namedtuple('Anomaly', ['run_id', 'checked_at', 'project',
+                                             'day', 'test_id', 'missing_from'])
+
+MonthlyFailures = collections.namedtuple(
+    'MonthlyFailures', ['project', 'month', 'windows', 'failures', 'anomalies'])
+
+
+def _anomaly_day(test_id, window_start):
+    """Returns the day (in seconds since the epoch) of a missing test.
+
+    The day is taken from the test_id, or is the start of the window if the
+    test_id does not start with a date.
+    """
+    match = _TEST_ID_DATE_PATTERN.match(test_id)
+    if match:
+        try:
+            return intervals.to_timestamp(datetime.datetime(* [int(
+                part) for part in match.groups()]))
+        except ValueError:
+            pass
+    timestamp = intervals.to_timestamp(window_start)
+    return timestamp - timestamp % _SECONDS_PER_DAY
+
+
+class CheckHistory(object):
+    """Thread-safe record of the check results of every run."""
+
+    def __init__(self, path, clock=time.time):
+        """Creates a new CheckHistory, creating the database if necessary.
+
+        Args:
+            path: Path of the SQLite database.
+            clock: Function that returns the current time in seconds.
+        """
+        self._clock = clock
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.text_factory = str
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+            self._add_complete_column()
+
+    def _add_complete_column(self):
+        """Adds the complete column to databases created without it."""
+        columns = [
+            row[1]
+            for row in self._connection.execute(
+                'PRAGMA table_info(window_results)')
+        ]
+        if 'complete' not in columns:
+            with self._connection:
+                self._connection.execute(
+                    'ALTER TABLE window_results ADD COLUMN complete INTEGER '
+                    'NOT NULL DEFAULT 1')
+
+    def start_run(self):
+        """Records the start of a run.
+
+        Returns:
+            The ID of the new run, to pass to record.
+        """
+        with self._lock, self._connection:
+            return self._connection.execute(
+                'INSERT INTO runs (started_at) VALUES (?)',
+                (self._clock(),)).lastrowid
+
+    def record(self,
+               run_id,
+               project,
+               window_start,
+               window_end,
+               check_result,
+               shard_count=1,
+               shard_index=0):
+        """Records the result of checking a time window.
+
+        Args:
+            run_id: ID of the run, as returned by start_run.
+            project: Numeric ID of the M-Lab project.
+            window_start: Start of the time window (as datetime).
+            window_end: End of the time window (as datetime).
+            check_result: The CheckResult of the window. If it is not
+                complete, its test_ids are recorded but the window is left out
+                of new_anomalies and the anomaly counts of monthly_failures.
+            shard_count: Number of shards the window was split into.
+            shard_index: Index of the shard that was checked.
+        """
+        anomalies = ([(test_id, MISSING_FROM_PER_PROJECT)
+                      for test_id in check_result.per_month_ids] + [
+                          (test_id, MISSING_FROM_PER_MONTH)
+                          for test_id in check_result.per_project_ids
+                      ])
+        with self._lock, self._connection:
+            window_result_id = self._connection.execute(
+                'INSERT INTO window_results (run_id, project, window_start, '
+                'window_end, shard_count, shard_index, success, complete, '
+                'checked_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (run_id, project, intervals.to_timestamp(window_start),
+                 intervals.to_timestamp(window_end), shard_count, shard_index,
+                 int(check_result.success), int(check_result.complete),
+                 self._clock())).lastrowid
+            self._connection.executemany(
+                'INSERT INTO anomalies (run_id, window_result_id, project, day, '
+                'test_id, missing_from) VALUES (?, ?, ?, ?, ?, ?)', (
+                    (run_id, window_result_id, project,
+                     _anomaly_day(test_id, window_start), test_id, missing_from)
+                    for test_id, missing_from in anomalies))
+
+    def window_stats(self, project, window_start, window_end):
+        """Summarizes the earlier checks of data in a time window.
+
+        Counts every recorded check of a window that overlaps the given window,
+        so that results carry over between runs that use different intervals.
+
+        Returns:
+            A WindowStats with the number of overlapping checks, how many of
+            them failed, and the time (in seconds since the epoch) of the most
+            recent one, or None if there were none.
+        """
+        with self._lock:
+            checks, failures, last_checked = self._connection.execute(
+                'SELECT COUNT(*), SUM(1 - success), MAX(checked_at) '
+                'FROM window_results WHERE project = ? AND window_start < ? '
+                'AND window_end > ?',
+                (project, intervals.to_timestamp(window_end),
+                 intervals.to_timestamp(window_start))).fetchone()
+        return WindowStats(checks, failures or 0, last_checked)
+
+    def latest_run_id(self):
+        """Returns the ID of the most recent run, or None if there are none."""
+        with self._lock:
+            return self._connection.execute(
+                'SELECT MAX(id) FROM runs').fetchone()[0]
+
+    def first_missing(self, test_id):
+        """Finds the first run in which a test_id was missing from a table.
+
+        Returns:
+            The earliest Anomaly recorded for the test_id, or None if it was
+            never missing.
+        """
+        with self._lock:
+            row = self._connection.execute(
+                'SELECT a.run_id, w.checked_at, a.project, a.day, a.test_id, '
+                'a.missing_from FROM anomalies a JOIN window_results w ON '
+                'w.id = a.window_result_id WHERE a.test_id = ? '
+                'ORDER BY a.run_id, w.checked_at LIMIT 1',
+                (test_id,)).fetchone()
+        return Anomaly(*row) if row else None
+
+    def new_anomalies(self, run_id=None):
+        """Lists the anomalies of a run that no earlier run recorded.
+
+        Windows whose check did not fetch every missing test_id are left out,
+        since only some of their anomalies were recorded.
+
+        Args:
+            run_id: ID of the run, or None for the most recent run.
+
+        Returns:
+            A list of Anomaly, ordered by project, day and test_id.
+        """
+        if run_id is None:
+            run_id = self.latest_run_id()
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT a.run_id, w.checked_at, a.project, a.day, a.test_id, '
+                'a.missing_from FROM anomalies a JOIN window_results w ON '
+                'w.id = a.window_result_id WHERE a.run_id = ? AND w.complete '
+                'AND NOT EXISTS ('
+                'SELECT 1 FROM anomalies earlier WHERE earlier.test_id = '
+                'a.test_id AND earlier.run_id < a.run_id AND earlier.project = '
+                'a.project AND earlier.missing_from = a.missing_from) '
+                'ORDER BY a.project, a.day, a.test_id', (run_id,)).fetchall()
+        return [Anomaly(*row) for row in rows]
+
+    def monthly_failures(self, project=None):
+        """Counts failed windows and anomalies for each month of data.
+
+        Every recorded check counts, so a window that failed in several runs
+        counts several times. Anomalies are only counted for windows whose
+        check fetched every missing test_id.
+
+        Args:
+            project: Numeric ID of the M-Lab project to count, or None to count
+                every project.
+
+        Returns:
+            A list of MonthlyFailures, ordered by project and month, where
+            month is a string such as '2016-01'.
+        """
+        project_filter = ''
+        parameters = ()
+        if project is not None:
+            project_filter = 'WHERE project = ? '
+            parameters = (project,)
+        with self._lock:
+            window_rows = self._connection.execute(
+                "SELECT project, strftime('%%Y-%%m', window_start, 'unixepoch') "
+                'AS month, COUNT(*), SUM(1 - success) FROM window_results %s'
+                'GROUP BY project, month' % project_filter,
+                parameters).fetchall()
+            anomaly_rows = self._connection.execute(
+                "SELECT a.project, strftime('%%Y-%%m', a.day, 'unixepoch') AS "
+                'month, COUNT(*) FROM anomalies a JOIN window_results w ON '
+                'w.id = a.window_result_id WHERE w.complete %s'
+                'GROUP BY a.project, month' %
+                project_filter.replace('WHERE project', 'AND a.project'),
+                parameters).fetchall()
+        anomaly_counts = dict(((row[0], row[1]), row[2])
+                              for row in anomaly_rows)
+        months = dict(((project, month),
+                       MonthlyFailures(project, month, windows, failures,
+                                       anomaly_counts.get((project, month), 0)))
+                      for project, month, windows, failures in window_rows)
+        for key, anomalies in anomaly_counts.items():
+            if key not in months:
+                months[key] = MonthlyFailures(key[0], key[1], 0, 0, anomalies)
+        return [months[key] for key in sorted(months)]
+
+
+def _format_anomaly(anomaly):
+    return '%s  project=%d  day=%s  run=%d  missing from %s table' % (
+        anomaly.test_id, anomaly.project,
+        intervals.from_timestamp(anomaly.day).strftime('%Y-%m-%d'),
+        anomaly.run_id, anomaly.missing_from.replace('_', '-'))
+
+
+def main(args):
+    check_history = CheckHistory(args.history)
+    if args.query == 'first_missing':
+        anomaly = check_history.first_missing(args.test_id)
+        if anomaly is None:
+            print('%s was never missing.' % args.test_id)
+        else:
+            print(_format_anomaly(anomaly))
+    elif args.query == 'new_anomalies':
+        for anomaly in check_history.new_anomalies(args.run_id):
+            print(_format_anomaly(anomaly))
+    else:
+        print('project  month    windows  failures  anomalies')
+        for months in check_history.monthly_failures(args.project):
+            print('%7d  %s  %7d  %8d  %9d' % months)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='BigSanity: Check History Queries',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--history',
+                        metavar='PATH',
+                        required=True,
+                        help='Path of the history database of BigSanity runs.')
+    subparsers = parser.add_subparsers(dest='query')
+    first_missing_parser = subparsers.add_parser(
+        'first_missing',
+        help='Show the first run in which a test_id was missing from a table.')
+    first_missing_parser.add_argument('test_id')
+    new_anomalies_parser = subparsers.add_parser(
+        'new_anomalies',
+        help=('List the missing test_ids of a run that no earlier run '
+              'recorded.'))
+    new_anomalies_parser.add_argument(
+        '--run_id',
+        type=int,
+        help='ID of the run. Defaults to the most recent run.')
+    monthly_failures_parser = subparsers.add_parser(
+        'monthly_failures',
+        help='Count failed windows and missing test_ids per month of data.')
+    monthly_failures_parser.add_argument('-p',
+                                         '--project',
+                                         type=int,
+                                         help='Only count this project.')
+    main(parser.parse_args())
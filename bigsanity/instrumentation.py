@@ -0,0 +1,342 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Records per-window timing and cost metrics for sanity checks.
+
+The driver binds a WindowMetrics object to the thread that checks a time
+window. Code deeper in the check pipeline (the checker and the query executor)
+records timing spans and query statistics through the module-level functions
+below, which do nothing when no metrics are bound. This keeps the
+instrumentation out of the interfaces between pipeline stages.
+
+Stages can nest: the query stages (execute_query, execute_scan_query and
+execute_duplicate_query) enclose the concurrency_wait, bq_startup, bq_wait and
+bq_job_statistics stages of the bq calls they make, and bigquery_execution is
+the part of bq_wait that BigQuery reports it spent executing the job. Stage
+times are therefore not additive across stages.
+"""
+
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+
+import formatting
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class WindowMetrics(object):
+    """Timing and cost metrics for the check of a single time window."""
+
+    def __init__(self,
+                 project,
+                 time_range_start,
+                 time_range_end,
+                 shard_count=1,
+                 shard_index=0,
+                 clock=time.time):
+        """Creates a new WindowMetrics and starts its wall clock.
+
+        Args:
+            project: Numerical ID of M-Lab project in BigQuery (e.g. NDT = 0).
+            time_range_start: Start of the time window (as datetime).
+            time_range_end: End of the time window (as datetime).
+            shard_count: Number of test_id hash shards the window is split
+                into.
+            shard_index: Index of the shard being checked.
+            clock: Function that returns the current time in seconds.
+        """
+        self.project = project
+        self.time_range_start = time_range_start
+        self.time_range_end = time_range_end
+        self.shard_count = shard_count
+        self.shard_index = shard_index
+        self.success = None
+        self.bytes_processed = None
+        self.rows_returned = None
+        self.concurrency_limit = None
+        self._clock = clock
+        self._start_time = clock()
+        self._end_time = None
+        self._stage_seconds = {}
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, stage):
+        """Context manager that adds the time spent inside it to a stage."""
+        start_time = self._clock()
+        try:
+            yield
+        finally:
+            self.add_stage_time(stage, self._clock() - start_time)
+
+    def add_stage_time(self, stage, seconds):
+        """Adds time (in seconds) to a stage of the check pipeline."""
+        with self._lock:
+            self._stage_seconds[stage] = (
+                self._stage_seconds.get(stage, 0.0) + seconds)
+
+    def add_bytes_processed(self, bytes_processed):
+        """Adds the bytes processed by one of the window's queries."""
+        with self._lock:
+            self.bytes_processed = (self.bytes_processed or 0) + bytes_processed
+
+    def add_rows_returned(self, rows_returned):
+        """Adds the rows returned by one of the window's queries."""
+        with self._lock:
+            self.rows_returned = (self.rows_returned or 0) + rows_returned
+
+    def fork(self):
+        """Returns empty metrics for the same window, to merge in later.
+
+        Work that may turn out not to count, such as a hedged query attempt
+        that loses its race, records to a fork that is merged only if needed.
+        """
+        return WindowMetrics(self.project,
+                             self.time_range_start,
+                             self.time_range_end,
+                             shard_count=self.shard_count,
+                             shard_index=self.shard_index,
+                             clock=self._clock)
+
+    def merge(self, other):
+        """Adds the stage times and query statistics of other to these."""
+        for stage, seconds in other.stage_seconds.items():
+            self.add_stage_time(stage, seconds)
+        if other.bytes_processed is not None:
+            self.add_bytes_processed(other.bytes_processed)
+        if other.rows_returned is not None:
+            self.add_rows_returned(other.rows_returned)
+        if other.concurrency_limit is not None:
+            self.concurrency_limit = other.concurrency_limit
+
+    def finish(self, success):
+        """Stops the wall clock and records the outcome of the check."""
+        self.success = success
+        self._end_time = self._clock()
+
+    @property
+    def duration(self):
+        """Wall clock seconds from creation until finish (or now)."""
+        end_time = self._end_time
+        if end_time is None:
+            end_time = self._clock()
+        return end_time - self._start_time
+
+    @property
+    def stage_seconds(self):
+        """A dictionary of stage name to seconds spent in that stage."""
+        with self._lock:
+            return dict(self._stage_seconds)
+
+    def to_dict(self):
+        """Returns the metrics as a dictionary that can be encoded as JSON."""
+        return {
+            'project': self.project,
+            'time_range_start': self.time_range_start.isoformat(),
+            'time_range_end': self.time_range_end.isoformat(),
+            'shard_count': self.shard_count,
+            'shard_index': self.shard_index,
+            'success': self.success,
+            'duration_seconds': self.duration,
+            'stage_seconds': self.stage_seconds,
+            'bytes_processed': self.bytes_processed,
+            'rows_returned': self.rows_returned,
+            'concurrency_limit': self.concurrency_limit,
+        }
+
+    def describe(self):
+        """Returns a short description of the window for log messages."""
+        description = 'project=%d, %s -> %s' % (
+            self.project, self.time_range_start.isoformat(),
+            self.time_range_end.isoformat())
+        if self.shard_count > 1:
+            description += ', shard %d/%d' % (self.shard_index + 1,
+                                              self.shard_count)
+        return description
+
+
+def current_metrics():
+    """Returns the WindowMetrics bound to this thread, or None."""
+    return getattr(_local, 'metrics', None)
+
+
+@contextlib.contextmanager
+def bind(metrics):
+    """Context manager that binds metrics to this thread while inside it."""
+    previous = current_metrics()
+    _local.metrics = metrics
+    try:
+        yield
+    finally:
+        _local.metrics = previous
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Times a stage of the check against this thread's metrics, if any."""
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+        return
+    with metrics.span(stage):
+        yield
+
+
+def add_stage_time(stage, seconds):
+    """Adds time to a stage of this thread's metrics, if any."""
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_stage_time(stage, seconds)
+
+
+def add_bytes_processed(bytes_processed):
+    """Adds the bytes processed by this thread's query, if instrumented."""
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_bytes_processed(bytes_processed)
+
+
+def add_rows_returned(rows_returned):
+    """Adds the rows returned by this thread's query, if instrumented."""
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.add_rows_returned(rows_returned)
+
+
+def set_concurrency_limit(concurrency_limit):
+    """Records the adaptive concurrency limit this thread's query ran under."""
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.concurrency_limit = concurrency_limit
+
+
+def _escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+
+class MetricsRecorder(object):
+    """Thread-safe collector for the metrics of every checked window."""
+
+    def __init__(self, jsonl_file=None):
+        """Creates a new MetricsRecorder.
+
+        Args:
+            jsonl_file: File object to which each window's metrics are written
+                as a line of JSON as soon as they are recorded, or None.
+        """
+        self._jsonl_file = jsonl_file
+        self._windows = []
+        self._lock = threading.Lock()
+
+    def record(self, metrics):
+        """Records the metrics of a window whose check has finished."""
+        with self._lock:
+            self._windows.append(metrics)
+            if self._jsonl_file:
+                self._jsonl_file.write(json.dumps(metrics.to_dict(),
+                                                  sort_keys=True) + '\n')
+                self._jsonl_file.flush()
+
+    def write_prometheus_textfile(self, path):
+        """Writes aggregate metrics in the Prometheus textfile format.
+
+        The file is written atomically, so that a collector (e.g. the node
+        exporter's textfile collector) never reads a partial file.
+
+        Args:
+            path: Path of the file to write.
+        """
+        with self._lock:
+            windows = list(self._windows)
+        status_counts = {}
+        project_bytes = {}
+        stage_seconds = {}
+        for metrics in windows:
+            status = 'success' if metrics.success else 'failure'
+            key = (metrics.project, status)
+            status_counts[key] = status_counts.get(key, 0) + 1
+            project_bytes[metrics.project] = (
+                project_bytes.get(metrics.project, 0) +
+                (metrics.bytes_processed or 0))
+            for stage, seconds in metrics.stage_seconds.items():
+                stage_seconds[stage] = stage_seconds.get(stage, 0.0) + seconds
+        lines = [
+            '# HELP bigsanity_windows_total Time windows checked.',
+            '# TYPE bigsanity_windows_total counter',
+        ]
+        for (project, status), count in sorted(status_counts.items()):
+            lines.append('bigsanity_windows_total{project="%s",status="%s"} %d'
+                         % (_escape_label(project), status, count))
+        lines.extend([
+            '# HELP bigsanity_bytes_processed_total Bytes processed by '
+            'BigQuery.',
+            '# TYPE bigsanity_bytes_processed_total counter',
+        ])
+        for project, num_bytes in sorted(project_bytes.items()):
+            lines.append('bigsanity_bytes_processed_total{project="%s"} %d' %
+                         (_escape_label(project), num_bytes))
+        lines.extend([
+            '# HELP bigsanity_stage_seconds_total Time spent in each stage of '
+            'the check pipeline. Stages nest: execute_query, '
+            'execute_scan_query and execute_duplicate_query include '
+            'concurrency_wait, bq_startup, bq_wait and bq_job_statistics, so '
+            'stages do not add up to the total time.',
+            '# TYPE bigsanity_stage_seconds_total counter',
+        ])
+        for stage, seconds in sorted(stage_seconds.items()):
+            lines.append('bigsanity_stage_seconds_total{stage="%s"} %f' %
+                         (_escape_label(stage), seconds))
+        limited = [m for m in windows if m.concurrency_limit is not None]
+        if limited:
+            lines.extend([
+                '# HELP bigsanity_concurrency_limit Adaptive limit on concurrent '
+                'queries when the last checked window ran.',
+                '# TYPE bigsanity_concurrency_limit gauge',
+                'bigsanity_concurrency_limit %d' %
+                limited[-1].concurrency_limit,
+            ])
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as textfile:
+            textfile.write('\n'.join(lines) + '\n')
+        os.rename(temp_path, path)
+
+    def log_summary(self, count=5):
+        """Logs the slowest and the most expensive windows.
+
+        Args:
+            count: Number of windows to list in each category.
+        """
+        with self._lock:
+            windows = list(self._windows)
+        if not windows:
+            return
+        slowest = sorted(windows,
+                         key=lambda m: m.duration,
+                         reverse=True)[:count]
+        logger.info('Slowest time windows:\n%s', formatting.indent('\n'.join(
+            '%.1fs  %s' % (m.duration, m.describe()) for m in slowest)))
+        with_bytes = [m for m in windows if m.bytes_processed is not None]
+        if with_bytes:
+            most_expensive = sorted(with_bytes,
+                                    key=lambda m: m.bytes_processed,
+                                    reverse=True)[:count]
+            logger.info(
+                'Most expensive time windows:\n%s',
+                formatting.indent('\n'.join('%s  %s' % (formatting.format_bytes(
+                    m.bytes_processed), m.describe()) for m in most_expensive)))
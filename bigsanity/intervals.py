@@ -12,8 +12,17 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
 
-def date_limits_to_intervals(date_start, date_end, date_step):
+from dateutil import relativedelta
+
+_EPOCH = datetime.datetime(1970, 1, 1)
+
+
+def date_limits_to_intervals(date_start,
+                             date_end,
+                             date_step,
+                             align_to_months=False):
     """Convert a date range and step to a series of date intervals.
 
     Given a date start, end, and step, creates a list of 2-tuples of
@@ -37,12 +46,32 @@ def date_limits_to_intervals(date_start, date_end, date_step):
          (datetime.datetime(2015, 3, 1),
           datetime.datetime(2015, 4, 1)),]
 
+    If align_to_months is True, an interval that would end partway into a later
+    month is cut short at the start of that month, so intervals never end in
+    the middle of a month other than the one they start in. This keeps the
+    number of M-Lab per-month tables each interval reads to a minimum. The
+    interval before a month border is extended to the border when the
+    leftover would be shorter than half a step, so that there are no tiny
+    windows that cost a query each. With the arguments above and a step of 10
+    days, an aligned series would contain:
+
+        [...
+         (datetime.datetime(2015, 1, 11),
+          datetime.datetime(2015, 1, 21)),
+         (datetime.datetime(2015, 1, 21),
+          datetime.datetime(2015, 2, 1)),
+         (datetime.datetime(2015, 2, 1),
+          datetime.datetime(2015, 2, 11)),
+         ...]
+
     Args:
         date_start: A datetime indicating the start of the date range
             (inclusive).
         date_end: A datetime indicating the end of the date range (exclusive).
         date_step: A relativedelta indicating how large the date intervals
             should be. This must be a positive delta.
+        align_to_months: Whether to snap interval boundaries to the start of
+            calendar months.
 
     Returns:
         A list of 2-tuples of (start, end) datetimes to fill the date range.
@@ -51,6 +80,88 @@ def date_limits_to_intervals(date_start, date_end, date_step):
     interval_start = date_start
     while interval_start < date_end:
         interval_end = min(interval_start + date_step, date_end)
+        if align_to_months:
+            month_boundary = start_of_month(interval_end)
+            if interval_start < month_boundary:
+                interval_end = month_boundary
+            else:
+                interval_end = _absorb_leftover(interval_start, interval_end,
+                                                date_step, date_end)
         intervals.append((interval_start, interval_end))
         interval_start = interval_end
     return intervals
+
+
+def grid_intervals(date_start, date_end, date_step):
+    """Convert a date range to intervals cut on a fixed grid of date_step.
+
+    Unlike date_limits_to_intervals, the interval boundaries do not depend on
+    date_start: the grid starts at the Unix epoch, so that ranges that overlap
+    share the same intervals. Only the first and last intervals are cut short
+    to fit the range. For example, with a step of one day, a range from noon
+    on 2015-01-01 to 2015-01-03 yields:
+
+        [(datetime.datetime(2015, 1, 1, 12),
+          datetime.datetime(2015, 1, 2)),
+         (datetime.datetime(2015, 1, 2),
+          datetime.datetime(2015, 1, 3))]
+
+    Args:
+        date_start: A datetime indicating the start of the date range
+            (inclusive).
+        date_end: A datetime indicating the end of the date range (exclusive).
+        date_step: A relativedelta indicating how large the date intervals
+            should be. This must be a positive delta.
+
+    Returns:
+        A list of 2-tuples of (start, end) datetimes to fill the date range.
+    """
+    grid_start = _grid_start(date_start, date_step)
+    return [(max(start, date_start), end)
+            for start, end in date_limits_to_intervals(grid_start, date_end,
+                                                       date_step)
+            if end > date_start]
+
+
+def to_timestamp(dt):
+    """Converts a naive UTC datetime to seconds since the Unix epoch."""
+    return int((dt - _EPOCH).total_seconds())
+
+
+def from_timestamp(timestamp):
+    """Converts seconds since the Unix epoch to a naive UTC datetime."""
+    # Avoids strptime(), which is not thread-safe on first use in Python 2.
+    return _EPOCH + datetime.timedelta(seconds=timestamp)
+
+
+def start_of_month(dt):
+    """Returns midnight on the first day of the month containing dt."""
+    return dt.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def _absorb_leftover(interval_start, interval_end, date_step, date_end):
+    """Extends an interval to the month border if the leftover is short.
+
+    Returns:
+        The end of the interval: the start of the next month when it is no
+        later than date_end and the time left before it is less than half of
+        date_step, or interval_end otherwise.
+    """
+    border = (
+        start_of_month(interval_start) + relativedelta.relativedelta(months=1))
+    step_length = (interval_start + date_step) - interval_start
+    if border <= date_end and (border - interval_end) * 2 < step_length:
+        return border
+    return interval_end
+
+
+def _grid_start(dt, date_step):
+    """Returns the last boundary of the date_step grid at or before dt."""
+    step_months = date_step.years * 12 + date_step.months
+    if step_months:
+        months = (dt.year - _EPOCH.year) * 12 + dt.month - 1
+        months -= months % step_months
+        return datetime.datetime(_EPOCH.year + months // 12, months % 12 + 1, 1)
+    step_seconds = int(((dt + date_step) - dt).total_seconds())
+    timestamp = to_timestamp(dt)
+    return from_timestamp(timestamp - timestamp % step_seconds)
@@ -0,0 +1,412 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Executes BigSanity's queries against a local SQLite database.
+
+SqliteQueryExecutor is a stand-in for QueryExecutor that needs neither bq nor
+BigQuery. It translates the BigQuery legacy SQL features that BigSanity's
+queries use into SQLite, so the generated SQL can be exercised end to end, and
+whole sweeps can be reproduced and benchmarked offline.
+
+The translation covers:
+
+    * Table references such as plx.google:m_lab.2015_01.all, which become
+      quoted SQLite table names.
+    * Comma-separated tables or subqueries in a FROM clause, which legacy SQL
+      treats as a UNION ALL.
+    * The EACH modifier of JOIN and GROUP BY, which SQLite does not need.
+    * Nested record fields such as web100_log_entry.log_time, which are stored
+      as flat columns with a dot in their name.
+    * Output column names: legacy SQL names a selected column
+      per_month.test_id as per_month_test_id.
+    * Functions that SQLite lacks, such as HASH, STRING, INTEGER and
+      BIT_XOR.
+
+SQLite 3.39 or later is required for FULL OUTER JOIN support.
+"""
+
+import csv
+import hashlib
+import io
+import re
+import sqlite3
+import struct
+import threading
+import time
+
+import query_execution
+
+# Columns of the M-Lab tables that local databases provide. Nested fields are
+# flattened into columns named <record>.<field>.
+MLAB_COLUMNS = ('test_id', 'project', 'log_time', 'web100_log_entry.log_time',
+                'web100_log_entry.is_last_entry')
+
+# Assumed size of each column value, used to estimate bytes processed.
+_ESTIMATED_BYTES_PER_VALUE = 8
+
+# Names of record types whose fields legacy SQL accesses with dot notation.
+_NESTED_RECORDS = ('web100_log_entry', 'connection_spec',
+                   'paris_traceroute_hop')
+
+# A legacy SQL table reference, e.g. plx.google:m_lab.2015_01.all.
+_TABLE_REFERENCE = r'[\w-]+(?:\.[\w-]+)*:[\w-]+(?:\.[\w-]+)*'
+_TABLE_LIST_PATTERN = re.compile(r'\bFROM(\s+)(%s(?:\s*,\s*%s)*)' %
+                                 (_TABLE_REFERENCE, _TABLE_REFERENCE))
+_TABLE_REFERENCE_PATTERN = re.compile(_TABLE_REFERENCE)
+_EACH_PATTERN = re.compile(r'\b(JOIN|GROUP)\s+EACH\b', re.IGNORECASE)
+_NESTED_FIELD_PATTERN = re.compile(r'\b(%s)\.(\w+)' % '|'.join(_NESTED_RECORDS))
+_COMMENT_PATTERN = re.compile(r'--[^\n]*')
+_QUALIFIED_COLUMN_PATTERN = re.compile(r'^\s*(\w+)\.(\w+)\s*$')
+_FROM_PATTERN = re.compile(r'\bFROM\b', re.IGNORECASE)
+# A table name in translated SQL. Only table names contain a colon.
+_QUOTED_TABLE_PATTERN = re.compile(r'"[^"]*:[^"]*"')
+
+
+def _hash(value):
+    """Stand-in for BigQuery's HASH function (a signed 64-bit hash)."""
+    if value is None:
+        return None
+    if not isinstance(value, bytes):
+        value = str(value).encode('utf-8')
+    return struct.unpack('>q', hashlib.md5(value).digest()[:8])[0]
+
+
+def _mod(dividend, divisor):
+    """Stand-in for BigQuery's MOD function, which truncates like C."""
+    if dividend is None or divisor is None:
+        return None
+    remainder = abs(dividend) % abs(divisor)
+    return -remainder if dividend < 0 else remainder
+
+
+def _column_reference_pattern(column):
+    """Matches references to a column in translated SQL."""
+    if '.' in column:
+        return re.compile(re.escape(_quote_identifier(column)))
+    return re.compile(r'(?<![\w."])%s\b' % column)
+
+
+def _string(value):
+    """Stand-in for BigQuery's STRING function."""
+    if value is None:
+        return None
+    return str(value)
+
+
+def _integer(value):
+    """Implements legacy SQL's INTEGER(), which truncates numbers to integers."""
+    if value is None:
+        return None
+    return int(value)
+
+
+class _BitXor(object):
+    """Stand-in for BigQuery's BIT_XOR aggregate function."""
+
+    def __init__(self):
+        self._value = None
+
+    def step(self, value):
+        if value is not None:
+            self._value = (self._value or 0) ^ value
+
+    def finalize(self):
+        return self._value
+
+
+def _quote_identifier(identifier):
+    return '"%s"' % identifier.replace('"', '""')
+
+
+def _split_top_level(text, separator=','):
+    """Splits text on a separator, ignoring separators inside parentheses."""
+    parts = []
+    depth = 0
+    current = []
+    for character in text:
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        if character == separator and depth == 0:
+            parts.append(''.join(current))
+            current = []
+        else:
+            current.append(character)
+    parts.append(''.join(current))
+    return parts
+
+
+def _find_top_level_keyword(sql, keyword, start=0):
+    """Finds a keyword in sql that is not inside parentheses, or -1."""
+    pattern = re.compile(r'\b%s\b' % keyword, re.IGNORECASE)
+    depth = 0
+    for position in range(start, len(sql)):
+        character = sql[position]
+        if character == '(':
+            depth += 1
+        elif character == ')':
+            depth -= 1
+        elif depth == 0 and pattern.match(sql, position):
+            return position
+    return -1
+
+
+def _alias_output_columns(sql):
+    """Gives qualified columns in the outer SELECT their legacy SQL names."""
+    select_start = _find_top_level_keyword(sql, 'SELECT')
+    if select_start < 0:
+        return sql
+    list_start = select_start + len('SELECT')
+    list_end = _find_top_level_keyword(sql, 'FROM', list_start)
+    if list_end < 0:
+        return sql
+    items = []
+    for item in _split_top_level(sql[list_start:list_end]):
+        match = _QUALIFIED_COLUMN_PATTERN.match(item)
+        if match:
+            item = ' %s.%s AS %s_%s ' % (match.group(1), match.group(2),
+                                         match.group(1), match.group(2))
+        items.append(item)
+    return sql[:list_start] + ','.join(items) + sql[list_end:]
+
+
+def _find_closing_parenthesis(sql, start):
+    """Returns the index of the parenthesis closing the one at start."""
+    depth = 0
+    for position in range(start, len(sql)):
+        if sql[position] == '(':
+            depth += 1
+        elif sql[position] == ')':
+            depth -= 1
+            if depth == 0:
+                return position
+    raise ValueError('Unbalanced parentheses in query: %s' % sql)
+
+
+def _skip_whitespace(sql, position):
+    while position < len(sql) and sql[position].isspace():
+        position += 1
+    return position
+
+
+def _translate_subquery_lists(sql):
+    """Translates comma-separated subqueries in FROM clauses to UNION ALL."""
+    # Work backwards so that inner lists are translated before the lists that
+    # contain them, and earlier positions remain valid.
+    for match in reversed(list(_FROM_PATTERN.finditer(sql))):
+        start = _skip_whitespace(sql, match.end())
+        if sql[start:start + 1] != '(':
+            continue
+        subqueries = []
+        position = start
+        while True:
+            end = _find_closing_parenthesis(sql, position)
+            subqueries.append(sql[position:end + 1])
+            separator = _skip_whitespace(sql, end + 1)
+            next_subquery = _skip_whitespace(sql, separator + 1)
+            if (sql[separator:separator + 1] != ',' or
+                    sql[next_subquery:next_subquery + 1] != '('):
+                break
+            position = next_subquery
+        if len(subqueries) > 1:
+            union = ' UNION ALL '.join('SELECT * FROM %s' % subquery
+                                       for subquery in subqueries)
+            sql = '%s(%s)%s' % (sql[:start], union, sql[end + 1:])
+    return sql
+
+
+def _translate_table_list(match):
+    tables = [_quote_identifier(t.strip()) for t in match.group(2).split(',')]
+    if len(tables) == 1:
+        return 'FROM%s%s' % (match.group(1), tables[0])
+    union = ' UNION ALL '.join('SELECT * FROM %s' % t for t in tables)
+    return 'FROM%s(%s)' % (match.group(1), union)
+
+
+def translate_query(query):
+    """Translates a BigQuery legacy SQL query into SQLite SQL.
+
+    Args:
+        query: A BigQuery legacy SQL query, as generated by BigSanity.
+
+    Returns:
+        An equivalent query that SQLite can execute against a database in
+        which M-Lab tables are stored under their legacy SQL names.
+    """
+    sql = _COMMENT_PATTERN.sub('', query)
+    sql = _alias_output_columns(sql)
+    sql = _TABLE_LIST_PATTERN.sub(_translate_table_list, sql)
+    sql = _translate_subquery_lists(sql)
+    sql = _EACH_PATTERN.sub(r'\1', sql)
+    sql = _NESTED_FIELD_PATTERN.sub(r'"\1.\2"', sql)
+    return sql
+
+
+def referenced_tables(query):
+    """Returns the names of the legacy SQL tables a query references."""
+    tables = set()
+    for match in _TABLE_LIST_PATTERN.finditer(_COMMENT_PATTERN.sub('', query)):
+        tables.update(_TABLE_REFERENCE_PATTERN.findall(match.group(2)))
+    return sorted(tables)
+
+
+class SqliteQueryExecutor(object):
+    """Query executor backed by a local SQLite database.
+
+    Supports the same interface as query_execution.QueryExecutor. M-Lab tables
+    are stored under their legacy SQL names (e.g. plx.google:m_lab.ndt.all)
+    with the columns in MLAB_COLUMNS. In BigQuery, every monthly table exists,
+    so tables that a query references but that have not been loaded are
+    created empty.
+    """
+
+    def __init__(self, database=':memory:'):
+        """Creates a new SqliteQueryExecutor.
+
+        Args:
+            database: Path of the SQLite database file, or ':memory:' for a
+                database that exists only in memory.
+        """
+        self._connection = sqlite3.connect(database, check_same_thread=False)
+        # Return TEXT values as native strings in Python 2.
+        self._connection.text_factory = str
+        self._connection.create_function('HASH', 1, _hash)
+        self._connection.create_function('MOD', 2, _mod)
+        self._connection.create_function('STRING', 1, _string)
+        self._connection.create_function('INTEGER', 1, _integer)
+        self._connection.create_aggregate('BIT_XOR', 1, _BitXor)
+        # Queries may come from several threads, but a connection can only
+        # run one statement at a time.
+        self._lock = threading.Lock()
+        self._modified_times = {}
+
+    def load_table(self, table_name, rows):
+        """Adds rows to an M-Lab table, creating the table if needed.
+
+        Args:
+            table_name: Legacy SQL name of the table, e.g.
+                'plx.google:m_lab.2015_01.all'.
+            rows: An iterable of dictionaries that map column names from
+                MLAB_COLUMNS to values. Missing columns are NULL.
+        """
+        insert = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            _quote_identifier(table_name), ', '.join(_quote_identifier(c)
+                                                     for c in MLAB_COLUMNS),
+            ', '.join('?' for _ in MLAB_COLUMNS))
+        with self._lock:
+            self._create_table(table_name)
+            self._connection.executemany(insert,
+                                         (tuple(row.get(column)
+                                                for column in MLAB_COLUMNS)
+                                          for row in rows))
+            self._connection.commit()
+            self._modified_times[table_name] = time.time()
+
+    def execute_query(self, query):
+        """Executes a legacy SQL query and returns the results in CSV format.
+
+        Args:
+            query: A BigQuery legacy SQL string containing a query to execute.
+
+        Returns:
+            The result of the query in CSV format with a header row, like the
+            output of bq. If the query yields no rows, an empty string.
+
+        Raises:
+            BqFailedError: If the query cannot be translated or SQLite fails to
+                execute it.
+        """
+        with self._lock:
+            self._create_referenced_tables(query)
+            try:
+                cursor = self._connection.execute(translate_query(query))
+                rows = cursor.fetchall()
+            except (sqlite3.Error, ValueError) as e:
+                raise query_execution.BqFailedError(query, str(e))
+        if not rows:
+            return ''
+        output = io.BytesIO() if str is bytes else io.StringIO()
+        writer = csv.writer(output, lineterminator='\n')
+        writer.writerow([column[0] for column in cursor.description])
+        for row in rows:
+            writer.writerow(['' if value is None else value for value in row])
+        return output.getvalue()
+
+    def estimate_query_bytes(self, query):
+        """Estimates the number of bytes a query would process.
+
+        Mirrors BigQuery's pricing model: every value of each column the query
+        references is read from every table the query references.
+        """
+        with self._lock:
+            self._create_referenced_tables(query)
+            total_rows = 0
+            for table_name in referenced_tables(query):
+                total_rows += self._connection.execute(
+                    'SELECT COUNT(*) FROM %s' %
+                    _quote_identifier(table_name)).fetchone()[0]
+        translated = translate_query(query)
+        referenced_columns = [
+            c for c in MLAB_COLUMNS
+            if _column_reference_pattern(c).search(translated)
+        ]
+        return total_rows * len(referenced_columns) * _ESTIMATED_BYTES_PER_VALUE
+
+    def count_rows_read(self, query):
+        """Runs a query and counts the rows it reads from M-Lab tables.
+
+        Each table is read through a subquery that counts its rows. The LIMIT
+        of the subquery keeps SQLite from flattening it or pushing filters into
+        it, so every reference to a table reads all of its rows, as BigQuery
+        does, and a table that the query reads several times counts each time.
+
+        Raises:
+            BqFailedError: If the query cannot be translated or SQLite fails to
+                execute it.
+        """
+        counter = [0]
+
+        def count_row(_):
+            counter[0] += 1
+            return 1
+
+        with self._lock:
+            self._create_referenced_tables(query)
+            self._connection.create_function('_COUNT_ROW', 1, count_row)
+            try:
+                self._connection.execute(_QUOTED_TABLE_PATTERN.sub(
+                    r'(SELECT * FROM \g<0> WHERE _COUNT_ROW(rowid) '
+                    'LIMIT -1)', translate_query(query))).fetchall()
+            except (sqlite3.Error, ValueError) as e:
+                raise query_execution.BqFailedError(query, str(e))
+        return counter[0]
+
+    def table_modified_time(self, table_name):
+        """Returns the time rows were last loaded into a table.
+
+        Returns:
+            The time in seconds since the epoch, or None if no rows were loaded
+            into the table by this executor.
+        """
+        with self._lock:
+            return self._modified_times.get(table_name)
+
+    def _create_referenced_tables(self, query):
+        for table_name in referenced_tables(query):
+            self._create_table(table_name)
+
+    def _create_table(self, table_name):
+        self._connection.execute('CREATE TABLE IF NOT EXISTS %s (%s)' % (
+            _quote_identifier(table_name), ', '.join(_quote_identifier(c)
+                                                     for c in MLAB_COLUMNS)))
@@ -0,0 +1,134 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Orders check windows so that the likeliest problems are checked first.
+
+By default, windows are checked in chronological order, so problems in recent
+data, which are the most likely and the most urgent, are found last. In
+priority order, each window is scored on three signals:
+
+    * Recency: the score halves for every RECENCY_HALF_LIFE_DAYS between the
+      end of the window and now.
+    * Failure history: the fraction of earlier checks of the window's data
+      that failed, smoothed so that a window that was never checked counts as
+      having failed half the time.
+    * Table modification: whether any table the window reads was modified
+      after the window was last checked (or the window was never checked).
+
+and windows are checked in order of decreasing score.
+"""
+
+import logging
+import time
+
+import intervals
+import query_execution
+import table_names
+
+ORDER_CHRONOLOGICAL = 'chronological'
+ORDER_PRIORITY = 'priority'
+ORDERS = (ORDER_CHRONOLOGICAL, ORDER_PRIORITY)
+
+RECENCY_HALF_LIFE_DAYS = 30.0
+
+# Contribution of each signal, which ranges from 0 to 1, to a window's score.
+_RECENCY_WEIGHT = 1.0
+_FAILURE_WEIGHT = 2.0
+_MODIFIED_WEIGHT = 1.0
+
+logger = logging.getLogger(__name__)
+
+
+class WindowPrioritizer(object):
+    """Scores check windows and orders them by decreasing score."""
+
+    def __init__(self,
+                 check_history=None,
+                 table_modified_time=None,
+                 clock=time.time):
+        """Creates a new WindowPrioritizer.
+
+        Args:
+            check_history: CheckHistory of earlier runs, or None to score
+                windows without their failure history.
+            table_modified_time: Function that returns the time (in seconds
+                since the epoch) a table was last modified, such as a query
+                executor's table_modified_time, or None to score windows
+                without table modification times.
+            clock: Function that returns the current time in seconds.
+        """
+        self._check_history = check_history
+        self._table_modified_time = table_modified_time
+        self._clock = clock
+        self._table_modified_times = {}
+
+    def score(self, project, window_start, window_end):
+        """Returns the priority score of a time window of a project."""
+        age_days = max(
+            0,
+            self._clock() - intervals.to_timestamp(window_end)) / (24 * 60 * 60)
+        score = _RECENCY_WEIGHT * 0.5**(age_days / RECENCY_HALF_LIFE_DAYS)
+        last_checked = None
+        if self._check_history:
+            stats = self._check_history.window_stats(project, window_start,
+                                                     window_end)
+            score += _FAILURE_WEIGHT * (
+                (stats.failures + 1.0) / (stats.checks + 2.0))
+            last_checked = stats.last_checked
+        if self._table_modified_time:
+            modified_time = self._last_modified(project, window_start,
+                                                window_end)
+            if modified_time is not None and (last_checked is None or
+                                              modified_time > last_checked):
+                score += _MODIFIED_WEIGHT
+        return score
+
+    def prioritize(self, jobs):
+        """Orders check jobs by decreasing score of their windows.
+
+        Jobs of equally scored windows keep their relative order.
+
+        Args:
+            jobs: A list of (project, window_start, window_end, shard_index)
+                4-tuples.
+
+        Returns:
+            The jobs, highest priority first.
+        """
+        scores = {}
+        for project, window_start, window_end, _ in jobs:
+            window = (project, window_start, window_end)
+            if window not in scores:
+                scores[window] = self.score(*window)
+        return sorted(jobs, key=lambda job: -scores[job[:3]])
+
+    def _last_modified(self, project, window_start, window_end):
+        """Returns when a table the window reads was last modified, or None."""
+        tables = table_names.monthly_tables(window_start, window_end)
+        tables.append(table_names.per_project_table(project))
+        modified_times = [
+            self._table_last_modified(table_name) for table_name in tables
+        ]
+        known_times = [t for t in modified_times if t is not None]
+        return max(known_times) if known_times else None
+
+    def _table_last_modified(self, table_name):
+        if table_name not in self._table_modified_times:
+            try:
+                modified_time = self._table_modified_time(table_name)
+            except query_execution.Error as e:
+                logger.warning('Failed to retrieve modification time of %s: %s',
+                               table_name, e)
+                modified_time = None
+            self._table_modified_times[table_name] = modified_time
+        return self._table_modified_times[table_name]
@@ -0,0 +1,181 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Profiles the phases of the sanity check pipeline.
+
+The pipeline marks its phases with phase(), which does nothing unless a
+PipelineProfiler has been activated for the process. Each phase is profiled
+separately with cProfile, so that a report can rank the functions that are
+expensive within, for example, result parsing, without them being drowned out
+by time spent waiting on BigQuery.
+"""
+
+import contextlib
+import cProfile
+import logging
+import os
+import pstats
+import resource
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of functions listed for each phase in the text report.
+_REPORT_FUNCTIONS_PER_PHASE = 25
+
+_active_profiler = None
+
+
+class PipelineProfiler(object):
+    """Collects cProfile data and memory peaks for each pipeline phase."""
+
+    def __init__(self, measure_memory=False):
+        """Creates a new PipelineProfiler.
+
+        Args:
+            measure_memory: Whether to record how much phases that request
+                memory measurement raise the peak resident memory of the
+                process.
+        """
+        self._measure_memory = measure_memory
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        # Each thread profiles a phase with its own cProfile.Profile, since a
+        # profiler only observes the thread that enabled it.
+        self._profiles = {}
+        self._phase_seconds = {}
+        self._phase_calls = {}
+        self._memory_peaks = {}
+
+    @contextlib.contextmanager
+    def phase(self, name, measure_memory=False):
+        """Context manager that profiles the code inside it as a phase.
+
+        Phases nested within another phase on the same thread are attributed
+        to the outer phase.
+
+        Args:
+            name: Name of the pipeline phase.
+            measure_memory: Whether to record how much the phase raises the
+                peak resident memory of the process. A phase that stays below
+                an earlier peak records no growth, and peaks are process-wide,
+                so they are only accurate when phases do not run concurrently.
+        """
+        if getattr(self._local, 'in_phase', False):
+            yield
+            return
+        profile = self._thread_profile(name)
+        measure_memory = measure_memory and self._measure_memory
+        if measure_memory:
+            baseline = _peak_rss_kib()
+        self._local.in_phase = True
+        start_time = time.time()
+        profile.enable()
+        try:
+            yield
+        finally:
+            profile.disable()
+            elapsed = time.time() - start_time
+            self._local.in_phase = False
+            with self._lock:
+                self._phase_seconds[name] = (
+                    self._phase_seconds.get(name, 0.0) + elapsed)
+                self._phase_calls[name] = self._phase_calls.get(name, 0) + 1
+                if measure_memory:
+                    peak = _peak_rss_kib() - baseline
+                    self._memory_peaks[name] = max(
+                        peak, self._memory_peaks.get(name, 0))
+
+    def _thread_profile(self, name):
+        profiles = getattr(self._local, 'profiles', None)
+        if profiles is None:
+            profiles = self._local.profiles = {}
+        if name not in profiles:
+            profiles[name] = cProfile.Profile()
+            with self._lock:
+                self._profiles.setdefault(name, []).append(profiles[name])
+        return profiles[name]
+
+    def write_report(self, output_dir):
+        """Writes profiling data and a ranked text report to a directory.
+
+        Writes one <phase>.pstats file per phase, which can be loaded with the
+        pstats module or visualization tools, and a report.txt that ranks the
+        phases by total time and lists the most expensive functions in each.
+
+        Args:
+            output_dir: Directory in which to write the profiling output. It is
+                created if it does not exist.
+        """
+        if not os.path.isdir(output_dir):
+            os.makedirs(output_dir)
+        with self._lock:
+            phases = sorted(self._phase_seconds.items(),
+                            key=lambda item: item[1],
+                            reverse=True)
+            profiles = dict((name, list(p))
+                            for name, p in self._profiles.items())
+            phase_calls = dict(self._phase_calls)
+            memory_peaks = dict(self._memory_peaks)
+        report_path = os.path.join(output_dir, 'report.txt')
+        with open(report_path, 'w') as report:
+            report.write('Pipeline phases by total time:\n')
+            for name, seconds in phases:
+                line = '  %-20s %10.3fs in %d calls' % (name, seconds,
+                                                        phase_calls[name])
+                if name in memory_peaks:
+                    line += (', peak memory growth %d KiB' % memory_peaks[name])
+                report.write(line + '\n')
+            for name, _ in phases:
+                stats = pstats.Stats(profiles[name][0], stream=report)
+                for profile in profiles[name][1:]:
+                    stats.add(profile)
+                stats.dump_stats(os.path.join(output_dir, name + '.pstats'))
+                report.write('\n=== Phase: %s ===\n' % name)
+                stats.sort_stats('cumulative').print_stats(
+                    _REPORT_FUNCTIONS_PER_PHASE)
+        logger.info('Wrote profiling report to %s', report_path)
+
+
+def _peak_rss_kib():
+    """Returns the peak resident memory of this process so far, in KiB."""
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere.
+    if sys.platform == 'darwin':
+        peak_rss //= 1024
+    return peak_rss
+
+
+def activate(profiler):
+    """Makes profiler the process-wide profiler for pipeline phases."""
+    global _active_profiler
+    _active_profiler = profiler
+
+
+def deactivate():
+    """Stops profiling pipeline phases."""
+    global _active_profiler
+    _active_profiler = None
+
+
+@contextlib.contextmanager
+def phase(name, measure_memory=False):
+    """Profiles a pipeline phase with the active profiler, if any."""
+    profiler = _active_profiler
+    if profiler is None:
+        yield
+        return
+    with profiler.phase(name, measure_memory):
+        yield
@@ -0,0 +1,153 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Reports the progress of a sanity check sweep."""
+
+import collections
+import datetime
+import logging
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Number of most recent window completions used to calculate throughput.
+_MOVING_AVERAGE_WINDOWS = 20
+
+
+def _format_eta(seconds):
+    if seconds is None:
+        return 'unknown'
+    return str(datetime.timedelta(seconds=int(round(seconds))))
+
+
+class ProgressReporter(object):
+    """Tracks and reports the progress of a sweep over time windows.
+
+    Throughput is a moving average over the most recent completions, so the ETA
+    adapts when windows become faster or slower during a sweep (e.g. as data
+    gets denser in recent years). Only completion counts and times are used, so
+    the report stays correct when concurrent windows complete out of order.
+
+    When the output stream is a terminal, a single status line is updated in
+    place after every completion. Otherwise, a status line is logged at most
+    once per log interval.
+    """
+
+    def __init__(self,
+                 total_windows,
+                 total_days,
+                 stream=sys.stderr,
+                 log_interval=60,
+                 clock=time.time):
+        """Creates a new ProgressReporter.
+
+        Args:
+            total_windows: Number of windows in the sweep.
+            total_days: Number of days of data covered by the sweep.
+            stream: Stream to which a terminal status line is written.
+            log_interval: Minimum number of seconds between logged status lines
+                when the stream is not a terminal.
+            clock: Function that returns the current time in seconds.
+        """
+        self._total_windows = total_windows
+        self._total_days = total_days
+        self._stream = stream
+        self._is_tty = hasattr(stream, 'isatty') and stream.isatty()
+        self._log_interval = log_interval
+        self._clock = clock
+        self._start_time = clock()
+        self._last_log_time = self._start_time
+        self._completed_windows = 0
+        self._completed_days = 0.0
+        self._failures = 0
+        # Times and sizes (in days) of the most recent completions.
+        self._recent = collections.deque(maxlen=_MOVING_AVERAGE_WINDOWS)
+        self._lock = threading.Lock()
+
+    def window_completed(self, days, success):
+        """Records the completion of a window and reports progress.
+
+        Args:
+            days: Number of days of data covered by the window.
+            success: Whether the check of the window succeeded.
+        """
+        with self._lock:
+            now = self._clock()
+            self._completed_windows += 1
+            self._completed_days += days
+            if not success:
+                self._failures += 1
+            self._recent.append((now, days))
+            status = self._format_status(now)
+            if self._is_tty:
+                self._stream.write('\r%s\x1b[K' % status)
+                self._stream.flush()
+            elif now - self._last_log_time >= self._log_interval:
+                self._last_log_time = now
+                logger.info(status)
+
+    def finish(self):
+        """Reports final progress at the end of the sweep."""
+        with self._lock:
+            status = self._format_status(self._clock())
+            if self._is_tty:
+                self._stream.write('\r%s\x1b[K\n' % status)
+                self._stream.flush()
+            else:
+                logger.info(status)
+
+    def status(self):
+        """Returns a one-line description of the progress of the sweep."""
+        with self._lock:
+            return self._format_status(self._clock())
+
+    def _rates(self, now):
+        """Returns throughput as (windows per second, days per second).
+
+        Rates are averaged over the most recent completions. Until the moving
+        average is full, they are averaged since the start of the sweep.
+        """
+        if not self._recent:
+            return 0.0, 0.0
+        if len(self._recent) < self._recent.maxlen:
+            period_start = self._start_time
+            windows = len(self._recent)
+            days = sum(d for _, d in self._recent)
+        else:
+            # The oldest completion marks the start of the period, so it is not
+            # counted in it.
+            period_start = self._recent[0][0]
+            windows = len(self._recent) - 1
+            days = sum(d for _, d in list(self._recent)[1:])
+        elapsed = now - period_start
+        if elapsed <= 0:
+            return 0.0, 0.0
+        return windows / elapsed, days / elapsed
+
+    def _format_status(self, now):
+        windows_per_second, days_per_second = self._rates(now)
+        remaining_windows = self._total_windows - self._completed_windows
+        eta = None
+        if windows_per_second > 0:
+            eta = remaining_windows / windows_per_second
+        percent = 100.0
+        if self._total_windows:
+            percent = 100.0 * self._completed_windows / self._total_windows
+        return ('Progress: %d/%d windows (%.1f%%), %.1f/%.1f days, %d '
+                'failures, %.1f windows/min, %.1f days/min, ETA %s') % (
+                    self._completed_windows, self._total_windows, percent,
+                    self._completed_days, self._total_days, self._failures,
+                    windows_per_second * 60, days_per_second * 60,
+                    _format_eta(eta))
@@ -12,12 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import collections
 import datetime
 
+import cli
 import constants
 import formatting
+import intervals
 import table_names
 
+# Strategies for finding the test_id values that appear in only one table.
+# A FULL OUTER JOIN reads each side once. The anti-join reads each side twice,
+# but shuffles only the test_ids of the side being filtered.
+STRATEGY_FULL_OUTER_JOIN = 'full_outer_join'
+STRATEGY_ANTI_JOIN = 'anti_join'
+STRATEGIES = (STRATEGY_FULL_OUTER_JOIN, STRATEGY_ANTI_JOIN)
+
+# The sides of an aggregate scan.
+SIDE_PER_MONTH = 'per_month'
+SIDE_PER_PROJECT = 'per_project'
+
+# An aggregate expression computed over the rows of one side of an aggregate
+# scan, for each day of data. The name must be a valid column alias.
+Aggregate = collections.namedtuple('Aggregate', ['side', 'name', 'expression'])
+
+_SECONDS_PER_DAY = 24 * 60 * 60
+_EPOCH_DATE = datetime.date(1970, 1, 1)
+
+# Number of test_id hash buckets that sampling selects from. Sample rates are
+# rounded to a whole number of buckets.
+_SAMPLE_BUCKETS = 1000000
+
 
 def _construct_equivalence_query(per_month_query, per_project_query):
     """Constructs BigQuery SQL to be used in a table equivalence check.
@@ -57,6 +82,228 @@ WHERE
         per_project_query=formatting.indent(per_project_query, 8))
 
 
+def _construct_anti_join_query(per_month_query, per_project_query):
+    """Constructs BigQuery SQL for a table equivalence check using anti-joins.
+
+    Yields the same rows as the query from _construct_equivalence_query, in
+    the same columns, but finds the test_id values missing from each table with
+    a separate NOT IN anti-join. The comma between the two anti-joins is legacy
+    SQL's UNION ALL.
+
+    Args:
+        per_month_query: A BigQuery SQL query that selects test_id values from
+            the per-month tables.
+        per_project_query: A BigQuery SQL query that selects test_id values from
+            a per-project table.
+
+    Returns:
+        A BigQuery SQL query to test the equivalence of the two subqueries.
+    """
+    return """
+SELECT
+    per_month_test_id,
+    per_project_test_id
+FROM
+    (
+        SELECT
+            test_id AS per_month_test_id,
+            STRING(NULL) AS per_project_test_id
+        FROM
+            (
+{per_month_query}
+            )
+        WHERE
+            test_id NOT IN (
+{per_project_query}
+            )
+    ),
+    (
+        SELECT
+            STRING(NULL) AS per_month_test_id,
+            test_id AS per_project_test_id
+        FROM
+            (
+{per_project_query}
+            )
+        WHERE
+            test_id NOT IN (
+{per_month_query}
+            )
+    )""".format(per_month_query=formatting.indent(per_month_query, 16),
+                per_project_query=formatting.indent(per_project_query, 16))
+
+
+def _construct_fingerprint_query(per_month_query, per_project_query):
+    """Constructs BigQuery SQL that fingerprints the test_ids of each table.
+
+    The query yields a single row with the number of rows and an XOR of the
+    hashes of the test_id values on each side. If the tables are equivalent,
+    the two sides have equal fingerprints, so a cheap fingerprint query can
+    rule out differences before a full comparison.
+
+    Args:
+        per_month_query: A BigQuery SQL query that selects test_id values from
+            the per-month tables.
+        per_project_query: A BigQuery SQL query that selects test_id values from
+            a per-project table.
+
+    Returns:
+        A BigQuery SQL query yielding the columns per_month_row_count,
+        per_month_fingerprint, per_project_row_count and
+        per_project_fingerprint.
+    """
+    return """
+SELECT
+    per_month.row_count,
+    per_month.fingerprint,
+    per_project.row_count,
+    per_project.fingerprint
+FROM
+    (
+        SELECT
+            COUNT(*) AS row_count,
+            BIT_XOR(HASH(test_id)) AS fingerprint
+        FROM
+            (
+{per_month_query}
+            )
+    ) AS per_month
+    CROSS JOIN
+    (
+        SELECT
+            COUNT(*) AS row_count,
+            BIT_XOR(HASH(test_id)) AS fingerprint
+        FROM
+            (
+{per_project_query}
+            )
+    ) AS per_project""".format(
+        per_month_query=formatting.indent(per_month_query, 16),
+        per_project_query=formatting.indent(per_project_query, 16))
+
+
+def _construct_aggregate_query(day_expression, per_month_tables,
+                               per_month_conditions, per_project_tables,
+                               per_project_conditions, aggregates):
+    """Constructs BigQuery SQL that computes aggregates over both tables.
+
+    Each side is scanned once and grouped by day, and the two sides are joined
+    on the day, so any number of aggregates costs a single scan of each table.
+
+    Args:
+        day_expression: A BigQuery SQL expression yielding the day of a row, as
+            the number of days since the epoch.
+        per_month_tables: A list of the per-month tables to scan.
+        per_month_conditions: A list of WHERE clauses for the per-month tables.
+        per_project_tables: A list of the per-project tables to scan.
+        per_project_conditions: A list of WHERE clauses for the per-project
+            table.
+        aggregates: A list of Aggregate to compute.
+
+    Returns:
+        A BigQuery SQL query yielding, for every day with rows on either side,
+        the columns per_month_day, per_project_day and a column named
+        <side>_<name> for each aggregate.
+    """
+    sides = ((SIDE_PER_MONTH, per_month_tables, per_month_conditions),
+             (SIDE_PER_PROJECT, per_project_tables, per_project_conditions))
+    subqueries = {}
+    output_columns = []
+    for side, tables, conditions in sides:
+        columns = ['%s AS day' % day_expression]
+        columns.extend('%s AS %s' % (aggregate.expression, aggregate.name)
+                       for aggregate in aggregates if aggregate.side == side)
+        output_columns.extend('%s.%s' % (side, aggregate.name)
+                              for aggregate in aggregates
+                              if aggregate.side == side)
+        subqueries[side] = """
+SELECT
+    {columns}
+FROM
+    {tables}
+WHERE
+    {conditions}
+GROUP BY
+    day""".format(columns=',\n    '.join(columns),
+                  tables=',\n    '.join(tables),
+                  conditions='\n    AND '.join(conditions)).strip()
+    return """
+SELECT
+    {output_columns}
+FROM
+    (
+{per_month_query}
+    ) AS per_month
+    FULL OUTER JOIN EACH
+    (
+{per_project_query}
+    ) AS per_project
+ON
+    per_month.day=per_project.day""".format(
+        output_columns=',\n    '.join(['per_month.day', 'per_project.day'] +
+                                      output_columns),
+        per_month_query=formatting.indent(subqueries[SIDE_PER_MONTH], 8),
+        per_project_query=formatting.indent(subqueries[SIDE_PER_PROJECT], 8))
+
+
+def _construct_duplicate_query(per_month_tables, per_month_conditions,
+                               per_project_tables, per_project_conditions):
+    """Constructs BigQuery SQL that finds test_id values with several rows.
+
+    Args:
+        per_month_tables: A list of the per-month tables to search, or None to
+            search only the per-project table.
+        per_month_conditions: A list of WHERE clauses for the per-month tables.
+        per_project_tables: A list of the per-project tables to search, or None
+            to search only the per-month tables.
+        per_project_conditions: A list of WHERE clauses for the per-project
+            table.
+
+    Returns:
+        A BigQuery SQL query yielding the columns side (SIDE_PER_MONTH or
+        SIDE_PER_PROJECT), test_id and row_count for every test_id that appears
+        in more than one row of a side.
+    """
+    sides = ((SIDE_PER_MONTH, per_month_tables, per_month_conditions),
+             (SIDE_PER_PROJECT, per_project_tables, per_project_conditions))
+    subqueries = []
+    for side, tables, conditions in sides:
+        if not tables:
+            continue
+        grouped_query = """
+SELECT
+    test_id,
+    COUNT(*) AS row_count
+FROM
+    {tables}
+WHERE
+    {conditions}
+GROUP EACH BY
+    test_id
+HAVING
+    row_count > 1""".format(tables=',\n    '.join(tables),
+                            conditions='\n    AND '.join(conditions)).strip()
+        subqueries.append("""
+SELECT
+    '{side}' AS side,
+    test_id,
+    row_count
+FROM
+    (
+{grouped_query}
+    )""".format(side=side,
+                grouped_query=formatting.indent(grouped_query, 8)).strip())
+    return """
+SELECT
+    side,
+    test_id,
+    row_count
+FROM
+{subqueries}""".format(subqueries=',\n'.join(
+        formatting.indent('(\n%s\n)' % formatting.indent(subquery, 4), 4)
+        for subquery in subqueries))
+
+
 def _construct_test_id_subquery(tables, conditions):
     """Constructs BigQuery SQL to retrieve test_id values.
 
@@ -84,14 +331,37 @@ def _format_project_condition(project):
     return 'project = %d' % project
 
 
-def _to_unix_timestamp(dt):
-    """Converts a datetime to Unix timestamp."""
-    return int((dt - datetime.datetime(1970, 1, 1)).total_seconds())
+def _format_shard_condition(shard_count, shard_index):
+    """Formats a condition restricting rows to a single hash shard of test_id.
 
+    Because the shard is derived only from the test_id value, a given test_id
+    falls in the same shard on both sides of the equivalence query, so each
+    shard can be checked independently of the others.
+    """
+    return 'MOD(ABS(HASH(test_id)), %d) = %d' % (shard_count, shard_index)
 
-def _to_human_readable_date(dt):
-    """Converts a datetime to a human readable date of the form YYYY-MM-DD."""
-    return dt.strftime('%Y-%m-%d')
+
+def _format_day_condition(time_field, days):
+    """Formats a condition restricting rows to the given days.
+
+    Args:
+        time_field: The name of the field that holds the time of a row.
+        days: A list of the days (as dates) to which rows are restricted.
+    """
+    return 'INTEGER(%s / %d) IN (%s)' % (time_field, _SECONDS_PER_DAY,
+                                         ', '.join(str((day - _EPOCH_DATE).days)
+                                                   for day in days))
+
+
+def _format_sample_condition(sample_buckets):
+    """Formats a condition restricting rows to a hash sample of test_id.
+
+    Like shards, the sample is derived only from the test_id value, so the
+    same test_ids are sampled on both sides of the equivalence query. The
+    large number of buckets keeps the sample independent of the shards.
+    """
+    return 'MOD(ABS(HASH(test_id)), %d) < %d' % (_SAMPLE_BUCKETS,
+                                                 sample_buckets)
 
 
 def _project_has_intermediate_snapshots(project):
@@ -125,7 +395,14 @@ def _project_to_time_field(project):
 class TableEquivalenceQueryGenerator(object):
     """Generates queries to test the equivalence of two M-Lab tables."""
 
-    def __init__(self, project, time_range_start, time_range_end):
+    def __init__(self,
+                 project,
+                 time_range_start,
+                 time_range_end,
+                 shard_count=1,
+                 shard_index=0,
+                 strategy=STRATEGY_FULL_OUTER_JOIN,
+                 sample_rate=None):
         """Creates a new TableEquivalenceQueryGenerator.
 
         Args:
@@ -134,12 +411,39 @@ class TableEquivalenceQueryGenerator(object):
                 query (as datetime).
             time_range_end: End of time window (not inclusive) for which to
                 generate query (as datetime).
+            shard_count: Number of hash shards the time window is split into.
+                A value of 1 disables sharding.
+            shard_index: Index of the shard (in the range [0, shard_count)) to
+                which the query is limited.
+            strategy: Strategy used by generate_query to find the test_id values
+                that appear in only one table, one of STRATEGIES.
+            sample_rate: If set, the fraction of test_id values, in the range
+                (0, 1], to which all queries are limited. The same test_ids
+                are sampled on both sides.
+
+        Raises:
+            ValueError: If the shard parameters, the strategy or the sample
+                rate are invalid.
         """
+        if shard_count < 1:
+            raise ValueError('shard_count must be positive, but was %d' %
+                             shard_count)
+        if not 0 <= shard_index < shard_count:
+            raise ValueError('shard_index (%d) is out of range [0, %d)' %
+                             (shard_index, shard_count))
+        if strategy not in STRATEGIES:
+            raise ValueError('Unknown query strategy: %s' % strategy)
+        self._sample_buckets = _SAMPLE_BUCKETS
+        if sample_rate is not None:
+            self._sample_buckets = _count_sample_buckets(sample_rate)
         self._project = project
         self._time_range_start = time_range_start
         self._time_range_end = time_range_end
+        self._shard_count = shard_count
+        self._shard_index = shard_index
+        self._strategy = strategy
 
-    def generate_query(self):
+    def generate_query(self, limit=None):
         """Generates a query demonstrating equivalence between two table types.
 
         Generates a query that should yield 0 rows if the target tables contain
@@ -150,34 +454,200 @@ class TableEquivalenceQueryGenerator(object):
         NULL values in the per_project.test_id column indicate test_ids present
         in the per-project table that did not appear in the per-month table.
 
+        Args:
+            limit: If set, the maximum number of rows the query yields. A
+                limit of 1 answers whether the tables are equivalent without
+                returning the rows that show how they differ.
+
         Returns:
             A BigQuery SQL statement that yields 0 rows if the per month and
             per-project tables are equivalent.
         """
-        return _construct_equivalence_query(self._generate_per_month_query(),
+        if self._strategy == STRATEGY_ANTI_JOIN:
+            query = _construct_anti_join_query(
+                self._generate_per_month_query(),
+                self._generate_per_project_query())
+        else:
+            query = _construct_equivalence_query(
+                self._generate_per_month_query(),
+                self._generate_per_project_query())
+        if limit is not None:
+            query += '\nLIMIT %d' % limit
+        return query
+
+    def generate_fingerprint_query(self):
+        """Generates a query that fingerprints the test_ids of both tables.
+
+        Returns:
+            A BigQuery SQL statement that yields one row with the row count and
+            test_id fingerprint of the per-month and per-project tables. If the
+            tables are equivalent, the counts and fingerprints are equal.
+        """
+        return _construct_fingerprint_query(self._generate_per_month_query(),
                                             self._generate_per_project_query())
 
-    def _generate_per_month_query(self):
+    def generate_test_id_queries(self):
+        """Generates queries that select the test_ids of each table.
+
+        Returns:
+            A (per_month_query, per_project_query) 2-tuple of BigQuery SQL
+            statements that select the test_id values of the per-month and
+            per-project tables within the time window.
+        """
+        return (self._generate_per_month_query(),
+                self._generate_per_project_query())
+
+    @property
+    def sample_rate(self):
+        """The fraction of test_id values the queries are limited to."""
+        return float(self._sample_buckets) / _SAMPLE_BUCKETS
+
+    @property
+    def time_field(self):
+        """The name of the field that holds the time of the project's tests."""
+        return _project_to_time_field(self._project)
+
+    @property
+    def has_intermediate_snapshots(self):
+        """Whether the per-month tables hold intermediate snapshots of tests.
+
+        If so, only rows whose web100_log_entry.is_last_entry is True belong
+        in the per-project table.
+        """
+        return _project_has_intermediate_snapshots(self._project)
+
+    def generate_aggregate_query(self, aggregates):
+        """Generates a query that computes aggregates over both tables per day.
+
+        Both sides are scanned without the is_last_entry filter of
+        generate_query, so aggregates can inspect intermediate snapshots.
+        For web100 projects, rows whose web100_log_entry.log_time is NULL are
+        included if their top-level log_time is within the time window, so that
+        aggregates can count them. An aggregate that should only count rows
+        within the window must require that time_field is not NULL.
+
+        Args:
+            aggregates: A list of Aggregate, with unique names for each side.
+
+        Returns:
+            A BigQuery SQL statement yielding one row for each day of data in
+            the time window, with the columns per_month_day and
+            per_project_day (the number of days since the epoch, or empty if the
+            side has no rows that day) and <side>_<name> for each aggregate.
+        """
+        per_month_conditions = [_format_project_condition(self._project)]
+        per_month_conditions.append(self._format_scan_time_condition())
+        per_month_conditions.extend(self._format_shard_conditions())
+        per_project_conditions = [self._format_scan_time_condition()]
+        per_project_conditions.extend(self._format_shard_conditions())
+        day_time = self.time_field
+        if day_time != 'log_time':
+            day_time = 'IFNULL(%s, log_time)' % day_time
+        return _construct_aggregate_query(
+            'INTEGER(%s / %d)' % (day_time, _SECONDS_PER_DAY),
+            table_names.monthly_tables(self._time_range_start,
+                                       self._time_range_end),
+            per_month_conditions,
+            [table_names.per_project_table(self._project)],
+            per_project_conditions, aggregates)
+
+    def generate_duplicate_query(self, per_month_days, per_project_days):
+        """Generates a query that finds test_ids with several rows in a table.
+
+        Counts the rows that generate_query compares, so intermediate snapshots
+        of a test in the per-month tables are not duplicates.
+
+        Args:
+            per_month_days: A list of the days (as dates) of the per-month
+                tables to search. If empty, the per-month tables are not
+                searched.
+            per_project_days: A list of the days (as dates) of the per-project
+                table to search. If empty, the per-project table is not
+                searched.
+
+        Returns:
+            A BigQuery SQL statement yielding the columns side, test_id and
+            row_count for every test_id that appears in more than one row of
+            the per-month tables or of the per-project table on those days.
+
+        Raises:
+            ValueError: If both lists of days are empty.
+        """
+        if not (per_month_days or per_project_days):
+            raise ValueError('At least one day must be searched.')
+        per_month_tables = None
+        per_month_conditions = []
+        if per_month_days:
+            per_month_tables = table_names.monthly_tables(
+                self._time_range_start, self._time_range_end)
+            per_month_conditions = self._per_month_conditions()
+            per_month_conditions.append(_format_day_condition(self.time_field,
+                                                              per_month_days))
+        per_project_tables = None
+        per_project_conditions = []
+        if per_project_days:
+            per_project_tables = [table_names.per_project_table(self._project)]
+            per_project_conditions = self._per_project_conditions()
+            per_project_conditions.append(_format_day_condition(
+                self.time_field, per_project_days))
+        return _construct_duplicate_query(
+            per_month_tables, per_month_conditions, per_project_tables,
+            per_project_conditions)
+
+    def _per_month_conditions(self):
         conditions = []
         conditions.append(_format_project_condition(self._project))
         if _project_has_intermediate_snapshots(self._project):
             conditions.append('web100_log_entry.is_last_entry = True')
         conditions.append(self._format_time_range_condition())
+        conditions.extend(self._format_shard_conditions())
+        return conditions
+
+    def _per_project_conditions(self):
+        conditions = [self._format_time_range_condition()]
+        conditions.extend(self._format_shard_conditions())
+        return conditions
+
+    def _generate_per_month_query(self):
         tables = table_names.monthly_tables(self._time_range_start,
                                             self._time_range_end)
-        return _construct_test_id_subquery(tables, conditions)
+        return _construct_test_id_subquery(tables, self._per_month_conditions())
 
     def _generate_per_project_query(self):
         tables = [table_names.per_project_table(self._project)]
-        conditions = [self._format_time_range_condition()]
-        return _construct_test_id_subquery(tables, conditions)
-
-    def _format_time_range_condition(self):
-        time_field = _project_to_time_field(self._project)
-        start_time = _to_unix_timestamp(self._time_range_start)
-        start_time_human = _to_human_readable_date(self._time_range_start)
-        end_time = _to_unix_timestamp(self._time_range_end)
-        end_time_human = _to_human_readable_date(self._time_range_end)
+        return _construct_test_id_subquery(tables,
+                                           self._per_project_conditions())
+
+    def _format_shard_conditions(self):
+        conditions = []
+        if self._shard_count > 1:
+            conditions.append(_format_shard_condition(self._shard_count,
+                                                      self._shard_index))
+        if self._sample_buckets < _SAMPLE_BUCKETS:
+            conditions.append(_format_sample_condition(self._sample_buckets))
+        return conditions
+
+    def _format_scan_time_condition(self):
+        time_condition = self._format_time_range_condition()
+        if self.time_field == 'log_time':
+            return time_condition
+        # The time conditions end in comments, so the closing parentheses
+        # go on a line of their own.
+        return (
+            '({time_condition}\n     OR ({time_field} IS NULL AND\n'
+            '         {log_time_condition}\n    ))'
+        ).format(
+            time_condition=time_condition,
+            time_field=self.time_field,
+            log_time_condition=self._format_time_range_condition('log_time'))
+
+    def _format_time_range_condition(self, time_field=None):
+        if time_field is None:
+            time_field = _project_to_time_field(self._project)
+        start_time = intervals.to_timestamp(self._time_range_start)
+        start_time_human = cli.format_time(self._time_range_start)
+        end_time = intervals.to_timestamp(self._time_range_end)
+        end_time_human = cli.format_time(self._time_range_end)
         return ('(({time_field} >= {start_time}) AND  -- {start_time_human}'
                 '\n         ({time_field} < {end_time}))  -- {end_time_human}'
                ).format(time_field=time_field,
@@ -187,9 +657,53 @@ class TableEquivalenceQueryGenerator(object):
                         end_time_human=end_time_human)
 
 
+def _count_sample_buckets(sample_rate):
+    """Returns the number of hash buckets that sample a fraction of test_ids.
+
+    Raises:
+        ValueError: If sample_rate is not in (0, 1] or rounds to no buckets.
+    """
+    if not 0 < sample_rate <= 1:
+        raise ValueError('sample_rate (%s) is out of range (0, 1]' %
+                         sample_rate)
+    sample_buckets = int(round(sample_rate * _SAMPLE_BUCKETS))
+    if not sample_buckets:
+        raise ValueError('sample_rate (%s) is below the minimum of %s' %
+                         (sample_rate, 1.0 / _SAMPLE_BUCKETS))
+    return sample_buckets
+
+
 class TableEquivalenceQueryGeneratorFactory(object):
 
-    def create(self, project, time_range_start, time_range_end):
+    def __init__(self, sample_rate=None):
+        """Creates a new TableEquivalenceQueryGeneratorFactory.
+
+        Args:
+            sample_rate: If set, the fraction of test_id values to which the
+                queries of every generator created are limited.
+        """
+        self._sample_rate = sample_rate
+
+    @property
+    def sample_rate(self):
+        """The fraction of test_id values the queries are limited to.
+
+        The requested rate is rounded to a whole number of hash buckets, so
+        this is the rate the queries actually apply, or None if the queries are
+        not sampled.
+        """
+        if self._sample_rate is None:
+            return None
+        return (float(_count_sample_buckets(self._sample_rate)) /
+                _SAMPLE_BUCKETS)
+
+    def create(self,
+               project,
+               time_range_start,
+               time_range_end,
+               shard_count=1,
+               shard_index=0,
+               strategy=STRATEGY_FULL_OUTER_JOIN):
         """Creates a new TableEquivalenceQueryGenerator.
 
         Args:
@@ -198,6 +712,11 @@ class TableEquivalenceQueryGeneratorFactory(object):
                 query (as datetime).
             time_range_end: End of time window (not inclusive) for which to
                 generate query (as datetime).
+            shard_count: Number of hash shards the time window is split into.
+            shard_index: Index of the shard to which the query is limited.
+            strategy: Strategy used to find the test_id values that appear in
+                only one table, one of STRATEGIES.
         """
-        return TableEquivalenceQueryGenerator(project, time_range_start,
-                                              time_range_end)
+        return TableEquivalenceQueryGenerator(
+            project, time_range_start, time_range_end, shard_count, shard_index,
+            strategy, self._sample_rate)
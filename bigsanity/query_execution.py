@@ -12,7 +12,37 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import bisect
+import json
+import logging
+import math
+import re
 import subprocess
+import threading
+import time
+import uuid
+
+import instrumentation
+import rate_limiting
+
+logger = logging.getLogger(__name__)
+
+# Pattern that matches the number of bytes a query would process in the output
+# of a bq dry run.
+_DRY_RUN_BYTES_PATTERN = re.compile(r'will process (\d+) bytes')
+
+# Thread-local state: the _QueryAttempt running on each thread, if any.
+_local = threading.local()
+
+# Substrings of bq error output that identify each category of failure. The
+# reasons come from
+# https://cloud.google.com/bigquery/troubleshooting-errors
+_RATE_LIMITED_ERROR_MARKERS = ('rateLimitExceeded', 'Exceeded rate limits',
+                               'quotaExceeded', 'Quota exceeded')
+_BACKEND_ERROR_MARKERS = ('backendError', 'internalError', 'Backend Error',
+                          'Internal Error', 'Service Unavailable', 'HTTP 500',
+                          'HTTP 502', 'HTTP 503', 'HTTP 504')
+_RESOURCES_EXCEEDED_ERROR_MARKERS = ('resourcesExceeded', 'Resources exceeded')
 
 
 class Error(Exception):
@@ -32,14 +62,107 @@ class BqNotInstalledError(Error):
 class BqFailedError(Error):
     """Error raised when the bq utility fails."""
 
-    def __init__(self, query):
-        super(
-            BqFailedError,
-            self).__init__('bq failed when attempt to execute query:\n' + query)
+    def __init__(self, query, stderr=''):
+        message = 'bq failed when attempt to execute query:\n' + query
+        if stderr:
+            message += '\nbq error output:\n' + stderr
+        super(BqFailedError, self).__init__(message)
+        self.stderr = stderr
+
+
+class BqRateLimitedError(BqFailedError):
+    """Error raised when BigQuery rejects a query due to rate limits or quota.
+
+    These errors are transient, so the query may succeed if retried later.
+    """
+    pass
+
+
+class BqBackendError(BqFailedError):
+    """Error raised when BigQuery fails a query due to an internal error.
+
+    These errors are transient, so the query may succeed if retried later.
+    """
+    pass
+
+
+class BqResourcesExceededError(BqFailedError):
+    """Error raised when a query needs more resources than BigQuery allows.
+
+    Retrying the same query will not help, but a query over a smaller time
+    window may succeed.
+    """
+    pass
+
+
+class BqTimeoutError(BqFailedError):
+    """Error raised when a query does not complete before its deadline."""
+
+    def __init__(self, query, timeout):
+        super(BqTimeoutError, self).__init__(
+            query, 'Query did not complete within %.1f seconds.' % timeout)
+
+
+class QueryCancelledError(Error):
+    """Error raised when a query attempt was cancelled before it completed."""
+    pass
+
+
+TRANSIENT_ERRORS = (
+    # Errors for which it is worth retrying the query that caused them.
+    BqRateLimitedError,
+    BqBackendError)
+
+
+def _classify_bq_failure(query, stderr):
+    """Creates the appropriate BqFailedError for bq's error output.
+
+    Args:
+        query: The query that bq failed to execute.
+        stderr: The error output of bq.
+
+    Returns:
+        An instance of BqFailedError, or of its most specific subclass that
+        matches the error output.
+    """
+    categories = ((BqRateLimitedError, _RATE_LIMITED_ERROR_MARKERS),
+                  (BqBackendError, _BACKEND_ERROR_MARKERS),
+                  (BqResourcesExceededError, _RESOURCES_EXCEEDED_ERROR_MARKERS))
+    for error_class, markers in categories:
+        if any(marker in stderr for marker in markers):
+            return error_class(query, stderr)
+    return BqFailedError(query, stderr)
+
+
+class BqUnexpectedOutputError(Error):
+    """Error raised when bq's output is not in the expected format."""
+
+    def __init__(self, output):
+        super(BqUnexpectedOutputError,
+              self).__init__('Failed to parse output of bq:\n' + output)
+
+
+def _kill_process(process):
+    try:
+        process.kill()
+    except OSError:
+        # The process already exited.
+        pass
 
 
 class QueryExecutor(object):
 
+    def __init__(self, timeout=None):
+        """Creates a new QueryExecutor.
+
+        Args:
+            timeout: Maximum number of seconds to wait for each query to
+                complete, or None to wait indefinitely. When a query exceeds
+                its deadline, the bq process is killed and the BigQuery job is
+                cancelled.
+        """
+        self._timeout = timeout
+
     def execute_query(self, query):
         """Executes a BigQuery query and returns the results in CSV format.
 
@@ -53,19 +176,494 @@ class QueryExecutor(object):
 
         Returns:
             The result of the query in CSV format.
+
+        Raises:
+            BqTimeoutError: If the query did not complete within the timeout.
         """
         bq_params = [
             'query', '--format=csv', '--headless', '--quiet',
             '--max_rows=2000000000'
         ]
+        # Name the job so that it can be cancelled if it exceeds its deadline
+        # or loses a hedged race.
+        job_id = 'bigsanity_%s' % uuid.uuid4().hex
+        attempt = getattr(_local, 'attempt', None)
+        if attempt:
+            reason = 'another attempt at the same query completed'
+            attempt.register_job(lambda: self._cancel_job(job_id, reason))
+        result = self._run_bq(['--job_id=%s' % job_id] + bq_params, query,
+                              job_id)
+        if instrumentation.current_metrics():
+            # Don't count the header row.
+            instrumentation.add_rows_returned(max(0, len(result.splitlines()) -
+                                                  1))
+            self._record_job_statistics(job_id)
+        return result
+
+    def estimate_query_bytes(self, query):
+        """Estimates the number of bytes BigQuery would process for a query.
+
+        Performs a dry run of the query, which is free of charge and does not
+        execute the query.
+
+        Args:
+            query: A BigQuery SQL string containing a query to estimate.
+
+        Returns:
+            The number of bytes BigQuery would process to execute the query.
+
+        Raises:
+            BqUnexpectedOutputError: If the dry run output does not contain a
+                byte count.
+        """
+        output = self._run_bq(['query', '--dry_run', '--headless'], query)
+        match = _DRY_RUN_BYTES_PATTERN.search(output)
+        if not match:
+            raise BqUnexpectedOutputError(output)
+        return int(match.group(1))
+
+    def table_modified_time(self, table_name):
+        """Retrieves the time a BigQuery table was last modified.
+
+        Args:
+            table_name: Name of the table, e.g. 'plx.google:m_lab.2015_02.all'.
+
+        Returns:
+            The time the table was last modified, in seconds since the epoch.
+
+        Raises:
+            BqUnexpectedOutputError: If the table metadata does not contain a
+                modification time.
+        """
+        output = self._run_bq(['--format=json', 'show', table_name], '')
+        try:
+            # The modification time is in milliseconds since the epoch.
+            return int(json.loads(output)['lastModifiedTime']) / 1000.0
+        except (ValueError, KeyError, TypeError):
+            raise BqUnexpectedOutputError(output)
+
+    def _record_job_statistics(self, job_id):
+        """Records the statistics of a completed job in the thread's metrics.
+
+        Statistics are informational, so failing to retrieve them is logged
+        rather than raised.
+        """
         try:
-            bq_proc = subprocess.Popen(['bq'] + bq_params,
-                                       stdin=subprocess.PIPE,
-                                       stdout=subprocess.PIPE,
-                                       stderr=subprocess.PIPE)
+            show_params = ['--format=json', 'show', '-j', job_id]
+            with instrumentation.span('bq_job_statistics'):
+                # Keep the bq stages of this call out of the query's metrics.
+                with instrumentation.bind(None):
+                    job = json.loads(self._run_bq(show_params, ''))
+            statistics = job['statistics']
+            bytes_processed = int(statistics['totalBytesProcessed'])
+            # Job times are in milliseconds since the epoch.
+            execution_millis = (
+                int(statistics['endTime']) - int(statistics['startTime']))
+            instrumentation.add_bytes_processed(bytes_processed)
+            instrumentation.add_stage_time('bigquery_execution',
+                                           execution_millis / 1000.0)
+        except (Error, ValueError, KeyError) as e:
+            logger.warning('Failed to retrieve statistics for job %s: %s',
+                           job_id, e)
+
+    def _run_bq(self, bq_params, query, job_id=None):
+        try:
+            with instrumentation.span('bq_startup'):
+                bq_proc = subprocess.Popen(['bq'] + bq_params,
+                                           stdin=subprocess.PIPE,
+                                           stdout=subprocess.PIPE,
+                                           stderr=subprocess.PIPE)
         except OSError:
             raise BqNotInstalledError()
-        result = bq_proc.communicate(query)[0]
+        timed_out = threading.Event()
+        deadline_timer = None
+        if self._timeout:
+
+            def expire():
+                timed_out.set()
+                _kill_process(bq_proc)
+
+            deadline_timer = threading.Timer(self._timeout, expire)
+            deadline_timer.daemon = True
+            deadline_timer.start()
+        try:
+            with instrumentation.span('bq_wait'):
+                result, stderr = bq_proc.communicate(query)
+        finally:
+            if deadline_timer:
+                deadline_timer.cancel()
+        if timed_out.is_set():
+            if job_id:
+                self._cancel_job(job_id, 'it exceeded its deadline')
+            raise BqTimeoutError(query, self._timeout)
         if bq_proc.returncode != 0:
-            raise BqFailedError(query)
+            raise _classify_bq_failure(query, stderr)
         return result
+
+    def _cancel_job(self, job_id, reason):
+        """Requests cancellation of a BigQuery job, without waiting for it."""
+        logger.warning('Cancelling BigQuery job %s after %s.', job_id, reason)
+        try:
+            subprocess.Popen(['bq', '--nosync', 'cancel', job_id],
+                             stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE).communicate()
+        except OSError:
+            raise BqNotInstalledError()
+
+
+class RetryingQueryExecutor(object):
+    """Query executor that rate limits queries and retries transient failures.
+
+    Wraps another query executor. Every attempt to run a query first takes a
+    token from a shared token bucket, which keeps the rate of queries from
+    concurrent checks within the project quota. Queries that fail with
+    transient errors (rate limits or BigQuery backend errors) are retried after
+    a jittered exponential backoff.
+    """
+
+    def __init__(self,
+                 query_executor,
+                 token_bucket=None,
+                 max_attempts=5,
+                 initial_delay=1.0,
+                 max_delay=60.0,
+                 sleep=time.sleep):
+        """Creates a new RetryingQueryExecutor.
+
+        Args:
+            query_executor: The query executor to wrap.
+            token_bucket: TokenBucket shared by all queries, or None to not
+                limit the rate of queries.
+            max_attempts: Maximum number of times to attempt each query.
+            initial_delay: Cap on the backoff delay (in seconds) after the
+                first failed attempt. The cap doubles with each attempt.
+            max_delay: Upper limit on the backoff delay (in seconds).
+            sleep: Function that sleeps for a given number of seconds.
+        """
+        self._query_executor = query_executor
+        self._token_bucket = token_bucket
+        self._max_attempts = max_attempts
+        self._initial_delay = initial_delay
+        self._max_delay = max_delay
+        self._sleep = sleep
+
+    def execute_query(self, query):
+        """Executes a BigQuery query and returns the results in CSV format."""
+        return self._call_with_retries(self._query_executor.execute_query,
+                                       query)
+
+    def estimate_query_bytes(self, query):
+        """Estimates the number of bytes BigQuery would process for a query."""
+        return self._call_with_retries(
+            self._query_executor.estimate_query_bytes, query)
+
+    def table_modified_time(self, table_name):
+        """Retrieves the time a BigQuery table was last modified."""
+        return self._call_with_retries(self._query_executor.table_modified_time,
+                                       table_name)
+
+    def _call_with_retries(self, function, query):
+        attempt = 1
+        while True:
+            if self._token_bucket:
+                self._token_bucket.acquire()
+            try:
+                return function(query)
+            except TRANSIENT_ERRORS as e:
+                if attempt >= self._max_attempts:
+                    raise
+                delay = rate_limiting.backoff_delay(
+                    attempt, self._initial_delay, self._max_delay)
+                logger.warning(
+                    'Transient bq failure (%s) on attempt %d of %d, retrying '
+                    'in %.1f seconds.', e.__class__.__name__, attempt,
+                    self._max_attempts, delay)
+                self._sleep(delay)
+                attempt += 1
+
+
+OVERLOAD_ERRORS = (
+    # Failures that show BigQuery lacks the capacity for more concurrent
+    # queries.
+    BqRateLimitedError,
+    BqResourcesExceededError)
+
+
+class AdaptiveConcurrencyQueryExecutor(object):
+    """Query executor that adapts the number of concurrent queries.
+
+    Wraps another query executor. Every query waits for a slot under a shared
+    AimdConcurrencyLimit, which grows while queries succeed at a steady
+    latency and shrinks when BigQuery fails queries for rate limits or
+    exhausted resources. The limit in effect when each query starts is
+    recorded in the window's metrics.
+    """
+
+    def __init__(self, query_executor, concurrency_limit):
+        """Creates a new AdaptiveConcurrencyQueryExecutor.
+
+        Args:
+            query_executor: The query executor to wrap.
+            concurrency_limit: AimdConcurrencyLimit shared by all queries.
+        """
+        self._query_executor = query_executor
+        self._concurrency_limit = concurrency_limit
+
+    def execute_query(self, query):
+        """Executes a BigQuery query and returns the results in CSV format."""
+        with instrumentation.span('concurrency_wait'):
+            ticket = self._concurrency_limit.acquire()
+        instrumentation.set_concurrency_limit(self._concurrency_limit.limit)
+        outcome = rate_limiting.OUTCOME_ERROR
+        try:
+            result = self._query_executor.execute_query(query)
+            outcome = rate_limiting.OUTCOME_SUCCESS
+            return result
+        except OVERLOAD_ERRORS:
+            outcome = rate_limiting.OUTCOME_OVERLOADED
+            raise
+        finally:
+            self._concurrency_limit.release(ticket, outcome)
+
+    def estimate_query_bytes(self, query):
+        """Estimates the number of bytes BigQuery would process for a query."""
+        return self._query_executor.estimate_query_bytes(query)
+
+    def table_modified_time(self, table_name):
+        """Retrieves the time a BigQuery table was last modified."""
+        return self._query_executor.table_modified_time(table_name)
+
+
+class LatencyTracker(object):
+    """Thread-safe record of the latencies of completed queries."""
+
+    def __init__(self):
+        self._latencies = []
+        self._lock = threading.Lock()
+
+    def add(self, latency):
+        """Records the latency (in seconds) of a completed query."""
+        with self._lock:
+            bisect.insort(self._latencies, latency)
+
+    def count(self):
+        """Returns the number of latencies recorded."""
+        with self._lock:
+            return len(self._latencies)
+
+    def percentile(self, percentile):
+        """Returns the given percentile (0-100) of recorded latencies.
+
+        Uses the nearest-rank method. Returns None if no latencies have been
+        recorded.
+        """
+        with self._lock:
+            if not self._latencies:
+                return None
+            rank = int(math.ceil(percentile / 100.0 * len(self._latencies)))
+            return self._latencies[max(0, min(rank, len(self._latencies)) - 1)]
+
+
+class _QueryAttempt(object):
+    """One attempt of a hedged query, whose BigQuery jobs can be cancelled.
+
+    While an attempt runs, QueryExecutor registers each job it starts on the
+    attempt's thread, including retries of the same query.
+    """
+
+    def __init__(self):
+        self._cancel_current_job = None
+        self._cancelled = False
+        self._lock = threading.Lock()
+
+    def register_job(self, cancel_job):
+        """Records the job the attempt is about to run.
+
+        Args:
+            cancel_job: Function that requests cancellation of the job.
+
+        Raises:
+            QueryCancelledError: If the attempt was already cancelled, so the
+                job should not be started.
+        """
+        with self._lock:
+            if self._cancelled:
+                raise QueryCancelledError('Query attempt was cancelled.')
+            self._cancel_current_job = cancel_job
+
+    def cancel(self):
+        """Cancels the attempt's current job and prevents it from starting more.
+        """
+        with self._lock:
+            self._cancelled = True
+            cancel_job = self._cancel_current_job
+        if cancel_job:
+            cancel_job()
+
+
+class _QueryRace(object):
+    """Runs attempts at the same query on background threads."""
+
+    def __init__(self, function, query, latency_tracker, clock):
+        self._function = function
+        self._query = query
+        self._latency_tracker = latency_tracker
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._attempts = []
+        self._finished_attempts = set()
+        self._outcomes = []
+        # Attempts run on other threads, so carry over the caller's metrics.
+        self._metrics = instrumentation.current_metrics()
+
+    def merge_metrics(self, attempt_metrics):
+        """Adds the metrics of the attempt whose outcome was used.
+
+        Each attempt records to its own fork of the caller's metrics, so that
+        an attempt that loses the race is not counted.
+        """
+        if attempt_metrics is not None:
+            self._metrics.merge(attempt_metrics)
+
+    def start_attempt(self):
+        attempt = _QueryAttempt()
+        with self._condition:
+            self._attempts.append(attempt)
+        attempt_thread = threading.Thread(target=self._run_attempt,
+                                          args=(attempt,))
+        # Losing attempts must not keep the process alive. They are cancelled
+        # once another attempt wins.
+        attempt_thread.daemon = True
+        attempt_thread.start()
+
+    def cancel_unfinished_attempts(self):
+        """Cancels the BigQuery jobs of attempts that have not completed."""
+        with self._condition:
+            unfinished = [
+                attempt for attempt in self._attempts
+                if attempt not in self._finished_attempts
+            ]
+        for attempt in unfinished:
+            attempt.cancel()
+
+    def wait_for_outcomes(self, count, timeout=None):
+        """Waits for attempts to complete.
+
+        Args:
+            count: Number of completed attempts to wait for.
+            timeout: Maximum number of seconds to wait, or None to wait
+                indefinitely.
+
+        Returns:
+            A list of (error, result, metrics) 3-tuples, one for each attempt
+            that has completed, where error is None if the attempt succeeded
+            and metrics is what the attempt recorded, if the caller's metrics
+            are bound.
+        """
+        deadline = None if timeout is None else self._clock() + timeout
+        with self._condition:
+            while len(self._outcomes) < count:
+                if deadline is None:
+                    # Wait in short intervals so the thread stays responsive
+                    # to KeyboardInterrupt.
+                    self._condition.wait(1.0)
+                    continue
+                remaining = deadline - self._clock()
+                if remaining <= 0:
+                    break
+                self._condition.wait(remaining)
+            return list(self._outcomes)
+
+    def _run_attempt(self, attempt):
+        start_time = self._clock()
+        _local.attempt = attempt
+        attempt_metrics = self._metrics.fork() if self._metrics else None
+        try:
+            with instrumentation.bind(attempt_metrics):
+                outcome = (None, self._function(self._query), attempt_metrics)
+            self._latency_tracker.add(self._clock() - start_time)
+        except Exception as e:
+            outcome = (e, None, attempt_metrics)
+        finally:
+            _local.attempt = None
+        with self._condition:
+            self._finished_attempts.add(attempt)
+            self._outcomes.append(outcome)
+            self._condition.notify_all()
+
+
+class HedgingQueryExecutor(object):
+    """Query executor that re-issues straggling queries.
+
+    Wraps another query executor and tracks the latency of every query it runs.
+    Once enough latencies have been observed, a query that takes longer than a
+    high percentile of them (e.g. p95) is issued a second time, and whichever
+    attempt finishes first provides the result. This keeps a few stuck queries
+    from setting the duration of a whole sweep.
+    """
+
+    def __init__(self,
+                 query_executor,
+                 percentile=95,
+                 min_samples=20,
+                 clock=time.time):
+        """Creates a new HedgingQueryExecutor.
+
+        Args:
+            query_executor: The query executor to wrap.
+            percentile: Latency percentile (0-100) after which a duplicate
+                query is issued.
+            min_samples: Number of queries that must complete before any
+                query is hedged.
+            clock: Function that returns the current time in seconds.
+        """
+        self._query_executor = query_executor
+        self._percentile = percentile
+        self._min_samples = min_samples
+        self._clock = clock
+        self._latency_tracker = LatencyTracker()
+
+    def execute_query(self, query):
+        """Executes a BigQuery query and returns the results in CSV format."""
+        hedge_delay = self._hedge_delay()
+        if hedge_delay is None:
+            # The query will not be hedged, so run it on this thread.
+            start_time = self._clock()
+            result = self._query_executor.execute_query(query)
+            self._latency_tracker.add(self._clock() - start_time)
+            return result
+        race = _QueryRace(self._query_executor.execute_query, query,
+                          self._latency_tracker, self._clock)
+        race.start_attempt()
+        outcomes = race.wait_for_outcomes(1, hedge_delay)
+        if not outcomes:
+            logger.info('Query exceeded p%s latency of %.1f seconds, issuing '
+                        'a duplicate query.', self._percentile, hedge_delay)
+            race.start_attempt()
+            outcomes = race.wait_for_outcomes(1)
+            if outcomes[0][0]:
+                # The first attempt to complete failed, so fall back to the
+                # other attempt.
+                outcomes = race.wait_for_outcomes(2)
+            # Stop paying for the losing attempt.
+            race.cancel_unfinished_attempts()
+        for error, result, attempt_metrics in outcomes:
+            if not error:
+                race.merge_metrics(attempt_metrics)
+                return result
+        error, _, attempt_metrics = outcomes[-1]
+        race.merge_metrics(attempt_metrics)
+        raise error
+
+    def estimate_query_bytes(self, query):
+        """Estimates the number of bytes BigQuery would process for a query."""
+        return self._query_executor.estimate_query_bytes(query)
+
+    def table_modified_time(self, table_name):
+        """Retrieves the time a BigQuery table was last modified."""
+        return self._query_executor.table_modified_time(table_name)
+
+    def _hedge_delay(self):
+        if self._latency_tracker.count() < self._min_samples:
+            return None
+        return self._latency_tracker.percentile(self._percentile)
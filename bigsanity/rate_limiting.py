@@ -0,0 +1,233 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Utilities to keep BigQuery request rates within the project quota."""
+
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Outcomes of an operation run under an AimdConcurrencyLimit.
+OUTCOME_SUCCESS = 'success'
+OUTCOME_ERROR = 'error'
+OUTCOME_OVERLOADED = 'overloaded'
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket that limits the rate of an operation.
+
+    Tokens accumulate at a fixed rate up to a maximum capacity. Each operation
+    consumes one token, so operations can run in bursts of up to capacity, but
+    the long-run rate of operations never exceeds the fill rate.
+    """
+
+    def __init__(self, rate, capacity, clock=time.time, sleep=time.sleep):
+        """Creates a new TokenBucket, initially full.
+
+        Args:
+            rate: Number of tokens added to the bucket per second. Must be
+                positive.
+            capacity: Maximum number of tokens the bucket can hold. Must be at
+                least 1.
+            clock: Function that returns the current time in seconds.
+            sleep: Function that sleeps for a given number of seconds.
+
+        Raises:
+            ValueError: If rate or capacity are invalid.
+        """
+        if rate <= 0:
+            raise ValueError('rate must be positive, but was %s' % rate)
+        if capacity < 1:
+            raise ValueError('capacity must be at least 1, but was %s' %
+                             capacity)
+        self._rate = float(rate)
+        self._capacity = float(capacity)
+        self._clock = clock
+        self._sleep = sleep
+        self._tokens = self._capacity
+        self._last_fill = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Takes a token from the bucket, blocking until one is available."""
+        while True:
+            wait = self._try_acquire()
+            if not wait:
+                return
+            self._sleep(wait)
+
+    def _try_acquire(self):
+        """Takes a token if one is available.
+
+        Returns:
+            0 if a token was taken, otherwise the number of seconds until the
+            next token becomes available.
+        """
+        with self._lock:
+            now = self._clock()
+            self._tokens = min(self._capacity, self._tokens +
+                               (now - self._last_fill) * self._rate)
+            self._last_fill = now
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return 0
+            return (1 - self._tokens) / self._rate
+
+
+def backoff_delay(attempt, initial_delay, max_delay, rand=random.random):
+    """Calculates a jittered exponential backoff delay before a retry.
+
+    Uses "full jitter": the delay is chosen uniformly between zero and an
+    exponentially growing cap, which spreads retries from concurrent clients
+    apart so they do not hit the quota again in lockstep.
+
+    Args:
+        attempt: Number of attempts that have failed so far (starting at 1).
+        initial_delay: Cap on the delay (in seconds) after the first failure.
+        max_delay: Upper limit on the cap (in seconds) for any attempt.
+        rand: Function returning a random float in the range [0, 1).
+
+    Returns:
+        The number of seconds to wait before the next attempt.
+    """
+    cap = min(max_delay, initial_delay * (2**(attempt - 1)))
+    return rand() * cap
+
+
+class AimdConcurrencyLimit(object):
+    """Thread-safe limit on concurrent operations that adapts to capacity.
+
+    Uses additive increase, multiplicative decrease (AIMD), as TCP congestion
+    control does. Each operation that succeeds without its latency rising
+    above the recent trend raises the limit by 1/limit, so the limit grows by
+    about one for every limit's worth of operations. An operation that fails
+    because the backend is overloaded (e.g. rate limits or exhausted
+    resources) multiplies the limit by a backoff ratio. Operations that were
+    already running when the limit was reduced do not reduce it again, so a
+    burst of failures from a single overload backs off only once.
+    """
+
+    def __init__(self,
+                 max_limit,
+                 initial_limit=1,
+                 min_limit=1,
+                 backoff_ratio=0.5,
+                 latency_tolerance=2.0,
+                 clock=time.time):
+        """Creates a new AimdConcurrencyLimit.
+
+        Args:
+            max_limit: Upper bound on the limit.
+            initial_limit: Limit before any operation has completed.
+            min_limit: Lower bound on the limit. Must be at least 1.
+            backoff_ratio: Factor by which an overloaded operation multiplies
+                the limit. Must be between 0 and 1.
+            latency_tolerance: The limit is not raised while the latency of
+                recent operations exceeds this multiple of their long-run
+                average latency.
+            clock: Function that returns the current time in seconds.
+
+        Raises:
+            ValueError: If the arguments are invalid.
+        """
+        if min_limit < 1 or not min_limit <= initial_limit <= max_limit:
+            raise ValueError(
+                'limits must satisfy 1 <= min <= initial <= max, but were %s, '
+                '%s, %s' % (min_limit, initial_limit, max_limit))
+        if not 0 < backoff_ratio < 1:
+            raise ValueError('backoff_ratio must be between 0 and 1, but was '
+                             '%s' % backoff_ratio)
+        self._max_limit = float(max_limit)
+        self._min_limit = float(min_limit)
+        self._backoff_ratio = backoff_ratio
+        self._latency_tolerance = latency_tolerance
+        self._clock = clock
+        self._limit = float(initial_limit)
+        self._in_flight = 0
+        self._generation = 0
+        self._recent_latency = None
+        self._average_latency = None
+        self._condition = threading.Condition()
+
+    @property
+    def limit(self):
+        """The current number of operations allowed to run at once."""
+        with self._condition:
+            return int(self._limit)
+
+    @property
+    def in_flight(self):
+        """The number of operations running now."""
+        with self._condition:
+            return self._in_flight
+
+    def acquire(self):
+        """Blocks until an operation may start under the current limit.
+
+        Returns:
+            A ticket to pass to release when the operation completes.
+        """
+        with self._condition:
+            while self._in_flight >= int(self._limit):
+                # Wait in short intervals so the thread stays responsive to
+                # KeyboardInterrupt.
+                self._condition.wait(1.0)
+            self._in_flight += 1
+            return self._generation, self._clock()
+
+    def release(self, ticket, outcome):
+        """Records the outcome of an operation and adjusts the limit.
+
+        Args:
+            ticket: The ticket returned by acquire when the operation started.
+            outcome: One of OUTCOME_SUCCESS, OUTCOME_ERROR (a failure that says
+                nothing about capacity, which leaves the limit unchanged) or
+                OUTCOME_OVERLOADED.
+        """
+        generation, start_time = ticket
+        with self._condition:
+            self._in_flight -= 1
+            previous_limit = int(self._limit)
+            if outcome == OUTCOME_OVERLOADED:
+                if generation == self._generation:
+                    self._generation += 1
+                    self._limit = max(self._min_limit,
+                                      self._limit * self._backoff_ratio)
+                    logger.info('Reduced concurrency limit to %d.',
+                                int(self._limit))
+            elif outcome == OUTCOME_SUCCESS:
+                if self._record_latency(self._clock() - start_time):
+                    self._limit = min(self._max_limit,
+                                      self._limit + 1.0 / self._limit)
+                    if int(self._limit) > previous_limit:
+                        logger.info('Raised concurrency limit to %d.',
+                                    int(self._limit))
+            self._condition.notify_all()
+
+    def _record_latency(self, latency):
+        """Updates the latency averages.
+
+        Returns:
+            True if recent latency is within tolerance of the long-run average.
+        """
+        if self._recent_latency is None:
+            self._recent_latency = latency
+            self._average_latency = latency
+            return True
+        self._recent_latency += 0.3 * (latency - self._recent_latency)
+        self._average_latency += 0.05 * (latency - self._average_latency)
+        return (self._recent_latency <= self._average_latency *
+                self._latency_tolerance)
@@ -0,0 +1,138 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Streams a machine-readable report of a run, one JSON record per window.
+
+The report is written as results arrive, so it can be followed while a sweep
+runs and survives a sweep that is interrupted. Queries, which are several
+kilobytes each, are not repeated in every record. Instead, each distinct query
+is written once to a file named after the hash of its text, and records refer
+to that file.
+"""
+
+import hashlib
+import json
+import os
+import threading
+
+import check_table_equivalence
+
+STATUS_PASSED = 'passed'
+STATUS_FAILED = 'failed'
+
+REPORT_FILENAME = 'report.jsonl'
+SQL_DIRNAME = 'sql'
+
+
+class RunReportWriter(object):
+    """Thread-safe writer of a run report and its query artifacts."""
+
+    def __init__(self, report_dir):
+        """Creates a new RunReportWriter, creating its directory if necessary.
+
+        The report is written to report.jsonl in the directory, and queries to
+        files in its sql subdirectory. An existing report is replaced, but
+        existing query files are kept, so reports of several runs can share
+        them.
+
+        Args:
+            report_dir: Path of the directory to write the report to.
+        """
+        self._sql_dir = os.path.join(report_dir, SQL_DIRNAME)
+        if not os.path.isdir(self._sql_dir):
+            os.makedirs(self._sql_dir)
+        self._report_file = open(os.path.join(report_dir, REPORT_FILENAME), 'w')
+        self._written_sql = set()
+        self._lock = threading.Lock()
+
+    def record(self,
+               project,
+               window_start,
+               window_end,
+               check_result,
+               shard_count=1,
+               shard_index=0,
+               metrics=None):
+        """Writes the record of a checked window to the report.
+
+        Args:
+            project: Numeric ID of the M-Lab project.
+            window_start: Start of the time window (as datetime).
+            window_end: End of the time window (as datetime).
+            check_result: The CheckResult of the window.
+            shard_count: Number of shards the window was split into.
+            shard_index: Index of the shard that was checked.
+            metrics: The WindowMetrics of the check, or None if it was not
+                instrumented.
+
+        Returns:
+            The path of the file that contains the window's query, or None if
+            the query is not known.
+        """
+        sql_path = None
+        if check_result.query is not None:
+            sql_path = self._write_sql(check_result.query)
+        record = {
+            'project': project,
+            'window_start': window_start.isoformat(),
+            'window_end': window_end.isoformat(),
+            'shard_count': shard_count,
+            'shard_index': shard_index,
+            'status': (STATUS_PASSED
+                       if check_result.success else STATUS_FAILED),
+            'per_month_only_count': len(check_result.per_month_ids),
+            'per_project_only_count': len(check_result.per_project_ids),
+            'per_month_only_sample':
+            check_table_equivalence.sample_test_ids(check_result.per_month_ids),
+            'per_project_only_sample': check_table_equivalence.sample_test_ids(
+                check_result.per_project_ids),
+            'complete': check_result.complete,
+            'sql': sql_path,
+            'duration_seconds': None,
+            'stage_seconds': None,
+            'bytes_processed': None,
+        }
+        if metrics:
+            record['duration_seconds'] = metrics.duration
+            record['stage_seconds'] = metrics.stage_seconds
+            record['bytes_processed'] = metrics.bytes_processed
+        line = json.dumps(record, sort_keys=True) + '\n'
+        with self._lock:
+            self._report_file.write(line)
+            self._report_file.flush()
+        return sql_path
+
+    def close(self):
+        """Closes the report file."""
+        with self._lock:
+            self._report_file.close()
+
+    def _write_sql(self, query):
+        """Writes a query to its artifact file, unless already written.
+
+        Returns:
+            The path of the artifact file.
+        """
+        encoded = query if isinstance(query, bytes) else query.encode('utf-8')
+        digest = hashlib.sha256(encoded).hexdigest()
+        path = os.path.join(self._sql_dir, digest + '.sql')
+        with self._lock:
+            if digest not in self._written_sql and not os.path.exists(path):
+                # Write atomically, so that a file named after a hash always
+                # contains the whole query, even if the run is interrupted.
+                temp_path = path + '.tmp'
+                with open(temp_path, 'wb') as sql_file:
+                    sql_file.write(encoded)
+                os.rename(temp_path, path)
+            self._written_sql.add(digest)
+        return path
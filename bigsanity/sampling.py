@@ -0,0 +1,76 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Estimates the discrepancies of whole tables from checks of a sample.
+
+When checks are limited to a hash sample of test_id values, each test_id that
+is missing from one of the tables is found with probability equal to the
+sample rate. The number found is then approximately Poisson distributed, which
+gives an estimate of the number in the whole tables and a bound on it that
+holds even when the sample finds nothing.
+"""
+
+import collections
+import math
+
+# The z-score of the one-sided 95% confidence level of reported bounds.
+_Z_95 = 1.6448536269514722
+
+# Estimate of the number of mismatched test_ids in the tables checked.
+#   observed: Number of mismatched test_ids found in the sample.
+#   estimate: Estimated number in the whole tables.
+#   upper_bound: One-sided 95% upper confidence bound on the number in the
+#       whole tables.
+Estimate = collections.namedtuple('Estimate',
+                                  ['observed', 'estimate', 'upper_bound'])
+
+
+def poisson_upper_bound(observed):
+    """Returns a one-sided 95% upper confidence bound on a Poisson mean.
+
+    Uses the Wilson-Hilferty approximation, which is within about 1% of the
+    exact bound for every count. When nothing is observed, the bound is about
+    3, the "rule of three".
+
+    Args:
+        observed: The observed count.
+
+    Returns:
+        The upper bound, as a float.
+    """
+    count = observed + 1
+    return count * (1 - 1.0 / (9 * count) + _Z_95 / (3 * math.sqrt(count)))**3
+
+
+def estimate_mismatches(observed, sample_rate):
+    """Estimates the mismatched test_ids of whole tables from a sample.
+
+    Args:
+        observed: Number of mismatched test_ids found in the sample.
+        sample_rate: Fraction of test_ids that were sampled, in (0, 1].
+
+    Returns:
+        An Estimate of the number of mismatched test_ids in the whole tables.
+    """
+    if sample_rate == 1:
+        return Estimate(observed, observed, observed)
+    return Estimate(observed, observed / sample_rate,
+                    poisson_upper_bound(observed) / sample_rate)
+
+
+def format_estimate(estimate, sample_rate):
+    """Formats an Estimate to be printed to the console."""
+    return ('%d mismatched test_ids in a %g%% sample of test_ids, an estimated '
+            '%d in all (95%% upper bound: %d)' %
+            (estimate.observed, sample_rate * 100, round(estimate.estimate),
+             math.ceil(estimate.upper_bound)))
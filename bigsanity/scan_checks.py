@@ -0,0 +1,518 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Checks that share a single aggregate scan of the tables of a time window.
+
+The table equivalence check joins the test_id values of both tables, but many
+other problems can be found from per-day aggregates of the rows on each side.
+Each ScanCheck contributes aggregate expressions to one shared query from
+TableEquivalenceQueryGenerator.generate_aggregate_query, so adding a check adds
+columns to the query rather than another scan of the tables.
+"""
+
+import collections
+import csv
+import datetime
+import io
+import logging
+
+import check_table_equivalence
+import formatting
+import instrumentation
+import profiling
+import query_construct
+
+logger = logging.getLogger(__name__)
+
+_EPOCH = datetime.date(1970, 1, 1)
+
+# Legacy SQL's COUNT(DISTINCT) is exact up to this many distinct values, and a
+# statistical estimate beyond it.
+_EXACT_DISTINCT_LIMIT = 1000
+
+# Fraction of a day's rows by which the row count of a table may exceed its
+# estimated number of distinct test_ids before duplicates are searched for.
+DEFAULT_DUPLICATE_TOLERANCE = 0.01
+
+# The maximum number of duplicate test_id values to display for each table in
+# check failure messages.
+_MAX_DISPLAYED_DUPLICATES = 10
+
+
+def _counted_row_conditions(query_generator):
+    """Returns the conditions of the rows that are tests of the time window.
+
+    Returns:
+        A (per_month_condition, per_project_condition) 2-tuple. In the
+        per-month tables, only the last snapshot of a test is counted, which is
+        the row that belongs in the per-project table.
+    """
+    per_project_condition = '%s IS NOT NULL' % query_generator.time_field
+    per_month_condition = per_project_condition
+    if query_generator.has_intermediate_snapshots:
+        per_month_condition += ' AND web100_log_entry.is_last_entry = True'
+    return per_month_condition, per_project_condition
+
+
+def _format_day_counts(counts_by_day, labels):
+    """Formats per-day counts to be included in a check failure message.
+
+    Args:
+        counts_by_day: A list of (day, counts) 2-tuples, where counts is a tuple
+            of row counts in the same order as labels.
+        labels: The labels of the counts, e.g. ('per-month', 'per-project').
+
+    Returns:
+        An indented list with one line per day.
+    """
+    lines = []
+    for day, counts in counts_by_day:
+        lines.append('%s: %s' % (day.strftime('%Y-%m-%d'), ', '.join(
+            '%d %s' % (count, label) for count, label in zip(counts, labels))))
+    return formatting.indent('\n'.join(lines), 2)
+
+
+class ScanCheck(object):
+    """Base class of checks computed from the shared aggregate scan.
+
+    Subclasses set name and override aggregates and evaluate.
+    """
+
+    # Name of the check, used to select it on the command line. Must be a
+    # valid column alias.
+    name = None
+
+    def aggregates(self, query_generator):
+        """Returns the aggregates the check needs for a time window.
+
+        Args:
+            query_generator: The TableEquivalenceQueryGenerator of the window.
+
+        Returns:
+            A list of query_construct.Aggregate, with names unique within the
+            check. An empty list if the check does not apply to the project.
+        """
+        raise NotImplementedError()
+
+    def evaluate(self, query_generator, values_by_day, query_executor):
+        """Evaluates the check from the aggregate values of a time window.
+
+        Args:
+            query_generator: The TableEquivalenceQueryGenerator of the window.
+            values_by_day: An OrderedDict, in order of day, that maps each day
+                (as a date) with rows on either side to a dict mapping the
+                (side, name) of each of the check's aggregates to its integer
+                value. Values of a side with no rows that day are 0.
+            query_executor: Executor for any follow-up queries the check needs
+                to confirm a failure.
+
+        Returns:
+            A CheckResult object representing the result of the check.
+        """
+        raise NotImplementedError()
+
+
+class RowCountParityCheck(ScanCheck):
+    """Checks that both tables have the same number of tests each day.
+
+    Only the last snapshot of a test in the per-month tables is counted, which
+    is the row that belongs in the per-project table.
+    """
+
+    name = 'row_count_parity'
+
+    def aggregates(self, query_generator):
+        per_month_condition, per_project_condition = _counted_row_conditions(
+            query_generator)
+        return [
+            query_construct.Aggregate(
+                query_construct.SIDE_PER_MONTH, 'row_count',
+                'SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % per_month_condition),
+            query_construct.Aggregate(
+                query_construct.SIDE_PER_PROJECT, 'row_count',
+                'SUM(CASE WHEN %s THEN 1 ELSE 0 END)' % per_project_condition)
+        ]
+
+    def evaluate(self, query_generator, values_by_day, query_executor):
+        mismatched_days = []
+        for day, values in values_by_day.items():
+            counts = (values[(query_construct.SIDE_PER_MONTH, 'row_count')],
+                      values[(query_construct.SIDE_PER_PROJECT, 'row_count')])
+            if counts[0] != counts[1]:
+                mismatched_days.append((day, counts))
+        if not mismatched_days:
+            return check_table_equivalence.CheckResult(success=True)
+        return check_table_equivalence.CheckResult(
+            success=False,
+            message=('Check failed: ROW COUNT PARITY\n'
+                     'Days on which the tables have different numbers of '
+                     'rows:\n%s\n' % _format_day_counts(
+                         mismatched_days, ('per-month', 'per-project'))))
+
+
+class NullLogTimeCheck(ScanCheck):
+    """Checks that no web100 test is missing its web100_log_entry.log_time.
+
+    Such rows fall outside every time window, so the table equivalence check
+    never sees them. They are attributed to a day by their top-level log_time.
+    Paris Traceroute tests have no web100 log time, so they always pass.
+    """
+
+    name = 'null_log_time'
+
+    def aggregates(self, query_generator):
+        time_field = query_generator.time_field
+        if time_field == 'log_time':
+            return []
+        expression = 'SUM(CASE WHEN %s IS NULL THEN 1 ELSE 0 END)' % time_field
+        return [
+            query_construct.Aggregate(query_construct.SIDE_PER_MONTH,
+                                      'null_count', expression),
+            query_construct.Aggregate(query_construct.SIDE_PER_PROJECT,
+                                      'null_count', expression)
+        ]
+
+    def evaluate(self, query_generator, values_by_day, query_executor):
+        null_days = []
+        for day, values in values_by_day.items():
+            counts = (values.get(
+                (query_construct.SIDE_PER_MONTH, 'null_count'), 0), values.get(
+                    (query_construct.SIDE_PER_PROJECT, 'null_count'), 0))
+            if any(counts):
+                null_days.append((day, counts))
+        if not null_days:
+            return check_table_equivalence.CheckResult(success=True)
+        return check_table_equivalence.CheckResult(
+            success=False,
+            message=('Check failed: NULL LOG TIME\n'
+                     'Days with rows whose %s is NULL:\n%s\n' %
+                     (query_generator.time_field, _format_day_counts(
+                         null_days, ('per-month', 'per-project')))))
+
+
+class IntermediateSnapshotCheck(ScanCheck):
+    """Checks that no intermediate snapshot leaked into the per-project table.
+
+    Only applies to projects whose per-month tables hold intermediate snapshots
+    of tests, which are marked by web100_log_entry.is_last_entry being False.
+    """
+
+    name = 'intermediate_snapshots'
+
+    def aggregates(self, query_generator):
+        if not query_generator.has_intermediate_snapshots:
+            return []
+        return [
+            query_construct.Aggregate(
+                query_construct.SIDE_PER_PROJECT, 'snapshot_count',
+                'SUM(CASE WHEN web100_log_entry.is_last_entry = False '
+                'THEN 1 ELSE 0 END)')
+        ]
+
+    def evaluate(self, query_generator, values_by_day, query_executor):
+        snapshot_days = []
+        for day, values in values_by_day.items():
+            count = values.get(
+                (query_construct.SIDE_PER_PROJECT, 'snapshot_count'), 0)
+            if count:
+                snapshot_days.append((day, (count,)))
+        if not snapshot_days:
+            return check_table_equivalence.CheckResult(success=True)
+        return check_table_equivalence.CheckResult(
+            success=False,
+            message=('Check failed: INTERMEDIATE SNAPSHOTS\n'
+                     'Days with intermediate snapshots in the per-project '
+                     'table:\n%s\n' % _format_day_counts(
+                         snapshot_days, ('intermediate snapshots',))))
+
+
+class DuplicateTestIdCheck(ScanCheck):
+    """Checks that no test_id appears in more than one row of a table.
+
+    A test near a month border can be written to two monthly tables, and the
+    table equivalence check cannot see that. The shared scan compares the row
+    count of each table on each day with an approximate count of its distinct
+    test_ids. Only on days where the rows exceed that estimate by more than the
+    tolerance does a follow-up query search for the duplicates themselves, so
+    clean days cost two columns of the shared scan.
+    """
+
+    name = 'duplicate_test_ids'
+
+    def __init__(self, tolerance=DEFAULT_DUPLICATE_TOLERANCE):
+        """Creates a new DuplicateTestIdCheck.
+
+        Args:
+            tolerance: Fraction of a day's rows by which the row count may
+                exceed the estimated distinct count without a search for
+                duplicates. Days with fewer distinct test_ids than legacy SQL
+                counts exactly are searched whenever the counts differ.
+        """
+        self._tolerance = tolerance
+
+    def aggregates(self, query_generator):
+        sides = (query_construct.SIDE_PER_MONTH,
+                 query_construct.SIDE_PER_PROJECT)
+        aggregates = []
+        for side, condition in zip(sides,
+                                   _counted_row_conditions(query_generator)):
+            aggregates.append(query_construct.Aggregate(
+                side, 'row_count', 'SUM(CASE WHEN %s THEN 1 ELSE 0 END)' %
+                condition))
+            # Unlike EXACT_COUNT_DISTINCT, legacy SQL's COUNT(DISTINCT)
+            # estimates large counts in bounded memory.
+            aggregates.append(query_construct.Aggregate(
+                side, 'distinct_count',
+                'COUNT(DISTINCT CASE WHEN %s THEN test_id END)' % condition))
+        return aggregates
+
+    def evaluate(self, query_generator, values_by_day, query_executor):
+        suspect_days = collections.OrderedDict(
+            (side, [])
+            for side in (query_construct.SIDE_PER_MONTH,
+                         query_construct.SIDE_PER_PROJECT))
+        for day, values in values_by_day.items():
+            for side, days in suspect_days.items():
+                if self._exceeds_tolerance(values[(side, 'row_count')],
+                                           values[(side, 'distinct_count')]):
+                    days.append(day)
+        if not any(suspect_days.values()):
+            return check_table_equivalence.CheckResult(success=True)
+        query = query_generator.generate_duplicate_query(
+            suspect_days[query_construct.SIDE_PER_MONTH],
+            suspect_days[query_construct.SIDE_PER_PROJECT])
+        logger.debug('Searching for duplicate test_ids. BigQuery SQL:%s',
+                     formatting.indent(query))
+        with instrumentation.span('execute_duplicate_query'), profiling.phase(
+                'execute_duplicate_query'):
+            query_result = query_executor.execute_query(query)
+        duplicates = collections.OrderedDict((side, {})
+                                             for side in suspect_days)
+        for row in csv.DictReader(io.BytesIO(query_result)):
+            duplicates[row['side']][row['test_id']] = int(row['row_count'])
+        if not any(duplicates.values()):
+            return check_table_equivalence.CheckResult(success=True)
+        message = 'Check failed: DUPLICATE TEST IDS\n'
+        labels = {
+            query_construct.SIDE_PER_MONTH: 'per-month tables',
+            query_construct.SIDE_PER_PROJECT: 'per-project table'
+        }
+        for side, row_counts in duplicates.items():
+            if row_counts:
+                message += ('test_id values that appear in more than one row '
+                            'of the %s:\n%s\n' %
+                            (labels[side], _format_duplicates(row_counts)))
+        return check_table_equivalence.CheckResult(success=False,
+                                                   message=message)
+
+    def _exceeds_tolerance(self, row_count, distinct_count):
+        if distinct_count < _EXACT_DISTINCT_LIMIT:
+            return row_count > distinct_count
+        return row_count - distinct_count > self._tolerance * row_count
+
+
+def _format_duplicates(row_counts):
+    """Formats duplicate test_ids to be included in a check failure message.
+
+    Args:
+        row_counts: A dict mapping duplicate test_id values to their number of
+            rows.
+
+    Returns:
+        An indented list of at most _MAX_DISPLAYED_DUPLICATES test_id values
+        and their row counts, in lexicographic order.
+    """
+    test_ids = sorted(row_counts)
+    lines = [
+        '%s (%d rows)' % (test_id, row_counts[test_id])
+        for test_id in test_ids[:_MAX_DISPLAYED_DUPLICATES]
+    ]
+    number_omitted_ids = len(test_ids) - _MAX_DISPLAYED_DUPLICATES
+    if number_omitted_ids > 0:
+        lines.append('(%d additional test_id values omitted)' %
+                     number_omitted_ids)
+    return formatting.indent('\n'.join(lines), 2)
+
+
+CHECKS = collections.OrderedDict(
+    # Checks that can be selected by name, in the order they run.
+    (check.name, check)
+    for check in (RowCountParityCheck, NullLogTimeCheck,
+                  IntermediateSnapshotCheck, DuplicateTestIdCheck))
+
+
+def create_checks(names):
+    """Creates the checks with the given names, in the order of CHECKS."""
+    return [check() for name, check in CHECKS.items() if name in names]
+
+
+def _collect_aggregates(query_generator, checks):
+    """Collects the aggregates that scan checks need for a window.
+
+    Returns:
+        A tuple of the list of Aggregate for the shared aggregate query, with
+        names prefixed by the check name, and a dict mapping each check name
+        to the list of Aggregate it contributed.
+    """
+    aggregates_by_check = collections.OrderedDict()
+    query_aggregates = []
+    for check in checks:
+        aggregates = check.aggregates(query_generator)
+        aggregates_by_check[check.name] = aggregates
+        query_aggregates.extend(query_construct.Aggregate(
+            aggregate.side, '%s_%s' % (check.name, aggregate.name),
+            aggregate.expression) for aggregate in aggregates)
+    return query_aggregates, aggregates_by_check
+
+
+def generate_scan_query(query_generator, checks):
+    """Generates the aggregate query that scan checks share for a window.
+
+    Args:
+        query_generator: TableEquivalenceQueryGenerator for the window.
+        checks: A list of ScanCheck, with unique names.
+
+    Returns:
+        The aggregate query, or None if none of the checks needs one.
+    """
+    query_aggregates, _ = _collect_aggregates(query_generator, checks)
+    if not query_aggregates:
+        return None
+    return query_generator.generate_aggregate_query(query_aggregates)
+
+
+def _column_name(side, check_name, aggregate_name):
+    return '%s_%s_%s' % (side, check_name, aggregate_name)
+
+
+def _parse_aggregate_result(query_result, aggregates_by_check):
+    """Parses the results of an aggregate query into the values of each check.
+
+    Args:
+        query_result: The results of an aggregate query, in CSV format.
+        aggregates_by_check: A dict mapping each check name to the list of
+            Aggregate it contributed to the query.
+
+    Returns:
+        A dict mapping each check name to an OrderedDict of its values by day,
+        in the form expected by ScanCheck.evaluate.
+    """
+    rows = []
+    for row in csv.DictReader(io.BytesIO(query_result)):
+        day = row['per_month_day'] or row['per_project_day']
+        rows.append((_EPOCH + datetime.timedelta(days=int(day)), row))
+    rows.sort(key=lambda day_row: day_row[0])
+    values_by_check = {}
+    for check_name, aggregates in aggregates_by_check.items():
+        values_by_day = collections.OrderedDict()
+        for day, row in rows:
+            values_by_day[day] = dict(((aggregate.side, aggregate.name), int(
+                row[_column_name(aggregate.side, check_name, aggregate.name)] or
+                0)) for aggregate in aggregates)
+        values_by_check[check_name] = values_by_day
+    return values_by_check
+
+
+def combine_results(equivalence_result, scan_results):
+    """Combines the result of the equivalence check with those of scan checks.
+
+    Args:
+        equivalence_result: The CheckResult of the table equivalence check.
+        scan_results: A dict mapping scan check names to their CheckResult.
+
+    Returns:
+        A CheckResult that succeeds only if all of the checks succeeded, with
+        the failure messages of all the checks and the test_ids, query and
+        completeness of the table equivalence check.
+    """
+    results = [equivalence_result] + list(scan_results.values())
+    failures = [result.message for result in results if not result.success]
+    return check_table_equivalence.CheckResult(
+        success=not failures,
+        message='\n'.join(failures) if failures else None,
+        per_month_ids=equivalence_result.per_month_ids,
+        per_project_ids=equivalence_result.per_project_ids,
+        query=equivalence_result.query,
+        complete=equivalence_result.complete)
+
+
+class FusedScanChecker(object):
+    """Runs several scan checks with a single aggregate query per window."""
+
+    def __init__(self, query_generator_factory, query_executor, checks):
+        """Creates a new FusedScanChecker.
+
+        Args:
+            query_generator_factory: Factory to create
+                TableEquivalenceQueryGenerator instances.
+            query_executor: Executor for BigQuery SQL queries.
+            checks: A list of ScanCheck to run, with unique names.
+        """
+        self._query_generator_factory = query_generator_factory
+        self._query_executor = query_executor
+        self._checks = checks
+
+    def check(self,
+              project,
+              time_range_start,
+              time_range_end,
+              shard_count=1,
+              shard_index=0):
+        """Performs the scan checks for a project in a time window.
+
+        Args:
+            project: Numerical ID of M-Lab project in BigQuery (e.g. NDT = 0).
+            time_range_start: Start of window (inclusive) to check (as
+                datetime).
+            time_range_end: End of time window (not inclusive) to check (as
+                datetime).
+            shard_count: Number of test_id hash shards the time window is split
+                into. A value of 1 checks the whole window.
+            shard_index: Index of the shard to check, in the range
+                [0, shard_count).
+
+        Returns:
+            An OrderedDict mapping the name of each check to its CheckResult.
+        """
+        query_generator = self._query_generator_factory.create(
+            project,
+            time_range_start,
+            time_range_end,
+            shard_count=shard_count,
+            shard_index=shard_index)
+        query_aggregates, aggregates_by_check = _collect_aggregates(
+            query_generator, self._checks)
+        query = None
+        query_result = ''
+        if query_aggregates:
+            with instrumentation.span('generate_scan_query'), profiling.phase(
+                    'generate_scan_query'):
+                query = query_generator.generate_aggregate_query(
+                    query_aggregates)
+            logger.debug('Performing scan checks. BigQuery SQL:%s',
+                         formatting.indent(query))
+            with instrumentation.span('execute_scan_query'), profiling.phase(
+                    'execute_scan_query'):
+                query_result = self._query_executor.execute_query(query)
+        values_by_check = _parse_aggregate_result(query_result,
+                                                  aggregates_by_check)
+        results = collections.OrderedDict()
+        for check in self._checks:
+            result = check.evaluate(query_generator,
+                                    values_by_check[check.name],
+                                    self._query_executor)
+            results[check.name] = check_table_equivalence.CheckResult(
+                success=result.success,
+                message=result.message,
+                query=query)
+        return results
@@ -0,0 +1,197 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Schedules the execution of sanity check jobs."""
+
+import collections
+import sys
+import threading
+from multiprocessing import pool
+
+try:
+    import Queue as queue
+except ImportError:  # Python 3
+    import queue
+
+# Sentinel a worker thread enqueues when it runs out of jobs.
+_WORKER_DONE = object()
+
+
+def _reraise(exc_type, exc_value, exc_tb):
+    """Re-raises an exception with the traceback where it was first raised."""
+    raise exc_value.with_traceback(exc_tb)
+
+
+if sys.version_info[0] < 3:
+    # Python 2 needs the three-argument raise statement, which is a syntax
+    # error in Python 3, so it is compiled only when running on Python 2.
+    exec ('def _reraise(exc_type, exc_value, exc_tb):\n'
+          '    raise exc_type, exc_value, exc_tb\n')
+
+
+def run_concurrently(function, jobs, concurrency):
+    """Applies a function to each job, running several jobs at once.
+
+    Jobs are expected to spend most of their time waiting on BigQuery, so they
+    run on threads rather than in separate processes.
+
+    Args:
+        function: Function to apply to each job.
+        jobs: A list of jobs to pass to the function.
+        concurrency: Maximum number of jobs to run at once. If this is 1, jobs
+            run in order on the calling thread.
+
+    Yields:
+        The result of the function for each job. If concurrency is greater than
+        1, results are yielded in the order the jobs complete, which may differ
+        from the order of the jobs.
+    """
+    if concurrency == 1:
+        for job in jobs:
+            yield function(job)
+        return
+    thread_pool = pool.ThreadPool(concurrency)
+    try:
+        for result in thread_pool.imap_unordered(function, jobs):
+            yield result
+    finally:
+        thread_pool.terminate()
+
+
+class _FairShareDispatcher(object):
+    """Hands out jobs from several groups in proportion to their weights.
+
+    Groups take turns in proportion to their weights (stride scheduling), but
+    a group is skipped while its running jobs already fill its weighted share
+    of the concurrency slots among the groups that still have jobs. A group
+    whose jobs take longer to run therefore does not take slots away from the
+    other groups.
+    """
+
+    def __init__(self, jobs_by_group, weights, concurrency):
+        self._lock = threading.Lock()
+        self._pending = collections.OrderedDict()
+        for group, jobs in jobs_by_group.items():
+            if jobs:
+                self._pending[group] = collections.deque(jobs)
+        self._weights = dict((group, float(weights.get(group, 1)))
+                             for group in self._pending)
+        self._concurrency = concurrency
+        self._running = collections.defaultdict(int)
+        self._dispatched = collections.defaultdict(int)
+        self._stopped = False
+
+    def _next_group(self):
+        active_weight = sum(weight for group, weight in self._weights.items()
+                            if group in self._pending or self._running[group])
+        eligible = [
+            group for group in self._pending
+            if self._running[group] < self._concurrency * self._weights[group] /
+            active_weight
+        ]
+        return min(
+            eligible or self._pending,
+            key=lambda group: (self._dispatched[group] + 1) / self._weights[group])
+
+    def next_job(self):
+        """Returns a (group, job) pair, or None once no jobs remain."""
+        with self._lock:
+            if self._stopped or not self._pending:
+                return None
+            group = self._next_group()
+            job = self._pending[group].popleft()
+            if not self._pending[group]:
+                del self._pending[group]
+            self._running[group] += 1
+            self._dispatched[group] += 1
+            return group, job
+
+    def job_finished(self, group):
+        with self._lock:
+            self._running[group] -= 1
+
+    def stop(self):
+        """Stops handing out jobs, e.g. after a job fails."""
+        with self._lock:
+            self._stopped = True
+
+
+def run_fair_share(function, jobs_by_group, concurrency, weights=None):
+    """Applies a function to jobs from several groups under one concurrency cap.
+
+    For example, the jobs of each M-Lab project form a group, so that checking
+    several projects at once neither exceeds the overall query concurrency nor
+    lets one project's windows starve the others.
+
+    Args:
+        function: Function to apply to each job.
+        jobs_by_group: A dict mapping each group to a list of its jobs.
+        concurrency: Maximum number of jobs to run at once, across all groups.
+        weights: An optional dict mapping groups to positive numbers. While
+            several groups have pending jobs, each group's share of the
+            concurrency is proportional to its weight. Groups not in the dict
+            have a weight of 1.
+
+    Yields:
+        The result of the function for each job, in the order the jobs
+        complete.
+    """
+    dispatcher = _FairShareDispatcher(jobs_by_group, weights or {}, concurrency)
+    if concurrency == 1:
+        while True:
+            next_job = dispatcher.next_job()
+            if next_job is None:
+                return
+            group, job = next_job
+            yield function(job)
+            dispatcher.job_finished(group)
+
+    results = queue.Queue()
+
+    def work():
+        try:
+            while True:
+                next_job = dispatcher.next_job()
+                if next_job is None:
+                    break
+                group, job = next_job
+                try:
+                    result = function(job)
+                except Exception:
+                    dispatcher.stop()
+                    results.put((False, sys.exc_info()))
+                    break
+                dispatcher.job_finished(group)
+                results.put((True, result))
+        finally:
+            results.put(_WORKER_DONE)
+
+    workers = [threading.Thread(target=work) for _ in range(concurrency)]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    try:
+        workers_done = 0
+        while workers_done < len(workers):
+            item = results.get()
+            if item is _WORKER_DONE:
+                workers_done += 1
+                continue
+            succeeded, value = item
+            if not succeeded:
+                # Re-raise with the traceback of the worker thread, which
+                # shows where the job failed.
+                _reraise(*value)
+            yield value
+    finally:
+        dispatcher.stop()
@@ -0,0 +1,426 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Runs BigSanity as a long-lived service.
+
+In service mode, a single query executor (with its rate limiter and latency
+statistics) is shared by every check, and the result of each checked time
+window is cached. Per-project schedules periodically re-check recent windows,
+and a small HTTP API answers ad hoc checks of a time range, using cached
+window results where they are fresh enough:
+
+    GET /check?project=0&start=2015-01-01&end=2015-01-08[&cached_only=1]
+    GET /status
+"""
+
+import collections
+import datetime
+import json
+import logging
+import threading
+import time
+
+try:
+    import BaseHTTPServer as http_server
+    import SocketServer as socketserver
+    import urlparse
+except ImportError:
+    import http.server as http_server
+    import socketserver
+    import urllib.parse as urlparse
+
+import cli
+import intervals
+import query_execution
+import scheduling
+import table_names
+
+# Statuses of a time window in service responses.
+STATUS_PASSED = 'passed'
+STATUS_FAILED = 'failed'
+STATUS_ERROR = 'error'
+STATUS_UNKNOWN = 'unknown'
+
+logger = logging.getLogger(__name__)
+
+CachedResult = collections.namedtuple('CachedResult',
+                                      ['check_result', 'checked_at'])
+
+# A periodic re-check of a project's most recent lookback_days days, every
+# interval seconds.
+Schedule = collections.namedtuple('Schedule',
+                                  ['project', 'interval', 'lookback_days'])
+
+
+def parse_schedule_arg(schedule_arg):
+    """Parses a schedule command line parameter of the form P:MINUTES:DAYS.
+
+    For example, '0:60:7' re-checks the last 7 days of project 0 every 60
+    minutes.
+
+    Raises:
+        ValueError: If the schedule is malformed or contains values that are
+            not positive.
+    """
+    try:
+        project, minutes, lookback_days = [
+            int(part) for part in schedule_arg.split(':')
+        ]
+    except ValueError:
+        raise ValueError('Schedule must have the form PROJECT:MINUTES:DAYS: '
+                         '%s' % schedule_arg)
+    if project < 0 or minutes <= 0 or lookback_days <= 0:
+        raise ValueError('Schedule values must be positive: %s' % schedule_arg)
+    return Schedule(project, minutes * 60, lookback_days)
+
+
+class ResultCache(object):
+    """Thread-safe cache of check results for individual time windows."""
+
+    def __init__(self, ttl=None, clock=time.time):
+        """Creates a new ResultCache.
+
+        Args:
+            ttl: Number of seconds for which a result stays fresh, or None if
+                results never expire.
+            clock: Function that returns the current time in seconds.
+        """
+        self._ttl = ttl
+        self._clock = clock
+        self._results = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Returns the fresh CachedResult for a key, or None."""
+        with self._lock:
+            cached = self._results.get(key)
+        if cached is None:
+            return None
+        if self._ttl is not None and (
+                self._clock() - cached.checked_at > self._ttl):
+            return None
+        return cached
+
+    def put(self, key, check_result):
+        """Caches the result of a check and returns the cached entry.
+
+        Expired entries are removed, so that the cache of a long-running
+        service stays bounded by the windows checked within the TTL.
+        """
+        now = self._clock()
+        cached = CachedResult(check_result, now)
+        with self._lock:
+            if self._ttl is not None:
+                expired = [
+                    expired_key
+                    for expired_key, expired_result in self._results.items()
+                    if now - expired_result.checked_at > self._ttl
+                ]
+                for expired_key in expired:
+                    del self._results[expired_key]
+            self._results[key] = cached
+        return cached
+
+    def __len__(self):
+        with self._lock:
+            return len(self._results)
+
+
+class CheckService(object):
+    """Checks time ranges by window, reusing cached window results."""
+
+    def __init__(self,
+                 checker,
+                 date_step,
+                 concurrency=1,
+                 cache_ttl=None,
+                 clock=time.time,
+                 today=None):
+        """Creates a new CheckService.
+
+        Args:
+            checker: TableEquivalenceChecker used to check each window.
+            date_step: Size of each checked time window (as relativedelta).
+            concurrency: Maximum number of windows to check at once.
+            cache_ttl: Number of seconds for which a window result can answer
+                ad hoc checks, or None if results never expire.
+            clock: Function that returns the current time in seconds.
+            today: Function that returns midnight of the current day (as
+                datetime), which ends the range of scheduled checks.
+        """
+        self._checker = checker
+        self._date_step = date_step
+        self._concurrency = concurrency
+        self._cache = ResultCache(cache_ttl, clock)
+        self._clock = clock
+        self._today = today or _midnight_today
+        self._last_scheduled_runs = {}
+        self._lock = threading.Lock()
+
+    def check_range(self,
+                    project,
+                    start,
+                    end,
+                    cached_only=False,
+                    refresh=False):
+        """Checks a time range, window by window.
+
+        Args:
+            project: Numeric ID of the M-Lab project.
+            start: Start of the time range (as datetime, inclusive).
+            end: End of the time range (as datetime, exclusive).
+            cached_only: If True, only cached results are reported, and windows
+                without a fresh result have the status STATUS_UNKNOWN.
+            refresh: If True, every window is checked again, even if it has a
+                fresh cached result.
+
+        Returns:
+            A dict describing the check of the range, suitable for JSON.
+
+        Raises:
+            ValueError: If the project is unknown, or the time range is empty
+                or outside the range of the M-Lab tables.
+        """
+        _validate_range(project, start, end)
+        # Windows are cut on a fixed grid, so that overlapping ranges share
+        # cached window results.
+        windows = intervals.grid_intervals(start, end, self._date_step)
+        statuses = {}
+        pending = []
+        for window in windows:
+            cached = None if refresh else self._cache.get((project,) + window)
+            if cached:
+                statuses[window] = self._format_window(window, cached, True)
+            elif cached_only:
+                statuses[window] = self._format_unknown_window(window)
+            else:
+                pending.append(window)
+
+        def check_window(window):
+            return window, self._check_window(project, window)
+
+        for window, status in scheduling.run_concurrently(check_window, pending,
+                                                          self._concurrency):
+            statuses[window] = status
+        window_statuses = [statuses[window] for window in windows]
+        return {
+            'project': project,
+            'start': cli.format_time(start),
+            'end': cli.format_time(end),
+            'success': _summarize_success(window_statuses),
+            'windows': window_statuses,
+        }
+
+    def run_schedule(self, schedule):
+        """Re-checks the windows covered by a schedule."""
+        end = self._today()
+        start = end - datetime.timedelta(days=schedule.lookback_days)
+        logger.info('Running scheduled check for project=%d, %s -> %s',
+                    schedule.project, cli.format_time(start),
+                    cli.format_time(end))
+        result = self.check_range(schedule.project, start, end, refresh=True)
+        with self._lock:
+            self._last_scheduled_runs[schedule.project] = {
+                'checked_at': self._clock(),
+                'success': result['success'],
+            }
+        return result
+
+    def status(self):
+        """Returns a dict describing the service, suitable for JSON."""
+        with self._lock:
+            last_scheduled_runs = dict(
+                (str(project), run)
+                for project, run in self._last_scheduled_runs.items())
+        return {
+            'cached_windows': len(self._cache),
+            'last_scheduled_runs': last_scheduled_runs,
+        }
+
+    def _check_window(self, project, window):
+        window_start, window_end = window
+        try:
+            check_result = self._checker.check(project, window_start,
+                                               window_end)
+        except Exception as e:
+            # A failure of one window should not fail the whole range. Errors
+            # other than query errors are unexpected, so log their traceback.
+            log = (logger.error if isinstance(e, query_execution.Error) else
+                   logger.exception)
+            log('Check of project=%d, %s -> %s failed: %s', project,
+                cli.format_time(window_start), cli.format_time(window_end), e)
+            window_status = self._format_unknown_window(window)
+            window_status.update({'status': STATUS_ERROR, 'message': str(e)})
+            return window_status
+        cached = self._cache.put((project,) + window, check_result)
+        return self._format_window(window, cached, False)
+
+    def _format_window(self, window, cached, from_cache):
+        check_result = cached.check_result
+        return {
+            'start': cli.format_time(window[0]),
+            'end': cli.format_time(window[1]),
+            'status': STATUS_PASSED if check_result.success else STATUS_FAILED,
+            'message': check_result.message,
+            'checked_at': cached.checked_at,
+            'cached': from_cache,
+        }
+
+    def _format_unknown_window(self, window):
+        return {
+            'start': cli.format_time(window[0]),
+            'end': cli.format_time(window[1]),
+            'status': STATUS_UNKNOWN,
+            'message': None,
+            'checked_at': None,
+            'cached': False,
+        }
+
+
+def _midnight_today():
+    """Returns midnight of the current day (as datetime)."""
+    return datetime.datetime.combine(datetime.date.today(), datetime.time())
+
+
+def _validate_range(project, start, end):
+    """Checks that a project and time range can be checked.
+
+    Raises:
+        ValueError: If the project is unknown, or the time range is empty or
+            outside the range of the M-Lab tables.
+    """
+    table_names.per_project_table(project)
+    if start >= end:
+        raise ValueError('start (%s) must be before end (%s)' %
+                         (cli.format_time(start), cli.format_time(end)))
+    table_names.monthly_tables(start, end)
+
+
+def _summarize_success(window_statuses):
+    """Returns whether all windows passed, or None if any is undetermined."""
+    statuses = set(w['status'] for w in window_statuses)
+    if STATUS_FAILED in statuses:
+        return False
+    if statuses - set([STATUS_PASSED]):
+        return None
+    return True
+
+
+class ScheduleRunner(threading.Thread):
+    """Background thread that runs each schedule at its interval."""
+
+    def __init__(self, service, schedules, clock=time.time):
+        super(ScheduleRunner, self).__init__(name='ScheduleRunner')
+        self.daemon = True
+        self._service = service
+        self._schedules = schedules
+        self._clock = clock
+        self._stopped = threading.Event()
+
+    def run(self):
+        if not self._schedules:
+            # Only the HTTP API is served, so wait until stopped.
+            self._stopped.wait()
+            return
+        next_runs = [self._clock()] * len(self._schedules)
+        while not self._stopped.is_set():
+            for i, schedule in enumerate(self._schedules):
+                if self._clock() >= next_runs[i]:
+                    try:
+                        self._service.run_schedule(schedule)
+                    except Exception:
+                        logger.exception('Scheduled check of project=%d failed',
+                                         schedule.project)
+                    next_runs[i] = self._clock() + schedule.interval
+            self._stopped.wait(max(0, min(next_runs) - self._clock()))
+
+    def stop(self):
+        self._stopped.set()
+
+
+class _RequestHandler(http_server.BaseHTTPRequestHandler):
+    """Handles requests to the service's HTTP API."""
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        params = dict((name, values[-1])
+                      for name, values in urlparse.parse_qs(url.query).items())
+        if url.path == '/status':
+            self._send_json(200, self.server.service.status())
+        elif url.path == '/check':
+            try:
+                project = int(params['project'])
+                start = cli.parse_date_arg(params['start'])
+                end = cli.parse_date_arg(params['end'])
+            except (KeyError, ValueError) as e:
+                self._send_json(400, {
+                    'error': ('/check requires the parameters project, start '
+                              'and end: %s' % e)
+                })
+                return
+            cached_only = params.get('cached_only') in ('1', 'true')
+            try:
+                result = self.server.service.check_range(project, start, end,
+                                                         cached_only)
+            except ValueError as e:
+                self._send_json(400, {'error': str(e)})
+                return
+            self._send_json(200, result)
+        else:
+            self._send_json(404, {'error': 'Unknown path: %s' % url.path})
+
+    def _send_json(self, code, response):
+        body = json.dumps(response, sort_keys=True).encode('utf-8')
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug('%s - %s', self.address_string(), format % args)
+
+
+class _ThreadingHTTPServer(socketserver.ThreadingMixIn, http_server.HTTPServer):
+    daemon_threads = True
+
+
+def create_http_server(service, port, host='127.0.0.1'):
+    """Creates an HTTP server for the service's API.
+
+    Args:
+        service: CheckService that answers requests.
+        port: Port to listen on, or 0 for any free port.
+        host: Address to listen on. Defaults to the loopback interface.
+
+    Returns:
+        An HTTP server, which starts handling requests when its
+        serve_forever() method is called.
+    """
+    server = _ThreadingHTTPServer((host, port), _RequestHandler)
+    server.service = service
+    return server
+
+
+def serve(service, schedules, port, host='127.0.0.1'):
+    """Runs the schedules and serves the HTTP API until interrupted."""
+    runner = ScheduleRunner(service, schedules)
+    runner.start()
+    server = create_http_server(service, port, host)
+    logger.info('Serving BigSanity API on http://%s:%d/', host,
+                server.server_address[1])
+    try:
+        server.serve_forever()
+    finally:
+        runner.stop()
+        server.server_close()
@@ -0,0 +1,363 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Generates synthetic M-Lab tables with known discrepancies.
+
+The generated tables reproduce the quirks of the real M-Lab dataset that the
+equivalence checks must handle:
+
+    * test_id values in the format each project uses.
+    * paris_traceroute rows store their time in log_time, while the web100
+      projects store it in web100_log_entry.log_time.
+    * NDT and NPAD tests have intermediate snapshots in the per-month tables
+      (rows with web100_log_entry.is_last_entry = False).
+    * Tests close to a month border are sometimes published in the adjacent
+      month's table.
+
+A chosen fraction of tests is left out of one of the two tables, and each such
+discrepancy is written to a ground truth file, so that sweeps against the
+generated tables can be verified. Rows are written to the database in chunks,
+and discrepancies to the ground truth file one day at a time, so the generated
+tables may be much larger than memory.
+
+Usage:
+
+    python synthetic_data.py --database synthetic.db --ground_truth truth.json \
+        -p 0 -s 2015-01-01 -e 2015-03-01 --tests_per_day 10000
+"""
+
+import argparse
+import collections
+import datetime
+import json
+import logging
+import random
+
+import cli
+import constants
+import local_execution
+import table_names
+
+MISSING_FROM_PER_MONTH = 'per_month'
+MISSING_FROM_PER_PROJECT = 'per_project'
+
+# Tests within this many seconds of a month border may be published in the
+# adjacent month's table.
+_SPILLOVER_SECONDS = 3600
+
+_MLAB_SITES = ('ams01', 'atl01', 'lga02', 'lhr01', 'nuq01', 'syd01', 'tyo01')
+
+LOG_FORMAT = '%(asctime)-15s %(levelname)-5s %(message)s'
+logger = logging.getLogger(__name__)
+
+Discrepancy = collections.namedtuple(
+    'Discrepancy', ['project', 'test_id', 'log_time', 'missing_from'])
+
+
+def _to_unix_timestamp(dt):
+    return int((dt - datetime.datetime(1970, 1, 1)).total_seconds())
+
+
+def _format_ip(number):
+    """Formats the low 32 bits of a number as an IPv4 address."""
+    return '.'.join(str((number >> shift) & 0xff) for shift in (24, 16, 8, 0))
+
+
+def format_test_id(project, test_time, sequence, rng):
+    """Formats a test_id in the style of the given project.
+
+    Args:
+        project: Numeric ID of the M-Lab project.
+        test_time: Time of the test (as datetime).
+        sequence: Sequence number of the test, which makes the test_id unique
+            among up to 2^32 tests of a project.
+        rng: Random number generator used to choose the server.
+
+    Returns:
+        A test_id, e.g. for NDT:
+        '2015/01/05/mlab1.lga02.measurement-lab.org/'
+        '20150105T12:34:56.789012000Z_c-0-0-0-42.example.net:5042.'
+        's2c_snaplog.gz'
+    """
+    server = 'mlab%d.%s.measurement-lab.org' % (rng.randint(1, 4),
+                                                rng.choice(_MLAB_SITES))
+    prefix = '%s/%s' % (test_time.strftime('%Y/%m/%d'), server)
+    client_ip = _format_ip(sequence)
+    client_port = 1024 + sequence % 64000
+    if project == constants.PROJECT_ID_NDT:
+        return '%s/%s000Z_c-%s.example.net:%d.s2c_snaplog.gz' % (
+            prefix, test_time.strftime('%Y%m%dT%H:%M:%S.%f'),
+            client_ip.replace('.', '-'), client_port)
+    if project == constants.PROJECT_ID_NPAD:
+        return '%s/%s000Z_%s:%d.c2s_snaplog.gz' % (
+            prefix, test_time.strftime('%Y%m%dT%H:%M:%S.%f'), client_ip,
+            client_port)
+    if project == constants.PROJECT_ID_SIDESTREAM:
+        return '%s/%sZ_%s_%d.web100' % (prefix,
+                                        test_time.strftime('%Y%m%dT%H:%M:%S'),
+                                        client_ip, client_port)
+    if project == constants.PROJECT_ID_PARIS_TRACEROUTE:
+        return '%s/%sZ-%s-%d-%s-%d.paris' % (
+            prefix, test_time.strftime('%Y%m%dT%H:%M:%S'),
+            _format_ip(rng.getrandbits(32)), rng.randint(33434, 33534),
+            client_ip, client_port)
+    raise ValueError('Unexpected project ID: %d' % project)
+
+
+def _has_intermediate_snapshots(project):
+    return (project == constants.PROJECT_ID_NDT or
+            project == constants.PROJECT_ID_NPAD)
+
+
+class _ChunkedTableWriter(object):
+    """Buffers rows per table and loads them into the database in chunks."""
+
+    def __init__(self, executor, chunk_size):
+        self._executor = executor
+        self._chunk_size = chunk_size
+        self._buffers = collections.defaultdict(list)
+
+    def write(self, table_name, row):
+        buffer = self._buffers[table_name]
+        buffer.append(row)
+        if len(buffer) >= self._chunk_size:
+            self._flush_table(table_name)
+
+    def flush(self):
+        for table_name in list(self._buffers):
+            self._flush_table(table_name)
+
+    def _flush_table(self, table_name):
+        self._executor.load_table(table_name, self._buffers.pop(table_name))
+
+
+class SyntheticDatasetGenerator(object):
+    """Generates synthetic per-month and per-project M-Lab tables."""
+
+    def __init__(self,
+                 executor,
+                 seed=0,
+                 missing_rate=0.0,
+                 snapshots_per_test=3,
+                 spillover_rate=0.5,
+                 chunk_size=10000):
+        """Creates a new SyntheticDatasetGenerator.
+
+        Args:
+            executor: SqliteQueryExecutor to which generated tables are written.
+            seed: Seed for the random number generator. The same seed always
+                produces the same tables.
+            missing_rate: Fraction of tests that are left out of one of the two
+                tables (per-month or per-project, with equal probability).
+            snapshots_per_test: Number of snapshots written to the per-month
+                table for each NDT and NPAD test, including the last one.
+            spillover_rate: Fraction of tests close to a month border that are
+                published in the adjacent month's table.
+            chunk_size: Number of rows to buffer per table before writing them
+                to the database.
+        """
+        self._executor = executor
+        self._seed = seed
+        self._missing_rate = missing_rate
+        self._snapshots_per_test = snapshots_per_test
+        self._spillover_rate = spillover_rate
+        self._chunk_size = chunk_size
+
+    def generate(self,
+                 project,
+                 start_date,
+                 end_date,
+                 tests_per_day,
+                 ground_truth_file=None):
+        """Generates tests for a project over a date range.
+
+        Args:
+            project: Numeric ID of the M-Lab project.
+            start_date: Start of the date range (as datetime, inclusive).
+            end_date: End of the date range (as datetime, exclusive).
+            tests_per_day: Number of tests to generate for each day.
+            ground_truth_file: Optional file to which a Discrepancy is written
+                for each test that was left out of one of the tables, in the
+                format of write_ground_truth and sorted by log_time.
+
+        Returns:
+            The number of tests that were left out of one of the tables.
+        """
+        rng = random.Random(self._seed * 4 + project)
+        writer = _ChunkedTableWriter(self._executor, self._chunk_size)
+        per_project_table = table_names.per_project_table(project)
+        discrepancy_count = 0
+        sequence = 0
+        day = start_date
+        while day < end_date:
+            # Only one day of discrepancies is held in memory, and days are
+            # generated in order, so sorting each day sorts the whole file.
+            discrepancies = []
+            for _ in range(tests_per_day):
+                test_time = day + datetime.timedelta(
+                    seconds=rng.randrange(86400),
+                    microseconds=rng.randrange(1000000))
+                test_id = format_test_id(project, test_time, sequence, rng)
+                sequence += 1
+                log_time = _to_unix_timestamp(test_time)
+                missing_from = None
+                if rng.random() < self._missing_rate:
+                    missing_from = rng.choice(
+                        (MISSING_FROM_PER_MONTH, MISSING_FROM_PER_PROJECT))
+                    discrepancies.append(Discrepancy(project, test_id, log_time,
+                                                     missing_from))
+                if missing_from != MISSING_FROM_PER_MONTH:
+                    per_month_table = self._per_month_table(test_time, rng)
+                    for row in self._per_month_rows(project, test_id, log_time):
+                        writer.write(per_month_table, row)
+                if missing_from != MISSING_FROM_PER_PROJECT:
+                    writer.write(per_project_table,
+                                 self._format_row(project, test_id, log_time))
+            discrepancies.sort(key=lambda d: (d.log_time, d.test_id))
+            if ground_truth_file:
+                write_ground_truth(discrepancies, ground_truth_file)
+            discrepancy_count += len(discrepancies)
+            day += datetime.timedelta(days=1)
+        writer.flush()
+        logger.info('Generated %d tests for project=%d with %d discrepancies.',
+                    sequence, project, discrepancy_count)
+        return discrepancy_count
+
+    def _per_month_rows(self, project, test_id, log_time):
+        """Returns the per-month table rows for a test."""
+        if not _has_intermediate_snapshots(project):
+            return [self._format_row(project, test_id, log_time)]
+        rows = []
+        for snapshot in range(self._snapshots_per_test - 1, -1, -1):
+            rows.append(self._format_row(project,
+                                         test_id,
+                                         log_time - snapshot,
+                                         is_last_entry=(snapshot == 0)))
+        return rows
+
+    def _per_month_table(self, test_time, rng):
+        """Returns the monthly table in which a test is published."""
+        month_start = test_time.replace(day=1,
+                                        hour=0,
+                                        minute=0,
+                                        second=0,
+                                        microsecond=0)
+        next_month_start = (month_start + datetime.timedelta(days=32)).replace(
+            day=1)
+        if rng.random() < self._spillover_rate:
+            if test_time - month_start < datetime.timedelta(
+                    seconds=_SPILLOVER_SECONDS):
+                return table_names.monthly_table(month_start -
+                                                 datetime.timedelta(days=1))
+            if next_month_start - test_time < datetime.timedelta(
+                    seconds=_SPILLOVER_SECONDS):
+                return table_names.monthly_table(next_month_start)
+        return table_names.monthly_table(month_start)
+
+    def _format_row(self, project, test_id, log_time, is_last_entry=True):
+        row = {'test_id': test_id, 'project': project}
+        if project == constants.PROJECT_ID_PARIS_TRACEROUTE:
+            row['log_time'] = log_time
+        else:
+            row['web100_log_entry.log_time'] = log_time
+            row['web100_log_entry.is_last_entry'] = is_last_entry
+        return row
+
+
+def write_ground_truth(discrepancies, ground_truth_file):
+    """Writes discrepancies to a file as JSON, one object per line."""
+    for discrepancy in discrepancies:
+        ground_truth_file.write(json.dumps(discrepancy._asdict(),
+                                           sort_keys=True) + '\n')
+
+
+def read_ground_truth(ground_truth_file):
+    """Reads the discrepancies written by write_ground_truth.
+
+    Yields:
+        A Discrepancy for each line of the file.
+    """
+    for line in ground_truth_file:
+        fields = json.loads(line)
+        yield Discrepancy(fields['project'], str(fields['test_id']),
+                          fields['log_time'], str(fields['missing_from']))
+
+
+def main(args):
+    logging.basicConfig(level=logging.INFO, format=LOG_FORMAT)
+    executor = local_execution.SqliteQueryExecutor(args.database)
+    generator = SyntheticDatasetGenerator(
+        executor, args.seed, args.missing_rate, args.snapshots_per_test,
+        args.spillover_rate, args.chunk_size)
+    with open(args.ground_truth, 'w') as ground_truth_file:
+        for project in args.project:
+            generator.generate(project, args.start_date, args.end_date,
+                               args.tests_per_day, ground_truth_file)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        prog='BigSanity: Synthetic M-Lab Dataset Generator',
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--database',
+                        required=True,
+                        help='Path of the SQLite database to write tables to')
+    parser.add_argument(
+        '--ground_truth',
+        required=True,
+        help=('Path of a file to which the injected discrepancies are '
+              'written, one JSON object per line'))
+    parser.add_argument('-p',
+                        '--project',
+                        type=int,
+                        choices=range(0, 4),
+                        nargs='+',
+                        required=True,
+                        help='IDs of M-Lab projects to generate tests for')
+    parser.add_argument('-s',
+                        '--start_date',
+                        required=True,
+                        type=cli.parse_date_arg,
+                        help='Date of the first generated test')
+    parser.add_argument('-e',
+                        '--end_date',
+                        required=True,
+                        type=cli.parse_date_arg,
+                        help='Date after the last generated test')
+    parser.add_argument('--tests_per_day',
+                        default=1000,
+                        type=cli.parse_positive_int_arg,
+                        help='Number of tests to generate per project per day')
+    parser.add_argument(
+        '--missing_rate',
+        default=0.001,
+        type=float,
+        help=('Fraction of tests to leave out of either the per-month or the '
+              'per-project table'))
+    parser.add_argument(
+        '--snapshots_per_test',
+        default=3,
+        type=cli.parse_positive_int_arg,
+        help='Number of per-month snapshots of each NDT and NPAD test')
+    parser.add_argument(
+        '--spillover_rate',
+        default=0.5,
+        type=float,
+        help=('Fraction of tests near a month border to publish in the '
+              'adjacent month\'s table'))
+    parser.add_argument('--seed', default=0, type=int, help='Random seed')
+    parser.add_argument('--chunk_size',
+                        default=10000,
+                        type=cli.parse_positive_int_arg,
+                        help='Number of rows to write to the database at once')
+    main(parser.parse_args())
@@ -18,6 +18,7 @@ import datetime
 from dateutil import relativedelta
 
 import constants
+import intervals
 
 
 def monthly_tables(time_range_start, time_range_end):
@@ -41,12 +42,8 @@ def monthly_tables(time_range_start, time_range_end):
              'plx.google:m_lab.2015_02.all',
              'plx.google:m_lab.2015_03.all']
     """
-    MIN_TABLE_MONTH = datetime.datetime.fromtimestamp(
-        constants.MLAB_EPOCH).replace(day=1,
-                                      hour=0,
-                                      minute=0,
-                                      second=0,
-                                      microsecond=0)
+    MIN_TABLE_MONTH = intervals.start_of_month(datetime.datetime.fromtimestamp(
+        constants.MLAB_EPOCH))
     MAX_TABLE_MONTH = datetime.datetime.now()
     if not (MIN_TABLE_MONTH <= time_range_start <= MAX_TABLE_MONTH):
         raise ValueError(
@@ -57,19 +54,20 @@ def monthly_tables(time_range_start, time_range_end):
             'time_range_end (%s) is out of range (must be within %s to %s)' %
             (time_range_end, MIN_TABLE_MONTH, MAX_TABLE_MONTH))
     day_delta = relativedelta.relativedelta(days=1)
-    tables = set()
+    month_delta = relativedelta.relativedelta(months=1)
+    tables = []
     # We add adjacent days here because a bug in BigQuery causes a handful of
     # tests to be published in the next or previous month if their log_time is
     # very close to the month border.
     current_time = max(MIN_TABLE_MONTH, time_range_start - day_delta)
     time_limit = min(MAX_TABLE_MONTH, time_range_end + day_delta)
-    # Keep incrementing current_time by 1 day until we reach the end of the
-    # range. This is not optimal for efficiency, but it is simple.
-    while current_time < time_limit:
-        table_name = monthly_table(current_time)
-        tables.add(table_name)
-        current_time += day_delta
-    return sorted(tables)
+    # Step by whole months from the start of the first month so that the
+    # result is correct even when the range limits are not at midnight.
+    current_month = intervals.start_of_month(current_time)
+    while current_month < time_limit:
+        tables.append(monthly_table(current_month))
+        current_month += month_delta
+    return tables
 
 
 def monthly_table(table_time):
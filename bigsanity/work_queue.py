@@ -0,0 +1,389 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Distributes check windows among workers through a shared SQLite database.
+
+A sweep is published as one row per check job (time window and shard). Any
+number of workers, on any machines that share the database file, claim jobs by
+taking a lease on them, check them, and write back the results. A lease that
+is not renewed before it expires (e.g. because its worker crashed) makes the
+job claimable again, and a job whose check raised an error is queued again.
+Either way, a job is given up as an error after a maximum number of attempts,
+so that a job that keeps crashing its workers does not hold up the sweep. The
+results of all workers are then merged into a single report.
+"""
+
+import collections
+import logging
+import os
+import socket
+import sqlite3
+import threading
+import time
+
+import cli
+import intervals
+import query_execution
+
+# Statuses of a job in the queue.
+STATUS_PENDING = 'pending'
+STATUS_LEASED = 'leased'
+STATUS_DONE = 'done'
+STATUS_ERROR = 'error'
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY,
+    project INTEGER NOT NULL,
+    window_start INTEGER NOT NULL,
+    window_end INTEGER NOT NULL,
+    shard_count INTEGER NOT NULL,
+    shard_index INTEGER NOT NULL,
+    status TEXT NOT NULL,
+    worker TEXT,
+    lease_expires REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    success INTEGER,
+    message TEXT,
+    UNIQUE (project, window_start, window_end, shard_count, shard_index)
+);
+CREATE INDEX IF NOT EXISTS jobs_by_status ON jobs (status, lease_expires);
+"""
+
+logger = logging.getLogger(__name__)
+
+QueuedJob = collections.namedtuple('QueuedJob', [
+    'id', 'project', 'window_start', 'window_end', 'shard_count', 'shard_index',
+    'attempts'
+])
+
+JobResult = collections.namedtuple('JobResult', [
+    'project', 'window_start', 'window_end', 'shard_count', 'shard_index',
+    'status', 'success', 'message'
+])
+
+
+def default_worker_id():
+    """Returns an ID that is unique to this process."""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+class WorkQueue(object):
+    """Queue of check jobs with expiring leases, stored in SQLite."""
+
+    def __init__(self,
+                 path,
+                 lease_seconds=3600,
+                 max_attempts=3,
+                 clock=time.time):
+        """Creates a new WorkQueue, creating the database if necessary.
+
+        Args:
+            path: Path of the SQLite database shared by all workers.
+            lease_seconds: Number of seconds for which a claimed job belongs to
+                its worker, unless the worker renews the lease.
+            max_attempts: Number of times a job is claimed before an error or
+                an expired lease marks it as an error for good.
+            clock: Function that returns the current time in seconds.
+        """
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._clock = clock
+        # Transactions are managed explicitly, so that a claim can lock the
+        # database before it reads.
+        self._connection = sqlite3.connect(path,
+                                           timeout=60,
+                                           isolation_level=None,
+                                           check_same_thread=False)
+        self._connection.text_factory = str
+        self._lock = threading.Lock()
+        with self._lock:
+            self._connection.executescript(_SCHEMA)
+
+    def publish(self, project, jobs, shard_count):
+        """Adds check jobs to the queue.
+
+        Jobs that are already in the queue keep their status and results, so a
+        sweep can be published again to add windows without repeating work.
+
+        Args:
+            project: Numeric ID of the M-Lab project.
+            jobs: A list of (window_start, window_end, shard_index) 3-tuples.
+            shard_count: Number of shards each window is split into.
+
+        Returns:
+            The number of jobs added.
+        """
+        rows = [(project, intervals.to_timestamp(start),
+                 intervals.to_timestamp(end), shard_count, shard_index,
+                 STATUS_PENDING) for start, end, shard_index in jobs]
+        with self._transaction() as connection:
+            before = connection.total_changes
+            connection.executemany(
+                'INSERT OR IGNORE INTO jobs (project, window_start, window_end, '
+                'shard_count, shard_index, status) VALUES (?, ?, ?, ?, ?, ?)',
+                rows)
+            return connection.total_changes - before
+
+    def claim(self, worker_id):
+        """Claims a job that is pending or whose lease has expired.
+
+        Expired leases on jobs that used up their attempts are not reclaimed;
+        those jobs are marked as errors instead.
+
+        Returns:
+            The claimed QueuedJob, or None if no job is claimable.
+        """
+        now = self._clock()
+        with self._transaction() as connection:
+            abandoned = connection.execute(
+                'UPDATE jobs SET status = ?, message = ? WHERE status = ? AND '
+                'lease_expires < ? AND attempts >= ?',
+                (STATUS_ERROR, 'Gave up after the lease expired %d times.' %
+                 self.max_attempts, STATUS_LEASED, now,
+                 self.max_attempts)).rowcount
+            row = connection.execute(
+                'SELECT id, project, window_start, window_end, shard_count, '
+                'shard_index, attempts FROM jobs WHERE status = ? OR '
+                '(status = ? AND lease_expires < ?) ORDER BY id LIMIT 1',
+                (STATUS_PENDING, STATUS_LEASED, now)).fetchone()
+            if row is None:
+                return None
+            connection.execute(
+                'UPDATE jobs SET status = ?, worker = ?, lease_expires = ?, '
+                'attempts = attempts + 1 WHERE id = ?',
+                (STATUS_LEASED, worker_id, now + self.lease_seconds, row[0]))
+        if abandoned:
+            logger.error('Gave up on %d jobs whose leases expired %d times.',
+                         abandoned, self.max_attempts)
+        if row[6]:
+            logger.warning('Reclaimed expired lease on job %d.', row[0])
+        return QueuedJob(row[0], row[1], intervals.from_timestamp(row[2]),
+                         intervals.from_timestamp(row[3]), row[4], row[5],
+                         row[6] + 1)
+
+    def renew(self, job_id, worker_id):
+        """Extends the lease on a job.
+
+        Returns:
+            True if the worker still held the lease, False otherwise.
+        """
+        return self._update_leased(job_id, worker_id, 'lease_expires = ?',
+                                   (self._clock() + self.lease_seconds,))
+
+    def complete(self, job_id, worker_id, check_result):
+        """Records the result of a job.
+
+        Returns:
+            True if the result was recorded. False if the worker no longer held
+            the lease, in which case the job belongs to another worker and the
+            result is discarded.
+        """
+        return self._update_leased(
+            job_id, worker_id, 'status = ?, success = ?, message = ?',
+            (STATUS_DONE, int(check_result.success), check_result.message))
+
+    def fail(self, job_id, worker_id, message):
+        """Records that a job could not be checked.
+
+        The job is queued again, unless it used up its attempts, in which case
+        it is marked as an error.
+
+        Returns:
+            True if the error was recorded, False if the worker no longer held
+            the lease.
+        """
+        return self._update_leased(
+            job_id, worker_id,
+            'status = CASE WHEN attempts < ? THEN ? ELSE ? END, message = ?',
+            (self.max_attempts, STATUS_PENDING, STATUS_ERROR, message))
+
+    def counts(self):
+        """Returns a dict mapping each job status to its number of jobs."""
+        with self._lock:
+            return dict(self._connection.execute(
+                'SELECT status, COUNT(*) FROM jobs GROUP BY status'))
+
+    def results(self):
+        """Returns a JobResult for every job, in window order."""
+        with self._lock:
+            rows = self._connection.execute(
+                'SELECT project, window_start, window_end, shard_count, '
+                'shard_index, status, success, message FROM jobs ORDER BY '
+                'project, window_start, shard_index').fetchall()
+        return [
+            JobResult(row[0], intervals.from_timestamp(row[1]),
+                      intervals.from_timestamp(row[2]), row[3], row[4], row[5],
+                      None if row[6] is None else bool(row[6]), row[7])
+            for row in rows
+        ]
+
+    def _update_leased(self, job_id, worker_id, assignments, values):
+        with self._transaction() as connection:
+            cursor = connection.execute(
+                'UPDATE jobs SET %s WHERE id = ? AND worker = ? AND status = ?'
+                % assignments, values + (job_id, worker_id, STATUS_LEASED))
+            return cursor.rowcount == 1
+
+    def _transaction(self):
+        return _Transaction(self._connection, self._lock)
+
+
+class _Transaction(object):
+    """Runs a block in an immediate transaction, which locks the database."""
+
+    def __init__(self, connection, lock):
+        self._connection = connection
+        self._lock = lock
+
+    def __enter__(self):
+        self._lock.acquire()
+        self._connection.execute('BEGIN IMMEDIATE')
+        return self._connection
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self._connection.execute('COMMIT')
+            else:
+                self._connection.execute('ROLLBACK')
+        finally:
+            self._lock.release()
+
+
+class _LeaseRenewer(object):
+    """Renews the lease on a job periodically while it is being checked."""
+
+    def __init__(self, queue, job_id, worker_id, interval):
+        self._queue = queue
+        self._job_id = job_id
+        self._worker_id = worker_id
+        self._interval = interval
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._stopped.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stopped.wait(self._interval):
+            if not self._queue.renew(self._job_id, self._worker_id):
+                logger.warning('Lost the lease on job %d.', self._job_id)
+                return
+
+
+def run_worker(queue,
+               checker,
+               worker_id,
+               concurrency=1,
+               poll_interval=10,
+               sleep=time.sleep):
+    """Checks jobs from the queue until every job is finished.
+
+    When no job is claimable but other workers still hold leases, the worker
+    waits, so that it can take over the jobs of workers that crash.
+
+    Args:
+        queue: WorkQueue to take jobs from.
+        checker: TableEquivalenceChecker used to check each job.
+        worker_id: ID of this worker, unique among all workers.
+        concurrency: Number of jobs to check at once.
+        poll_interval: Number of seconds to wait before looking for claimable
+            jobs again.
+        sleep: Function used to wait.
+
+    Returns:
+        The number of jobs this worker checked.
+    """
+    checked = [0]
+    checked_lock = threading.Lock()
+
+    def work(thread_index):
+        thread_worker_id = '%s/%d' % (worker_id, thread_index)
+        while True:
+            job = queue.claim(thread_worker_id)
+            if job is None:
+                if not queue.counts().get(STATUS_LEASED):
+                    return
+                sleep(poll_interval)
+                continue
+            logger.info('Checking job %d: project=%d, %s -> %s, shard %d/%d',
+                        job.id, job.project, cli.format_time(job.window_start),
+                        cli.format_time(job.window_end), job.shard_index + 1,
+                        job.shard_count)
+            # Renew well before the lease expires, so that a slow check keeps
+            # its job.
+            with _LeaseRenewer(queue, job.id, thread_worker_id,
+                               queue.lease_seconds / 3.0):
+                try:
+                    check_result = checker.check(job.project,
+                                                 job.window_start,
+                                                 job.window_end,
+                                                 shard_count=job.shard_count,
+                                                 shard_index=job.shard_index)
+                except Exception as e:
+                    # A failure of one job should not stop the worker. Errors
+                    # other than query errors are unexpected, so log their
+                    # traceback.
+                    log = (logger.error if isinstance(e, query_execution.Error)
+                           else logger.exception)
+                    log('Job %d failed: %s', job.id, e)
+                    queue.fail(job.id, thread_worker_id, str(e))
+                    continue
+            if not queue.complete(job.id, thread_worker_id, check_result):
+                logger.warning('Discarded result of job %d, which was '
+                               'reclaimed by another worker.', job.id)
+                continue
+            with checked_lock:
+                checked[0] += 1
+
+    threads = [
+        threading.Thread(target=work, args=(i,)) for i in range(concurrency)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return checked[0]
+
+
+def log_report(queue):
+    """Logs the merged results of all workers.
+
+    Returns:
+        The number of jobs that failed their check or could not be checked.
+    """
+    results = queue.results()
+    failures = 0
+    for result in results:
+        if result.status == STATUS_ERROR or result.success is False:
+            failures += 1
+            logger.error('project=%d, %s -> %s, shard %d/%d:\n%s',
+                         result.project, cli.format_time(result.window_start),
+                         cli.format_time(result.window_end),
+                         result.shard_index + 1, result.shard_count,
+                         result.message)
+    counts = queue.counts()
+    logger.info(
+        'Queue contains %d jobs: %d checked, %d failed checks, %d errors, '
+        '%d pending, %d in progress.', len(results), counts.get(STATUS_DONE, 0),
+        len([r for r in results if r.success is False]),
+        counts.get(STATUS_ERROR, 0), counts.get(STATUS_PENDING, 0),
+        counts.get(STATUS_LEASED, 0))
+    return failures
@@ -0,0 +1,60 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Fakes and test data shared by the BigSanity tests."""
+
+import calendar
+import datetime
+import os
+import sys
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import constants
+
+
+class FakeClock(object):
+    """Fake time source whose sleep function advances the current time.
+
+    The clock can be passed either as the clock itself or as its time method.
+    """
+
+    def __init__(self, now=1000.0):
+        self.now = now
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+def timestamp(day, hour=0):
+    """Returns the Unix timestamp of an hour in January 2015."""
+    return calendar.timegm(datetime.datetime(2015, 1, day, hour).timetuple())
+
+
+def ndt_row(test_id, day, is_last_entry=True):
+    """Returns an NDT table row for a test on a day in January 2015."""
+    return {
+        'test_id': test_id,
+        'project': constants.PROJECT_ID_NDT,
+        'log_time': timestamp(day),
+        'web100_log_entry.log_time': timestamp(day),
+        'web100_log_entry.is_last_entry': is_last_entry
+    }
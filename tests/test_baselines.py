@@ -0,0 +1,87 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../benchmarks')))
+import baselines
+
+METRIC_DIRECTIONS = {
+    'throughput': baselines.HIGHER_IS_BETTER,
+    'latency': baselines.LOWER_IS_BETTER,
+}
+
+
+class BaselinesTest(unittest.TestCase):
+
+    def test_find_regressions_within_tolerance(self):
+        self.assertEqual([], baselines.find_regressions(
+            {'a': {'throughput': 81.0,
+                   'latency': 11.9}}, {'a': {'throughput': 100.0,
+                                             'latency': 10.0}},
+            METRIC_DIRECTIONS, 0.2))
+
+    def test_find_regressions_in_either_direction(self):
+        self.assertEqual([
+            'a: latency regressed from 10 to 12.5',
+            'b: throughput regressed from 100 to 50'
+        ], baselines.find_regressions({
+            'a': {'throughput': 100.0,
+                  'latency': 12.5},
+            'b': {'throughput': 50.0,
+                  'latency': 1.0}
+        }, {
+            'a': {'throughput': 100.0,
+                  'latency': 10.0},
+            'b': {'throughput': 100.0,
+                  'latency': 10.0}
+        }, METRIC_DIRECTIONS, 0.2))
+
+    def test_find_regressions_ignores_improvements(self):
+        self.assertEqual([], baselines.find_regressions(
+            {'a': {'throughput': 500.0,
+                   'latency': 1.0}}, {'a': {'throughput': 100.0,
+                                            'latency': 10.0}},
+            METRIC_DIRECTIONS, 0.2))
+
+    def test_find_regressions_skips_scenarios_without_baseline(self):
+        self.assertEqual([], baselines.find_regressions(
+            {'new': {'throughput': 1.0}}, {'a': {'throughput': 100.0}},
+            METRIC_DIRECTIONS, 0.2))
+
+    def test_fit_exponent(self):
+        sizes = [1000, 10000, 100000]
+        self.assertAlmostEqual(
+            1.0, baselines.fit_exponent(sizes, [size * 0.5 for size in sizes]))
+        self.assertAlmostEqual(
+            2.0, baselines.fit_exponent(sizes, [size**2 for size in sizes]))
+
+    def test_save_and_load_round_trip(self):
+        temp_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(temp_dir, 'nested', 'baseline.json')
+            self.assertEqual({}, baselines.load(path))
+            baselines.save(path, {'a': {'throughput': 1.5}})
+            self.assertEqual({'a': {'throughput': 1.5}}, baselines.load(path))
+        finally:
+            shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    unittest.main()
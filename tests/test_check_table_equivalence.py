@@ -24,6 +24,7 @@ sys.path.insert(1, os.path.abspath(os.path.join(
 import check_table_equivalence
 import constants
 import formatting
+import instrumentation
 import query_construct
 import query_execution
 
@@ -56,11 +57,32 @@ class TableEquivalenceCheckerTest(unittest.TestCase):
         self.assertIsNone(check_result.message)
         # Make sure the query generator was created with the right parameters.
         self.query_generator_factory.create.assert_called_with(
-            constants.PROJECT_ID_NDT, START_TIME, END_TIME)
+            constants.PROJECT_ID_NDT,
+            START_TIME,
+            END_TIME,
+            shard_count=1,
+            shard_index=0)
         # Make sure the query executor executes the query produced by the query
         # generator.
         self.query_executor.execute_query.assert_called_with(MOCK_QUERY)
 
+    def test_check_passes_shard_to_query_generator(self):
+        """A sharded check should generate a query for only that shard."""
+        self.query_executor.execute_query.return_value = ''
+
+        check_result = self.checker.check(constants.PROJECT_ID_NDT,
+                                          START_TIME,
+                                          END_TIME,
+                                          shard_count=4,
+                                          shard_index=3)
+        self.assertTrue(check_result.success)
+        self.query_generator_factory.create.assert_called_with(
+            constants.PROJECT_ID_NDT,
+            START_TIME,
+            END_TIME,
+            shard_count=4,
+            shard_index=3)
+
     def test_check_fails_when_extra_ids_are_in_both_tables(self):
         """If both tables contain disjoint IDs, equivalence check fails."""
         self.query_executor.execute_query.return_value = (
@@ -83,6 +105,38 @@ class TableEquivalenceCheckerTest(unittest.TestCase):
             '  mock_id_3\n'
             'BigQuery SQL:\n' + formatting.indent(MOCK_QUERY)))
 
+    def test_check_result_records_mismatched_ids_and_query(self):
+        self.query_executor.execute_query.return_value = (
+            'per_month_test_id,per_project_test_id\n'
+            'mock_id_1,\n'
+            ',mock_id_3')
+
+        check_result = self.checker.check(constants.PROJECT_ID_NDT, START_TIME,
+                                          END_TIME)
+        self.assertEqual(['mock_id_1'], check_result.per_month_ids)
+        self.assertEqual(['mock_id_3'], check_result.per_project_ids)
+        self.assertEqual(MOCK_QUERY, check_result.query)
+        self.assertMultiLineEqual(
+            ('Check failed: TABLE EQUIVALENCE\n'
+             'test_id values present in per-month table, but NOT present in '
+             'per-project table:\n'
+             '  mock_id_1\n'
+             'test_id values present in per-project table, but NOT present in '
+             'per-month table:\n'
+             '  mock_id_3\n'
+             'BigQuery SQL: sql/abc.sql'),
+            check_table_equivalence.format_failure_summary(check_result,
+                                                           'sql/abc.sql'))
+
+    def test_passing_check_result_records_query(self):
+        self.query_executor.execute_query.return_value = ''
+
+        check_result = self.checker.check(constants.PROJECT_ID_NDT, START_TIME,
+                                          END_TIME)
+        self.assertEqual([], check_result.per_month_ids)
+        self.assertEqual([], check_result.per_project_ids)
+        self.assertEqual(MOCK_QUERY, check_result.query)
+
     def test_check_fails_when_extra_ids_are_in_per_month_table_only(self):
         """If per-month table contains extra test_ids, check fails."""
         self.query_executor.execute_query.return_value = (
@@ -117,6 +171,53 @@ class TableEquivalenceCheckerTest(unittest.TestCase):
             '  mock_id_3\n'
             'BigQuery SQL:\n' + formatting.indent(MOCK_QUERY)))
 
+    def test_check_without_details_stops_at_first_mismatch(self):
+        checker = check_table_equivalence.TableEquivalenceChecker(
+            self.query_generator_factory, self.query_executor,
+            check_table_equivalence.DETAILS_NONE)
+        self.query_executor.execute_query.return_value = (
+            'per_month_test_id,per_project_test_id\n'
+            'mock_id_1,')
+
+        check_result = checker.check(constants.PROJECT_ID_NDT, START_TIME,
+                                     END_TIME)
+        self.query_generator.generate_query.assert_called_once_with(limit=1)
+        self.assertFalse(check_result.success)
+        self.assertFalse(check_result.complete)
+        self.assertIn(
+            'Only the first 1 mismatched test_id values were fetched. Use '
+            '--details full to fetch them all.\n', check_result.message)
+        self.assertIn('--details full',
+                      check_table_equivalence.format_failure_summary(
+                          check_result, 'sql/abc.sql'))
+
+    def test_check_with_sample_details_is_complete_below_limit(self):
+        checker = check_table_equivalence.TableEquivalenceChecker(
+            self.query_generator_factory, self.query_executor,
+            check_table_equivalence.DETAILS_SAMPLE)
+        self.query_executor.execute_query.return_value = (
+            'per_month_test_id,per_project_test_id\n'
+            'mock_id_1,\n'
+            ',mock_id_3')
+
+        check_result = checker.check(constants.PROJECT_ID_NDT, START_TIME,
+                                     END_TIME)
+        self.query_generator.generate_query.assert_called_once_with(limit=100)
+        self.assertTrue(check_result.complete)
+        self.assertNotIn('--details', check_result.message)
+
+    def test_check_with_full_details_does_not_limit_query(self):
+        self.query_executor.execute_query.return_value = ''
+
+        self.assertTrue(self.checker.check(constants.PROJECT_ID_NDT, START_TIME,
+                                           END_TIME).complete)
+        self.query_generator.generate_query.assert_called_once_with()
+
+    def test_checker_rejects_unknown_details(self):
+        with self.assertRaises(ValueError):
+            check_table_equivalence.TableEquivalenceChecker(
+                self.query_generator_factory, self.query_executor, 'some')
+
     def test_check_trims_list_of_extra_ids_when_the_list_is_large(self):
         """When the check finds many extra test_ids, we should trim the list.
 
@@ -158,6 +259,18 @@ class TableEquivalenceCheckerTest(unittest.TestCase):
             '  (95 additional or duplicate test_id values omitted)\n'
             'BigQuery SQL:\n' + formatting.indent(MOCK_QUERY)))
 
+    def test_check_records_stage_timings_when_instrumented(self):
+        self.query_executor.execute_query.return_value = (
+            'per_month_test_id,per_project_test_id\n'
+            'mock_id_1,')
+        metrics = instrumentation.WindowMetrics(constants.PROJECT_ID_NDT,
+                                                START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            self.checker.check(constants.PROJECT_ID_NDT, START_TIME, END_TIME)
+        self.assertItemsEqual(['generate_query', 'execute_query',
+                               'parse_results', 'format_message'],
+                              metrics.stage_seconds.keys())
+
     def test_check_raises_exception_if_generator_factory_raises_exception(self):
         """Checker should not catch any exceptions from generator factory."""
         factory = mock.Mock(
@@ -31,6 +31,17 @@ class CliTest(unittest.TestCase):
         self.assertEqual(
             datetime.datetime(2016, 1, 11), cli.parse_date_arg('2016-01-11'))
 
+    def test_parse_date_arg_succeeds_when_date_has_time_of_day(self):
+        self.assertEqual(
+            datetime.datetime(2016, 1, 11, 6, 30),
+            cli.parse_date_arg('2016-01-11T06:30'))
+
+    def test_format_time_omits_time_of_day_at_midnight(self):
+        self.assertEqual('2016-01-11',
+                         cli.format_time(datetime.datetime(2016, 1, 11)))
+        self.assertEqual('2016-01-11T06:00',
+                         cli.format_time(datetime.datetime(2016, 1, 11, 6)))
+
     def test_parse_date_arg_raises_error_on_invalid_format(self):
         with self.assertRaises(ValueError):
             # Missing days part.
@@ -42,6 +53,22 @@ class CliTest(unittest.TestCase):
             # Empty string.
             cli.parse_date_arg('')
 
+    def test_parse_interval_hours_arg_succeeds_with_valid_arg(self):
+        self.assertEqual(
+            relativedelta.relativedelta(hours=1),
+            cli.parse_interval_hours_arg('1'))
+        self.assertEqual(
+            relativedelta.relativedelta(hours=6),
+            cli.parse_interval_hours_arg('6'))
+
+    def test_parse_interval_hours_arg_raises_error_when_arg_is_not_positive(
+            self):
+        """Zero or negative values for time should raise a ValueError."""
+        with self.assertRaises(ValueError):
+            cli.parse_interval_hours_arg('-5')
+        with self.assertRaises(ValueError):
+            cli.parse_interval_hours_arg('0')
+
     def test_parse_interval_days_arg_succeeds_with_valid_arg(self):
         self.assertEqual(
             relativedelta.relativedelta(days=1),
@@ -74,21 +101,84 @@ class CliTest(unittest.TestCase):
         with self.assertRaises(ValueError):
             cli.parse_interval_months_arg('0')
 
+    def test_parse_shard_count_arg_succeeds_with_valid_arg(self):
+        self.assertEqual(1, cli.parse_shard_count_arg('1'))
+        self.assertEqual(16, cli.parse_shard_count_arg('16'))
+
+    def test_parse_shard_count_arg_raises_error_when_arg_is_not_positive(self):
+        with self.assertRaises(ValueError):
+            cli.parse_shard_count_arg('-2')
+        with self.assertRaises(ValueError):
+            cli.parse_shard_count_arg('0')
+
+    def test_parse_bytes_arg_succeeds_with_valid_arg(self):
+        self.assertEqual(1000, cli.parse_bytes_arg('1000'))
+        self.assertEqual(2048, cli.parse_bytes_arg('2K'))
+        self.assertEqual(500 * 1024**3, cli.parse_bytes_arg('500G'))
+        self.assertEqual(3 * 1024**4, cli.parse_bytes_arg('3t'))
+
+    def test_parse_bytes_arg_raises_error_on_invalid_arg(self):
+        with self.assertRaises(ValueError):
+            cli.parse_bytes_arg('0')
+        with self.assertRaises(ValueError):
+            cli.parse_bytes_arg('-5G')
+        with self.assertRaises(ValueError):
+            cli.parse_bytes_arg('5X')
+
+    def test_parse_positive_int_arg(self):
+        self.assertEqual(8, cli.parse_positive_int_arg('8'))
+        with self.assertRaises(ValueError):
+            cli.parse_positive_int_arg('0')
+        with self.assertRaises(ValueError):
+            cli.parse_positive_int_arg('1.5')
+
+    def test_parse_positive_float_arg(self):
+        self.assertEqual(0.5, cli.parse_positive_float_arg('0.5'))
+        with self.assertRaises(ValueError):
+            cli.parse_positive_float_arg('0')
+        with self.assertRaises(ValueError):
+            cli.parse_positive_float_arg('-2.5')
+
+    def test_parse_sample_rate_arg(self):
+        self.assertEqual(0.01, cli.parse_sample_rate_arg('0.01'))
+        self.assertEqual(1.0, cli.parse_sample_rate_arg('1'))
+        for invalid in ('0', '-0.5', '1.5'):
+            with self.assertRaises(ValueError):
+                cli.parse_sample_rate_arg(invalid)
+
+    def test_parse_project_weight_arg(self):
+        self.assertEqual((2, 3.0), cli.parse_project_weight_arg('2:3'))
+        self.assertEqual((0, 0.5), cli.parse_project_weight_arg('0:0.5'))
+        for invalid in ('2', '2:0', '-1:2', 'a:2', '1:2:3'):
+            with self.assertRaises(ValueError):
+                cli.parse_project_weight_arg(invalid)
+
     def test_get_interval_when_days_specified(self):
         interval_days = relativedelta.relativedelta(days=5)
-        mock_args = mock.Mock(interval_days=relativedelta.relativedelta(days=5),
+        mock_args = mock.Mock(interval_hours=None,
+                              interval_days=relativedelta.relativedelta(days=5),
                               interval_months=None)
         self.assertEqual(interval_days, cli.get_interval(mock_args))
 
     def test_get_interval_when_months_specified(self):
         interval_months = relativedelta.relativedelta(months=3)
         mock_args = mock.Mock(
+            interval_hours=None,
             interval_days=None,
             interval_months=relativedelta.relativedelta(months=3))
         self.assertEqual(interval_months, cli.get_interval(mock_args))
 
+    def test_get_interval_when_hours_specified(self):
+        interval_hours = relativedelta.relativedelta(hours=6)
+        mock_args = mock.Mock(interval_hours=interval_hours,
+                              interval_days=None,
+                              interval_months=None)
+        self.assertEqual(interval_hours, cli.get_interval(mock_args))
+
     def test_get_interval_raises_error_when_no_interval_is_specified(self):
-        mock_args = mock.Mock(interval_days=None, interval_months=None)
+        mock_args = mock.Mock(interval_hours=None,
+                              interval_days=None,
+                              interval_months=None)
         with self.assertRaises(ValueError):
             cli.get_interval(mock_args)
 
@@ -0,0 +1,89 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import constants
+import cost_estimation
+import query_construct
+import query_execution
+import scan_checks
+
+MOCK_QUERY = 'mock SQL query string'
+START_TIME = datetime.datetime(2010, 1, 5)
+END_TIME = datetime.datetime(2010, 1, 15)
+
+
+class CostEstimatorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_generator = mock.Mock(
+            spec=query_construct.TableEquivalenceQueryGenerator)
+        self.query_generator.generate_query.return_value = MOCK_QUERY
+        self.query_generator_factory = mock.Mock(
+            spec=query_construct.TableEquivalenceQueryGeneratorFactory)
+        self.query_generator_factory.create.return_value = self.query_generator
+        self.query_executor = mock.Mock(spec=query_execution.QueryExecutor)
+        self.estimator = cost_estimation.CostEstimator(
+            self.query_generator_factory, self.query_executor)
+
+    def test_estimate_returns_dry_run_bytes_of_check_query(self):
+        self.query_executor.estimate_query_bytes.return_value = 12345
+
+        self.assertEqual(12345,
+                         self.estimator.estimate(constants.PROJECT_ID_NDT,
+                                                 START_TIME,
+                                                 END_TIME,
+                                                 shard_count=2,
+                                                 shard_index=1))
+        self.query_generator_factory.create.assert_called_with(
+            constants.PROJECT_ID_NDT,
+            START_TIME,
+            END_TIME,
+            shard_count=2,
+            shard_index=1)
+        self.query_executor.estimate_query_bytes.assert_called_with(MOCK_QUERY)
+        self.assertFalse(self.query_executor.execute_query.called)
+
+    def test_estimate_includes_scan_query_of_checks(self):
+        self.query_generator.generate_aggregate_query.return_value = (
+            'mock scan query')
+        self.query_executor.estimate_query_bytes.side_effect = (
+            lambda query: {MOCK_QUERY: 12345, 'mock scan query': 1000}[query])
+        estimator = cost_estimation.CostEstimator(
+            self.query_generator_factory, self.query_executor,
+            [scan_checks.RowCountParityCheck()])
+
+        self.assertEqual(13345, estimator.estimate(constants.PROJECT_ID_NDT,
+                                                   START_TIME, END_TIME))
+        self.assertEqual(
+            1, self.query_generator.generate_aggregate_query.call_count)
+
+    def test_estimate_raises_exception_if_query_executor_raises_exception(self):
+        self.query_executor.estimate_query_bytes.side_effect = (
+            query_execution.BqFailedError(MOCK_QUERY))
+        with self.assertRaises(query_execution.BqFailedError):
+            self.estimator.estimate(constants.PROJECT_ID_NDT, START_TIME,
+                                    END_TIME)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -44,5 +44,14 @@ class FormattingTest(unittest.TestCase):
                            '  b\n'
                            'c'), 2)  # yapf: disable
 
+    def test_format_bytes(self):
+        self.assertEqual('0 B', formatting.format_bytes(0))
+        self.assertEqual('1023 B', formatting.format_bytes(1023))
+        self.assertEqual('1.5 KiB', formatting.format_bytes(1536))
+        self.assertEqual('2.0 GiB', formatting.format_bytes(2 * 1024**3))
+        self.assertEqual('3.0 TiB', formatting.format_bytes(3 * 1024**4))
+        self.assertEqual('2048.0 PiB', formatting.format_bytes(2 * 1024**6))
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,241 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import unittest
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import history
+import intervals
+
+
+def _day(day):
+    return datetime.datetime(2015, 1, day)
+
+
+PASSED = check_table_equivalence.CheckResult(True)
+FAILED = check_table_equivalence.CheckResult(False, 'mock failure message')
+
+
+class CheckHistoryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+        self.history = history.CheckHistory(':memory:', clock=self.clock)
+
+    def test_window_stats_of_unchecked_window(self):
+        self.assertEqual((0, 0, None), self.history.window_stats(0, _day(1),
+                                                                 _day(2)))
+
+    def test_window_stats_counts_checks_of_overlapping_windows(self):
+        first_run = self.history.start_run()
+        self.history.record(first_run, 0, _day(1), _day(3), FAILED)
+        self.clock.now = 2000.0
+        second_run = self.history.start_run()
+        self.assertNotEqual(first_run, second_run)
+        self.history.record(second_run, 0, _day(2), _day(3), PASSED)
+        self.history.record(second_run, 0, _day(3), _day(4), FAILED)
+        self.history.record(second_run, 2, _day(2), _day(3), FAILED)
+
+        self.assertEqual((2, 1, 2000.0), self.history.window_stats(0, _day(2),
+                                                                   _day(3)))
+        self.assertEqual((1, 1, 1000.0), self.history.window_stats(0, _day(1),
+                                                                   _day(2)))
+        self.assertEqual((1, 1, 2000.0), self.history.window_stats(2, _day(2),
+                                                                   _day(3)))
+
+    def test_history_persists_between_instances(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        path = os.path.join(temp_dir, 'history.db')
+        first = history.CheckHistory(path, clock=self.clock)
+        first.record(first.start_run(),
+                     0,
+                     _day(1),
+                     _day(2),
+                     FAILED,
+                     shard_count=2,
+                     shard_index=1)
+        second = history.CheckHistory(path, clock=self.clock)
+        self.assertEqual((1, 1, 1000.0), second.window_stats(0, _day(1),
+                                                             _day(2)))
+
+    def failed(self, per_month_ids=(), per_project_ids=(), complete=True):
+        return check_table_equivalence.CheckResult(
+            False,
+            'mock failure message',
+            per_month_ids=list(per_month_ids),
+            per_project_ids=list(per_project_ids),
+            complete=complete)
+
+    def test_first_missing_returns_earliest_anomaly(self):
+        self.assertIsNone(self.history.first_missing('2015/01/03/a'))
+        first_run = self.history.start_run()
+        self.history.record(first_run,
+                            0,
+                            _day(1),
+                            _day(5),
+                            self.failed(per_project_ids=['2015/01/03/a']))
+        self.clock.now = 2000.0
+        second_run = self.history.start_run()
+        self.history.record(second_run,
+                            0,
+                            _day(1),
+                            _day(5),
+                            self.failed(per_project_ids=['2015/01/03/a']))
+
+        anomaly = self.history.first_missing('2015/01/03/a')
+        self.assertEqual(
+            history.Anomaly(first_run, 1000.0, 0,
+                            intervals.to_timestamp(_day(3)), '2015/01/03/a',
+                            history.MISSING_FROM_PER_MONTH), anomaly)
+
+    def test_anomaly_day_falls_back_to_window_start(self):
+        run_id = self.history.start_run()
+        self.history.record(run_id,
+                            0,
+                            _day(2) + datetime.timedelta(hours=6),
+                            _day(3),
+                            self.failed(per_month_ids=['abc']))
+        anomaly = self.history.first_missing('abc')
+        self.assertEqual(intervals.to_timestamp(_day(2)), anomaly.day)
+        self.assertEqual(history.MISSING_FROM_PER_PROJECT, anomaly.missing_from)
+
+    def test_new_anomalies_excludes_anomalies_of_earlier_runs(self):
+        self.assertEqual([], self.history.new_anomalies())
+        first_run = self.history.start_run()
+        self.history.record(first_run,
+                            0,
+                            _day(1),
+                            _day(5),
+                            self.failed(per_month_ids=['2015/01/01/old']))
+        second_run = self.history.start_run()
+        self.history.record(
+            second_run,
+            0,
+            _day(1),
+            _day(5),
+            self.failed(per_month_ids=['2015/01/01/old', '2015/01/02/new'],
+                        per_project_ids=['2015/01/01/old']))
+        self.history.record(second_run,
+                            2,
+                            _day(1),
+                            _day(5),
+                            self.failed(per_month_ids=['2015/01/01/old']))
+
+        self.assertEqual(
+            [(0, '2015/01/01/old', history.MISSING_FROM_PER_MONTH),
+             (0, '2015/01/02/new', history.MISSING_FROM_PER_PROJECT),
+             (2, '2015/01/01/old', history.MISSING_FROM_PER_PROJECT)],
+            [(a.project, a.test_id, a.missing_from)
+             for a in self.history.new_anomalies()])
+        self.assertEqual(['2015/01/01/old'], [
+            a.test_id for a in self.history.new_anomalies(first_run)
+        ])
+
+    def test_new_anomalies_excludes_incomplete_windows(self):
+        run_id = self.history.start_run()
+        self.history.record(run_id,
+                            0,
+                            _day(1),
+                            _day(5),
+                            self.failed(per_month_ids=['2015/01/01/a']))
+        self.history.record(run_id,
+                            0,
+                            _day(5),
+                            _day(9),
+                            self.failed(per_month_ids=['2015/01/05/b'],
+                                        complete=False))
+
+        self.assertEqual(['2015/01/01/a'], [
+            a.test_id for a in self.history.new_anomalies()
+        ])
+        self.assertIsNotNone(self.history.first_missing('2015/01/05/b'))
+
+    def test_monthly_failures_skips_anomalies_of_incomplete_windows(self):
+        run_id = self.history.start_run()
+        self.history.record(run_id,
+                            0,
+                            _day(1),
+                            _day(2),
+                            self.failed(per_month_ids=['2015/01/01/a']))
+        self.history.record(run_id,
+                            0,
+                            _day(2),
+                            _day(3),
+                            self.failed(per_month_ids=['2015/01/02/b'],
+                                        complete=False))
+
+        self.assertEqual([history.MonthlyFailures(0, '2015-01', 2, 2, 1)],
+                         self.history.monthly_failures(project=0))
+
+    def test_adds_complete_column_to_existing_database(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'history.db')
+        connection = sqlite3.connect(path)
+        connection.executescript(
+            'CREATE TABLE window_results (id INTEGER PRIMARY KEY, run_id '
+            'INTEGER NOT NULL, project INTEGER NOT NULL, window_start INTEGER '
+            'NOT NULL, window_end INTEGER NOT NULL, shard_count INTEGER NOT '
+            'NULL DEFAULT 1, shard_index INTEGER NOT NULL DEFAULT 0, success '
+            'INTEGER NOT NULL, checked_at REAL NOT NULL);')
+        connection.close()
+
+        check_history = history.CheckHistory(path, clock=self.clock)
+        run_id = check_history.start_run()
+        check_history.record(
+            run_id,
+            0,
+            _day(1),
+            _day(2),
+            self.failed(per_month_ids=['a'], complete=False))
+        self.assertEqual([], check_history.new_anomalies())
+
+    def test_monthly_failures(self):
+        run_id = self.history.start_run()
+        self.history.record(run_id, 0, _day(1), _day(2), PASSED)
+        self.history.record(
+            run_id,
+            0,
+            _day(2),
+            _day(3),
+            self.failed(per_month_ids=['2015/01/02/a', '2015/01/02/b']))
+        self.history.record(run_id,
+                            0,
+                            datetime.datetime(2015, 2, 1),
+                            datetime.datetime(2015, 2, 2),
+                            self.failed(per_project_ids=['2015/02/01/c']))
+        self.history.record(run_id, 2, _day(1), _day(2), PASSED)
+
+        self.assertEqual([
+            history.MonthlyFailures(0, '2015-01', 2, 1, 2),
+            history.MonthlyFailures(0, '2015-02', 1, 1, 1),
+            history.MonthlyFailures(2, '2015-01', 1, 0, 0),
+        ], self.history.monthly_failures())
+        self.assertEqual([history.MonthlyFailures(2, '2015-01', 1, 0, 0)],
+                         self.history.monthly_failures(project=2))
+
+
+if __name__ == '__main__':
+    unittest.main()
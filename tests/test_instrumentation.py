@@ -0,0 +1,216 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import constants
+import instrumentation
+
+START_TIME = datetime.datetime(2010, 1, 5)
+END_TIME = datetime.datetime(2010, 1, 15)
+
+
+class WindowMetricsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+        self.metrics = instrumentation.WindowMetrics(constants.PROJECT_ID_NDT,
+                                                     START_TIME,
+                                                     END_TIME,
+                                                     clock=self.clock.time)
+
+    def test_spans_accumulate_time_per_stage(self):
+        with self.metrics.span('execute_query'):
+            self.clock.now += 2.0
+        with self.metrics.span('parse_results'):
+            self.clock.now += 0.5
+        with self.metrics.span('execute_query'):
+            self.clock.now += 1.0
+        self.metrics.finish(success=True)
+        self.clock.now += 10.0
+
+        self.assertEqual({'execute_query': 3.0,
+                          'parse_results': 0.5}, self.metrics.stage_seconds)
+        self.assertEqual(3.5, self.metrics.duration)
+        self.assertTrue(self.metrics.success)
+
+    def test_to_dict(self):
+        self.metrics.bytes_processed = 1024
+        self.metrics.rows_returned = 3
+        self.clock.now += 4.0
+        self.metrics.finish(success=False)
+        self.assertEqual({
+            'project': 0,
+            'time_range_start': '2010-01-05T00:00:00',
+            'time_range_end': '2010-01-15T00:00:00',
+            'shard_count': 1,
+            'shard_index': 0,
+            'success': False,
+            'duration_seconds': 4.0,
+            'stage_seconds': {},
+            'bytes_processed': 1024,
+            'rows_returned': 3,
+            'concurrency_limit': None,
+        }, self.metrics.to_dict())
+
+
+class ThreadMetricsTest(unittest.TestCase):
+
+    def test_module_functions_do_nothing_when_no_metrics_are_bound(self):
+        self.assertIsNone(instrumentation.current_metrics())
+        with instrumentation.span('execute_query'):
+            pass
+        instrumentation.add_stage_time('bq_wait', 1.0)
+        instrumentation.add_bytes_processed(1024)
+        instrumentation.add_rows_returned(5)
+        instrumentation.set_concurrency_limit(4)
+
+    def test_module_functions_record_to_bound_metrics(self):
+        clock = helpers.FakeClock()
+        metrics = instrumentation.WindowMetrics(constants.PROJECT_ID_NDT,
+                                                START_TIME,
+                                                END_TIME,
+                                                clock=clock.time)
+        with instrumentation.bind(metrics):
+            self.assertIs(metrics, instrumentation.current_metrics())
+            with instrumentation.span('execute_query'):
+                clock.now += 2.0
+            instrumentation.add_stage_time('bq_wait', 1.5)
+            instrumentation.add_bytes_processed(1024)
+            instrumentation.add_rows_returned(5)
+            instrumentation.set_concurrency_limit(4)
+        self.assertIsNone(instrumentation.current_metrics())
+        self.assertEqual({'execute_query': 2.0,
+                          'bq_wait': 1.5}, metrics.stage_seconds)
+        self.assertEqual(1024, metrics.bytes_processed)
+        self.assertEqual(5, metrics.rows_returned)
+        self.assertEqual(4, metrics.concurrency_limit)
+
+    def test_merge_adds_metrics_of_fork(self):
+        metrics = instrumentation.WindowMetrics(constants.PROJECT_ID_NDT,
+                                                START_TIME, END_TIME)
+        metrics.add_bytes_processed(100)
+        metrics.add_stage_time('bq_wait', 1.0)
+        fork = metrics.fork()
+        self.assertEqual(metrics.describe(), fork.describe())
+        fork.add_bytes_processed(50)
+        fork.add_rows_returned(2)
+        fork.add_stage_time('bq_wait', 0.5)
+        fork.concurrency_limit = 4
+        self.assertEqual(100, metrics.bytes_processed)
+
+        metrics.merge(fork)
+        self.assertEqual(150, metrics.bytes_processed)
+        self.assertEqual(2, metrics.rows_returned)
+        self.assertEqual({'bq_wait': 1.5}, metrics.stage_seconds)
+        self.assertEqual(4, metrics.concurrency_limit)
+
+    def test_query_statistics_add_up_across_queries_of_a_window(self):
+        metrics = instrumentation.WindowMetrics(constants.PROJECT_ID_NDT,
+                                                START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            instrumentation.add_bytes_processed(1024)
+            instrumentation.add_rows_returned(5)
+            instrumentation.add_bytes_processed(2048)
+            instrumentation.add_rows_returned(0)
+        self.assertEqual(3072, metrics.bytes_processed)
+        self.assertEqual(5, metrics.rows_returned)
+
+
+class MetricsRecorderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+
+    def create_metrics(self, project, duration, bytes_processed, success):
+        metrics = instrumentation.WindowMetrics(project,
+                                                START_TIME,
+                                                END_TIME,
+                                                clock=self.clock.time)
+        metrics.add_stage_time('bq_wait', duration)
+        metrics.bytes_processed = bytes_processed
+        self.clock.now += duration
+        metrics.finish(success)
+        return metrics
+
+    def test_record_writes_one_json_line_per_window(self):
+        jsonl_file = io.BytesIO()
+        recorder = instrumentation.MetricsRecorder(jsonl_file)
+        recorder.record(self.create_metrics(0, 2.0, 100, True))
+        recorder.record(self.create_metrics(2, 3.0, 200, False))
+
+        lines = jsonl_file.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        self.assertEqual(100, json.loads(lines[0])['bytes_processed'])
+        self.assertEqual(2, json.loads(lines[1])['project'])
+        self.assertFalse(json.loads(lines[1])['success'])
+
+    def test_write_prometheus_textfile(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        textfile_path = os.path.join(temp_dir, 'bigsanity.prom')
+        recorder = instrumentation.MetricsRecorder()
+        recorder.record(self.create_metrics(0, 2.0, 100, True))
+        recorder.record(self.create_metrics(0, 3.0, 200, True))
+        recorder.record(self.create_metrics(2, 1.0, 50, False))
+
+        recorder.write_prometheus_textfile(textfile_path)
+        with open(textfile_path) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('bigsanity_windows_total{project="0",status="success"} 2',
+                      lines)
+        self.assertIn('bigsanity_windows_total{project="2",status="failure"} 1',
+                      lines)
+        self.assertIn('bigsanity_bytes_processed_total{project="0"} 300', lines)
+        self.assertIn('bigsanity_stage_seconds_total{stage="bq_wait"} 6.000000',
+                      lines)
+        self.assertFalse(any(line.startswith('bigsanity_concurrency_limit')
+                             for line in lines))
+        self.assertEqual(['bigsanity.prom'], os.listdir(temp_dir))
+
+    def test_write_prometheus_textfile_reports_last_concurrency_limit(self):
+        temp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, temp_dir)
+        textfile_path = os.path.join(temp_dir, 'bigsanity.prom')
+        recorder = instrumentation.MetricsRecorder()
+        for concurrency_limit in (3, 5, None):
+            metrics = self.create_metrics(0, 1.0, 100, True)
+            metrics.concurrency_limit = concurrency_limit
+            recorder.record(metrics)
+
+        recorder.write_prometheus_textfile(textfile_path)
+        with open(textfile_path) as textfile:
+            lines = textfile.read().splitlines()
+        self.assertIn('bigsanity_concurrency_limit 5', lines)
+
+    def test_log_summary_handles_windows_without_bytes(self):
+        recorder = instrumentation.MetricsRecorder()
+        recorder.log_summary()
+        recorder.record(self.create_metrics(0, 2.0, None, True))
+        recorder.log_summary()
+
+
+if __name__ == '__main__':
+    unittest.main()
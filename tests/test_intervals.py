@@ -26,6 +26,13 @@ import intervals
 
 class IntervalsTest(unittest.TestCase):
 
+    def test_timestamps_round_trip(self):
+        day = datetime.datetime(2015, 1, 5)
+        self.assertEqual(0,
+                         intervals.to_timestamp(datetime.datetime(1970, 1, 1)))
+        self.assertEqual(day,
+                         intervals.from_timestamp(intervals.to_timestamp(day)))
+
     def test_date_limits_to_intervals_when_limit_is_exactly_one_interval(self):
         intervals_expected = [(datetime.datetime(2015, 1, 1),
                                datetime.datetime(2015, 2, 1))]
@@ -72,6 +79,91 @@ class IntervalsTest(unittest.TestCase):
             relativedelta.relativedelta(months=1))
         self.assertSequenceEqual(intervals_expected, intervals_actual)
 
+    def test_date_limits_to_intervals_with_hour_intervals(self):
+        """Intervals can be smaller than a day."""
+        hour = lambda h: datetime.datetime(2015, 1, 1, h)
+        intervals_expected = [
+            (hour(0), hour(8)),
+            (hour(8), hour(16)),
+            (hour(16), hour(20)),
+        ]
+        intervals_actual = intervals.date_limits_to_intervals(
+            hour(0), hour(20),
+            relativedelta.relativedelta(hours=8))
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
+    def test_date_limits_to_intervals_aligned_to_months_splits_at_borders(self):
+        """Aligned intervals restart at the start of each month."""
+        intervals_expected = [
+            (datetime.datetime(2009, 2, 11), datetime.datetime(2009, 2, 21)),
+            (datetime.datetime(2009, 2, 21), datetime.datetime(2009, 3, 1)),
+            (datetime.datetime(2009, 3, 1), datetime.datetime(2009, 3, 11)),
+            (datetime.datetime(2009, 3, 11), datetime.datetime(2009, 3, 15)),
+        ]
+        intervals_actual = intervals.date_limits_to_intervals(
+            datetime.datetime(2009, 2, 11),
+            datetime.datetime(2009, 3, 15),
+            relativedelta.relativedelta(days=10),
+            align_to_months=True)
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
+    def test_date_limits_to_intervals_aligned_to_months_absorbs_leftovers(self):
+        """A leftover shorter than half a step joins the window before it."""
+        intervals_expected = [
+            (datetime.datetime(2015, 1, 1), datetime.datetime(2015, 1, 11)),
+            (datetime.datetime(2015, 1, 11), datetime.datetime(2015, 1, 21)),
+            (datetime.datetime(2015, 1, 21), datetime.datetime(2015, 2, 1)),
+            (datetime.datetime(2015, 2, 1), datetime.datetime(2015, 2, 11)),
+            (datetime.datetime(2015, 2, 11), datetime.datetime(2015, 2, 21)),
+            (datetime.datetime(2015, 2, 21), datetime.datetime(2015, 3, 1)),
+            (datetime.datetime(2015, 3, 1), datetime.datetime(2015, 3, 11)),
+            (datetime.datetime(2015, 3, 11), datetime.datetime(2015, 3, 14)),
+        ]
+        intervals_actual = intervals.date_limits_to_intervals(
+            datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 3, 14),
+            relativedelta.relativedelta(days=10),
+            align_to_months=True)
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
+    def test_grid_intervals_do_not_depend_on_range_start(self):
+        intervals_expected = [
+            (datetime.datetime(2015, 1, 1, 12), datetime.datetime(2015, 1, 2)),
+            (datetime.datetime(2015, 1, 2), datetime.datetime(2015, 1, 3)),
+            (datetime.datetime(2015, 1, 3), datetime.datetime(2015, 1, 3, 6)),
+        ]
+        intervals_actual = intervals.grid_intervals(
+            datetime.datetime(2015, 1, 1, 12),
+            datetime.datetime(2015, 1, 3, 6),
+            relativedelta.relativedelta(days=1))
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
+    def test_grid_intervals_with_month_steps(self):
+        intervals_expected = [
+            (datetime.datetime(2015, 2, 11), datetime.datetime(2015, 4, 1)),
+            (datetime.datetime(2015, 4, 1), datetime.datetime(2015, 5, 1)),
+        ]
+        intervals_actual = intervals.grid_intervals(
+            datetime.datetime(2015, 2, 11),
+            datetime.datetime(2015, 5, 1),
+            relativedelta.relativedelta(months=3))
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
+    def test_date_limits_to_intervals_aligned_to_months_with_month_steps(self):
+        """Multi-month aligned intervals end on a month border."""
+        intervals_expected = [
+            (datetime.datetime(2009, 2, 11), datetime.datetime(2009, 7, 1)),
+            (datetime.datetime(2009, 7, 1), datetime.datetime(2009, 12, 1)),
+            (datetime.datetime(2009, 12, 1), datetime.datetime(2010, 1, 1)),
+            (datetime.datetime(2010, 1, 1), datetime.datetime(2010, 1, 20)),
+        ]
+        intervals_actual = intervals.date_limits_to_intervals(
+            datetime.datetime(2009, 2, 11),
+            datetime.datetime(2010, 1, 20),
+            relativedelta.relativedelta(months=5),
+            align_to_months=True)
+        self.assertSequenceEqual(intervals_expected, intervals_actual)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,243 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+import unittest
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import constants
+import local_execution
+import query_construct
+import query_execution
+
+JAN_2015_TABLE = 'plx.google:m_lab.2015_01.all'
+NDT_TABLE = 'plx.google:m_lab.ndt.all'
+PARIS_TRACEROUTE_TABLE = 'plx.google:m_lab.paris_traceroute.all'
+
+
+class TranslateQueryTest(unittest.TestCase):
+
+    def test_translate_query_unions_comma_separated_tables(self):
+        self.assertEqual(
+            'SELECT test_id FROM (SELECT * FROM "a:b.c" UNION ALL '
+            'SELECT * FROM "a:b.d") WHERE project = 0',
+            local_execution.translate_query(
+                'SELECT test_id FROM a:b.c, a:b.d WHERE project = 0'))
+
+    def test_translate_query_quotes_single_table(self):
+        self.assertEqual('SELECT test_id FROM "plx.google:m_lab.ndt.all"',
+                         local_execution.translate_query(
+                             'SELECT test_id FROM plx.google:m_lab.ndt.all'))
+
+    def test_translate_query_flattens_nested_fields(self):
+        self.assertEqual(
+            'SELECT test_id FROM "a:b.c" WHERE "web100_log_entry.log_time" > 5',
+            local_execution.translate_query(
+                'SELECT test_id FROM a:b.c WHERE web100_log_entry.log_time > 5'))
+
+    def test_translate_query_drops_each_and_comments(self):
+        self.assertEqual(
+            'SELECT x FROM (SELECT x FROM "a:b.c") AS l '
+            'FULL OUTER JOIN (SELECT x FROM "a:b.d") AS r ON l.x=r.x',
+            local_execution.translate_query(
+                'SELECT x FROM (SELECT x FROM a:b.c) AS l -- left\n'
+                'FULL OUTER JOIN EACH (SELECT x FROM a:b.d) AS r ON l.x=r.x').replace(
+                    '\n', ''))
+
+    def test_translate_query_unions_comma_separated_subqueries(self):
+        self.assertEqual(
+            'SELECT x FROM (SELECT * FROM (SELECT x FROM "a:b.c") UNION ALL '
+            'SELECT * FROM (SELECT x FROM (SELECT * FROM "a:b.d" UNION ALL '
+            'SELECT * FROM "a:b.e")))', local_execution.translate_query(
+                'SELECT x FROM (SELECT x FROM a:b.c), '
+                '(SELECT x FROM a:b.d, a:b.e)'))
+
+    def test_translate_query_keeps_single_subquery(self):
+        self.assertEqual('SELECT x FROM (SELECT x FROM "a:b.c") AS l, y',
+                         local_execution.translate_query(
+                             'SELECT x FROM (SELECT x FROM a:b.c) AS l, y'))
+
+    def test_translate_query_names_output_columns_like_legacy_sql(self):
+        self.assertEqual(
+            'SELECT l.x AS l_x , r.x AS r_x FROM "a:b.c"',
+            local_execution.translate_query('SELECT l.x, r.x FROM a:b.c'))
+
+    def test_referenced_tables(self):
+        self.assertEqual(
+            ['a:b.c', 'a:b.d', 'a:b.e'], local_execution.referenced_tables(
+                'SELECT x FROM (SELECT x FROM a:b.d, a:b.c) FULL OUTER JOIN '
+                '(SELECT x FROM a:b.e)'))
+
+
+class SqliteQueryExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = local_execution.SqliteQueryExecutor()
+        self.checker = check_table_equivalence.TableEquivalenceChecker(
+            query_construct.TableEquivalenceQueryGeneratorFactory(),
+            self.executor)
+
+    def check_january(self, project, **kwargs):
+        return self.checker.check(project, datetime.datetime(2015, 1, 1),
+                                  datetime.datetime(2015, 2, 1), **kwargs)
+
+    def test_equivalent_tables_pass_check(self):
+        rows = [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)]
+        self.executor.load_table(JAN_2015_TABLE, rows)
+        self.executor.load_table(NDT_TABLE, rows)
+        self.assertTrue(self.check_january(constants.PROJECT_ID_NDT).success)
+
+    def test_execute_query_returns_mismatches_as_bq_csv(self):
+        self.executor.load_table(
+            JAN_2015_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('c', 10)])
+        query = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 2, 1)).generate_query()
+        self.assertEqual('per_month_test_id,per_project_test_id\nb,\n,c\n',
+                         self.executor.execute_query(query))
+
+    def test_anti_join_strategy_finds_same_mismatches(self):
+        self.executor.load_table(
+            JAN_2015_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('c', 10)])
+        query = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT,
+            datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 2, 1),
+            strategy=query_construct.STRATEGY_ANTI_JOIN).generate_query()
+        self.assertEqual('per_month_test_id,per_project_test_id\nb,\n,c\n',
+                         self.executor.execute_query(query))
+
+    def test_fingerprints_match_only_for_equivalent_tables(self):
+        self.executor.load_table(
+            JAN_2015_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('b', 10), helpers.ndt_row('a', 3)])
+        generator = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 2, 1))
+        header, values = self.executor.execute_query(
+            generator.generate_fingerprint_query()).splitlines()
+        self.assertEqual('per_month_row_count,per_month_fingerprint,'
+                         'per_project_row_count,per_project_fingerprint',
+                         header)
+        month_count, month_print, project_count, project_print = (
+            values.split(','))
+        self.assertEqual(('2', month_print), (project_count, project_print))
+        self.assertEqual('2', month_count)
+
+        self.executor.load_table(NDT_TABLE, [helpers.ndt_row('c', 10)])
+        values = self.executor.execute_query(
+            generator.generate_fingerprint_query()).splitlines()[1]
+        self.assertNotEqual(values.split(',')[1], values.split(',')[3])
+
+    def test_intermediate_snapshots_are_ignored_in_per_month_table(self):
+        self.executor.load_table(JAN_2015_TABLE, [helpers.ndt_row(
+            'a', 3), helpers.ndt_row('b', 3, is_last_entry=False)])
+        self.executor.load_table(NDT_TABLE, [helpers.ndt_row('a', 3)])
+        self.assertTrue(self.check_january(constants.PROJECT_ID_NDT).success)
+
+    def test_rows_outside_window_are_ignored(self):
+        self.executor.load_table(JAN_2015_TABLE, [helpers.ndt_row('a', 3)])
+        self.executor.load_table(NDT_TABLE, [helpers.ndt_row('a', 3)])
+        self.executor.load_table(NDT_TABLE, [{
+            'test_id': 'late',
+            'project': constants.PROJECT_ID_NDT,
+            'web100_log_entry.log_time': helpers.timestamp(31) + 86400
+        }])
+        self.assertTrue(self.check_january(constants.PROJECT_ID_NDT).success)
+
+    def test_paris_traceroute_uses_top_level_log_time(self):
+        self.executor.load_table(JAN_2015_TABLE, [{
+            'test_id': 'a',
+            'project': constants.PROJECT_ID_PARIS_TRACEROUTE,
+            'log_time': helpers.timestamp(5)
+        }])
+        self.executor.load_table(PARIS_TRACEROUTE_TABLE, [{
+            'test_id': 'b',
+            'log_time': helpers.timestamp(5)
+        }])
+        result = self.check_january(constants.PROJECT_ID_PARIS_TRACEROUTE)
+        self.assertFalse(result.success)
+        self.assertIn('  a\n', result.message)
+        self.assertIn('  b\n', result.message)
+
+    def test_shards_partition_mismatches(self):
+        test_ids = ['id%d' % i for i in range(50)]
+        self.executor.load_table(
+            JAN_2015_TABLE,
+            [helpers.ndt_row(test_id, 5) for test_id in test_ids])
+        found = []
+        for shard_index in range(4):
+            query = query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_NDT,
+                datetime.datetime(2015, 1, 1),
+                datetime.datetime(2015, 2, 1),
+                shard_count=4,
+                shard_index=shard_index).generate_query()
+            found.extend(check_table_equivalence._parse_query_result(
+                self.executor.execute_query(query))[0])
+        self.assertItemsEqual(test_ids, found)
+
+    def test_tables_that_were_not_loaded_are_empty(self):
+        self.assertTrue(self.check_january(constants.PROJECT_ID_NDT).success)
+
+    def test_invalid_query_raises_bq_failed_error(self):
+        with self.assertRaises(query_execution.BqFailedError):
+            self.executor.execute_query('SELECT nonexistent FROM a:b.c')
+
+    def test_untranslatable_query_raises_bq_failed_error(self):
+        with self.assertRaises(query_execution.BqFailedError):
+            self.executor.execute_query('SELECT x FROM (SELECT x FROM a:b.c')
+
+    def test_estimate_query_bytes_counts_referenced_rows_and_columns(self):
+        self.executor.load_table('a:b.c', [{'test_id': 'a'}, {'test_id': 'b'}])
+        self.assertEqual(2 * 2 * 8, self.executor.estimate_query_bytes(
+            'SELECT test_id FROM a:b.c WHERE project = 0'))
+
+    def test_count_rows_read_counts_every_read_of_each_table(self):
+        self.executor.load_table('a:b.c', [{'test_id': 'a'}, {'test_id': 'b'}])
+        self.executor.load_table('a:b.d', [{'test_id': 'a'}])
+        self.assertEqual(2, self.executor.count_rows_read(
+            'SELECT test_id FROM a:b.c WHERE test_id = "a"'))
+        self.assertEqual(5, self.executor.count_rows_read(
+            'SELECT test_id FROM a:b.c WHERE test_id NOT IN (SELECT test_id '
+            'FROM a:b.d) UNION ALL SELECT test_id FROM a:b.c'))
+
+    def test_count_rows_read_of_equivalence_query(self):
+        rows = [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)]
+        self.executor.load_table(JAN_2015_TABLE, rows)
+        self.executor.load_table(NDT_TABLE, rows)
+        query = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2015, 1, 1),
+            datetime.datetime(2015, 2, 1)).generate_query()
+        self.assertEqual(4, self.executor.count_rows_read(query))
+
+    def test_table_modified_time_is_known_only_for_loaded_tables(self):
+        self.assertIsNone(self.executor.table_modified_time('a:b.c'))
+        self.executor.load_table('a:b.c', [{'test_id': 'a'}])
+        self.assertIsNotNone(self.executor.table_modified_time('a:b.c'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,135 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import history
+import intervals
+import prioritization
+import query_execution
+
+NOW = datetime.datetime(2016, 6, 1)
+
+
+def _day(month, day):
+    return datetime.datetime(2016, month, day)
+
+
+def _job(project, start, end, shard_index=0):
+    return (project, start, end, shard_index)
+
+
+class WindowPrioritizerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.check_history = mock.Mock(spec=history.CheckHistory)
+        self.check_history.window_stats.return_value = history.WindowStats(0, 0,
+                                                                           None)
+        self.clock = lambda: intervals.to_timestamp(NOW)
+
+    def test_recent_windows_come_first_without_history(self):
+        prioritizer = prioritization.WindowPrioritizer(clock=self.clock)
+        jobs = [
+            _job(0, _day(1, 1), _day(1, 2)),
+            _job(0, _day(3, 1), _day(3, 2)),
+            _job(0, _day(5, 30), _day(5, 31)),
+        ]
+        self.assertEqual(list(reversed(jobs)), prioritizer.prioritize(jobs))
+
+    def test_recency_score_halves_every_half_life(self):
+        prioritizer = prioritization.WindowPrioritizer(clock=self.clock)
+        self.assertAlmostEqual(1.0, prioritizer.score(0, _day(5, 31), NOW))
+        self.assertAlmostEqual(
+            0.5,
+            prioritizer.score(0,
+                              _day(5, 1),
+                              NOW - datetime.timedelta(
+                                  days=prioritization.RECENCY_HALF_LIFE_DAYS)))
+
+    def test_windows_that_failed_before_come_first(self):
+        stats = {
+            _day(1, 1): history.WindowStats(4, 4, 100.0),
+            _day(5, 1): history.WindowStats(4, 0, 100.0),
+        }
+        self.check_history.window_stats.side_effect = (
+            lambda project, start, end: stats[start])
+        prioritizer = prioritization.WindowPrioritizer(self.check_history,
+                                                       clock=self.clock)
+        jobs = [
+            _job(0, _day(5, 1), _day(5, 2)),
+            _job(0, _day(1, 1), _day(1, 2)),
+        ]
+        self.assertEqual(list(reversed(jobs)), prioritizer.prioritize(jobs))
+
+    def test_windows_with_tables_modified_since_last_check_come_first(self):
+        self.check_history.window_stats.return_value = history.WindowStats(
+            1, 0, 500.0)
+
+        def table_modified_time(table_name):
+            if table_name == 'plx.google:m_lab.2016_01.all':
+                return 1000.0
+            return 100.0
+
+        prioritizer = prioritization.WindowPrioritizer(self.check_history,
+                                                       table_modified_time,
+                                                       clock=self.clock)
+        jobs = [
+            _job(0, _day(3, 10), _day(3, 11)),
+            _job(0, _day(1, 10), _day(1, 11)),
+        ]
+        self.assertEqual(list(reversed(jobs)), prioritizer.prioritize(jobs))
+
+    def test_table_modification_times_are_retrieved_once(self):
+        table_modified_time = mock.Mock(return_value=None)
+        prioritizer = prioritization.WindowPrioritizer(
+            table_modified_time=table_modified_time,
+            clock=self.clock)
+        prioritizer.prioritize([
+            _job(0, _day(3, 10), _day(3, 11)),
+            _job(0, _day(3, 11), _day(3, 12)),
+        ])
+        # The March table and the NDT table.
+        self.assertEqual(2, table_modified_time.call_count)
+
+    def test_table_errors_are_treated_as_unknown(self):
+        table_modified_time = mock.Mock(
+            side_effect=query_execution.BqFailedError('', 'Not found'))
+        prioritizer = prioritization.WindowPrioritizer(
+            table_modified_time=table_modified_time,
+            clock=self.clock)
+        self.assertAlmostEqual(
+            prioritization.WindowPrioritizer(clock=self.clock).score(
+                0, _day(3, 10), _day(3, 11)),
+            prioritizer.score(0, _day(3, 10), _day(3, 11)))
+
+    def test_shards_of_a_window_stay_together_in_order(self):
+        prioritizer = prioritization.WindowPrioritizer(clock=self.clock)
+        jobs = [
+            _job(0, _day(1, 1), _day(1, 2), 0),
+            _job(0, _day(1, 1), _day(1, 2), 1),
+            _job(0, _day(2, 1), _day(2, 2), 0),
+            _job(0, _day(2, 1), _day(2, 2), 1),
+        ]
+        self.assertEqual(jobs[2:] + jobs[:2], prioritizer.prioritize(jobs))
+
+
+if __name__ == '__main__':
+    unittest.main()
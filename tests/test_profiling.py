@@ -0,0 +1,148 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import pstats
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+import mock
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import profiling
+
+
+def _busy_parse():
+    return sorted(str(i) for i in range(2000))
+
+
+def _busy_format():
+    return '\n'.join(str(i) for i in range(2000))
+
+
+class PipelineProfilerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.output_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.output_dir)
+        self.addCleanup(profiling.deactivate)
+
+    def read_report(self):
+        with open(os.path.join(self.output_dir, 'report.txt')) as report:
+            return report.read()
+
+    def test_phase_does_nothing_without_active_profiler(self):
+        with profiling.phase('parse_results'):
+            _busy_parse()
+
+    def test_report_ranks_phases_and_lists_their_functions(self):
+        profiler = profiling.PipelineProfiler()
+        profiling.activate(profiler)
+        with profiling.phase('parse_results'):
+            _busy_parse()
+        with profiling.phase('format_message'):
+            _busy_format()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        report = self.read_report()
+        self.assertIn('Pipeline phases by total time:', report)
+        self.assertIn('=== Phase: parse_results ===', report)
+        self.assertIn('=== Phase: format_message ===', report)
+        self.assertIn('_busy_parse', report)
+        self.assertIn('_busy_format', report)
+        stats = pstats.Stats(os.path.join(self.output_dir,
+                                          'parse_results.pstats'))
+        profiled_functions = [function for _, _, function in stats.stats]
+        self.assertIn('_busy_parse', profiled_functions)
+        self.assertNotIn('_busy_format', profiled_functions)
+
+    def test_nested_phases_are_attributed_to_outer_phase(self):
+        profiler = profiling.PipelineProfiler()
+        profiling.activate(profiler)
+        with profiling.phase('execute_query'):
+            with profiling.phase('parse_results'):
+                _busy_parse()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        self.assertEqual(['execute_query.pstats', 'report.txt'],
+                         sorted(os.listdir(self.output_dir)))
+
+    def test_phases_on_several_threads_are_merged(self):
+        profiler = profiling.PipelineProfiler()
+        profiling.activate(profiler)
+
+        def parse_in_phase():
+            with profiling.phase('parse_results'):
+                _busy_parse()
+
+        threads = [threading.Thread(target=parse_in_phase) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        self.assertIn('parse_results', self.read_report())
+        self.assertIn('in 3 calls', self.read_report())
+
+    def test_memory_peaks_are_reported_when_measuring_memory(self):
+        profiler = profiling.PipelineProfiler(measure_memory=True)
+        profiling.activate(profiler)
+        with profiling.phase('parse_results', measure_memory=True):
+            _busy_parse()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        self.assertIn('peak memory growth', self.read_report())
+
+    def test_memory_peaks_are_growth_of_peak_resident_memory(self):
+        peaks = [mock.Mock(ru_maxrss=1000), mock.Mock(ru_maxrss=1500)]
+        getrusage_patch = mock.patch.object(profiling.resource,
+                                            'getrusage',
+                                            side_effect=peaks)
+        self.addCleanup(getrusage_patch.stop)
+        getrusage_patch.start()
+        platform_patch = mock.patch.object(profiling.sys, 'platform', 'linux2')
+        self.addCleanup(platform_patch.stop)
+        platform_patch.start()
+
+        profiler = profiling.PipelineProfiler(measure_memory=True)
+        profiling.activate(profiler)
+        with profiling.phase('parse_results', measure_memory=True):
+            _busy_parse()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        self.assertIn('peak memory growth 500 KiB', self.read_report())
+
+    def test_memory_is_not_measured_unless_enabled(self):
+        profiler = profiling.PipelineProfiler()
+        profiling.activate(profiler)
+        with profiling.phase('parse_results', measure_memory=True):
+            _busy_parse()
+        profiling.deactivate()
+        profiler.write_report(self.output_dir)
+
+        self.assertNotIn('peak memory', self.read_report())
+
+
+if __name__ == '__main__':
+    unittest.main()
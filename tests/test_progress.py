@@ -0,0 +1,112 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import io
+import os
+import sys
+import unittest
+
+import mock
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import progress
+
+
+class FakeTerminal(io.BytesIO):
+
+    def isatty(self):
+        return True
+
+
+class ProgressReporterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+        logger_patch = mock.patch.object(progress, 'logger', autospec=True)
+        self.addCleanup(logger_patch.stop)
+        self.logger = logger_patch.start()
+
+    def create_reporter(self, stream, total_windows=10, total_days=30):
+        return progress.ProgressReporter(total_windows,
+                                         total_days,
+                                         stream=stream,
+                                         log_interval=60,
+                                         clock=self.clock.time)
+
+    def test_status_before_any_window_completes(self):
+        reporter = self.create_reporter(io.BytesIO())
+        self.assertEqual(
+            'Progress: 0/10 windows (0.0%), 0.0/30.0 days, 0 failures, 0.0 '
+            'windows/min, 0.0 days/min, ETA unknown', reporter.status())
+
+    def test_status_reports_throughput_and_eta(self):
+        reporter = self.create_reporter(io.BytesIO())
+        for success in (True, False):
+            self.clock.now += 30
+            reporter.window_completed(3, success)
+        self.assertEqual(
+            'Progress: 2/10 windows (20.0%), 6.0/30.0 days, 1 failures, 2.0 '
+            'windows/min, 6.0 days/min, ETA 0:04:00', reporter.status())
+
+    def test_throughput_is_a_moving_average(self):
+        """Throughput should follow recent completions, not the whole run."""
+        reporter = self.create_reporter(io.BytesIO(), total_windows=100)
+        # A slow start.
+        for _ in range(20):
+            self.clock.now += 60
+            reporter.window_completed(1, True)
+        # Then windows complete much faster.
+        for _ in range(20):
+            self.clock.now += 1
+            reporter.window_completed(1, True)
+        self.assertIn('60.0 windows/min', reporter.status())
+        self.assertIn('ETA 0:01:00', reporter.status())
+
+    def test_simultaneous_completions_do_not_break_rates(self):
+        """Out-of-order windows completing at the same time are counted."""
+        reporter = self.create_reporter(io.BytesIO(), total_windows=40)
+        for _ in range(30):
+            reporter.window_completed(1, True)
+        self.assertIn('30/40 windows', reporter.status())
+        self.assertIn('ETA unknown', reporter.status())
+
+    def test_terminal_output_updates_in_place(self):
+        terminal = FakeTerminal()
+        reporter = self.create_reporter(terminal)
+        self.clock.now += 30
+        reporter.window_completed(3, True)
+        reporter.window_completed(3, True)
+        reporter.finish()
+        output = terminal.getvalue()
+        self.assertTrue(output.startswith('\rProgress: 1/10 windows'))
+        self.assertEqual(3, output.count('\r'))
+        self.assertTrue(output.endswith('\n'))
+        self.assertFalse(self.logger.info.called)
+
+    def test_non_terminal_output_is_logged_periodically(self):
+        reporter = self.create_reporter(io.BytesIO())
+        for _ in range(10):
+            self.clock.now += 15
+            reporter.window_completed(3, True)
+        # 150 seconds have elapsed, so there should be two log messages.
+        self.assertEqual(2, self.logger.info.call_count)
+        reporter.finish()
+        self.assertEqual(3, self.logger.info.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -310,6 +310,379 @@ class TableEquivalenceQueryGeneratorTest(unittest.TestCase):
             end_time).generate_query()
         self.assertQueriesEqual(query_expected, query_actual)
 
+    def test_correct_query_generation_for_sharded_sidestream(self):
+        """Sharded queries should limit both tables to the same shard."""
+        query_expected = """
+        SELECT
+            per_month.test_id,
+            per_project.test_id
+        FROM
+          (
+            SELECT
+                test_id
+            FROM
+                plx.google:m_lab.2014_12.all,
+                plx.google:m_lab.2015_01.all
+            WHERE
+                project = 2
+                AND ((web100_log_entry.log_time >= 1419724800) AND  -- 2014-12-28
+                     (web100_log_entry.log_time <  1420243200))     -- 2015-01-03
+                AND MOD(ABS(HASH(test_id)), 8) = 5
+          ) AS per_month
+        FULL OUTER JOIN EACH
+          (
+            SELECT
+                test_id
+            FROM
+                plx.google:m_lab.sidestream.all
+            WHERE
+                ((web100_log_entry.log_time >= 1419724800) AND  -- 2014-12-28
+                 (web100_log_entry.log_time <  1420243200))     -- 2015-01-03
+                AND MOD(ABS(HASH(test_id)), 8) = 5
+          ) AS per_project
+        ON
+            per_month.test_id=per_project.test_id
+        WHERE
+            per_month.test_id IS NULL
+            OR per_project.test_id IS NULL"""
+
+        start_time = datetime.datetime(2014, 12, 28)
+        end_time = datetime.datetime(2015, 1, 3)
+        query_actual = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_SIDESTREAM,
+            start_time,
+            end_time,
+            shard_count=8,
+            shard_index=5).generate_query()
+        self.assertQueriesEqual(query_expected, query_actual)
+
+    def test_correct_query_generation_for_hour_window(self):
+        """Windows that do not start at midnight include the time of day."""
+        query_expected = """
+        SELECT
+            per_month.test_id,
+            per_project.test_id
+        FROM
+          (
+            SELECT
+                test_id
+            FROM
+                plx.google:m_lab.2014_12.all
+            WHERE
+                project = 2
+                AND ((web100_log_entry.log_time >= 1419746400) AND  -- 2014-12-28T06:00
+                     (web100_log_entry.log_time <  1419750000))     -- 2014-12-28T07:00
+          ) AS per_month
+        FULL OUTER JOIN EACH
+          (
+            SELECT
+                test_id
+            FROM
+                plx.google:m_lab.sidestream.all
+            WHERE
+                ((web100_log_entry.log_time >= 1419746400) AND  -- 2014-12-28T06:00
+                 (web100_log_entry.log_time <  1419750000))     -- 2014-12-28T07:00
+          ) AS per_project
+        ON
+            per_month.test_id=per_project.test_id
+        WHERE
+            per_month.test_id IS NULL
+            OR per_project.test_id IS NULL"""
+
+        start_time = datetime.datetime(2014, 12, 28, 6)
+        end_time = datetime.datetime(2014, 12, 28, 7)
+        query_actual = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_SIDESTREAM, start_time,
+            end_time).generate_query()
+        self.assertQueriesEqual(query_expected, query_actual)
+
+    def test_generator_rejects_invalid_shards(self):
+        start_time = datetime.datetime(2014, 12, 28)
+        end_time = datetime.datetime(2015, 1, 3)
+        with self.assertRaises(ValueError):
+            query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_NDT,
+                start_time,
+                end_time,
+                shard_count=0)
+        with self.assertRaises(ValueError):
+            query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_NDT,
+                start_time,
+                end_time,
+                shard_count=4,
+                shard_index=4)
+
+    def test_generator_rejects_unknown_strategy(self):
+        with self.assertRaises(ValueError):
+            query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_NDT,
+                datetime.datetime(2014, 12, 28),
+                datetime.datetime(2015, 1, 3),
+                strategy='nested_loop')
+
+    def test_correct_query_generation_for_anti_join_strategy(self):
+        query_expected = """
+        SELECT
+            per_month_test_id,
+            per_project_test_id
+        FROM
+          (
+            SELECT
+                test_id AS per_month_test_id,
+                STRING(NULL) AS per_project_test_id
+            FROM
+              (
+                SELECT
+                    test_id
+                FROM
+                    plx.google:m_lab.2014_12.all
+                WHERE
+                    project = 3
+                    AND ((log_time >= 1419724800) AND  -- 2014-12-28
+                         (log_time <  1419811200))     -- 2014-12-29
+              )
+            WHERE
+                test_id NOT IN (
+                    SELECT
+                        test_id
+                    FROM
+                        plx.google:m_lab.paris_traceroute.all
+                    WHERE
+                        ((log_time >= 1419724800) AND  -- 2014-12-28
+                         (log_time <  1419811200))     -- 2014-12-29
+                )
+          ),
+          (
+            SELECT
+                STRING(NULL) AS per_month_test_id,
+                test_id AS per_project_test_id
+            FROM
+              (
+                SELECT
+                    test_id
+                FROM
+                    plx.google:m_lab.paris_traceroute.all
+                WHERE
+                    ((log_time >= 1419724800) AND  -- 2014-12-28
+                     (log_time <  1419811200))     -- 2014-12-29
+              )
+            WHERE
+                test_id NOT IN (
+                    SELECT
+                        test_id
+                    FROM
+                        plx.google:m_lab.2014_12.all
+                    WHERE
+                        project = 3
+                        AND ((log_time >= 1419724800) AND  -- 2014-12-28
+                             (log_time <  1419811200))     -- 2014-12-29
+                )
+          )"""
+
+        query_actual = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_PARIS_TRACEROUTE,
+            datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 29),
+            strategy=query_construct.STRATEGY_ANTI_JOIN).generate_query()
+        self.assertQueriesEqual(query_expected, query_actual)
+
+    def test_correct_fingerprint_query_generation(self):
+        query_expected = """
+        SELECT
+            per_month.row_count,
+            per_month.fingerprint,
+            per_project.row_count,
+            per_project.fingerprint
+        FROM
+          (
+            SELECT
+                COUNT(*) AS row_count,
+                BIT_XOR(HASH(test_id)) AS fingerprint
+            FROM
+              (
+                SELECT
+                    test_id
+                FROM
+                    plx.google:m_lab.2014_12.all
+                WHERE
+                    project = 3
+                    AND ((log_time >= 1419724800) AND  -- 2014-12-28
+                         (log_time <  1419811200))     -- 2014-12-29
+              )
+          ) AS per_month
+        CROSS JOIN
+          (
+            SELECT
+                COUNT(*) AS row_count,
+                BIT_XOR(HASH(test_id)) AS fingerprint
+            FROM
+              (
+                SELECT
+                    test_id
+                FROM
+                    plx.google:m_lab.paris_traceroute.all
+                WHERE
+                    ((log_time >= 1419724800) AND  -- 2014-12-28
+                     (log_time <  1419811200))     -- 2014-12-29
+              )
+          ) AS per_project"""
+
+        query_actual = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_PARIS_TRACEROUTE,
+            datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 29)).generate_fingerprint_query()
+        self.assertQueriesEqual(query_expected, query_actual)
+
+    def test_generate_test_id_queries_selects_each_side(self):
+        per_month_query, per_project_query = (
+            query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_SIDESTREAM,
+                datetime.datetime(2014, 12, 28),
+                datetime.datetime(2014, 12, 29)).generate_test_id_queries())
+        self.assertIn('plx.google:m_lab.2014_12.all', per_month_query)
+        self.assertIn('project = 2', per_month_query)
+        self.assertIn('plx.google:m_lab.sidestream.all', per_project_query)
+        self.assertNotIn('project = 2', per_project_query)
+
+    def test_correct_aggregate_query_generation_for_paris_traceroute(self):
+        query_expected = """
+            SELECT
+                per_month.day,
+                per_project.day,
+                per_month.row_count,
+                per_project.row_count,
+                per_project.null_count
+            FROM
+              (
+                SELECT
+                    INTEGER(log_time / 86400) AS day,
+                    COUNT(*) AS row_count
+                FROM
+                    plx.google:m_lab.2014_12.all
+                WHERE
+                    project = 3
+                    AND ((log_time >= 1419724800) AND  -- 2014-12-28
+                         (log_time <  1419811200))     -- 2014-12-29
+                GROUP BY
+                    day
+              ) AS per_month
+              FULL OUTER JOIN EACH
+              (
+                SELECT
+                    INTEGER(log_time / 86400) AS day,
+                    COUNT(*) AS row_count,
+                    SUM(x) AS null_count
+                FROM
+                    plx.google:m_lab.paris_traceroute.all
+                WHERE
+                    ((log_time >= 1419724800) AND  -- 2014-12-28
+                     (log_time <  1419811200))     -- 2014-12-29
+                GROUP BY
+                    day
+              ) AS per_project
+            ON
+                per_month.day=per_project.day"""
+
+        query_actual = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_PARIS_TRACEROUTE,
+            datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 29)).generate_aggregate_query([
+                query_construct.Aggregate(query_construct.SIDE_PER_MONTH,
+                                          'row_count', 'COUNT(*)'),
+                query_construct.Aggregate(query_construct.SIDE_PER_PROJECT,
+                                          'row_count', 'COUNT(*)'),
+                query_construct.Aggregate(query_construct.SIDE_PER_PROJECT,
+                                          'null_count', 'SUM(x)')
+            ])
+        self.assertQueriesEqual(query_expected, query_actual)
+
+    def test_aggregate_query_for_web100_includes_rows_without_log_time(self):
+        generator = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 29))
+        query = generator.generate_aggregate_query([
+            query_construct.Aggregate(query_construct.SIDE_PER_MONTH,
+                                      'row_count', 'COUNT(*)')
+        ])
+        self.assertIn(
+            'INTEGER(IFNULL(web100_log_entry.log_time, log_time) / 86400) '
+            'AS day', query)
+        self.assertIn('OR (web100_log_entry.log_time IS NULL AND', query)
+        self.assertNotIn('is_last_entry', query)
+        self.assertEqual('web100_log_entry.log_time', generator.time_field)
+        self.assertTrue(generator.has_intermediate_snapshots)
+
+    def test_duplicate_query_searches_only_requested_days(self):
+        generator = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 31))
+        query = generator.generate_duplicate_query(
+            [datetime.date(2014, 12, 28), datetime.date(2014, 12, 30)], [])
+        self.assertIn(
+            'AND INTEGER(web100_log_entry.log_time / 86400) IN (16432, 16434)',
+            query)
+        self.assertIn('web100_log_entry.is_last_entry = True', query)
+        self.assertIn("'per_month' AS side", query)
+        self.assertNotIn("'per_project' AS side", query)
+        self.assertNotIn('plx.google:m_lab.ndt.all', query)
+
+    def test_duplicate_query_requires_days(self):
+        generator = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 31))
+        with self.assertRaises(ValueError):
+            generator.generate_duplicate_query([], [])
+
+    def test_sample_rate_limits_both_sides_to_same_test_ids(self):
+        per_month_query, per_project_query = (
+            query_construct.TableEquivalenceQueryGenerator(
+                constants.PROJECT_ID_SIDESTREAM,
+                datetime.datetime(2014, 12, 28),
+                datetime.datetime(2014, 12, 29),
+                shard_count=4,
+                shard_index=1,
+                sample_rate=0.01).generate_test_id_queries())
+        for query in (per_month_query, per_project_query):
+            self.assertIn('AND MOD(ABS(HASH(test_id)), 4) = 1\n', query)
+            self.assertIn('AND MOD(ABS(HASH(test_id)), 1000000) < 10000', query)
+
+    def test_factory_applies_sample_rate(self):
+        generator = query_construct.TableEquivalenceQueryGeneratorFactory(
+            sample_rate=0.25).create(constants.PROJECT_ID_NDT,
+                                     datetime.datetime(2014, 12, 28),
+                                     datetime.datetime(2014, 12, 29))
+        self.assertEqual(0.25, generator.sample_rate)
+        self.assertIn('MOD(ABS(HASH(test_id)), 1000000) < 250000',
+                      generator.generate_query())
+
+    def test_factory_reports_sample_rate_rounded_to_buckets(self):
+        self.assertIsNone(query_construct.TableEquivalenceQueryGeneratorFactory(
+        ).sample_rate)
+        factory = query_construct.TableEquivalenceQueryGeneratorFactory(
+            sample_rate=0.0000014)
+        generator = factory.create(constants.PROJECT_ID_NDT,
+                                   datetime.datetime(2014, 12, 28),
+                                   datetime.datetime(2014, 12, 29))
+        self.assertEqual(0.000001, factory.sample_rate)
+        self.assertEqual(generator.sample_rate, factory.sample_rate)
+
+    def test_generator_rejects_invalid_sample_rate(self):
+        for sample_rate in (0, 1.5, 1e-9):
+            with self.assertRaises(ValueError):
+                query_construct.TableEquivalenceQueryGenerator(
+                    constants.PROJECT_ID_NDT,
+                    datetime.datetime(2014, 12, 28),
+                    datetime.datetime(2014, 12, 29),
+                    sample_rate=sample_rate)
+
+    def test_generate_query_with_limit(self):
+        generator = query_construct.TableEquivalenceQueryGenerator(
+            constants.PROJECT_ID_NDT, datetime.datetime(2014, 12, 28),
+            datetime.datetime(2014, 12, 29))
+        self.assertEqual(generator.generate_query() + '\nLIMIT 1',
+                         generator.generate_query(limit=1))
+
 
 if __name__ == '__main__':
     unittest.main()
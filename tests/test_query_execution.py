@@ -12,18 +12,26 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import datetime
+import json
 import os
 import subprocess
 import sys
+import threading
+import time
 import unittest
 
 import mock
 
 sys.path.insert(1, os.path.abspath(os.path.join(
     os.path.dirname(__file__), '../bigsanity')))
+import instrumentation
 import query_execution
+import rate_limiting
 
 MOCK_QUERY = 'mock SQL query string'
+START_TIME = datetime.datetime(2010, 1, 5)
+END_TIME = datetime.datetime(2010, 1, 15)
 
 
 class QueryExecutorTest(unittest.TestCase):
@@ -69,6 +77,424 @@ class QueryExecutorTest(unittest.TestCase):
         with self.assertRaises(query_execution.BqFailedError):
             self.test_execute(MOCK_QUERY)
 
+    def test_estimate_query_bytes_parses_dry_run_output(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = [
+            ('Query successfully validated. Assuming the tables are not '
+             'modified, running this query will process 8675309 bytes of '
+             'data.'), ''
+        ]
+        subprocess.Popen.return_value = mock_process
+        self.assertEqual(
+            8675309,
+            query_execution.QueryExecutor().estimate_query_bytes(MOCK_QUERY))
+        self.assertIn('--dry_run', subprocess.Popen.call_args[0][0])
+
+    def test_estimate_query_bytes_when_output_is_unexpected(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = ['mock stdout output', '']
+        subprocess.Popen.return_value = mock_process
+        with self.assertRaises(query_execution.BqUnexpectedOutputError):
+            query_execution.QueryExecutor().estimate_query_bytes(MOCK_QUERY)
+
+    def test_table_modified_time_parses_table_metadata(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = [
+            '{"lastModifiedTime": "1476100000500", "numRows": "3"}', ''
+        ]
+        subprocess.Popen.return_value = mock_process
+        self.assertEqual(1476100000.5, query_execution.QueryExecutor(
+        ).table_modified_time('plx.google:m_lab.2016_10.all'))
+        self.assertEqual(
+            ['bq', '--format=json', 'show', 'plx.google:m_lab.2016_10.all'],
+            subprocess.Popen.call_args[0][0])
+
+    def test_table_modified_time_when_output_is_unexpected(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = ['{"numRows": "3"}', '']
+        subprocess.Popen.return_value = mock_process
+        with self.assertRaises(query_execution.BqUnexpectedOutputError):
+            query_execution.QueryExecutor().table_modified_time('a:b.c')
+
+    def test_execute_query_classifies_bq_failures(self):
+        """bq's error output should determine the type of error raised."""
+        stderr_to_error = (
+            ('BigQuery error in query operation: Exceeded rate limits: too '
+             'many concurrent queries for this project_and_region.',
+             query_execution.BqRateLimitedError),
+            ('BigQuery error in query operation: Error processing job: '
+             'backendError', query_execution.BqBackendError),
+            ('BigQuery error in query operation: Resources exceeded during '
+             'query execution.', query_execution.BqResourcesExceededError),
+            ('BigQuery error in query operation: Field not found.',
+             query_execution.BqFailedError),)
+        for stderr, error_class in stderr_to_error:
+            mock_process = mock.Mock(returncode=1)
+            mock_process.communicate.return_value = ['', stderr]
+            subprocess.Popen.return_value = mock_process
+            with self.assertRaises(error_class) as context:
+                self.test_execute(MOCK_QUERY)
+            self.assertIs(error_class, type(context.exception))
+            self.assertEqual(stderr, context.exception.stderr)
+            self.assertIn(stderr, str(context.exception))
+
+    def test_execute_query_names_the_job(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = ['', '']
+        subprocess.Popen.return_value = mock_process
+        self.test_execute(MOCK_QUERY)
+        bq_command = subprocess.Popen.call_args[0][0]
+        self.assertTrue(bq_command[1].startswith('--job_id=bigsanity_'))
+
+    def test_execute_query_registers_job_with_hedged_attempt(self):
+        """A hedged attempt should be able to cancel the job it started."""
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = ['', '']
+        subprocess.Popen.return_value = mock_process
+        attempt = query_execution._QueryAttempt()
+        query_execution._local.attempt = attempt
+        self.addCleanup(setattr, query_execution._local, 'attempt', None)
+        self.test_execute(MOCK_QUERY)
+        job_id = subprocess.Popen.call_args[0][0][1].split('=')[1]
+
+        attempt.cancel()
+        subprocess.Popen.assert_called_with(
+            ['bq', '--nosync', 'cancel', job_id],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+        with self.assertRaises(query_execution.QueryCancelledError):
+            self.test_execute(MOCK_QUERY)
+
+    def test_execute_query_records_job_statistics_when_instrumented(self):
+        query_process = mock.Mock(returncode=0)
+        query_process.communicate.return_value = ['a,b\n123,456\n789,012\n', '']
+        show_process = mock.Mock(returncode=0)
+        show_process.communicate.return_value = [
+            json.dumps({
+                'statistics': {
+                    'startTime': '1452000000000',
+                    'endTime': '1452000002500',
+                    'totalBytesProcessed': '8675309'
+                }
+            }), ''
+        ]
+        subprocess.Popen.side_effect = [query_process, show_process]
+
+        metrics = instrumentation.WindowMetrics(0, START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            self.test_execute(MOCK_QUERY)
+        self.assertEqual(8675309, metrics.bytes_processed)
+        self.assertEqual(2, metrics.rows_returned)
+        self.assertEqual(2.5, metrics.stage_seconds['bigquery_execution'])
+        self.assertIn('bq_startup', metrics.stage_seconds)
+        self.assertIn('bq_wait', metrics.stage_seconds)
+
+    def test_execute_query_succeeds_when_job_statistics_are_unavailable(self):
+        query_process = mock.Mock(returncode=0)
+        query_process.communicate.return_value = ['a,b\n123,456\n', '']
+        show_process = mock.Mock(returncode=1)
+        show_process.communicate.return_value = ['', 'mock stderr output']
+        subprocess.Popen.side_effect = [query_process, show_process]
+
+        metrics = instrumentation.WindowMetrics(0, START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            self.assertEqual('a,b\n123,456\n', self.test_execute(MOCK_QUERY))
+        self.assertIsNone(metrics.bytes_processed)
+
+    def test_execute_query_kills_and_cancels_query_after_deadline(self):
+        """If bq does not complete in time, kill it and cancel the job."""
+        killed = threading.Event()
+        mock_process = mock.Mock(returncode=-9)
+        mock_process.kill.side_effect = killed.set
+
+        def communicate(unused_input=None):
+            killed.wait(5)
+            return ['', '']
+
+        mock_process.communicate.side_effect = communicate
+        subprocess.Popen.return_value = mock_process
+
+        executor = query_execution.QueryExecutor(timeout=0.01)
+        with self.assertRaises(query_execution.BqTimeoutError):
+            executor.execute_query(MOCK_QUERY)
+        self.assertTrue(killed.is_set())
+        job_id = subprocess.Popen.call_args_list[0][0][0][1].split('=')[1]
+        subprocess.Popen.assert_called_with(
+            ['bq', '--nosync', 'cancel', job_id],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+
+    def test_execute_query_within_deadline_succeeds(self):
+        mock_process = mock.Mock(returncode=0)
+        mock_process.communicate.return_value = ['mock results', '']
+        subprocess.Popen.return_value = mock_process
+
+        executor = query_execution.QueryExecutor(timeout=60)
+        self.assertEqual('mock results', executor.execute_query(MOCK_QUERY))
+        self.assertFalse(mock_process.kill.called)
+
+
+class RetryingQueryExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_executor = mock.Mock(spec=query_execution.QueryExecutor)
+        self.token_bucket = mock.Mock(spec=rate_limiting.TokenBucket)
+        self.sleep = mock.Mock()
+        self.executor = query_execution.RetryingQueryExecutor(
+            self.query_executor,
+            self.token_bucket,
+            max_attempts=3,
+            sleep=self.sleep)
+
+    def test_execute_query_passes_through_results(self):
+        self.query_executor.execute_query.return_value = 'mock results'
+        self.assertEqual('mock results',
+                         self.executor.execute_query(MOCK_QUERY))
+        self.query_executor.execute_query.assert_called_once_with(MOCK_QUERY)
+        self.assertEqual(1, self.token_bucket.acquire.call_count)
+        self.assertFalse(self.sleep.called)
+
+    def test_execute_query_retries_transient_errors(self):
+        self.query_executor.execute_query.side_effect = [
+            query_execution.BqRateLimitedError(MOCK_QUERY),
+            query_execution.BqBackendError(MOCK_QUERY), 'mock results'
+        ]
+        self.assertEqual('mock results',
+                         self.executor.execute_query(MOCK_QUERY))
+        self.assertEqual(3, self.query_executor.execute_query.call_count)
+        # Every attempt must take a token from the bucket.
+        self.assertEqual(3, self.token_bucket.acquire.call_count)
+        self.assertEqual(2, self.sleep.call_count)
+
+    def test_execute_query_gives_up_after_max_attempts(self):
+        self.query_executor.execute_query.side_effect = (
+            query_execution.BqRateLimitedError(MOCK_QUERY))
+        with self.assertRaises(query_execution.BqRateLimitedError):
+            self.executor.execute_query(MOCK_QUERY)
+        self.assertEqual(3, self.query_executor.execute_query.call_count)
+
+    def test_execute_query_does_not_retry_permanent_errors(self):
+        self.query_executor.execute_query.side_effect = (
+            query_execution.BqResourcesExceededError(MOCK_QUERY))
+        with self.assertRaises(query_execution.BqResourcesExceededError):
+            self.executor.execute_query(MOCK_QUERY)
+        self.assertEqual(1, self.query_executor.execute_query.call_count)
+        self.assertFalse(self.sleep.called)
+
+    def test_estimate_query_bytes_retries_transient_errors(self):
+        self.query_executor.estimate_query_bytes.side_effect = [
+            query_execution.BqBackendError(MOCK_QUERY), 1024
+        ]
+        self.assertEqual(1024, self.executor.estimate_query_bytes(MOCK_QUERY))
+
+    def test_table_modified_time_retries_transient_errors(self):
+        self.query_executor.table_modified_time.side_effect = [
+            query_execution.BqBackendError(''), 1476100000.0
+        ]
+        self.assertEqual(1476100000.0,
+                         self.executor.table_modified_time('a:b.c'))
+
+    def test_executor_works_without_token_bucket(self):
+        executor = query_execution.RetryingQueryExecutor(self.query_executor)
+        self.query_executor.execute_query.return_value = 'mock results'
+        self.assertEqual('mock results', executor.execute_query(MOCK_QUERY))
+
+
+class AdaptiveConcurrencyQueryExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_executor = mock.Mock(spec=query_execution.QueryExecutor)
+        self.concurrency_limit = mock.Mock(
+            spec=rate_limiting.AimdConcurrencyLimit)
+        self.concurrency_limit.acquire.return_value = 'mock ticket'
+        self.concurrency_limit.limit = 3
+        self.executor = query_execution.AdaptiveConcurrencyQueryExecutor(
+            self.query_executor, self.concurrency_limit)
+
+    def test_execute_query_releases_success(self):
+        self.query_executor.execute_query.return_value = 'mock results'
+        metrics = instrumentation.WindowMetrics(0, START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            self.assertEqual('mock results',
+                             self.executor.execute_query(MOCK_QUERY))
+        self.concurrency_limit.release.assert_called_once_with(
+            'mock ticket', rate_limiting.OUTCOME_SUCCESS)
+        self.assertEqual(3, metrics.concurrency_limit)
+        self.assertIn('concurrency_wait', metrics.stage_seconds)
+
+    def test_execute_query_releases_overload_errors(self):
+        for error in (query_execution.BqRateLimitedError(MOCK_QUERY),
+                      query_execution.BqResourcesExceededError(MOCK_QUERY)):
+            self.concurrency_limit.reset_mock()
+            self.query_executor.execute_query.side_effect = error
+            with self.assertRaises(query_execution.BqFailedError):
+                self.executor.execute_query(MOCK_QUERY)
+            self.concurrency_limit.release.assert_called_once_with(
+                'mock ticket', rate_limiting.OUTCOME_OVERLOADED)
+
+    def test_execute_query_releases_other_errors(self):
+        self.query_executor.execute_query.side_effect = (
+            query_execution.BqBackendError(MOCK_QUERY))
+        with self.assertRaises(query_execution.BqBackendError):
+            self.executor.execute_query(MOCK_QUERY)
+        self.concurrency_limit.release.assert_called_once_with(
+            'mock ticket', rate_limiting.OUTCOME_ERROR)
+
+    def test_estimate_query_bytes_is_not_limited(self):
+        self.query_executor.estimate_query_bytes.return_value = 1024
+        self.assertEqual(1024, self.executor.estimate_query_bytes(MOCK_QUERY))
+        self.assertFalse(self.concurrency_limit.acquire.called)
+
+
+class LatencyTrackerTest(unittest.TestCase):
+
+    def test_percentile_uses_nearest_rank(self):
+        tracker = query_execution.LatencyTracker()
+        self.assertIsNone(tracker.percentile(95))
+        for latency in (5.0, 1.0, 3.0, 2.0, 4.0):
+            tracker.add(latency)
+        self.assertEqual(5, tracker.count())
+        self.assertEqual(3.0, tracker.percentile(50))
+        self.assertEqual(2.0, tracker.percentile(25))
+        self.assertEqual(5.0, tracker.percentile(95))
+        self.assertEqual(1.0, tracker.percentile(0))
+
+
+class HedgingQueryExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_executor = mock.Mock(spec=query_execution.QueryExecutor)
+        self.executor = query_execution.HedgingQueryExecutor(
+            self.query_executor, min_samples=2)
+
+    def warm_up(self):
+        """Completes enough fast queries to enable hedging."""
+        self.query_executor.execute_query.side_effect = None
+        self.query_executor.execute_query.return_value = 'fast results'
+        for _ in range(2):
+            self.executor.execute_query(MOCK_QUERY)
+        self.query_executor.execute_query.reset_mock()
+
+    def test_execute_query_does_not_hedge_before_min_samples(self):
+        self.query_executor.execute_query.return_value = 'mock results'
+        self.assertEqual('mock results',
+                         self.executor.execute_query(MOCK_QUERY))
+        self.assertEqual(1, self.query_executor.execute_query.call_count)
+
+    def test_execute_query_runs_on_caller_thread_before_min_samples(self):
+        threads = []
+
+        def execute_query(query):
+            threads.append(threading.current_thread())
+            return 'mock results'
+
+        self.query_executor.execute_query.side_effect = execute_query
+        self.executor.execute_query(MOCK_QUERY)
+        self.assertEqual([threading.current_thread()], threads)
+
+    def test_execute_query_counts_only_metrics_of_used_attempt(self):
+        self.warm_up()
+        release_straggler = threading.Event()
+        self.addCleanup(release_straggler.set)
+        straggler_done = threading.Event()
+
+        def straggler(query):
+            release_straggler.wait(5)
+            instrumentation.add_bytes_processed(1000)
+            straggler_done.set()
+            return 'straggler results'
+
+        def hedge(query):
+            instrumentation.add_bytes_processed(10)
+            instrumentation.add_stage_time('bq_wait', 1.0)
+            return 'hedged results'
+
+        attempts = [straggler, hedge]
+        self.query_executor.execute_query.side_effect = (
+            lambda query: attempts.pop(0)(query))
+
+        metrics = instrumentation.WindowMetrics(0, START_TIME, END_TIME)
+        with instrumentation.bind(metrics):
+            self.assertEqual('hedged results',
+                             self.executor.execute_query(MOCK_QUERY))
+        release_straggler.set()
+        self.assertTrue(straggler_done.wait(5))
+        self.assertEqual(10, metrics.bytes_processed)
+        self.assertEqual({'bq_wait': 1.0}, metrics.stage_seconds)
+
+    def test_execute_query_hedges_stragglers(self):
+        """A slow query should be re-issued, and the first result used."""
+        self.warm_up()
+        release_straggler = threading.Event()
+        self.addCleanup(release_straggler.set)
+
+        def straggler(query):
+            release_straggler.wait(5)
+            return 'straggler results'
+
+        attempts = [straggler, lambda query: 'hedged results']
+        self.query_executor.execute_query.side_effect = (
+            lambda query: attempts.pop(0)(query))
+
+        self.assertEqual('hedged results',
+                         self.executor.execute_query(MOCK_QUERY))
+        self.assertEqual(2, self.query_executor.execute_query.call_count)
+
+    def test_execute_query_cancels_losing_bq_job(self):
+        self.warm_up()
+        release_straggler = threading.Event()
+        self.addCleanup(release_straggler.set)
+        cancel_job = mock.Mock(side_effect=release_straggler.set)
+        straggler_errors = []
+
+        def straggler(query):
+            query_execution._local.attempt.register_job(cancel_job)
+            release_straggler.wait(5)
+            # A cancelled attempt does not start further jobs, e.g. retries.
+            try:
+                query_execution._local.attempt.register_job(cancel_job)
+            except query_execution.QueryCancelledError as e:
+                straggler_errors.append(e)
+            return 'straggler results'
+
+        attempts = [straggler, lambda query: 'hedged results']
+        self.query_executor.execute_query.side_effect = (
+            lambda query: attempts.pop(0)(query))
+
+        self.assertEqual('hedged results',
+                         self.executor.execute_query(MOCK_QUERY))
+        cancel_job.assert_called_once_with()
+        for _ in range(500):
+            if straggler_errors:
+                break
+            time.sleep(0.01)
+        self.assertEqual(1, len(straggler_errors))
+
+    def test_execute_query_uses_hedge_when_first_attempt_fails(self):
+        self.warm_up()
+        release_straggler = threading.Event()
+        self.addCleanup(release_straggler.set)
+
+        def failing_straggler(query):
+            release_straggler.wait(5)
+            raise query_execution.BqBackendError(query)
+
+        def slow_hedge(query):
+            release_straggler.set()
+            return 'hedged results'
+
+        attempts = [failing_straggler, slow_hedge]
+        self.query_executor.execute_query.side_effect = (
+            lambda query: attempts.pop(0)(query))
+        self.assertEqual('hedged results',
+                         self.executor.execute_query(MOCK_QUERY))
+
+    def test_execute_query_raises_error_when_all_attempts_fail(self):
+        self.query_executor.execute_query.side_effect = (
+            query_execution.BqFailedError(MOCK_QUERY))
+        with self.assertRaises(query_execution.BqFailedError):
+            self.executor.execute_query(MOCK_QUERY)
+
 
 if __name__ == '__main__':
     unittest.main()
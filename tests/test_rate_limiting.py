@@ -0,0 +1,184 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import threading
+import unittest
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import rate_limiting
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+
+    def create_bucket(self, rate, capacity):
+        return rate_limiting.TokenBucket(rate,
+                                         capacity,
+                                         clock=self.clock.time,
+                                         sleep=self.clock.sleep)
+
+    def test_acquire_does_not_block_within_capacity(self):
+        bucket = self.create_bucket(rate=1, capacity=3)
+        for _ in range(3):
+            bucket.acquire()
+        self.assertEqual([], self.clock.sleeps)
+
+    def test_acquire_blocks_until_token_is_available(self):
+        bucket = self.create_bucket(rate=2, capacity=1)
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual([0.5], self.clock.sleeps)
+        self.assertEqual(1000.5, self.clock.now)
+
+    def test_tokens_accumulate_up_to_capacity(self):
+        bucket = self.create_bucket(rate=1, capacity=2)
+        bucket.acquire()
+        bucket.acquire()
+        # Idle for long enough to refill many times over.
+        self.clock.now += 100
+        bucket.acquire()
+        bucket.acquire()
+        self.assertEqual([], self.clock.sleeps)
+        bucket.acquire()
+        self.assertEqual([1.0], self.clock.sleeps)
+
+    def test_invalid_parameters_raise_error(self):
+        with self.assertRaises(ValueError):
+            self.create_bucket(rate=0, capacity=1)
+        with self.assertRaises(ValueError):
+            self.create_bucket(rate=1, capacity=0)
+
+
+class BackoffDelayTest(unittest.TestCase):
+
+    def assertBackoffDelay(self, expected, attempt, random_value):
+        actual = rate_limiting.backoff_delay(attempt,
+                                             initial_delay=1.0,
+                                             max_delay=60.0,
+                                             rand=lambda: random_value)
+        self.assertEqual(expected, actual)
+
+    def test_backoff_delay_cap_grows_exponentially(self):
+        self.assertBackoffDelay(1.0, attempt=1, random_value=1.0)
+        self.assertBackoffDelay(2.0, attempt=2, random_value=1.0)
+        self.assertBackoffDelay(8.0, attempt=4, random_value=1.0)
+
+    def test_backoff_delay_never_exceeds_max_delay(self):
+        self.assertBackoffDelay(60.0, attempt=20, random_value=1.0)
+
+    def test_backoff_delay_is_jittered(self):
+        self.assertBackoffDelay(2.0, attempt=3, random_value=0.5)
+        self.assertBackoffDelay(0.0, attempt=3, random_value=0.0)
+
+
+class AimdConcurrencyLimitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+
+    def create_limit(self, max_limit=10, initial_limit=1, **kwargs):
+        return rate_limiting.AimdConcurrencyLimit(max_limit,
+                                                  initial_limit,
+                                                  clock=self.clock.time,
+                                                  **kwargs)
+
+    def run_operation(self, limit, latency, outcome):
+        ticket = limit.acquire()
+        self.clock.now += latency
+        limit.release(ticket, outcome)
+
+    def test_successes_raise_limit_additively(self):
+        limit = self.create_limit()
+        self.run_operation(limit, 1.0, rate_limiting.OUTCOME_SUCCESS)
+        self.assertEqual(2, limit.limit)
+        # Each success adds the reciprocal of the limit: 2.5, 2.9, 3.24.
+        for _ in range(2):
+            self.run_operation(limit, 1.0, rate_limiting.OUTCOME_SUCCESS)
+            self.assertEqual(2, limit.limit)
+        self.run_operation(limit, 1.0, rate_limiting.OUTCOME_SUCCESS)
+        self.assertEqual(3, limit.limit)
+        self.assertEqual(0, limit.in_flight)
+
+    def test_limit_does_not_exceed_max(self):
+        limit = self.create_limit(max_limit=3)
+        for _ in range(50):
+            self.run_operation(limit, 1.0, rate_limiting.OUTCOME_SUCCESS)
+        self.assertEqual(3, limit.limit)
+
+    def test_overload_reduces_limit_multiplicatively(self):
+        limit = self.create_limit(initial_limit=8)
+        self.run_operation(limit, 1.0, rate_limiting.OUTCOME_OVERLOADED)
+        self.assertEqual(4, limit.limit)
+        self.run_operation(limit, 1.0, rate_limiting.OUTCOME_OVERLOADED)
+        self.assertEqual(2, limit.limit)
+        for _ in range(3):
+            self.run_operation(limit, 1.0, rate_limiting.OUTCOME_OVERLOADED)
+        self.assertEqual(1, limit.limit)
+
+    def test_concurrent_overloads_reduce_limit_once(self):
+        limit = self.create_limit(initial_limit=8)
+        tickets = [limit.acquire() for _ in range(4)]
+        self.assertEqual(4, limit.in_flight)
+        for ticket in tickets:
+            limit.release(ticket, rate_limiting.OUTCOME_OVERLOADED)
+        self.assertEqual(4, limit.limit)
+
+    def test_other_errors_leave_limit_unchanged(self):
+        limit = self.create_limit(initial_limit=4)
+        self.run_operation(limit, 1.0, rate_limiting.OUTCOME_ERROR)
+        self.assertEqual(4, limit.limit)
+
+    def test_rising_latency_holds_limit(self):
+        limit = self.create_limit(initial_limit=4)
+        for _ in range(20):
+            self.run_operation(limit, 1.0, rate_limiting.OUTCOME_SUCCESS)
+        raised_limit = limit.limit
+        for _ in range(5):
+            self.run_operation(limit, 10.0, rate_limiting.OUTCOME_SUCCESS)
+        self.assertEqual(raised_limit, limit.limit)
+
+    def test_acquire_blocks_at_limit(self):
+        limit = self.create_limit(initial_limit=1)
+        ticket = limit.acquire()
+        acquired = threading.Event()
+
+        def acquire_second():
+            limit.release(limit.acquire(), rate_limiting.OUTCOME_SUCCESS)
+            acquired.set()
+
+        thread = threading.Thread(target=acquire_second)
+        thread.start()
+        self.assertFalse(acquired.wait(0.05))
+        limit.release(ticket, rate_limiting.OUTCOME_SUCCESS)
+        self.assertTrue(acquired.wait(5))
+        thread.join()
+
+    def test_invalid_arguments_raise_error(self):
+        with self.assertRaises(ValueError):
+            rate_limiting.AimdConcurrencyLimit(2, initial_limit=3)
+        with self.assertRaises(ValueError):
+            rate_limiting.AimdConcurrencyLimit(2, min_limit=0, initial_limit=1)
+        with self.assertRaises(ValueError):
+            rate_limiting.AimdConcurrencyLimit(2, backoff_ratio=1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
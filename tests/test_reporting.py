@@ -0,0 +1,137 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import instrumentation
+import reporting
+
+START_TIME = datetime.datetime(2015, 1, 1)
+END_TIME = datetime.datetime(2015, 1, 2)
+
+
+class RunReportWriterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.report_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.report_dir)
+        self.writer = reporting.RunReportWriter(self.report_dir)
+        self.addCleanup(self.writer.close)
+
+    def read_report(self):
+        with open(os.path.join(self.report_dir,
+                               reporting.REPORT_FILENAME)) as report_file:
+            return [json.loads(line) for line in report_file]
+
+    def test_record_writes_passed_window(self):
+        check_result = check_table_equivalence.CheckResult(True,
+                                                           query='SELECT 1')
+        sql_path = self.writer.record(0, START_TIME, END_TIME, check_result)
+        self.assertEqual([{
+            'project': 0,
+            'window_start': '2015-01-01T00:00:00',
+            'window_end': '2015-01-02T00:00:00',
+            'shard_count': 1,
+            'shard_index': 0,
+            'status': 'passed',
+            'per_month_only_count': 0,
+            'per_project_only_count': 0,
+            'per_month_only_sample': [],
+            'per_project_only_sample': [],
+            'complete': True,
+            'sql': sql_path,
+            'duration_seconds': None,
+            'stage_seconds': None,
+            'bytes_processed': None,
+        }], self.read_report())
+        with open(sql_path) as sql_file:
+            self.assertEqual('SELECT 1', sql_file.read())
+
+    def test_record_writes_mismatches_and_metrics(self):
+        check_result = check_table_equivalence.CheckResult(
+            False,
+            'mock failure message',
+            per_month_ids=['id%02d' % i for i in range(15, 0, -1)],
+            per_project_ids=['b', 'a', 'b'],
+            query='SELECT 2')
+        clock = helpers.FakeClock()
+        metrics = instrumentation.WindowMetrics(2,
+                                                START_TIME,
+                                                END_TIME,
+                                                shard_count=4,
+                                                shard_index=3,
+                                                clock=clock)
+        metrics.add_stage_time('execute_query', 1.5)
+        metrics.bytes_processed = 1024
+        clock.now += 2.0
+        metrics.finish(False)
+        self.writer.record(2, START_TIME, END_TIME, check_result, 4, 3, metrics)
+
+        record = self.read_report()[0]
+        self.assertEqual('failed', record['status'])
+        self.assertEqual(15, record['per_month_only_count'])
+        self.assertEqual(['id%02d' % i for i in range(1, 11)],
+                         record['per_month_only_sample'])
+        self.assertEqual(3, record['per_project_only_count'])
+        self.assertEqual(['a', 'b'], record['per_project_only_sample'])
+        self.assertEqual((4, 3), (record['shard_count'], record['shard_index']))
+        self.assertEqual(2.0, record['duration_seconds'])
+        self.assertEqual({'execute_query': 1.5}, record['stage_seconds'])
+        self.assertEqual(1024, record['bytes_processed'])
+
+    def test_each_distinct_query_is_written_once(self):
+        first = check_table_equivalence.CheckResult(True, query='SELECT 1')
+        second = check_table_equivalence.CheckResult(True, query='SELECT 2')
+        paths = [
+            self.writer.record(0, START_TIME, END_TIME, check_result)
+            for check_result in (first, second, first)
+        ]
+        self.assertEqual(paths[0], paths[2])
+        self.assertNotEqual(paths[0], paths[1])
+        self.assertEqual(2, len(os.listdir(os.path.join(
+            self.report_dir, reporting.SQL_DIRNAME))))
+        self.assertEqual(paths,
+                         [record['sql'] for record in self.read_report()])
+
+    def test_records_are_flushed_as_they_are_written(self):
+        self.writer.record(0, START_TIME, END_TIME,
+                           check_table_equivalence.CheckResult(True))
+        self.assertEqual(1, len(self.read_report()))
+        self.assertIsNone(self.read_report()[0]['sql'])
+
+    def test_query_files_are_kept_between_runs(self):
+        check_result = check_table_equivalence.CheckResult(True,
+                                                           query='SELECT 1')
+        self.writer.record(0, START_TIME, END_TIME, check_result)
+        self.writer.close()
+        writer = reporting.RunReportWriter(self.report_dir)
+        self.addCleanup(writer.close)
+        self.assertEqual([], self.read_report())
+        self.assertEqual(1, len(os.listdir(os.path.join(
+            self.report_dir, reporting.SQL_DIRNAME))))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,54 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import sampling
+
+
+class SamplingTest(unittest.TestCase):
+
+    def test_upper_bound_of_zero_follows_rule_of_three(self):
+        self.assertAlmostEqual(3.0, sampling.poisson_upper_bound(0), delta=0.05)
+
+    def test_upper_bound_is_close_to_exact_poisson_bound(self):
+        # Exact one-sided 95% upper bounds on a Poisson mean.
+        for observed, exact in ((1, 4.744), (5, 10.513), (20, 29.062)):
+            self.assertAlmostEqual(exact,
+                                   sampling.poisson_upper_bound(observed),
+                                   delta=exact * 0.01)
+
+    def test_estimate_scales_sample_to_whole_tables(self):
+        estimate = sampling.estimate_mismatches(5, 0.01)
+        self.assertEqual(5, estimate.observed)
+        self.assertAlmostEqual(500, estimate.estimate)
+        self.assertAlmostEqual(
+            sampling.poisson_upper_bound(5) * 100, estimate.upper_bound)
+
+    def test_estimate_of_full_sample_is_exact(self):
+        self.assertEqual((3, 3, 3), sampling.estimate_mismatches(3, 1))
+
+    def test_format_estimate(self):
+        self.assertEqual(
+            '0 mismatched test_ids in a 1% sample of test_ids, an estimated 0 '
+            'in all (95% upper bound: 297)', sampling.format_estimate(
+                sampling.estimate_mismatches(0, 0.01), 0.01))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,224 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import sys
+import unittest
+
+import mock
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import constants
+import local_execution
+import query_construct
+import scan_checks
+
+JAN_2015_TABLE = 'plx.google:m_lab.2015_01.all'
+FEB_2015_TABLE = 'plx.google:m_lab.2015_02.all'
+NDT_TABLE = 'plx.google:m_lab.ndt.all'
+
+
+def _null_log_time_row(test_id, day):
+    return {
+        'test_id': test_id,
+        'project': constants.PROJECT_ID_NDT,
+        'log_time': helpers.timestamp(day),
+        'web100_log_entry.is_last_entry': True
+    }
+
+
+class FusedScanCheckerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.maxDiff = None
+        self.executor = local_execution.SqliteQueryExecutor()
+        self.executor.execute_query = mock.Mock(
+            wraps=self.executor.execute_query)
+
+    def check_january(self, project, names=None):
+        checker = scan_checks.FusedScanChecker(
+            query_construct.TableEquivalenceQueryGeneratorFactory(),
+            self.executor,
+            scan_checks.create_checks(names or list(scan_checks.CHECKS)))
+        return checker.check(project, datetime.datetime(2015, 1, 1),
+                             datetime.datetime(2015, 2, 1))
+
+    def test_consistent_tables_pass_all_checks_with_one_query(self):
+        self.executor.load_table(JAN_2015_TABLE, [
+            helpers.ndt_row('a', 3),
+            helpers.ndt_row('a', 3, is_last_entry=False),
+            helpers.ndt_row('b', 10)
+        ])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('b', 10)])
+        results = self.check_january(constants.PROJECT_ID_NDT)
+        self.assertEqual(list(scan_checks.CHECKS), list(results))
+        self.assertTrue(all(result.success for result in results.values()))
+        self.assertEqual(1, self.executor.execute_query.call_count)
+        self.assertEqual(self.executor.execute_query.call_args[0][0],
+                         results['row_count_parity'].query)
+
+    def test_row_count_parity_reports_days_with_different_counts(self):
+        self.executor.load_table(JAN_2015_TABLE, [
+            helpers.ndt_row('a', 3), helpers.ndt_row('b', 3),
+            helpers.ndt_row('c', 10)
+        ])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('c', 10)])
+        results = self.check_january(constants.PROJECT_ID_NDT)
+        self.assertFalse(results['row_count_parity'].success)
+        self.assertEqual(
+            'Check failed: ROW COUNT PARITY\n'
+            'Days on which the tables have different numbers of rows:\n'
+            '  2015-01-03: 2 per-month, 1 per-project\n',
+            results['row_count_parity'].message)
+        self.assertTrue(results['null_log_time'].success)
+
+    def test_null_log_time_is_attributed_to_top_level_log_time(self):
+        self.executor.load_table(
+            JAN_2015_TABLE,
+            [helpers.ndt_row('a', 3), _null_log_time_row('b', 5)])
+        self.executor.load_table(NDT_TABLE, [helpers.ndt_row('a', 3)])
+        results = self.check_january(constants.PROJECT_ID_NDT)
+        self.assertEqual(
+            'Check failed: NULL LOG TIME\n'
+            'Days with rows whose web100_log_entry.log_time is NULL:\n'
+            '  2015-01-05: 1 per-month, 0 per-project\n',
+            results['null_log_time'].message)
+        # Rows without a log time are not counted as tests of the window.
+        self.assertTrue(results['row_count_parity'].success)
+
+    def test_intermediate_snapshot_in_per_project_table_fails(self):
+        self.executor.load_table(JAN_2015_TABLE, [helpers.ndt_row('a', 3)])
+        self.executor.load_table(
+            NDT_TABLE, [helpers.ndt_row('a', 3),
+                        helpers.ndt_row('b', 3, is_last_entry=False)])
+        results = self.check_january(constants.PROJECT_ID_NDT,
+                                     ['intermediate_snapshots'])
+        self.assertEqual(['intermediate_snapshots'], list(results))
+        self.assertEqual(
+            'Check failed: INTERMEDIATE SNAPSHOTS\n'
+            'Days with intermediate snapshots in the per-project table:\n'
+            '  2015-01-03: 1 intermediate snapshots\n',
+            results['intermediate_snapshots'].message)
+
+    def test_checks_that_do_not_apply_pass_without_a_query(self):
+        results = self.check_january(constants.PROJECT_ID_PARIS_TRACEROUTE,
+                                     ['null_log_time'])
+        self.assertTrue(results['null_log_time'].success)
+        self.assertFalse(self.executor.execute_query.called)
+
+    def test_duplicates_across_monthly_tables_are_found(self):
+        self.executor.load_table(
+            JAN_2015_TABLE, [helpers.ndt_row('a', 3), helpers.ndt_row('b', 31)])
+        self.executor.load_table(FEB_2015_TABLE, [helpers.ndt_row('b', 31)])
+        self.executor.load_table(NDT_TABLE, [
+            helpers.ndt_row('a', 3), helpers.ndt_row('a', 3),
+            helpers.ndt_row('a', 3), helpers.ndt_row('b', 31)
+        ])
+        results = self.check_january(constants.PROJECT_ID_NDT,
+                                     ['duplicate_test_ids'])
+        self.assertEqual(
+            'Check failed: DUPLICATE TEST IDS\n'
+            'test_id values that appear in more than one row of the per-month '
+            'tables:\n'
+            '  b (2 rows)\n'
+            'test_id values that appear in more than one row of the '
+            'per-project table:\n'
+            '  a (3 rows)\n', results['duplicate_test_ids'].message)
+        self.assertEqual(2, self.executor.execute_query.call_count)
+
+    def test_intermediate_snapshots_are_not_duplicates(self):
+        self.executor.load_table(JAN_2015_TABLE, [
+            helpers.ndt_row('a', 3, is_last_entry=False),
+            helpers.ndt_row('a', 3),
+        ])
+        self.executor.load_table(NDT_TABLE, [helpers.ndt_row('a', 3)])
+        results = self.check_january(constants.PROJECT_ID_NDT,
+                                     ['duplicate_test_ids'])
+        self.assertTrue(results['duplicate_test_ids'].success)
+        self.assertEqual(1, self.executor.execute_query.call_count)
+
+
+class DuplicateTestIdCheckTest(unittest.TestCase):
+
+    def setUp(self):
+        self.query_generator = mock.Mock(
+            spec=query_construct.TableEquivalenceQueryGenerator)
+        self.query_generator.generate_duplicate_query.return_value = (
+            'mock SQL query string')
+        self.query_executor = mock.Mock()
+
+    def evaluate(self, per_month_counts, per_project_counts, tolerance=0.01):
+        values = {}
+        for side, counts in ((query_construct.SIDE_PER_MONTH, per_month_counts),
+                             (query_construct.SIDE_PER_PROJECT,
+                              per_project_counts)):
+            values[(side, 'row_count')], values[(side,
+                                                 'distinct_count')] = counts
+        return scan_checks.DuplicateTestIdCheck(tolerance).evaluate(
+            self.query_generator, {datetime.date(2015, 1, 3): values},
+            self.query_executor)
+
+    def test_estimate_within_tolerance_skips_search(self):
+        self.assertTrue(self.evaluate((100000, 99500), (100000, 100200
+                                                       )).success)
+        self.assertFalse(self.query_executor.execute_query.called)
+
+    def test_estimate_beyond_tolerance_searches_only_that_side(self):
+        self.query_executor.execute_query.return_value = ''
+        self.assertTrue(self.evaluate((100000, 98000), (100000, 99500)).success)
+        self.query_generator.generate_duplicate_query.assert_called_once_with(
+            [datetime.date(2015, 1, 3)], [])
+
+    def test_exact_distinct_counts_search_on_any_difference(self):
+        self.query_executor.execute_query.return_value = ''
+        self.evaluate((500, 500), (500, 499), tolerance=0.5)
+        self.query_generator.generate_duplicate_query.assert_called_once_with(
+            [], [datetime.date(2015, 1, 3)])
+
+
+class CombineResultsTest(unittest.TestCase):
+
+    def test_combined_result_fails_if_any_check_fails(self):
+        equivalence_result = check_table_equivalence.CheckResult(
+            success=False,
+            message='equivalence failed\n',
+            per_month_ids=['a'],
+            query='SELECT a')
+        combined = scan_checks.combine_results(equivalence_result, {
+            'x': check_table_equivalence.CheckResult(success=True),
+            'y': check_table_equivalence.CheckResult(success=False,
+                                                     message='y failed\n')
+        })
+        self.assertFalse(combined.success)
+        self.assertEqual('equivalence failed\n\ny failed\n', combined.message)
+        self.assertEqual(['a'], combined.per_month_ids)
+        self.assertEqual('SELECT a', combined.query)
+
+    def test_combined_result_succeeds_if_all_checks_succeed(self):
+        combined = scan_checks.combine_results(
+            check_table_equivalence.CheckResult(success=True),
+            {'x': check_table_equivalence.CheckResult(success=True)})
+        self.assertTrue(combined.success)
+        self.assertIsNone(combined.message)
+
+
+if __name__ == '__main__':
+    unittest.main()
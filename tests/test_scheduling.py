@@ -0,0 +1,137 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import collections
+import os
+import sys
+import threading
+import traceback
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import scheduling
+
+
+class RunConcurrentlyTest(unittest.TestCase):
+
+    def test_run_concurrently_preserves_order_without_concurrency(self):
+        results = scheduling.run_concurrently(lambda x: x * 2, [3, 1, 2], 1)
+        self.assertEqual([6, 2, 4], list(results))
+
+    def test_run_concurrently_runs_every_job(self):
+        results = scheduling.run_concurrently(lambda x: x * 2, range(20), 4)
+        self.assertEqual(sorted(x * 2 for x in range(20)), sorted(results))
+
+    def test_run_concurrently_runs_jobs_at_the_same_time(self):
+        """Jobs that wait on each other complete only if run concurrently."""
+        barrier_count = [0]
+        barrier_lock = threading.Condition()
+
+        def wait_for_all(job):
+            with barrier_lock:
+                barrier_count[0] += 1
+                barrier_lock.notify_all()
+                while barrier_count[0] < 3:
+                    barrier_lock.wait(5)
+            return job
+
+        results = scheduling.run_concurrently(wait_for_all, [1, 2, 3], 3)
+        self.assertEqual([1, 2, 3], sorted(results))
+
+    def test_run_concurrently_propagates_job_exceptions(self):
+
+        def fail(job):
+            raise ValueError('mock value error')
+
+        with self.assertRaises(ValueError):
+            list(scheduling.run_concurrently(fail, [1, 2], 2))
+
+
+class RunFairShareTest(unittest.TestCase):
+
+    def test_run_fair_share_interleaves_groups_without_concurrency(self):
+        jobs_by_group = collections.OrderedDict([('a', ['a1', 'a2', 'a3']),
+                                                 ('b', ['b1', 'b2'])])
+        results = scheduling.run_fair_share(lambda x: x, jobs_by_group, 1)
+        self.assertEqual(['a1', 'b1', 'a2', 'b2', 'a3'], list(results))
+
+    def test_run_fair_share_dispatches_groups_in_proportion_to_weights(self):
+        jobs_by_group = collections.OrderedDict([('a', ['a%d' % i
+                                                        for i in range(6)]),
+                                                 ('b', ['b%d' % i
+                                                        for i in range(6)])])
+        results = list(scheduling.run_fair_share(
+            lambda x: x, jobs_by_group,
+            1, weights={'a': 2}))
+        self.assertEqual(['a0', 'a1', 'b0', 'a2', 'a3', 'b1'], results[:6])
+        self.assertEqual(12, len(results))
+
+    def test_run_fair_share_runs_every_job(self):
+        jobs_by_group = {'a': range(10), 'b': range(100, 115), 'c': []}
+        results = scheduling.run_fair_share(lambda x: x * 2, jobs_by_group, 4)
+        self.assertEqual(
+            sorted(x * 2 for x in list(range(10)) + list(range(100, 115))),
+            sorted(results))
+
+    def test_run_fair_share_divides_concurrency_among_groups(self):
+        """A group of slow jobs does not occupy slots beyond its share."""
+        running = collections.defaultdict(int)
+        slow_running_during_fast = [0]
+        lock = threading.Lock()
+        release_slow = threading.Event()
+
+        def run(job):
+            group, _ = job
+            with lock:
+                running[group] += 1
+                if group == 'fast':
+                    slow_running_during_fast[0] = max(
+                        slow_running_during_fast[0], running['slow'])
+            if group == 'slow':
+                release_slow.wait(5)
+            with lock:
+                running[group] -= 1
+            return job
+
+        jobs_by_group = collections.OrderedDict([
+            ('slow', [('slow', i) for i in range(4)]),
+            ('fast', [('fast', i) for i in range(20)]),
+        ])
+        completed = []
+        for job in scheduling.run_fair_share(run, jobs_by_group, 4):
+            completed.append(job)
+            if len(completed) == 20:
+                release_slow.set()
+        self.assertEqual(24, len(completed))
+        self.assertEqual(2, slow_running_during_fast[0])
+        self.assertEqual(['fast'] * 20, [group for group, _ in completed[:20]])
+
+    def test_run_fair_share_propagates_job_exceptions(self):
+
+        def fail(job):
+            raise ValueError('mock value error')
+
+        try:
+            list(scheduling.run_fair_share(fail, {'a': [1, 2], 'b': [3]}, 2))
+        except ValueError:
+            # The traceback should lead to the job that failed.
+            self.assertEqual('fail',
+                             traceback.extract_tb(sys.exc_info()[2])[-1][2])
+        else:
+            self.fail('ValueError was not raised.')
+
+
+if __name__ == '__main__':
+    unittest.main()
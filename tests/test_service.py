@@ -0,0 +1,277 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import json
+import os
+import sys
+import threading
+import unittest
+
+try:
+    from urllib2 import urlopen, HTTPError
+except ImportError:
+    from urllib.request import urlopen
+    from urllib.error import HTTPError
+
+from dateutil import relativedelta
+import mock
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import query_execution
+import service
+
+ONE_DAY = relativedelta.relativedelta(days=1)
+
+
+class ParseScheduleArgTest(unittest.TestCase):
+
+    def test_parse_schedule_arg(self):
+        self.assertEqual(
+            service.Schedule(2, 3600, 7), service.parse_schedule_arg('2:60:7'))
+
+    def test_parse_schedule_arg_rejects_invalid_schedules(self):
+        for schedule_arg in ('2:60', 'ndt:60:7', '2:0:7', '2:60:-1'):
+            with self.assertRaises(ValueError):
+                service.parse_schedule_arg(schedule_arg)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def test_results_expire_after_ttl(self):
+        clock = helpers.FakeClock()
+        cache = service.ResultCache(ttl=10, clock=clock)
+        check_result = check_table_equivalence.CheckResult(True)
+        cache.put('key', check_result)
+        clock.now += 10
+        self.assertEqual(
+            service.CachedResult(check_result, 1000.0), cache.get('key'))
+        clock.now += 1
+        self.assertIsNone(cache.get('key'))
+        self.assertIsNone(cache.get('missing key'))
+
+    def test_expired_results_are_removed_on_insert(self):
+        clock = helpers.FakeClock()
+        cache = service.ResultCache(ttl=60, clock=clock)
+        cache.put('a', 'result a')
+        clock.now += 61
+        cache.put('b', 'result b')
+        self.assertEqual(1, len(cache))
+        self.assertIsNone(cache.get('a'))
+
+    def test_results_never_expire_without_ttl(self):
+        clock = helpers.FakeClock()
+        cache = service.ResultCache(clock=clock)
+        cache.put('key', check_table_equivalence.CheckResult(True))
+        clock.now += 1e9
+        self.assertIsNotNone(cache.get('key'))
+        self.assertEqual(1, len(cache))
+
+
+class CheckServiceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = helpers.FakeClock()
+        self.checker = mock.Mock(
+            spec=check_table_equivalence.TableEquivalenceChecker)
+        self.checker.check.side_effect = self.check
+        self.failing_days = set()
+        self.service = service.CheckService(
+            self.checker,
+            ONE_DAY,
+            cache_ttl=60,
+            clock=self.clock,
+            today=lambda: datetime.datetime(2015, 1, 10))
+
+    def check(self, project, start, end):
+        if start.day in self.failing_days:
+            return check_table_equivalence.CheckResult(False, 'mock failure')
+        return check_table_equivalence.CheckResult(True)
+
+    def check_range(self, start_day, end_day, **kwargs):
+        return self.service.check_range(0, datetime.datetime(
+            2015, 1, start_day), datetime.datetime(2015, 1, end_day), **kwargs)
+
+    def test_check_range_reports_each_window(self):
+        self.failing_days.add(2)
+        result = self.check_range(1, 4)
+        self.assertFalse(result['success'])
+        self.assertEqual(['passed', 'failed', 'passed'],
+                         [w['status'] for w in result['windows']])
+        self.assertEqual('mock failure', result['windows'][1]['message'])
+        self.assertEqual(('2015-01-02', '2015-01-03'), (
+            result['windows'][1]['start'], result['windows'][1]['end']))
+
+    def test_check_range_answers_from_cache(self):
+        self.check_range(1, 3)
+        self.checker.check.reset_mock()
+        result = self.check_range(1, 4)
+        self.assertTrue(result['success'])
+        self.assertEqual([True, True, False],
+                         [w['cached'] for w in result['windows']])
+        self.checker.check.assert_called_once_with(
+            0, datetime.datetime(2015, 1, 3), datetime.datetime(2015, 1, 4))
+
+    def test_check_range_cuts_windows_on_day_grid(self):
+        self.service.check_range(0, datetime.datetime(2015, 1, 1, 12),
+                                 datetime.datetime(2015, 1, 3))
+        self.checker.check.reset_mock()
+        result = self.check_range(2, 3)
+        self.assertTrue(result['windows'][0]['cached'])
+        self.assertFalse(self.checker.check.called)
+
+    def test_check_range_rechecks_expired_results(self):
+        self.check_range(1, 2)
+        self.clock.now += 61
+        self.checker.check.reset_mock()
+        self.assertFalse(self.check_range(1, 2)['windows'][0]['cached'])
+        self.assertTrue(self.checker.check.called)
+
+    def test_check_range_cached_only_does_not_run_checks(self):
+        self.check_range(1, 2)
+        self.checker.check.reset_mock()
+        result = self.check_range(1, 3, cached_only=True)
+        self.assertIsNone(result['success'])
+        self.assertEqual(['passed', 'unknown'],
+                         [w['status'] for w in result['windows']])
+        self.assertFalse(self.checker.check.called)
+
+    def test_check_range_reports_query_errors_without_caching(self):
+        self.checker.check.side_effect = query_execution.BqFailedError(
+            'mock query', 'mock error')
+        result = self.check_range(1, 2)
+        self.assertIsNone(result['success'])
+        self.assertEqual('error', result['windows'][0]['status'])
+        self.assertEqual(0, self.service.status()['cached_windows'])
+
+    def test_check_range_reports_unexpected_errors_per_window(self):
+        self.checker.check.side_effect = [
+            check_table_equivalence.CheckResult(True), ValueError('mock error')
+        ]
+        result = self.check_range(1, 3)
+        self.assertIsNone(result['success'])
+        self.assertEqual(['passed', 'error'],
+                         [w['status'] for w in result['windows']])
+        self.assertEqual('mock error', result['windows'][1]['message'])
+
+    def test_check_range_rejects_invalid_ranges(self):
+        for project, start, end in (
+            (9, datetime.datetime(2015, 1, 1), datetime.datetime(2015, 1, 2)),
+            (0, datetime.datetime(2015, 1, 2), datetime.datetime(2015, 1, 1)),
+            (0, datetime.datetime(2030, 1, 1), datetime.datetime(2030, 1, 2))):
+            with self.assertRaises(ValueError):
+                self.service.check_range(project, start, end)
+        self.assertFalse(self.checker.check.called)
+
+    def test_run_schedule_rechecks_lookback_days(self):
+        self.check_range(7, 10)
+        self.checker.check.reset_mock()
+        self.clock.now = 2000.0
+        result = self.service.run_schedule(service.Schedule(0, 3600, 3))
+        self.assertEqual(('2015-01-07', '2015-01-10'),
+                         (result['start'], result['end']))
+        self.assertEqual(3, self.checker.check.call_count)
+        self.assertEqual({
+            'cached_windows': 3,
+            'last_scheduled_runs': {
+                '0': {
+                    'checked_at': 2000.0,
+                    'success': True
+                }
+            }
+        }, self.service.status())
+
+
+class ScheduleRunnerTest(unittest.TestCase):
+
+    def test_runner_without_schedules_runs_until_stopped(self):
+        check_service = mock.Mock(spec=service.CheckService)
+        runner = service.ScheduleRunner(check_service, [])
+        runner.start()
+        runner.join(0.05)
+        self.assertTrue(runner.is_alive())
+        runner.stop()
+        runner.join(5)
+        self.assertFalse(runner.is_alive())
+        self.assertFalse(check_service.run_schedule.called)
+
+
+class HttpApiTest(unittest.TestCase):
+
+    def setUp(self):
+        checker = mock.Mock(
+            spec=check_table_equivalence.TableEquivalenceChecker)
+        checker.check.return_value = check_table_equivalence.CheckResult(True)
+        self.server = service.create_http_server(
+            service.CheckService(checker, ONE_DAY), 0)
+        self.server_thread = threading.Thread(
+            target=lambda: self.server.serve_forever(poll_interval=0.01))
+        self.server_thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+
+    def get(self, path):
+        url = 'http://127.0.0.1:%d%s' % (self.server.server_address[1], path)
+        try:
+            response = urlopen(url)
+        except HTTPError as e:
+            return e.code, json.loads(e.read().decode('utf-8'))
+        return response.getcode(), json.loads(response.read().decode('utf-8'))
+
+    def test_check(self):
+        code, response = self.get(
+            '/check?project=2&start=2015-01-01&end=2015-01-03')
+        self.assertEqual(200, code)
+        self.assertEqual(2, response['project'])
+        self.assertTrue(response['success'])
+        self.assertEqual(2, len(response['windows']))
+
+    def test_check_cached_only(self):
+        code, response = self.get(
+            '/check?project=2&start=2015-01-01&end=2015-01-03&cached_only=1')
+        self.assertEqual(200, code)
+        self.assertIsNone(response['success'])
+
+    def test_check_rejects_missing_parameters(self):
+        code, response = self.get('/check?project=2&start=2015-01-01')
+        self.assertEqual(400, code)
+        self.assertIn('error', response)
+
+    def test_check_rejects_invalid_ranges(self):
+        for query in ('project=9&start=2015-01-01&end=2015-01-02',
+                      'project=0&start=2015-01-02&end=2015-01-01',
+                      'project=0&start=2030-01-01&end=2030-01-02'):
+            code, response = self.get('/check?' + query)
+            self.assertEqual(400, code)
+            self.assertIn('error', response)
+
+    def test_status(self):
+        self.assertEqual((200, {
+            'cached_windows': 0,
+            'last_scheduled_runs': {}
+        }), self.get('/status'))
+
+    def test_unknown_path(self):
+        self.assertEqual(404, self.get('/nonexistent')[0])
+
+
+if __name__ == '__main__':
+    unittest.main()
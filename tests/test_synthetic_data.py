@@ -0,0 +1,230 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import io
+import json
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import constants
+import local_execution
+import query_construct
+import synthetic_data
+
+START_DATE = datetime.datetime(2015, 1, 30)
+END_DATE = datetime.datetime(2015, 2, 3)
+
+
+class FormatTestIdTest(unittest.TestCase):
+
+    def test_format_test_id_ndt(self):
+        test_id = synthetic_data.format_test_id(
+            constants.PROJECT_ID_NDT,
+            datetime.datetime(2015, 1, 5, 12, 34, 56, 789012), 42,
+            random.Random(0))
+        self.assertRegexpMatches(
+            test_id, r'^2015/01/05/mlab\d\.\w+\.measurement-lab\.org/'
+            r'20150105T12:34:56\.789012000Z_c-0-0-0-42\.example\.net:1066\.'
+            r's2c_snaplog\.gz$')
+
+    def test_format_test_id_paris_traceroute(self):
+        test_id = synthetic_data.format_test_id(
+            constants.PROJECT_ID_PARIS_TRACEROUTE,
+            datetime.datetime(2015, 1, 5, 12, 34, 56), 258, random.Random(0))
+        self.assertRegexpMatches(
+            test_id, r'^2015/01/05/mlab\d\.\w+\.measurement-lab\.org/'
+            r'20150105T12:34:56Z-[\d.]+-\d+-0\.0\.1\.2-1282\.paris$')
+
+    def test_format_test_id_is_unique_per_sequence(self):
+        test_time = datetime.datetime(2015, 1, 5)
+        self.assertNotEqual(
+            synthetic_data.format_test_id(constants.PROJECT_ID_SIDESTREAM,
+                                          test_time, 1, random.Random(0)),
+            synthetic_data.format_test_id(constants.PROJECT_ID_SIDESTREAM,
+                                          test_time, 2, random.Random(0)))
+
+    def test_format_test_id_rejects_unknown_project(self):
+        with self.assertRaises(ValueError):
+            synthetic_data.format_test_id(7, START_DATE, 0, random.Random(0))
+
+
+def _new_ground_truth_file():
+    return io.StringIO() if str is not bytes else io.BytesIO()
+
+
+def _generate_discrepancies(generator, project, start_date, end_date,
+                            tests_per_day):
+    """Generates tests and returns the discrepancies of the ground truth.
+
+    Returns:
+        A (count, discrepancies) 2-tuple of the number of discrepancies that
+        generate() returned and the discrepancies it wrote.
+    """
+    ground_truth_file = _new_ground_truth_file()
+    count = generator.generate(project, start_date, end_date, tests_per_day,
+                               ground_truth_file)
+    ground_truth_file.seek(0)
+    return count, list(synthetic_data.read_ground_truth(ground_truth_file))
+
+
+class SyntheticDatasetGeneratorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = local_execution.SqliteQueryExecutor()
+
+    def count_rows(self, table_name, condition='1'):
+        result = self.executor.execute_query(
+            'SELECT COUNT(*) AS row_count FROM %s WHERE %s' % (table_name,
+                                                               condition))
+        return int(result.splitlines()[1])
+
+    def check_days(self, project):
+        """Checks each day of the generated range and returns mismatches."""
+        checker = check_table_equivalence.TableEquivalenceChecker(
+            query_construct.TableEquivalenceQueryGeneratorFactory(),
+            self.executor)
+        per_month_ids = []
+        per_project_ids = []
+        day = START_DATE
+        while day < END_DATE:
+            query = query_construct.TableEquivalenceQueryGenerator(
+                project, day, day + datetime.timedelta(days=1)).generate_query()
+            month_ids, project_ids = check_table_equivalence._parse_query_result(
+                self.executor.execute_query(query))
+            per_month_ids.extend(month_ids)
+            per_project_ids.extend(project_ids)
+            self.assertEqual(not (month_ids or project_ids),
+                             checker.check(
+                                 project,
+                                 day,
+                                 day + datetime.timedelta(days=1)).success)
+            day += datetime.timedelta(days=1)
+        return per_month_ids, per_project_ids
+
+    def assertChecksFindGroundTruth(self, project):
+        generator = synthetic_data.SyntheticDatasetGenerator(self.executor,
+                                                             seed=3,
+                                                             missing_rate=0.05,
+                                                             chunk_size=7)
+        count, discrepancies = _generate_discrepancies(generator, project,
+                                                       START_DATE, END_DATE, 50)
+        self.assertTrue(discrepancies)
+        self.assertEqual(len(discrepancies), count)
+        self.assertEqual(
+            sorted(discrepancies,
+                   key=lambda d: (d.log_time, d.test_id)),
+            discrepancies)
+        per_month_ids, per_project_ids = self.check_days(project)
+        self.assertItemsEqual([
+            d.test_id for d in discrepancies
+            if d.missing_from == synthetic_data.MISSING_FROM_PER_PROJECT
+        ], per_month_ids)
+        self.assertItemsEqual([
+            d.test_id for d in discrepancies
+            if d.missing_from == synthetic_data.MISSING_FROM_PER_MONTH
+        ], per_project_ids)
+
+    def test_checks_find_ground_truth_ndt(self):
+        self.assertChecksFindGroundTruth(constants.PROJECT_ID_NDT)
+
+    def test_checks_find_ground_truth_paris_traceroute(self):
+        self.assertChecksFindGroundTruth(constants.PROJECT_ID_PARIS_TRACEROUTE)
+
+    def test_ndt_tests_have_intermediate_snapshots(self):
+        generator = synthetic_data.SyntheticDatasetGenerator(
+            self.executor,
+            snapshots_per_test=3,
+            spillover_rate=0.0)
+        generator.generate(constants.PROJECT_ID_NDT,
+                           START_DATE,
+                           START_DATE + datetime.timedelta(days=1),
+                           10)
+        jan_table = 'plx.google:m_lab.2015_01.all'
+        self.assertEqual(30, self.count_rows(jan_table))
+        self.assertEqual(10, self.count_rows(
+            jan_table, 'web100_log_entry.is_last_entry = True'))
+        self.assertEqual(10, self.count_rows('plx.google:m_lab.ndt.all'))
+
+    def test_paris_traceroute_uses_log_time(self):
+        generator = synthetic_data.SyntheticDatasetGenerator(self.executor)
+        generator.generate(constants.PROJECT_ID_PARIS_TRACEROUTE,
+                           START_DATE,
+                           START_DATE + datetime.timedelta(days=1),
+                           10)
+        table = 'plx.google:m_lab.paris_traceroute.all'
+        self.assertEqual(10, self.count_rows(table, 'log_time IS NOT NULL'))
+        self.assertEqual(0, self.count_rows(
+            table, 'web100_log_entry.log_time IS NOT NULL'))
+
+    def test_tests_near_month_border_spill_into_adjacent_month(self):
+        generator = synthetic_data.SyntheticDatasetGenerator(self.executor,
+                                                             spillover_rate=1.0)
+        generator.generate(constants.PROJECT_ID_SIDESTREAM, START_DATE,
+                           END_DATE, 200)
+        self.assertGreater(
+            self.count_rows('plx.google:m_lab.2015_01.all',
+                            'web100_log_entry.log_time >= 1422748800'), 0)
+        self.assertGreater(
+            self.count_rows('plx.google:m_lab.2015_02.all',
+                            'web100_log_entry.log_time < 1422748800'), 0)
+        self.assertEqual(([], []),
+                         self.check_days(constants.PROJECT_ID_SIDESTREAM))
+
+    def test_same_seed_generates_same_dataset(self):
+        discrepancies = []
+        for _ in range(2):
+            generator = synthetic_data.SyntheticDatasetGenerator(
+                local_execution.SqliteQueryExecutor(),
+                seed=9,
+                missing_rate=0.1)
+            discrepancies.append(_generate_discrepancies(
+                generator, constants.PROJECT_ID_NPAD, START_DATE, END_DATE, 20))
+        self.assertEqual(discrepancies[0], discrepancies[1])
+
+    def test_write_ground_truth(self):
+        output = _new_ground_truth_file()
+        synthetic_data.write_ground_truth([
+            synthetic_data.Discrepancy(0, 'a', 5,
+                                       synthetic_data.MISSING_FROM_PER_MONTH)
+        ], output)
+        self.assertEqual({
+            'project': 0,
+            'test_id': 'a',
+            'log_time': 5,
+            'missing_from': 'per_month'
+        }, json.loads(output.getvalue()))
+
+    def test_read_ground_truth_returns_written_discrepancies(self):
+        discrepancies = [
+            synthetic_data.Discrepancy(0, 'a', 5,
+                                       synthetic_data.MISSING_FROM_PER_MONTH),
+            synthetic_data.Discrepancy(0, 'b', 6,
+                                       synthetic_data.MISSING_FROM_PER_PROJECT)
+        ]
+        ground_truth_file = _new_ground_truth_file()
+        synthetic_data.write_ground_truth(discrepancies, ground_truth_file)
+        ground_truth_file.seek(0)
+        self.assertEqual(
+            discrepancies,
+            list(synthetic_data.read_ground_truth(ground_truth_file)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -77,6 +77,29 @@ class TableNamesTest(unittest.TestCase):
              'plx.google:m_lab.2012_02.all'), table_names.monthly_tables(
                  datetime.datetime(2012, 1, 1), datetime.datetime(2012, 2, 1)))
 
+    def test_monthly_tables_for_sub_day_ranges(self):
+        """Time ranges that are not aligned to midnight use the same padding."""
+        # An hour within a month, far from its borders.
+        self.assertSequenceEqual(('plx.google:m_lab.2012_01.all',),
+                                 table_names.monthly_tables(
+                                     datetime.datetime(2012, 1, 15, 3),
+                                     datetime.datetime(2012, 1, 15, 4)))
+
+        # An hour that ends within a day of the next month.
+        self.assertSequenceEqual(
+            ('plx.google:m_lab.2012_01.all', 'plx.google:m_lab.2012_02.all'),
+            table_names.monthly_tables(
+                datetime.datetime(2012, 1, 31, 2),
+                datetime.datetime(2012, 1, 31, 3)))
+
+        # The padded end of the range falls in the next month, but at an
+        # earlier time of day than the padded start.
+        self.assertSequenceEqual(
+            ('plx.google:m_lab.2012_01.all', 'plx.google:m_lab.2012_02.all'),
+            table_names.monthly_tables(
+                datetime.datetime(2012, 1, 30, 5),
+                datetime.datetime(2012, 1, 31, 3)))
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,209 @@
+# Copyright 2016 Measurement Lab
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import datetime
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import mock
+
+from tests import helpers
+
+sys.path.insert(1, os.path.abspath(os.path.join(
+    os.path.dirname(__file__), '../bigsanity')))
+import check_table_equivalence
+import query_execution
+import work_queue
+
+
+def _day(day):
+    return datetime.datetime(2015, 1, day)
+
+
+JOBS = [(_day(1), _day(2), 0), (_day(2), _day(3), 0), (_day(3), _day(4), 0)]
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.temp_dir, 'queue.db')
+        self.clock = helpers.FakeClock()
+        self.queue = work_queue.WorkQueue(self.path,
+                                          lease_seconds=60,
+                                          max_attempts=2,
+                                          clock=self.clock)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_publish_is_idempotent(self):
+        self.assertEqual(3, self.queue.publish(2, JOBS, 1))
+        self.assertEqual(0, self.queue.publish(2, JOBS, 1))
+        self.assertEqual(1, self.queue.publish(3, JOBS[:1], 1))
+        self.assertEqual({'pending': 4}, self.queue.counts())
+
+    def test_queue_is_shared_through_database(self):
+        self.queue.publish(2, JOBS, 1)
+        other_queue = work_queue.WorkQueue(self.path, clock=self.clock)
+        self.assertEqual(
+            work_queue.QueuedJob(1, 2, _day(1), _day(2), 1, 0, 1),
+            other_queue.claim('other'))
+        self.assertEqual(2, self.queue.claim('worker').id)
+
+    def test_claim_takes_each_job_once(self):
+        self.queue.publish(2, JOBS, 1)
+        claimed = [self.queue.claim('worker').id for _ in range(3)]
+        self.assertEqual([1, 2, 3], claimed)
+        self.assertIsNone(self.queue.claim('worker'))
+        self.assertEqual({'leased': 3}, self.queue.counts())
+
+    def test_expired_lease_is_reclaimed(self):
+        self.queue.publish(2, JOBS[:1], 1)
+        job = self.queue.claim('crashed')
+        self.clock.now += 61
+        reclaimed = self.queue.claim('survivor')
+        self.assertEqual((job.id, 2), (reclaimed.id, reclaimed.attempts))
+        self.assertFalse(self.queue.complete(
+            job.id, 'crashed', check_table_equivalence.CheckResult(True)))
+        self.assertTrue(self.queue.complete(
+            job.id, 'survivor', check_table_equivalence.CheckResult(True)))
+
+    def test_expired_lease_is_given_up_after_max_attempts(self):
+        self.queue.publish(2, JOBS[:1], 1)
+        self.queue.claim('crashed')
+        self.clock.now += 61
+        self.queue.claim('crashed again')
+        self.clock.now += 61
+        self.assertIsNone(self.queue.claim('survivor'))
+        self.assertEqual({'error': 1}, self.queue.counts())
+        self.assertEqual('Gave up after the lease expired 2 times.',
+                         self.queue.results()[0].message)
+
+    def test_failed_job_is_queued_again_until_max_attempts(self):
+        self.queue.publish(2, JOBS[:1], 1)
+        job = self.queue.claim('worker')
+        self.assertTrue(self.queue.fail(job.id, 'worker', 'first error'))
+        self.assertEqual({'pending': 1}, self.queue.counts())
+        job = self.queue.claim('worker')
+        self.assertEqual(2, job.attempts)
+        self.assertTrue(self.queue.fail(job.id, 'worker', 'second error'))
+        self.assertIsNone(self.queue.claim('worker'))
+        self.assertEqual([('error', 'second error')],
+                         [(r.status, r.message) for r in self.queue.results()])
+
+    def test_renewed_lease_is_not_reclaimed(self):
+        self.queue.publish(2, JOBS[:1], 1)
+        job = self.queue.claim('worker')
+        self.clock.now += 50
+        self.assertTrue(self.queue.renew(job.id, 'worker'))
+        self.clock.now += 50
+        self.assertIsNone(self.queue.claim('other'))
+        self.assertFalse(self.queue.renew(job.id, 'other'))
+
+    def test_results_are_merged_in_window_order(self):
+        self.queue.publish(2, list(reversed(JOBS)), 1)
+        first = self.queue.claim('a')
+        second = self.queue.claim('b')
+        self.queue.complete(first.id, 'a',
+                            check_table_equivalence.CheckResult(False, 'bad'))
+        self.queue.fail(second.id, 'b', 'mock error')
+        self.queue.fail(self.queue.claim('b').id, 'b', 'mock error')
+        self.assertEqual([
+            work_queue.JobResult(2, _day(1), _day(2), 1, 0, 'pending', None,
+                                 None),
+            work_queue.JobResult(2, _day(2), _day(3), 1, 0, 'error', None,
+                                 'mock error'),
+            work_queue.JobResult(2, _day(3), _day(4), 1, 0, 'done', False,
+                                 'bad'),
+        ], self.queue.results())
+        self.assertEqual(2, work_queue.log_report(self.queue))
+
+
+class RunWorkerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.clock = helpers.FakeClock()
+        self.queue = work_queue.WorkQueue(
+            os.path.join(self.temp_dir, 'queue.db'),
+            lease_seconds=60,
+            max_attempts=2,
+            clock=self.clock)
+        self.checker = mock.Mock(
+            spec=check_table_equivalence.TableEquivalenceChecker)
+        self.checker.check.return_value = check_table_equivalence.CheckResult(
+            True)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_run_worker_checks_every_job(self):
+        self.queue.publish(2, JOBS, 4)
+        self.assertEqual(3,
+                         work_queue.run_worker(self.queue,
+                                               self.checker,
+                                               'worker',
+                                               concurrency=2,
+                                               poll_interval=0.01))
+        self.assertEqual({'done': 3}, self.queue.counts())
+        self.checker.check.assert_any_call(2,
+                                           _day(2),
+                                           _day(3),
+                                           shard_count=4,
+                                           shard_index=0)
+
+    def test_run_worker_records_query_errors(self):
+        self.queue.publish(2, JOBS[:1], 1)
+        self.checker.check.side_effect = query_execution.BqFailedError(
+            'mock query', 'mock error')
+        self.assertEqual(0, work_queue.run_worker(self.queue, self.checker,
+                                                  'worker'))
+        self.assertEqual({'error': 1}, self.queue.counts())
+        self.assertEqual(2, self.checker.check.call_count)
+
+    def test_run_worker_continues_after_unexpected_errors(self):
+        self.queue.publish(2, JOBS[:2], 1)
+        self.checker.check.side_effect = [
+            ValueError('mock unexpected error'),
+            ValueError('mock unexpected error'),
+            check_table_equivalence.CheckResult(True)
+        ]
+        self.assertEqual(1, work_queue.run_worker(self.queue, self.checker,
+                                                  'worker'))
+        self.assertEqual({'done': 1, 'error': 1}, self.queue.counts())
+        self.assertEqual(['mock unexpected error', None],
+                         [result.message for result in self.queue.results()])
+
+    def test_run_worker_takes_over_jobs_of_crashed_worker(self):
+        self.queue.publish(2, JOBS[:2], 1)
+        self.queue.claim('crashed')
+
+        def sleep(seconds):
+            self.clock.now += seconds
+
+        self.assertEqual(2,
+                         work_queue.run_worker(self.queue,
+                                               self.checker,
+                                               'survivor',
+                                               poll_interval=30,
+                                               sleep=sleep))
+        self.assertEqual({'done': 2}, self.queue.counts())
+
+
+if __name__ == '__main__':
+    unittest.main()